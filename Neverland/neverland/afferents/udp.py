@@ -6,6 +6,8 @@ import struct
 import logging
 
 from neverland.pkt import UDPPacket
+from neverland.utils import ObjectifiedDict
+from neverland.components.bufpool import BufferPool
 
 
 logger = logging.getLogger('Main')
@@ -13,18 +15,29 @@ logger = logging.getLogger('Main')
 
 UDP_BUFFER_SIZE = 65507
 
+# max amount of packets received in one batch
+DEFAULT_BATCH_SIZE = 64
+
 
 class UDPReceiver():
 
     ''' A normal implementation of the afferents
+
+    Packets are received into buffers of a BufferPool, the "data" field of
+    received packets is a memoryview of the buffer, see components.bufpool.
     '''
 
-    def __init__(self, config, listen_addr=None, listen_port=None):
+    def __init__(
+        self, config, listen_addr=None, listen_port=None, buffer_amount=None,
+    ):
         self.config = config
 
         self.listen_addr = listen_addr or self.config.net.aff_listen_addr
         self.listen_port = listen_port or self.config.net.aff_listen_port
 
+        buffer_amount = buffer_amount or self.config.net.recv_buffer_amount
+        self._buf_pool = BufferPool(UDP_BUFFER_SIZE, buffer_amount)
+
         self._sock = self.create_socket()
         self._fd = self._sock.fileno()
 
@@ -55,13 +68,33 @@ class UDPReceiver():
         self._sock = None
 
     def recv(self):
-        data, src = self._sock.recvfrom(UDP_BUFFER_SIZE)
+        buf = self._buf_pool.acquire()
+        nbytes, src = self._sock.recvfrom_into(buf)
         pkt = UDPPacket(
-                  data=data,
+                  data=memoryview(buf)[:nbytes],
                   previous_hop=src,
               )
         return pkt
 
+    def recv_batch(self, max_amount=None):
+        ''' receive packets until the socket is drained
+
+        :param max_amount: max amount of packets to receive
+        :return: a list of UDPPacket objects, may be empty
+        '''
+
+        max_amount = max_amount or DEFAULT_BATCH_SIZE
+        recv = self.recv
+        pkts = []
+
+        try:
+            while len(pkts) < max_amount:
+                pkts.append(recv())
+        except BlockingIOError:
+            pass
+
+        return pkts
+
     @property
     def fd(self):
         return self._fd
@@ -84,10 +117,11 @@ class ClientUDPReceiver(UDPReceiver):
         '''
 
         # TODO ipv6 support
-        data, anc, flags, src = self._sock.recvmsg(
-                                    UDP_BUFFER_SIZE,
-                                    socket.CMSG_SPACE(24),
-                                )
+        buf = self._buf_pool.acquire()
+        nbytes, anc, flags, src = self._sock.recvmsg_into(
+                                      [buf],
+                                      socket.CMSG_SPACE(24),
+                                  )
 
         # get and unpack the cmsg_data field from anc
         # https://docs.python.org/3/library/socket.html#socket.socket.recvmsg
@@ -99,8 +133,8 @@ class ClientUDPReceiver(UDPReceiver):
         )
 
         pkt = UDPPacket(
-                  data=data,
-                  src={'addr': src[0], 'port': src[1]},
-                  dest={'addr': dest_addr, 'port': dest_port},
+                  data=memoryview(buf)[:nbytes],
+                  src=ObjectifiedDict(addr=src[0], port=src[1]),
+                  dest=ObjectifiedDict(addr=dest_addr, port=dest_port),
               )
         return pkt
@@ -0,0 +1,96 @@
+#!/usr/bin/python3.6
+#coding: utf-8
+
+from collections import deque
+
+
+__all__ = ['BufferPool']
+
+
+''' The pool of preallocated receiving buffers
+
+Afferents receive packets with recv_into into buffers taken from the pool,
+and packets are parsed through memoryview slices of these buffers, so
+nothing is copied until the payload leaves the process.
+
+We don't release buffers explicitly. Packets may be kept by other modules
+(e.g. logic handlers), and a buffer shall not be overwritten while any
+memoryview of it is still alive. Instead, the pool checks if a buffer is
+still exported when it's going to be reused. A bytearray cannot be resized
+while it's exported, so appending a byte to it tells us whether there are
+living memoryviews of it. Buffers are allocated with one spare byte, so the
+check never reallocates them.
+
+Buffers that are still in use are skipped. If all buffers in the pool are
+in use, a new one will be allocated and added into the pool, until the pool
+is full, and then buffers will be allocated temporarily.
+'''
+
+
+DEFAULT_BUFFER_AMOUNT = 64
+
+
+class BufferPool():
+
+    ''' A pool of reusable bytearrays
+    '''
+
+    def __init__(self, buffer_size, amount=None, max_amount=None):
+        ''' Constructor
+
+        :param buffer_size: size of each buffer
+        :param amount: amount of buffers to be preallocated
+        :param max_amount: max amount of buffers in the pool,
+                           default is 4 times of the amount
+        '''
+
+        self.buffer_size = buffer_size
+        self.amount = amount or DEFAULT_BUFFER_AMOUNT
+        self.max_amount = max_amount or self.amount * 4
+
+        self._buffers = deque(
+            self._alloc() for _ in range(self.amount)
+        )
+
+    def _alloc(self):
+        buf = bytearray(self.buffer_size + 1)
+        buf.pop()
+        return buf
+
+    @staticmethod
+    def is_exported(buf):
+        ''' check if there are living memoryviews of the buffer
+        '''
+
+        try:
+            buf.append(0)
+        except BufferError:
+            return True
+
+        buf.pop()
+        return False
+
+    def acquire(self):
+        ''' get a buffer which is not in use
+
+        :return: bytearray
+        '''
+
+        buffers = self._buffers
+
+        # buffers are used in turn, so the next one is the least recently
+        # used one, which is the most likely to be free
+        for _ in range(len(buffers)):
+            buf = buffers[0]
+            buffers.rotate(-1)
+
+            if not self.is_exported(buf):
+                return buf
+
+        buf = self._alloc()
+        if len(buffers) < self.max_amount:
+            buffers.append(buf)
+        return buf
+
+    def __len__(self):
+        return len(self._buffers)
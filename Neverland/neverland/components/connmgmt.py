@@ -12,10 +12,13 @@ from neverland.exceptions import (
     ConnSlotNotAvailable,
     NoConnAvailable,
 )
-from neverland.pkt import UDPPacket, PktTypes
+from neverland.pkt import UDPPacket, PktTypes, PktFields
 from neverland.utils import ObjectifiedDict, MetaEnum
 from neverland.node.context import NodeContext
-from neverland.components.shm import SharedMemoryManager
+from neverland.components.shm import (
+    SharedMemoryManager,
+    SHMContainerTypes,
+)
 from neverland.protocol.crypto.openssl import EVP_MAX_IV_LENGTH
 
 
@@ -137,6 +140,16 @@ SLOT_1 = 'slot-1'
 SLOT_2 = 'slot-2'
 SLOTS = [SLOT_0, SLOT_1, SLOT_2]
 
+# IDs of slots, the ProtocolWrapper puts the slot ID in front of the
+# encrypted packet, so the recipient knows which IV shall be used.
+# ID 0x00 is reserved for the default IV, see neverland.protocol.crypto
+SLOT_IDS = {
+    SLOT_0: 0x01,
+    SLOT_1: 0x02,
+    SLOT_2: 0x03,
+}
+SLOT_NAMES = {slot_id: slot for slot, slot_id in SLOT_IDS.items()}
+
 
 class ConnectionManager():
 
@@ -154,6 +167,8 @@ class ConnectionManager():
     SHM_SOCKET_NAME_TEMPLATE = 'SHM-ConnectionManager-%d.socket'
 
     # The SHM container to store established connections.
+    # Connections are node-to-node, so the container is shared by all
+    # workers of the node, it's named by the node ID.
     #
     # Data structure:
     #     {
@@ -185,10 +200,11 @@ class ConnectionManager():
         self.iv_len = self.config.net.crypto.iv_len
         self.iv_duration_range = self.config.net.crypto.iv_duration_range
 
-        if not 0 < self.iv_len < EVP_MAX_IV_LENGTH:
+        if not 0 < self.iv_len <= EVP_MAX_IV_LENGTH:
             raise ArgumentError('iv_len out of range')
 
         self.pid = NodeContext.pid
+        self.node_id = self.config.basic.node_id
 
     def init_shm(self):
         ''' initialize the shared memory manager
@@ -199,12 +215,15 @@ class ConnectionManager():
             self.SHM_SOCKET_NAME_TEMPLATE % self.pid
         )
 
-        self.shm_key_conns = self.SHM_KEY_TMP_CONNS % self.pid
+        self.shm_key_conns = self.SHM_KEY_TMP_CONNS % self.node_id
         self.shm_mgr.create_key_and_ignore_conflict(
             self.shm_key_conns,
             SHMContainerTypes.DICT,
         )
 
+    def close_shm(self):
+        self.shm_mgr.disconnect()
+
     def _remote_sa_2_key(self, remote):
         ''' convert remote socket address to a key string
         '''
@@ -287,15 +306,18 @@ class ConnectionManager():
         iv = conn.iv
         if iv is not None:
             # the base64 string must be str but not bytes
-            iv = b64encode(iv).decode()
+            iv = base64.b64encode(iv).decode()
 
         conn_info = conn.__to_dict__()
         conn_info.update(iv=iv)
 
+        native_info = self._get_native_conn_info(remote)
+        native_info[slot] = conn_info
+
         self.shm_mgr.update_dict(
             key=self.shm_key_conns,
             dict_key=remote_name,
-            value=conn_info,
+            value=native_info,
         )
 
     def get_usable_slots(self, remote):
@@ -353,7 +375,7 @@ class ConnectionManager():
         iv_duration = random.randint(*self.iv_duration_range)
 
         pkt = UDPPacket()
-        pkt.fields = ObjectifiedDict(
+        pkt.fields = PktFields(
                          type=PktTypes.CONN_CTRL,
                          dest=remote,
                          communicating=1,
@@ -405,7 +427,7 @@ class ConnectionManager():
         :returns: Connection object
         '''
 
-        conns = self.get_conns()
+        conns = self.get_conns(remote)
 
         # according to the explanations above, the priority of slots is 1 > 0
         conn_s1 = conns.get(SLOT_1)
@@ -413,11 +435,64 @@ class ConnectionManager():
             return conn_s1
 
         conn_s0 = conns.get(SLOT_0)
-        if conn_s0 is not None and conn_s1.state == ConnStates.ESTABLISHED:
+        if conn_s0 is not None and conn_s0.state == ConnStates.ESTABLISHED:
             return conn_s0
 
         raise NoConnAvailable
 
+    def get_iv(self, remote, slot_id):
+        ''' get the IV in the specified slot of a remote
+
+        This is used in decrypting packets, so connections in all
+        states are available as long as they have an IV.
+
+        :param remote: remote socket address, (ip, port)
+        :param slot_id: slot ID, enumerated in SLOT_IDS
+        :returns: bytes, or None if the slot is empty
+        '''
+
+        slot = SLOT_NAMES.get(slot_id)
+        if slot is None:
+            return None
+
+        conn_info = self._get_native_conn_info(remote).get(slot)
+        if conn_info is None:
+            return None
+
+        iv = conn_info.get('iv')
+        if iv is None:
+            return None
+
+        return base64.b64decode(iv)
+
+    def get_current_iv(self, remote):
+        ''' get the IV that shall be used in encrypting packets to a remote
+
+        This works like get_conn, but it reads the native data directly
+        without creating Connection objects, it will be invoked for each
+        packet we send.
+
+        :param remote: remote socket address, (ip, port)
+        :returns: (slot_id, iv), or (None, None) if no connection available
+        '''
+
+        native_info = self._get_native_conn_info(remote)
+
+        # the priority of slots is 1 > 0, the same as get_conn
+        for slot in (SLOT_1, SLOT_0):
+            conn_info = native_info.get(slot)
+            if conn_info is None:
+                continue
+
+            if conn_info.get('state') != ConnStates.ESTABLISHED:
+                continue
+
+            iv = conn_info.get('iv')
+            if iv is not None:
+                return SLOT_IDS[slot], base64.b64decode(iv)
+
+        return None, None
+
     def remove_conn(self, remote, slot):
         ''' close a connection
 
@@ -425,11 +500,13 @@ class ConnectionManager():
         :param slot: slot name, enumerated in SLOTS
         '''
 
-        ip = remote[0]
-        port = remote[1]
-        remote_name = f'{ip}:{port}'
+        remote_name = self._remote_sa_2_key(remote)
 
         native_info = self._get_native_conn_info(remote)
         native_info[slot] = None
 
-        self.shm_mgr.update_dict(remote_name, native_info)
+        self.shm_mgr.update_dict(
+            key=self.shm_key_conns,
+            dict_key=remote_name,
+            value=native_info,
+        )
@@ -3,20 +3,25 @@
 
 import os
 import time
+import heapq
 import base64
-import random
+import select
 import socket
+import struct
 import signal as sig
 import logging
 
-from neverland.pkt import UDPPacket
-from neverland.utils import Converter
-from neverland.exceptions import InvalidPkt, SharedMemoryError
+from neverland.pkt import UDPPacket, PktFields
+from neverland.utils import Converter, MetaEnum
+from neverland.exceptions import InvalidPkt, SharedMemoryError, ConfigError
 from neverland.node.context import NodeContext
+from neverland.protocol.crypto import is_aead_cipher
+from neverland.components.rtt import RTTEstimator
 from neverland.components.shm import (
     SharedMemoryManager,
     SHMContainerTypes,
 )
+from neverland.components.shmcodec import SHMEncodings
 
 
 logger = logging.getLogger('PktMgr')
@@ -32,8 +37,39 @@ logger = logging.getLogger('PktMgr')
 #             next_hop: [ip, port],
 #         }
 #     }
+#
+# or in the "packed" storage mode:
+#     {
+#         sn: {
+#             blob: bytes, or base64 string in the JSON encoding
+#         }
+#     }
 SHM_KEY_PKTS = 'SpecPktMgr_Packets'
 
+# SHM container for storing RTT estimates of destinations of special packets,
+# shared by all workers, see neverland.components.rtt
+# data structure:
+#     {
+#         "ip:port": {
+#             srtt: float,
+#             rttvar: float,
+#         }
+#     }
+SHM_KEY_RTT = 'SpecPktMgr_RTT'
+
+# The max times that we try to apply an RTT sample, other workers may
+# update the estimate of the same destination at the same time.
+RTT_UPDATE_RETRIES = 3
+
+# the header of blobs in the "packed" storage mode:
+# type, sn, IP address and port of the next hop,
+# followed by the packed data of the packet
+PKT_BLOB_HEADER_STRUCT = struct.Struct('=BQ4sH')
+
+# Special packets will be removed once we got the response, but if the
+# response never arrives, then they will be removed after this TTL.
+PKT_TTL = 60
+
 
 # The following SHM_KEY_TMP_* consts are used as string tamplates,
 # The pid shall be passed to render templates into SHM keys.
@@ -42,89 +78,280 @@ SHM_KEY_PKTS = 'SpecPktMgr_Packets'
 # worker shall have its own packet repeater, so we need to distinguish the
 # SHM container by the pid.
 
-# SHM container for storing serial numbers of packets that need
-# to be sent repeatedly
+# SHM container for storing repeating states of packets that need to be
+# sent repeatedly, all states of a packet are kept in one record, so they
+# are stored, updated and removed together in one request.
 # data structure:
-#     [sn_0, sn_1]
-SHM_KEY_TMP_PKTS_TO_REPEAT = 'SpecPktRpter-%d_PacketsToRepeat'
+#     {
+#         sn: {
+#             max_rpt_times: integer,
+#             rpted_times: integer,
+#             last_rpt_time: timestamp or None,
+#             next_rpt_time: timestamp or None,
+#         }
+#     }
+SHM_KEY_TMP_REPEAT_STATES = 'SpecPktRpter-%d_RepeatStates'
+
 
-# SHM container for storing the last repeat time of packets
+# SHM container for storing pids of workers that are served by the
+# node-level repeater, see PktRpterModes.NODE
 # data structure:
-#     {sn: timestamp}
-SHM_KEY_TMP_LAST_REPEAT_TIME = 'SpecialPktRpter-%d_LastRptTime'
+#     {pid_0, pid_1}
+SHM_KEY_RPTER_WORKERS = 'SpecPktRpter_Workers'
 
-# similar with the above one, but contains the timestamp of the next repeat time
-SHM_KEY_TMP_NEXT_REPEAT_TIME = 'SpecialPktRpter-%d_NextRptTime'
 
-# SHM container for storing how many times packets could be repeated
-# data structure:
-#     {sn: integer}
-SHM_KEY_TMP_MAX_REPEAT_TIMES = 'SpecialPktRpter-%d_MaxRepeatTimes'
+# The name of the socket in config.shm.socket_dir that the repeater receives
+# notifications from the packet manager, rendered with the pid as well.
+RPTER_SOCKET_NAME_TEMPLATE = 'SpecPktRpter-%d.socket'
 
-# SHM container for storing how many times packets have been repeated
-# data structure:
-#     {sn: integer}
-SHM_KEY_TMP_REPEATED_TIMES = 'SpecialPktRpter-%d_RepeatedTimes'
+# the name of the socket of the node-level repeater
+NODE_RPTER_SOCKET_NAME = 'SpecPktRpter-node.socket'
+
+# the name of the socket that the node-level repeater receives SHM responses
+NODE_RPTER_SHM_SOCKET_NAME_TEMPLATE = 'SHM-NodePacketRepeater-%d.socket'
+
+# Notifications are sent in datagrams: action, sn and pid of the worker
+NOTIFICATION_STRUCT = struct.Struct('=BQI')
+
+# The max time that the packet manager waits for the repeater when the
+# socket of the repeater is full, the notification will be dropped after it.
+NOTIFICATION_TIMEOUT = 0.1
+
+# The repeater reloads all repeating states from the shared memory in this
+# interval, in case any notification is lost.
+RESYNC_INTERVAL = 5
+
+# The max amount of packets that the repeater repeats in a wakeup, requests
+# to the shared memory must fit in a datagram. The rest of due packets will
+# be repeated in the next wakeup without waiting.
+MAX_RPT_PER_WAKEUP = 64
+
+# The max time that the repeater waits for notifications,
+# so it can notice the shutdown in time.
+MAX_POLL_TIMEOUT = 1
+
+
+class PktStorageModes(metaclass=MetaEnum):
+
+    ''' Formats of special packets stored in the shared memory
+
+    Selected by config.net.special_pkt_storage
+    '''
+
+    # Fields of packets are stored, repeats restore the packet and wrap
+    # it again, all fields are packed and calculated again.
+    FIELDS = 'fields'
+
+    # The packed data of wrapped packets is stored with the next hop in a
+    # binary blob, repeats only encrypt it if the cipher is enabled, and
+    # the time and the mac can be restamped by config.net.special_pkt_restamp.
+    # See BaseProtocolWrapper.rewrap
+    PACKED = 'packed'
+
+
+def get_rtt_key(addr):
+    ''' get the key of RTT estimates of the address
+
+    :param addr: (ip, port) of the destination
+    '''
+
+    ip, port = addr
+    return f'{ip}:{port}'
+
+
+class PktRpterModes(metaclass=MetaEnum):
+
+    ''' How special packets are repeated
+
+    Selected by config.net.special_pkt_rpter
+    '''
+
+    # Each worker forks its own SpecialPacketRepeater.
+    WORKER = 'worker'
+
+    # The node starts one NodePacketRepeater which repeats special packets
+    # of all workers.
+    NODE = 'node'
+
+
+class RepeaterActions(metaclass=MetaEnum):
+
+    ''' Actions in notifications sent to the repeater
+    '''
+
+    REPEAT = 0x01
+    CANCEL = 0x02
 
 
 class SpecialPacketManager():
 
     SHM_SOCKET_NAME_TEMPLATE = 'SHM-SpecialPacketManager-%d.socket'
 
-    def __init__(self, config):
+    def __init__(self, config, pid=None):
+        ''' Constructor
+
+        :param config: the config instance
+        :param pid: pid of the worker that the packets belong to,
+                    default is NodeContext.pid
+        '''
+
         self.config = config
-        self.pid = NodeContext.pid
+        self.pid = pid or NodeContext.pid
+
+        self.storage = config.net.special_pkt_storage or PktStorageModes.FIELDS
+        if self.storage not in PktStorageModes:
+            raise ConfigError(
+                f'Unsupported special packet storage: {self.storage}'
+            )
+
+        # bytes can be stored without base64 in the binary encoding,
+        # determined after the SHM connection is established
+        self._binary_shm = False
+
+        self.rpter_mode = config.net.special_pkt_rpter or PktRpterModes.WORKER
+        if self.rpter_mode not in PktRpterModes:
+            raise ConfigError(
+                f'Unsupported special packet repeater mode: {self.rpter_mode}'
+            )
+
+        if self.rpter_mode == PktRpterModes.NODE:
+            rpter_sock_name = NODE_RPTER_SOCKET_NAME
+        else:
+            rpter_sock_name = RPTER_SOCKET_NAME_TEMPLATE % self.pid
+
+        # the socket to send notifications to the repeater, created lazily
+        self._rpter_sock = None
+        self._rpter_sock_path = os.path.join(
+            config.shm.socket_dir,
+            rpter_sock_name,
+        )
+
+        # whether the SHM connection is established by the manager itself
+        self._own_shm = False
 
         self.shm_key_pkts = SHM_KEY_PKTS
+        self.shm_key_rtt = SHM_KEY_RTT
+        self.rtt_estimator = RTTEstimator(config)
 
-        # These containers are for the SpecialPacketRepeater, the repeater
+        # This container is for the SpecialPacketRepeater, the repeater
         # will also access special packets by the manager.
-        self.shm_key_pkts_to_repeat = SHM_KEY_TMP_PKTS_TO_REPEAT % self.pid
-        self.shm_key_last_repeat_time = SHM_KEY_TMP_LAST_REPEAT_TIME % self.pid
-        self.shm_key_next_repeat_time = SHM_KEY_TMP_NEXT_REPEAT_TIME % self.pid
-        self.shm_key_max_repeat_times = SHM_KEY_TMP_MAX_REPEAT_TIMES % self.pid
-        self.shm_key_repeated_times = SHM_KEY_TMP_REPEATED_TIMES % self.pid
+        self.shm_key_repeat_states = SHM_KEY_TMP_REPEAT_STATES % self.pid
 
-    def init_shm(self):
+    def init_shm(self, shm_mgr=None):
         ''' initialize the shared memory manager
+
+        In the node-level repeater mode, the worker registers itself
+        to the NodePacketRepeater here.
+
+        :param shm_mgr: a connected SharedMemoryManager to share with,
+                        the manager connects by itself if it's not given
         '''
 
-        self.shm_mgr = SharedMemoryManager(self.config)
-        self.shm_mgr.connect(
-            self.SHM_SOCKET_NAME_TEMPLATE % self.pid
+        if shm_mgr is None:
+            self.shm_mgr = SharedMemoryManager(self.config)
+            self.shm_mgr.connect(
+                self.SHM_SOCKET_NAME_TEMPLATE % self.pid
+            )
+            self._own_shm = True
+        else:
+            self.shm_mgr = shm_mgr
+            self._own_shm = False
+
+        self._binary_shm = (
+            self.shm_mgr.current_connection.encoding == SHMEncodings.BINARY
         )
         self.shm_mgr.create_key_and_ignore_conflict(
             self.shm_key_pkts,
             SHMContainerTypes.DICT,
         )
         self.shm_mgr.create_key_and_ignore_conflict(
-            self.shm_key_pkts_to_repeat,
-            SHMContainerTypes.LIST,
-        )
-        self.shm_mgr.create_key_and_ignore_conflict(
-            self.shm_key_last_repeat_time,
-            SHMContainerTypes.DICT,
-        )
-        self.shm_mgr.create_key_and_ignore_conflict(
-            self.shm_key_next_repeat_time,
+            self.shm_key_repeat_states,
             SHMContainerTypes.DICT,
         )
         self.shm_mgr.create_key_and_ignore_conflict(
-            self.shm_key_max_repeat_times,
-            SHMContainerTypes.DICT,
-        )
-        self.shm_mgr.create_key_and_ignore_conflict(
-            self.shm_key_repeated_times,
+            self.shm_key_rtt,
             SHMContainerTypes.DICT,
         )
 
+        if self._own_shm and self.rpter_mode == PktRpterModes.NODE:
+            self.shm_mgr.create_key_and_ignore_conflict(
+                SHM_KEY_RPTER_WORKERS,
+                SHMContainerTypes.SET,
+            )
+            self.shm_mgr.add_value(SHM_KEY_RPTER_WORKERS, [self.pid])
+
     def close_shm(self):
-        self.shm_mgr.disconnect()
+        if self._own_shm:
+            if self.rpter_mode == PktRpterModes.NODE:
+                self.shm_mgr.remove_value(SHM_KEY_RPTER_WORKERS, [self.pid])
+            self.shm_mgr.disconnect()
 
-    def store_pkt(self, pkt, need_repeat=False, max_rpt_times=5):
+        if self._rpter_sock is not None:
+            self._rpter_sock.close()
+            self._rpter_sock = None
+
+    def notify_rpter(self, action, sn):
+        ''' notify the repeater that a packet shall be repeated or not
+
+        Notifications are not reliable, the repeater will find the
+        packet in the shared memory in the next resync if it's lost.
+
+        :param action: enumerated in RepeaterActions
+        :param sn: serial number of the packet
+        '''
+
+        if self._rpter_sock is None:
+            self._rpter_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._rpter_sock.settimeout(NOTIFICATION_TIMEOUT)
+
+        data = NOTIFICATION_STRUCT.pack(action, sn, self.pid)
+
+        try:
+            self._rpter_sock.sendto(data, self._rpter_sock_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            logger.debug('The repeater is not running, notification dropped')
+        except socket.timeout:
+            logger.warning(
+                f'The socket of the repeater is full, '
+                f'notification dropped, sn: {sn}'
+            )
+
+    def store_pkt(self, pkt, need_repeat=False, max_rpt_times=5, ttl=PKT_TTL):
         sn = pkt.fields.sn
         type_ = pkt.fields.type
 
+        if sn is None:
+            raise InvalidPkt(
+                'Packets to be stored must contain a serial number'
+            )
+
+        if self.storage == PktStorageModes.PACKED:
+            value = {sn: {'blob': self._pack_blob(pkt)}}
+        else:
+            value = {sn: self._dump_fields(pkt)}
+
+        # The packet and its repeating state are stored in one SHM batch,
+        # the state expires with the packet.
+        batch = self.shm_mgr.batch()
+        batch.add_value(self.shm_key_pkts, value, ttl=ttl)
+        if need_repeat:
+            batch.add_value(
+                self.shm_key_repeat_states,
+                {sn: self.new_repeat_state(max_rpt_times)},
+                ttl=ttl,
+            )
+        batch.execute()
+
+        if need_repeat:
+            self.notify_rpter(RepeaterActions.REPEAT, sn)
+
+        hex_type = Converter.int_2_hex(type_)
+        logger.debug(
+            f'Stored a special packet, need_repeat: {need_repeat}, '
+            f'sn: {sn}, type: {hex_type}, dest: {pkt.fields.dest}'
+        )
+
+    def _dump_fields(self, pkt):
         # The salt field is bytes, so we cannot serialize it in a JSON.
         # So, we shall encode it into a base64 string before store it.
         fields = pkt.fields.__to_dict__()
@@ -133,45 +360,137 @@ class SpecialPacketManager():
             salt_b64 = base64.b64encode(salt).decode()
             fields.update(salt=salt_b64)
 
-        previous_hop = list(pkt.previous_hop)
-        next_hop = list(pkt.next_hop)
+        return {
+            'type': pkt.fields.type,
+            'fields': fields,
+            'previous_hop': list(pkt.previous_hop),
+            'next_hop': list(pkt.next_hop),
+        }
 
-        if sn is None:
+    def _pack_blob(self, pkt):
+        ''' pack a wrapped packet and its next hop into a blob
+        '''
+
+        if pkt.data is None:
             raise InvalidPkt(
-                'Packets to be stored must contain a serial number'
+                'Packets must be wrapped before they are stored as blobs'
             )
 
-        value = {
-            sn: {
-                'type': type_,
-                'fields': fields,
-                'previous_hop': previous_hop,
-                'next_hop': next_hop,
-            }
-        }
+        ip, port = pkt.next_hop
+        blob = PKT_BLOB_HEADER_STRUCT.pack(
+                   pkt.fields.type,
+                   pkt.fields.sn,
+                   socket.inet_aton(ip),
+                   port,
+               ) + pkt.byte_fields.packed()
+
+        if self._binary_shm:
+            return blob
+        return base64.b64encode(blob).decode()
+
+    def _unpack_blob(self, blob, parse_fields=False):
+        ''' restore a packet from a blob
+
+        :param blob: the blob in bytes or base64 string
+        :param parse_fields: parse all fields from the packed data, or
+                             the packet carries only the type and the sn
+        :return: UDPPacket, pkt.data is the packed data
+        '''
 
-        self.shm_mgr.lock_key(self.shm_key_pkts)
-        self.shm_mgr.add_value(self.shm_key_pkts, value)
-        self.shm_mgr.unlock_key(self.shm_key_pkts)
+        if isinstance(blob, str):
+            blob = base64.b64decode(blob)
 
-        if need_repeat:
-            self.shm_mgr.add_value(self.shm_key_pkts_to_repeat, [sn])
-            self.set_pkt_max_repeat_times(sn, max_rpt_times)
-            self.set_pkt_repeated_times(sn, 0)
+        type_, sn, ip, port = PKT_BLOB_HEADER_STRUCT.unpack_from(blob)
+        data = blob[PKT_BLOB_HEADER_STRUCT.size:]
 
-        hex_type = Converter.int_2_hex(type_)
-        logger.debug(
-            f'Stored a special packet, need_repeat: {need_repeat}, '
-            f'sn: {sn}, type: {hex_type}, dest: {pkt.fields.dest}'
-        )
+        if parse_fields:
+            fields, byte_fields = NodeContext.protocol_wrapper.parse_packed(
+                                      data
+                                  )
+        else:
+            fields = PktFields(type=type_, sn=sn)
+            byte_fields = None
+
+        return UDPPacket(
+                   data=data,
+                   fields=fields,
+                   byte_fields=byte_fields,
+                   type=type_,
+                   next_hop=(socket.inet_ntoa(ip), port),
+               )
 
     def get_pkt(self, sn):
-        shm_data = self.shm_mgr.get_value(self.shm_key_pkts, sn)
-        shm_value = shm_data.get('value')
+        shm_data = self.shm_mgr.get_dict_value(self.shm_key_pkts, sn)
+        return self._restore_pkt(shm_data.get('value'), parse_fields=True)
+
+    def get_pkt_and_repeat_state(self, sn):
+        ''' get a packet and its repeating state in one SHM batch
+
+        :return: (UDPPacket or None, state dict or None)
+        '''
+
+        batch = self.shm_mgr.batch()
+        batch.get_dict_value(self.shm_key_pkts, sn)
+        batch.get_dict_value(self.shm_key_repeat_states, sn)
+        pkt_data, state_data = batch.execute()
+
+        return (
+            self._restore_pkt(pkt_data.get('value'), parse_fields=True),
+            state_data.get('value'),
+        )
+
+    def get_pkts(self, sn_list):
+        ''' get a group of packets in one SHM batch
+
+        :return: a list of UDPPacket or None, in the order of sn_list
+        '''
+
+        if len(sn_list) == 0:
+            return []
+
+        batch = self.shm_mgr.batch()
+        for sn in sn_list:
+            batch.get_dict_value(self.shm_key_pkts, sn)
+
+        return [
+            self._restore_pkt(shm_data.get('value'))
+            for shm_data in batch.execute()
+        ]
+
+    def get_repeating_pkts(self, sn_list):
+        ''' get packets and their repeating states in one SHM batch
+
+        The repeating state is None if the repeat has been cancelled.
+
+        :return: a list of (UDPPacket or None, state dict or None),
+                 in the order of sn_list
+        '''
+
+        if len(sn_list) == 0:
+            return []
 
+        batch = self.shm_mgr.batch()
+        for sn in sn_list:
+            batch.get_dict_value(self.shm_key_pkts, sn)
+            batch.get_dict_value(self.shm_key_repeat_states, sn)
+
+        results = batch.execute()
+        return [
+            (
+                self._restore_pkt(results[idx].get('value')),
+                results[idx + 1].get('value'),
+            )
+            for idx in range(0, len(results), 2)
+        ]
+
+    def _restore_pkt(self, shm_value, parse_fields=False):
         if shm_value is None:
             return None
 
+        blob = shm_value.get('blob')
+        if blob is not None:
+            return self._unpack_blob(blob, parse_fields)
+
         # and here, we restore the base64 encoded salt into bytes
         fields = shm_value.get('fields')
         salt_b64 = fields.get('salt')
@@ -186,77 +505,375 @@ class SpecialPacketManager():
         )
 
     def remove_pkt(self, sn):
-        self.cancel_repeat(sn)
-
-        self.shm_mgr.lock_key(self.shm_key_pkts)
-        self.shm_mgr.remove_value(self.shm_key_pkts, sn)
-        self.shm_mgr.unlock_key(self.shm_key_pkts)
+        batch = self.shm_mgr.batch()
+        batch.remove_value(self.shm_key_repeat_states, [sn])
+        batch.remove_value(self.shm_key_pkts, [sn])
+        batch.execute()
 
+        self.notify_rpter(RepeaterActions.CANCEL, sn)
         logger.debug(
             f'Removed a special packet, sn: {sn}'
         )
 
     def cancel_repeat(self, sn):
-        self.shm_mgr.remove_value(self.shm_key_pkts_to_repeat, sn)
-        self.shm_mgr.remove_value(self.shm_key_last_repeat_time, sn)
-        self.shm_mgr.remove_value(self.shm_key_next_repeat_time, sn)
-        self.shm_mgr.remove_value(self.shm_key_max_repeat_times, sn)
-        self.shm_mgr.remove_value(self.shm_key_repeated_times, sn)
+        self.cancel_repeats([sn])
         logger.debug(
             f'Cancelled repeat for a packet, sn: {sn}'
         )
 
+    def cancel_repeats(self, sn_list):
+        ''' cancel repeat for a group of packets in one SHM request
+        '''
+
+        self.remove_repeat_states(sn_list)
+
+        for sn in sn_list:
+            self.notify_rpter(RepeaterActions.CANCEL, sn)
+
+    def remove_repeat_states(self, sn_list):
+        ''' remove repeating states of a group of packets in one SHM request
+
+        Unlike cancel_repeats, the repeater will not be notified.
+        '''
+
+        if len(sn_list) == 0:
+            return
+
+        self.shm_mgr.remove_value(self.shm_key_repeat_states, sn_list)
+
     def repeat_pkt(self, pkt, max_rpt_times=5):
         self.store_pkt(pkt, need_repeat=True, max_rpt_times=max_rpt_times)
 
+    @staticmethod
+    def new_repeat_state(max_rpt_times):
+        ''' make the repeating state of a packet that has not been repeated
+        '''
+
+        return {
+            'max_rpt_times': max_rpt_times,
+            'rpted_times': 0,
+            'last_rpt_time': None,
+            'next_rpt_time': None,
+        }
+
     def get_repeating_sn_list(self):
-        shm_data = self.shm_mgr.read_key(self.shm_key_pkts_to_repeat)
+        return [int(key) for key in self.get_repeating_states()]
+
+    def get_repeating_state(self, sn):
+        shm_data = self.shm_mgr.get_dict_value(self.shm_key_repeat_states, sn)
         return shm_data.get('value')
 
-    def set_pkt_last_repeat_time(self, sn, timestamp):
-        self.shm_mgr.add_value(self.shm_key_last_repeat_time, {sn: timestamp})
-        logger.debug(f'set_pkt_last_repeat_time, sn: {sn}, ts: {timestamp}')
+    def get_repeating_states(self):
+        ''' read all repeating states in one SHM request
+
+        :return: {sn: state dict}, keyed by the serial number in string
+        '''
 
-    def get_pkt_last_repeat_time(self, sn):
-        shm_data = self.shm_mgr.get_value(self.shm_key_last_repeat_time, sn)
+        shm_data = self.shm_mgr.read_key(self.shm_key_repeat_states)
         return shm_data.get('value')
 
-    def set_pkt_next_repeat_time(self, sn, timestamp):
-        self.shm_mgr.add_value(self.shm_key_next_repeat_time, {sn: timestamp})
-        logger.debug(f'set_pkt_next_repeat_time, sn: {sn}, ts: {timestamp}')
+    def update_repeat_states(self, states):
+        ''' update repeating states of a group of packets in one SHM batch
 
-    def get_pkt_next_repeat_time(self, sn):
-        shm_data = self.shm_mgr.get_value(self.shm_key_next_repeat_time, sn)
-        return shm_data.get('value')
+        Each state is swapped only if it's not changed since it was read,
+        so a state removed by cancel_repeats in the meantime will not be
+        brought back.
 
-    def set_pkt_max_repeat_times(self, sn, times):
-        self.shm_mgr.add_value(self.shm_key_max_repeat_times, {sn: times})
-        logger.debug(f'set_pkt_max_repeat_times, sn: {sn}, times: {times}')
+        :param states: {sn: (old state dict, new state dict)}
+        :return: serial numbers of states which have not been swapped
+        '''
 
-    def get_pkt_max_repeat_times(self, sn):
-        shm_data = self.shm_mgr.get_value(self.shm_key_max_repeat_times, sn)
-        return shm_data.get('value')
+        if len(states) == 0:
+            return []
+
+        batch = self.shm_mgr.batch()
+        for sn, (old_state, new_state) in states.items():
+            batch.cas_value(
+                self.shm_key_repeat_states,
+                old_state,
+                new_state,
+                dict_key=sn,
+            )
+
+        return [
+            sn
+            for sn, shm_data in zip(states, batch.execute())
+            if not shm_data.get('value').get('swapped')
+        ]
+
+    def sample_rtt(self, pkt, state, current_ts=None):
+        ''' measure the RTT by the response of a packet
+
+        Only packets that have been sent only once are sampled, see
+        neverland.components.rtt.
+
+        :param pkt: the packet that has been responded
+        :param state: the repeating state of the packet
+        :param current_ts: the time that the response arrived
+        :return: the sample, or None if the packet is not sampled
+        '''
+
+        if state is None or state.get('rpted_times') != 1:
+            return None
+
+        last_rpt_time = state.get('last_rpt_time')
+        if last_rpt_time is None:
+            return None
+
+        current_ts = current_ts or time.time()
+        sample = current_ts - last_rpt_time
+        if sample < 0:
+            return None
+
+        self.update_rtt(pkt.next_hop, sample)
+        return sample
+
+    def update_rtt(self, addr, sample):
+        ''' apply an RTT sample to the estimate of the destination
+        '''
+
+        rtt_key = get_rtt_key(addr)
+
+        shm_data = self.shm_mgr.get_dict_value(self.shm_key_rtt, rtt_key)
+        estimate = shm_data.get('value')
+
+        for _ in range(RTT_UPDATE_RETRIES):
+            shm_data = self.shm_mgr.cas_value(
+                self.shm_key_rtt,
+                estimate,
+                self.rtt_estimator.update(estimate, sample),
+                dict_key=rtt_key,
+            )
+
+            result = shm_data.get('value')
+            if result.get('swapped'):
+                logger.debug(
+                    f'Updated RTT estimate of {rtt_key}, '
+                    f'sample: {sample:.3f}, estimate: {result.get("value")}'
+                )
+                return
+
+            estimate = result.get('value')
+
+        logger.debug(f'Dropped an RTT sample of {rtt_key}, too many conflicts')
+
+    def get_rtt_estimates(self):
+        ''' read RTT estimates of all destinations
 
-    def set_pkt_repeated_times(self, sn, times):
-        self.shm_mgr.add_value(self.shm_key_repeated_times, {sn: times})
-        logger.debug(f'set_pkt_repeated_times, sn: {sn}, times: {times}')
+        :return: {"ip:port": estimate dict}
+        '''
 
-    def get_pkt_repeated_times(self, sn):
-        shm_data = self.shm_mgr.get_value(self.shm_key_repeated_times, sn)
+        shm_data = self.shm_mgr.read_key(self.shm_key_rtt)
         return shm_data.get('value')
 
-    def increase_pkt_repeated_times(self, sn):
-        repeated_times = self.get_pkt_repeated_times(sn)
 
-        if repeated_times is None:
-            repeated_times = 1
-        else:
-            repeated_times += 1
+class RepeatSchedule():
+
+    ''' The schedule of packets to be repeated
+
+    A min-heap of due times, so the repeater only touches packets that
+    are due. Cancelled or rescheduled packets are not removed from the
+    heap immediately, their stale entries are skipped when popped.
+    '''
+
+    def __init__(self):
+        # heap of (due_ts, sn)
+        self._heap = []
+
+        # structure: {sn: [due_ts, rpted_times]}
+        self._entries = dict()
+
+    def add(self, sn, due_ts, rpted_times=0):
+        ''' add a packet into the schedule, nothing changes if it exists
+        '''
+
+        if sn in self._entries:
+            return
+
+        self._entries[sn] = [due_ts, rpted_times]
+        heapq.heappush(self._heap, (due_ts, sn))
+
+    def reschedule(self, sn, due_ts, rpted_times):
+        entry = self._entries.get(sn)
+        if entry is None:
+            return
+
+        entry[0] = due_ts
+        entry[1] = rpted_times
+        heapq.heappush(self._heap, (due_ts, sn))
+
+        # stale entries are piled up if packets are repeated many times
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._compact()
+
+    def cancel(self, sn):
+        self._entries.pop(sn, None)
+
+    def get(self, sn):
+        ''' get [due_ts, rpted_times] of a packet
+        '''
+
+        return self._entries.get(sn)
+
+    def _compact(self):
+        self._heap = [(entry[0], sn) for sn, entry in self._entries.items()]
+        heapq.heapify(self._heap)
+
+    def _drop_stale(self):
+        heap = self._heap
+        entries = self._entries
+
+        while heap:
+            due_ts, sn = heap[0]
+            entry = entries.get(sn)
+            if entry is not None and entry[0] == due_ts:
+                return
+
+            heapq.heappop(heap)
+
+    def next_due_ts(self):
+        ''' get the earliest due time, None if the schedule is empty
+        '''
+
+        self._drop_stale()
+        if self._heap:
+            return self._heap[0][0]
+        return None
+
+    def pop_due(self, current_ts, limit=None):
+        ''' pop serial numbers of packets that are due
+
+        Popped packets are still in the schedule, they shall be
+        rescheduled or cancelled by the caller.
+
+        :param current_ts: the current timestamp
+        :param limit: the max amount of packets to pop
+        :return: a list of serial numbers
+        '''
+
+        heap = self._heap
+        due = []
+
+        while limit is None or len(due) < limit:
+            self._drop_stale()
+            if not heap or heap[0][0] > current_ts:
+                break
+
+            _, sn = heapq.heappop(heap)
+            due.append(sn)
+
+        return due
+
+    def sn_list(self):
+        return list(self._entries)
+
+    def __contains__(self, sn):
+        return sn in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class BasePacketRepeater():
+
+    ''' The base class of packet repeaters
+
+    Receives notifications from packet managers in a unix datagram socket
+    and runs the main loop, subclasses shall implement resync, run_once,
+    get_poll_timeout and close_shm.
+    '''
+
+    def __init__(self, sock_path):
+        self.__running = False
+
+        self._sock = None
+        self._sock_path = sock_path
+
+    def listen(self):
+        ''' bind the socket to receive notifications
+
+        It shall be invoked before the repeater worker is forked, so
+        notifications sent before the worker starts running will not
+        be lost.
+        '''
+
+        # the socket file may be left by a crashed repeater
+        if os.path.exists(self._sock_path):
+            os.remove(self._sock_path)
 
-        self.set_pkt_repeated_times(sn, repeated_times)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self._sock.bind(self._sock_path)
 
+    def close_sock(self, unlink=True):
+        ''' close the socket to receive notifications
 
-class SpecialPacketRepeater():
+        :param unlink: remove the socket file, processes which share the
+                       socket with the repeater worker shall not remove it
+        '''
+
+        if self._sock is None:
+            return
+
+        self._sock.close()
+        self._sock = None
+
+        if unlink and os.path.exists(self._sock_path):
+            os.remove(self._sock_path)
+
+    def shutdown(self):
+        self.__running = False
+
+    def recv_notifications(self):
+        ''' read all pending notifications
+
+        :return: a generator of (action, sn, pid)
+        '''
+
+        while True:
+            try:
+                data = self._sock.recv(NOTIFICATION_STRUCT.size)
+            except BlockingIOError:
+                return
+
+            try:
+                yield NOTIFICATION_STRUCT.unpack(data)
+            except struct.error:
+                logger.error('Repeater received an invalid notification')
+
+    def wait_for_notifications(self, timeout):
+        ''' wait until notifications arrive or the timeout
+
+        :return: bool, whether there are notifications to read
+        '''
+
+        readable, _, _ = select.select([self._sock], [], [], timeout)
+        return len(readable) > 0
+
+    def run(self):
+        pid = os.getpid()
+        name = type(self).__name__
+        logger.info(f'starting {name} worker {pid}')
+
+        if self._sock is None:
+            self.listen()
+
+        self.__running = True
+        next_resync_ts = 0
+
+        while self.__running:
+            if time.time() >= next_resync_ts:
+                self.resync()
+                next_resync_ts = time.time() + RESYNC_INTERVAL
+
+            self.run_once(self.get_poll_timeout(next_resync_ts))
+
+        self.close_sock()
+        self.close_shm()
+        logger.info(f'{name} worker {pid} exits')
+
+
+class SpecialPacketRepeater(BasePacketRepeater):
 
     ''' The repeater for special packets
 
@@ -264,6 +881,18 @@ class SpecialPacketRepeater():
 
     Actually, the packet repeater is a part of the packet manager though
     we made it standalone, but it still work together with the packet manager.
+
+    The repeater keeps a RepeatSchedule of due times in its own memory.
+    The packet manager notifies the repeater when a packet is stored to be
+    repeated or cancelled, so the repeater doesn't need to poll all
+    repeating states in the shared memory. Each wakeup only reads the
+    packets that are due. Repeating states in the shared memory are still
+    updated, and the repeater reloads them every RESYNC_INTERVAL seconds
+    in case any notification is lost.
+
+    Retransmission timeouts are calculated by the RTTEstimator with
+    exponential backoff. RTT estimates are sampled by node workers when
+    responses arrive, and the repeater reloads them in each resync as well.
     '''
 
     def __init__(
@@ -271,100 +900,373 @@ class SpecialPacketRepeater():
         config,
         efferent,
         protocol_wrapper,
-        interval_args=(0.5, 1),
+        pid=None,
     ):
         ''' Constructor
 
         :param config: the config instance
         :param efferent: an instance of the Efferents
         :param protocol_wrapper: an instance of ProtocolWrappers
-        :param interval_args: a pair of number in tuple or list format
-                              that will be used in random.uniform to
-                              generate a random interval time
+        :param pid: pid of the worker whose packets shall be repeated,
+                    default is NodeContext.pid
         '''
 
-        self.__running = False
         self.config = config
-        self.interval_args = interval_args
 
-        self.pkt_mgr = SpecialPacketManager(config)
+        self.pkt_mgr = SpecialPacketManager(config, pid=pid)
         self.efferent = efferent
         self.protocol_wrapper = protocol_wrapper
 
+        # update the time and the mac of packets stored in the packed format
+        self.restamp = bool(config.net.special_pkt_restamp)
+        if self.restamp and is_aead_cipher(config.net.crypto.cipher):
+            raise ConfigError(
+                'net.special_pkt_restamp is not supported by AEAD ciphers'
+            )
+
+        self.schedule = RepeatSchedule()
+
+        self.rtt_estimator = RTTEstimator(config)
+
+        # RTT estimates loaded from the shared memory in resync
+        # structure: {"ip:port": estimate dict}
+        self.rtt_estimates = dict()
+
+        BasePacketRepeater.__init__(
+            self,
+            os.path.join(
+                config.shm.socket_dir,
+                RPTER_SOCKET_NAME_TEMPLATE % self.pkt_mgr.pid,
+            ),
+        )
+
     def init_shm(self):
         self.pkt_mgr.init_shm()
 
     def close_shm(self):
         self.pkt_mgr.close_shm()
 
-    def shutdown(self):
-        self.__running = False
+    def gen_interval(self, next_hop, rpted_times):
+        ''' generate the timeout of the next retransmission
 
-    def gen_interval(self):
-        return random.uniform(*self.interval_args)
+        :param next_hop: the address that the packet is sent to
+        :param rpted_times: how many times the packet has been sent
+        '''
+
+        estimate = self.rtt_estimates.get(get_rtt_key(next_hop))
+        return self.rtt_estimator.gen_timeout(estimate, rpted_times)
 
     def repeat_pkt(self, pkt):
-        pkt = self.protocol_wrapper.wrap(pkt)
+        # packets stored in the packed format carry the packed data
+        if pkt.data is None:
+            pkt = self.protocol_wrapper.wrap(pkt)
+        else:
+            pkt = self.protocol_wrapper.rewrap(pkt, restamp=self.restamp)
+
         self.efferent.transmit(pkt)
 
-    def repeat(self, sn, pkt, current_ts):
-        interval = self.gen_interval()
-        next_rpt_ts = current_ts + interval
+    def repeat(self, sn, pkt, current_ts, rpted_times=1):
+        ''' send the packet and generate the next repeat time
+
+        Repeating states will be updated by the caller in batch.
+
+        :param rpted_times: how many times the packet has been sent,
+                            including this time
+        :return: timestamp of the next repeat
+        '''
 
         self.repeat_pkt(pkt)
-        self.pkt_mgr.set_pkt_last_repeat_time(sn, current_ts)
-        self.pkt_mgr.set_pkt_next_repeat_time(sn, next_rpt_ts)
-        self.pkt_mgr.increase_pkt_repeated_times(sn)
 
         type_ = Converter.int_2_hex(pkt.fields.type)
         logger.debug(
             f'Repeated a special packet, sn: {pkt.fields.sn}, '
-            f'type: {type_}, dest: {pkt.fields.dest}'
+            f'type: {type_}, next_hop: {pkt.next_hop}'
         )
 
-    def run(self):
-        pid = os.getpid()
-        logger.info(f'starting SpecialPacketRepeater worker {pid}')
+        return current_ts + self.gen_interval(pkt.next_hop, rpted_times)
 
-        self.__running = True
+    def handle_notifications(self):
+        ''' read all pending notifications and update the schedule
+        '''
 
-        while self.__running:
-            sn_list = self.pkt_mgr.get_repeating_sn_list()
-            interval_to_next_poll = 1
+        current_ts = time.time()
+        for action, sn, _ in self.recv_notifications():
+            self.apply_notification(action, sn, current_ts)
 
-            for sn in sn_list:
-                pkt = self.pkt_mgr.get_pkt(sn)
-
-                if pkt is None:
-                    # packet removed in the interval of these 2 times of shared
-                    # memory request, so we just need to skip
-                    #
-                    # Maybe we need to invoke remove_pkt here again to ensure
-                    # that this serial number has been removed?
+    def apply_notification(self, action, sn, current_ts):
+        if action == RepeaterActions.REPEAT:
+            self.schedule.add(sn, current_ts)
+        elif action == RepeaterActions.CANCEL:
+            self.schedule.cancel(sn)
+
+    def resync(self):
+        ''' reload RTT estimates and the schedule from the shared memory
+        '''
+
+        self.rtt_estimates = self.pkt_mgr.get_rtt_estimates()
+        self.resync_schedule()
+
+    def resync_schedule(self):
+        ''' reload the schedule from repeating states in the shared memory
+        '''
+
+        states = self.pkt_mgr.get_repeating_states()
+        current_ts = time.time()
+
+        for sn in self.schedule.sn_list():
+            if str(sn) not in states:
+                self.schedule.cancel(sn)
+
+        for key, state in states.items():
+            self.schedule.add(
+                int(key),
+                state.get('next_rpt_time') or current_ts,
+                state.get('rpted_times') or 0,
+            )
+
+    def repeat_due_pkts(self, sn_list, current_ts):
+        ''' repeat packets that are due
+
+        All SHM requests are sent in 3 batches at most: reading packets,
+        cancelling and updating states.
+
+        Packets have been popped from the schedule, so if anything goes
+        wrong, packets that are not handled yet will be retried after
+        the initial RTO, and states of handled ones are still updated.
+        '''
+
+        handled = set()
+        sn_list_to_cancel = []
+        new_states = {}
+
+        try:
+            pkts = self.pkt_mgr.get_repeating_pkts(sn_list)
+
+            for sn, (pkt, state) in zip(sn_list, pkts):
+                # The repeat has been cancelled, the notification may be lost
+                if state is None:
+                    self.schedule.cancel(sn)
+                    handled.add(sn)
+                    continue
+
+                # The packet has been removed or expired, or it has been
+                # repeated enough times
+                rpted = state.get('rpted_times')
+                if pkt is None or rpted >= state.get('max_rpt_times'):
+                    self.schedule.cancel(sn)
+                    sn_list_to_cancel.append(sn)
+                    handled.add(sn)
                     continue
 
-                last_rpt_ts = self.pkt_mgr.get_pkt_last_repeat_time(sn)
-                next_rpt_ts = self.pkt_mgr.get_pkt_next_repeat_time(sn)
-                max_rpt_times = self.pkt_mgr.get_pkt_max_repeat_times(sn)
-                rpted_times = self.pkt_mgr.get_pkt_repeated_times(sn)
-                current_ts = time.time()
-
-                if rpted_times >= max_rpt_times:
-                    self.pkt_mgr.cancel_repeat(sn)
-                elif last_rpt_ts is None or next_rpt_ts is None:
-                    self.repeat(sn, pkt, current_ts)
-                elif current_ts < next_rpt_ts:
-                    # here, we calculate a minimum interval time that we need
-                    # to sleep to the next poll
-                    interval = next_rpt_ts - current_ts
-                    if interval < interval_to_next_poll:
-                        interval_to_next_poll = interval
-                else:
-                    self.repeat(sn, pkt, current_ts)
-
-            s = interval_to_next_poll   # too long ...
-            #logger.debug(f'SpecialPacketRepeater is going to sleep {s} sec.')
-            time.sleep(s)
+                next_rpt_ts = self.repeat(sn, pkt, current_ts, rpted + 1)
+                self.schedule.reschedule(sn, next_rpt_ts, rpted + 1)
+                handled.add(sn)
+
+                new_state = dict(state)
+                new_state.update(
+                    rpted_times=rpted + 1,
+                    last_rpt_time=current_ts,
+                    next_rpt_time=next_rpt_ts,
+                )
+                new_states[sn] = (state, new_state)
+        finally:
+            retry_ts = current_ts + self.rtt_estimator.initial_rto
+            for sn in sn_list:
+                entry = self.schedule.get(sn)
+                if sn not in handled and entry is not None:
+                    self.schedule.reschedule(sn, retry_ts, entry[1])
 
-        self.pkt_mgr.close_shm()
-        logger.info(f'SpecialPacketRepeater worker {pid} exits')
+            self.pkt_mgr.remove_repeat_states(sn_list_to_cancel)
+
+            # The repeat is cancelled after we read the state
+            for sn in self.pkt_mgr.update_repeat_states(new_states):
+                self.schedule.cancel(sn)
+
+    def get_poll_timeout(self, next_resync_ts):
+        timeout = min(next_resync_ts, time.time() + MAX_POLL_TIMEOUT)
+
+        next_due_ts = self.schedule.next_due_ts()
+        if next_due_ts is not None and next_due_ts < timeout:
+            timeout = next_due_ts
+
+        return max(0, timeout - time.time())
+
+    def run_once(self, timeout):
+        ''' wait for notifications and repeat packets that are due
+        '''
+
+        if self.wait_for_notifications(timeout):
+            self.handle_notifications()
+
+        current_ts = time.time()
+        sn_list = self.schedule.pop_due(current_ts, MAX_RPT_PER_WAKEUP)
+        if len(sn_list) > 0:
+            self.repeat_due_pkts(sn_list, current_ts)
+
+
+class NodePacketRepeater(BasePacketRepeater):
+
+    ''' The node-level repeater for special packets
+
+    Used in the PktRpterModes.NODE mode. Instead of forking a repeater
+    for each worker, the node starts only one NodePacketRepeater, which
+    repeats special packets of all workers.
+
+    Packets of each worker are kept in a partition, a partition is a
+    SpecialPacketRepeater which works on SHM containers of the worker
+    with its own RepeatSchedule, but without its own notification socket,
+    SHM connection and efferent. Workers notify the repeater in one socket
+    with their pids, and register themselves in the shared memory when
+    they start, so the repeater finds partitions in resync even if
+    notifications are lost.
+
+    Workers that exit without deregistering themselves are deregistered
+    by the master process, see deregister_worker.
+    '''
+
+    def __init__(self, config, efferent, protocol_wrapper):
+        ''' Constructor
+
+        :param config: the config instance
+        :param efferent: the efferent shared by all partitions
+        :param protocol_wrapper: an instance of ProtocolWrappers
+        '''
+
+        self.config = config
+        self.efferent = efferent
+        self.protocol_wrapper = protocol_wrapper
+
+        self.rpter_mode = config.net.special_pkt_rpter
+        if self.rpter_mode != PktRpterModes.NODE:
+            raise ConfigError(
+                'net.special_pkt_rpter shall be "node" to use '
+                'the NodePacketRepeater'
+            )
+
+        # structure: {pid: SpecialPacketRepeater}
+        self.partitions = dict()
+
+        self.shm_mgr = None
+
+        BasePacketRepeater.__init__(
+            self,
+            os.path.join(config.shm.socket_dir, NODE_RPTER_SOCKET_NAME),
+        )
+
+    def init_shm(self):
+        self.shm_mgr = SharedMemoryManager(self.config)
+        self.shm_mgr.connect(
+            NODE_RPTER_SHM_SOCKET_NAME_TEMPLATE % os.getpid()
+        )
+        self.shm_mgr.create_key_and_ignore_conflict(
+            SHM_KEY_RPTER_WORKERS,
+            SHMContainerTypes.SET,
+        )
+
+    def close_shm(self):
+        self.shm_mgr.disconnect()
+
+    @staticmethod
+    def deregister_worker(shm_mgr, pid):
+        ''' remove a worker from the registered workers
+
+        Packets that the worker left are still repeated by its partition,
+        the partition is removed in resync after they are finished.
+
+        :param shm_mgr: a connected SharedMemoryManager
+        :param pid: pid of the worker
+        '''
+
+        shm_mgr.remove_value(SHM_KEY_RPTER_WORKERS, [pid])
+
+    def get_partition(self, pid):
+        ''' get the partition of the worker, create it if it doesn't exist
+        '''
+
+        partition = self.partitions.get(pid)
+        if partition is None:
+            partition = SpecialPacketRepeater(
+                            self.config,
+                            self.efferent,
+                            self.protocol_wrapper,
+                            pid=pid,
+                        )
+            partition.pkt_mgr.init_shm(self.shm_mgr)
+            self.partitions[pid] = partition
+
+            logger.debug(f'Created the repeater partition of worker {pid}')
+
+        return partition
+
+    def get_worker_pids(self):
+        shm_data = self.shm_mgr.read_key(SHM_KEY_RPTER_WORKERS)
+        return shm_data.get('value')
+
+    def handle_notifications(self):
+        ''' read all pending notifications and update schedules
+        '''
+
+        current_ts = time.time()
+        for action, sn, pid in self.recv_notifications():
+            if action == RepeaterActions.REPEAT:
+                partition = self.get_partition(pid)
+            else:
+                partition = self.partitions.get(pid)
+
+            if partition is not None:
+                partition.apply_notification(action, sn, current_ts)
+
+    def resync(self):
+        ''' reload RTT estimates and schedules of all partitions
+
+        Partitions of workers that have exited are removed after all of
+        their packets are finished.
+        '''
+
+        worker_pids = set(self.get_worker_pids())
+        for pid in worker_pids:
+            self.get_partition(pid)
+
+        if len(self.partitions) == 0:
+            return
+
+        partitions = list(self.partitions.values())
+        rtt_estimates = partitions[0].pkt_mgr.get_rtt_estimates()
+
+        for partition in partitions:
+            partition.rtt_estimates = rtt_estimates
+            partition.resync_schedule()
+
+        for pid, partition in list(self.partitions.items()):
+            if pid not in worker_pids and len(partition.schedule) == 0:
+                self.partitions.pop(pid)
+                logger.debug(f'Removed the repeater partition of worker {pid}')
+
+    def get_poll_timeout(self, next_resync_ts):
+        timeout = min(next_resync_ts, time.time() + MAX_POLL_TIMEOUT)
+
+        for partition in self.partitions.values():
+            next_due_ts = partition.schedule.next_due_ts()
+            if next_due_ts is not None and next_due_ts < timeout:
+                timeout = next_due_ts
+
+        return max(0, timeout - time.time())
+
+    def run_once(self, timeout):
+        ''' wait for notifications and repeat packets that are due
+
+        Each partition repeats at most MAX_RPT_PER_WAKEUP packets in a
+        wakeup, so a busy worker doesn't delay packets of other workers.
+        '''
+
+        if self.wait_for_notifications(timeout):
+            self.handle_notifications()
+
+        current_ts = time.time()
+        for partition in self.partitions.values():
+            sn_list = partition.schedule.pop_due(
+                          current_ts,
+                          MAX_RPT_PER_WAKEUP,
+                      )
+            if len(sn_list) > 0:
+                partition.repeat_due_pkts(sn_list, current_ts)
@@ -0,0 +1,150 @@
+#!/usr/bin/python3.6
+#coding: utf-8
+
+import random
+
+from neverland.exceptions import ConfigError
+
+
+__all__ = ['RTTEstimator']
+
+
+''' Round-trip time estimation of special packets
+
+Retransmission timeouts are calculated in the way of TCP (RFC 6298):
+
+    on the first sample R:
+        SRTT <- R
+        RTTVAR <- R / 2
+
+    on each following sample R:
+        RTTVAR <- (1 - BETA) * RTTVAR + BETA * |SRTT - R|
+        SRTT <- (1 - ALPHA) * SRTT + ALPHA * R
+
+    RTO <- SRTT + max(G, K * RTTVAR)
+
+Samples are measured from CTRL RESPONSE packets. Following Karn's algorithm,
+only packets that have been sent only once are sampled, a response to a
+retransmitted packet cannot tell which transmission it responds to.
+
+Each retransmission doubles the timeout until it reaches the max RTO, and
+the timeout is randomly shortened by at most RTO_JITTER of it, so packets
+sent at the same time will not be repeated in bursts.
+
+Estimates are plain dicts, so they can be kept in the shared memory:
+
+    {
+        srtt: float,
+        rttvar: float,
+    }
+'''
+
+
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+RTT_K = 4
+
+# the clock granularity, the repeater doesn't wake up more precisely
+RTT_G = 0.01
+
+# RTO of destinations that we don't have any samples yet
+INITIAL_RTO = 1
+
+# the range of the RTO
+MIN_RTO = 0.2
+MAX_RTO = 16
+
+# the max ratio that timeouts are shortened by
+RTO_JITTER = 0.25
+
+# timeouts stop doubling after this amount of retransmissions,
+# they have reached the max RTO long before it anyway
+MAX_BACKOFF_EXP = 16
+
+
+class RTTEstimator():
+
+    ''' Calculates RTT estimates and retransmission timeouts
+
+    Limits of the RTO can be modified by config.net.special_pkt_rto:
+
+        {
+            "initial": 1,
+            "min": 0.2,
+            "max": 16
+        }
+    '''
+
+    def __init__(self, config):
+        rto_conf = config.net.special_pkt_rto
+
+        if rto_conf is None:
+            self.initial_rto = INITIAL_RTO
+            self.min_rto = MIN_RTO
+            self.max_rto = MAX_RTO
+        else:
+            self.initial_rto = rto_conf.initial or INITIAL_RTO
+            self.min_rto = rto_conf.min or MIN_RTO
+            self.max_rto = rto_conf.max or MAX_RTO
+
+        if not 0 < self.min_rto <= self.max_rto:
+            raise ConfigError(
+                'net.special_pkt_rto: min shall be positive and not '
+                'greater than max'
+            )
+
+    @staticmethod
+    def update(estimate, sample):
+        ''' apply an RTT sample to the estimate
+
+        :param estimate: the current estimate, None if there isn't one
+        :param sample: the measured RTT in seconds
+        :return: the new estimate
+        '''
+
+        if estimate is None:
+            return {
+                'srtt': sample,
+                'rttvar': sample / 2,
+            }
+
+        srtt = estimate.get('srtt')
+        rttvar = estimate.get('rttvar')
+
+        rttvar = (1 - RTT_BETA) * rttvar + RTT_BETA * abs(srtt - sample)
+        srtt = (1 - RTT_ALPHA) * srtt + RTT_ALPHA * sample
+
+        return {
+            'srtt': srtt,
+            'rttvar': rttvar,
+        }
+
+    def rto(self, estimate):
+        ''' get the retransmission timeout of the estimate
+
+        :param estimate: the estimate, None if there isn't one
+        :return: seconds
+        '''
+
+        if estimate is None:
+            rto = self.initial_rto
+        else:
+            rto = estimate.get('srtt') + max(
+                RTT_G,
+                RTT_K * estimate.get('rttvar'),
+            )
+
+        return min(max(rto, self.min_rto), self.max_rto)
+
+    def gen_timeout(self, estimate, rpted_times):
+        ''' generate the timeout of the next retransmission
+
+        :param estimate: the estimate of the destination
+        :param rpted_times: how many times the packet has been sent,
+                            including this time
+        :return: seconds
+        '''
+
+        backoff = 2 ** min(max(rpted_times - 1, 0), MAX_BACKOFF_EXP)
+        timeout = min(self.rto(estimate) * backoff, self.max_rto)
+        return timeout * (1 - random.uniform(0, RTO_JITTER))
@@ -2,13 +2,21 @@
 #coding: utf-8
 
 import os
-import json
+import copy
+import time
+import zlib
+import heapq
 import select
 import socket
 import logging
 
+from itertools import islice
+from collections import deque
+
 from neverland.exceptions import (
     DropPacket,
+    ConfigError,
+    ArgumentError,
     AddressAlreadyInUse,
     SharedMemoryError,
     SHMRequestFailed,
@@ -19,12 +27,32 @@ from neverland.exceptions import (
     SHMWorkerConnectFailed,
 )
 from neverland.utils import MetaEnum, ObjectifiedDict, gen_uuid
+from neverland.components.shmcodec import (
+    SHMEncodings,
+    JSONCodec,
+    CODECS,
+    detect_codec,
+    pack_value,
+    split_fragments,
+    is_fragment,
+    parse_fragment,
+)
+from neverland.components.shmmmap import (
+    MMapRegion,
+    SlotFull,
+    TableFull,
+    KeyTooLong,
+    LockBusy,
+    DEFAULT_MMAP_KEY_PREFIXES,
+)
+from neverland.components.shmpersist import SHMPersister
 
 
 __all__ = [
     'Actions',
     'SHMContainerTypes',
     'SharedMemoryManager',
+    'SHMBatch',
 ]
 
 
@@ -42,6 +70,26 @@ by the socket-based IPC, and it shall only support the Unix domain socket.
 And it's not necessary to make this communication become encrypted. We can
 simply solve the security problem by using the permission mechanism of Linux.
 
+Optionally, hot containers can be placed in a real shared memory region by
+enabling the mmap backend (config.shm.backend = "mmap"). Keys that match
+config.shm.mmap_key_prefixes will be accessed by clients directly through
+the mmap region without a round trip to the worker, see shmmmap for details.
+
+Containers of the worker can be kept on disk by setting
+config.shm.snapshot_dir, so they will be loaded again when the worker
+restarts, see shmpersist for details. Locks are not persistent. The
+persistence cannot be enabled together with the mmap backend, clients
+change containers in the mmap region directly, so the worker never sees
+the changes and cannot log them.
+
+The worker is single-threaded, so it may become the throughput ceiling when
+there are many node workers. In this case, the key space can be partitioned
+into shards by setting config.shm.shard_amount, each shard is served by an
+individual worker process. Clients connect to all of the shards, and route
+each request to the shard which owns the key, see get_shard_idx. Because all
+requests of a key (including LOCK and CREATE) go to the same shard, they have
+exactly the same semantics as with a single worker.
+
 
 The protocol of communication:
     The choice of transport layer protocol is UDP. UDP is much easier to handle
@@ -59,6 +107,14 @@ The protocol of communication:
 
     Then, we can simply transfer stringified JSON through the socket.
 
+    The stringified JSON is not the only encoding. Clients can also use the
+    binary encoding which is defined in neverland.components.shmcodec.
+    The encoding is negotiated in the CONNECT request, the CONNECT request
+    itself is always in JSON, and the worker will respond with the encoding
+    picked up from the "encodings" field. Once the connection is established,
+    both sides shall use the negotiated encoding. If the "encodings" field is
+    not given, then the JSON will be used.
+
     Fields in request body:
 
         socket:
@@ -82,11 +138,33 @@ The protocol of communication:
         value_key:
             the key of a value in a container
 
+        ttl:
+            time to live in seconds, int or float, optional.
+
+            In CREATE and SET requests, it's the TTL of the container.
+            In ADD, DICT_UPDATE and DICT_INCR requests on DICT containers,
+            it's the TTL of the entries which are added or updated.
+            Expired containers and entries will be removed by the worker
+            automatically.
+
+            Like SET in Redis, overwriting without the ttl field clears
+            the existing TTL: SET clears the TTL of the container, ADD and
+            DICT_UPDATE on DICT containers clear TTLs of the written
+            entries. Other changes (e.g. DICT_INCR, CAS and REMOVE) don't
+            touch existing TTLs.
+            TTLs are not supported for keys in the mmap region.
+
         backlogging:
             backlog the request if the container is locked, if backlogging
             is not enabled, then the server side shall respond immediately
             with the return code 0x21
 
+            Backlogged requests wait in a FIFO queue of the locked key. Once
+            the key is unlocked, or the connection which holds the lock is
+            closed, the worker wakes the first request in the queue. If the
+            woken request doesn't take the lock, then the next one will be
+            woken as well.
+
             Default: True
 
 
@@ -96,6 +174,8 @@ The protocol of communication:
             {
                 "socket": str,
                 "action": int,
+                "encodings": list of encodings in preference order,
+                             enumerated in shmcodec.SHMEncodings, optional,
             }
 
         if action in [DISCONNECT]:
@@ -160,6 +240,75 @@ The protocol of communication:
                 "backlogging": bool,
             }
 
+        if action in [SCAN]:
+            {
+                "conn_id": str,
+                "action": int,
+                "key": str,
+                "cursor": int, 0 to start a new iteration,
+                "count": int, max amount of elements to return,
+                "backlogging": bool,
+            }
+
+            SCAN iterates multi-value containers (SET, LIST and DICT) in
+            pieces. The cursor is the position of the next element in the
+            container, so elements may be skipped or returned twice if the
+            container is changed between two SCAN requests.
+
+        if action in [SLICE]:
+            {
+                "conn_id": str,
+                "action": int,
+                "key": str,
+                "start": int or null,
+                "stop": int or null,
+                "backlogging": bool,
+            }
+
+            SLICE reads a part of a LIST container, same as list[start:stop]
+
+        if action in [INCR, DECR]:
+            {
+                "conn_id": str,
+                "action": int,
+                "key": str,
+                "value": the amount, int or float, default: 1,
+                "backlogging": bool,
+            }
+
+        if action in [DICT_INCR]:
+            {
+                "conn_id": str,
+                "action": int,
+                "key": str,
+                "value_key": any serializable type in json,
+                "value": the amount, int or float, default: 1,
+                "backlogging": bool,
+            }
+
+            INCR and DECR work on INT and FLOAT containers, DICT_INCR works
+            on numbers in DICT containers, missing entries are treated as 0.
+            INT containers only accept integer amounts.
+
+        if action in [CAS]:
+            {
+                "conn_id": str,
+                "action": int,
+                "key": str,
+                "value_key": the key of a dict entry, or null,
+                "expected": the expected current value,
+                "value": the new value,
+                "backlogging": bool,
+            }
+
+            CAS replaces the value of a single-value container, or an entry
+            of a DICT container if value_key is given, only if the current
+            value is equal to the expected one in both value and type.
+            A missing entry is compared as null.
+
+            The worker handles these actions in one step, so they can be
+            used instead of the LOCK -> READ -> SET -> UNLOCK sequence.
+
             The SET action has been limited, it can only be used on
             single-value containers.
 
@@ -179,6 +328,67 @@ The protocol of communication:
                 "backlogging": bool,
             }
 
+        if action in [BATCH]:
+            {
+                "conn_id": str,
+                "action": int,
+                "requests": [
+                    {
+                        "action": int,
+                        "key": str,
+                        ... other fields of the action, without conn_id
+                    },
+                ],
+                "atomic": bool,
+                "backlogging": bool,
+            }
+
+            Requests in a batch will be handled in order, and the worker
+            checks locks of all requests before it handles the first one.
+            If any of the containers is locked by another connection, then
+            the whole batch will be backlogged (or fail with LOCKED).
+
+            The worker is single-threaded, so no other requests can be
+            handled in the middle of a batch. If "atomic" is true, then all
+            changes made by the batch will be rolled back once a request in
+            it fails, and the rest of requests will not be handled.
+
+            CONNECT, DISCONNECT and BATCH are not allowed in a batch.
+
+        if action in [SUBSCRIBE, UNSUBSCRIBE]:
+            {
+                "conn_id": str,
+                "action": int,
+                "key": str,
+                "socket": name of the socket to receive notifications,
+                          only required in SUBSCRIBE,
+            }
+
+            Once a connection has subscribed a key, the worker sends a
+            notification to the given socket when the container is
+            changed by CREATE, SET, ADD, REMOVE, DICT_UPDATE, INCR, DECR,
+            DICT_INCR, CAS or CLEAN.
+
+            The notification is in the same format as responses, encoded
+            in the negotiated encoding:
+                {
+                    'succeeded': True,
+                    'value': the changed key,
+                    'rcode': OK,
+                }
+
+            Notifications of a key will not be sent again until the
+            subscriber reads the key (READ) after the last notification,
+            so at most one notification of each key can be pending on the
+            notification socket.
+
+        if action in [LOCK_STATS, STATS]:
+            {
+                "conn_id": str,
+                "action": int,
+                "key": str or null for all keys,
+            }
+
 
     JSON structures in response:
 
@@ -189,6 +399,86 @@ The protocol of communication:
                 'rcode': the return code,
             }
 
+        if action in [INCR, DECR, DICT_INCR]:
+            {
+                'succeeded': bool,
+                'value': the new number,
+                'rcode': the return code,
+            }
+
+        if action == CAS:
+            {
+                'succeeded': bool,
+                'value': {
+                    'swapped': whether the value has been replaced,
+                    'value': the current value after the action,
+                },
+                'rcode': the return code,
+            }
+
+        if action == SCAN:
+            {
+                'succeeded': bool,
+                'value': {
+                    'cursor': cursor for the next SCAN, 0 if finished,
+                    'items': a dict for DICT containers, or a list,
+                },
+                'rcode': the return code,
+            }
+
+        Responses which are larger than UDP_BUFFER_SIZE will be sent in
+        fragments, see shmcodec for the format.
+
+        if action == BATCH:
+            {
+                'succeeded': True if all requests succeeded,
+                'value': [response of each handled request],
+                'rcode': OK, or the rcode of the first failed request,
+            }
+
+        if action == LOCK_STATS:
+            {
+                'succeeded': True,
+                'value': {
+                    key: {
+                        'waits': count of requests which have waited,
+                        'total_wait': total waiting time in seconds,
+                        'max_wait': max waiting time in seconds,
+                        'waiting': count of requests waiting currently,
+                    },
+                },
+                'rcode': OK,
+            }
+
+        if action == STATS:
+            {
+                'succeeded': bool,
+                'value': {
+                    'keys': count of containers,
+                    'entries': count of elements in containers,
+                    'bytes': approximate size of containers in the
+                             binary encoding,
+                    'expiring_keys': count of containers with TTL,
+                    'expiring_entries': count of dict entries with TTL,
+                    'expired_keys': count of expired containers,
+                    'expired_entries': count of expired dict entries,
+                },
+                'rcode': the return code,
+            }
+
+            If the key is given, then only 'entries', 'bytes',
+            'expiring_entries' and 'ttl' (remaining seconds or null) of
+            the container will be responded.
+
+        if action == CONNECT:
+            {
+                'succeeded': bool,
+                'conn_id': the connection ID,
+                'encoding': the negotiated encoding,
+                'value': None,
+                'rcode': the return code,
+            }
+
         if action == DISCONNECT:
             In this case, nothing shall be sent back.
             The connection will be removed immediately.
@@ -204,11 +494,24 @@ UDP_BUFFER_SIZE = 65507
 # The max blocing time at the client side of the SharedMemoryManager
 SHM_MAX_BLOCKING_TIME = 4
 
+# default amount of elements returned by a SCAN request
+DEFAULT_SCAN_COUNT = 100
+
+# fields of requests that will be written into the persistent log
+PERSISTENT_FIELDS = ('action', 'key', 'type', 'value', 'value_key', 'expected')
+
+# min TTL of replayed records, expired records will be removed right after
+# they are replayed
+MIN_REPLAYED_TTL = 0.001
+
 MSG_NOT_CONNECTED = 'Not connected with SharedMemoryManager Worker yet'
 MSG_CONN_FAILED = 'Failed to connect to SharedMemoryManager Worker'
 MSG_INVALID_DATA = 'SharedMemoryManager didn\'t handle the request correctly'
 MSG_TIMEOUT = 'SharedMemoryManager worker timeout'
 
+# encodings in preference order, used in the CONNECT request
+DEFAULT_ENCODINGS = [SHMEncodings.BINARY, SHMEncodings.JSON]
+
 
 class Actions(metaclass=MetaEnum):
 
@@ -218,8 +521,9 @@ class Actions(metaclass=MetaEnum):
 
     # read value from a key
     # this action will cause the shared memory manager respond with
-    # whole value in the accessing container. If the value's length is
-    # greater than 65507 then there will be some exceptions
+    # whole value in the accessing container. If the encoded value is
+    # greater than 65507 bytes then it will be sent in fragments, use
+    # SCAN or SLICE to read a part of large containers
     READ = 0x02
 
     # change value of a key
@@ -234,6 +538,21 @@ class Actions(metaclass=MetaEnum):
     # update a dict container
     DICT_UPDATE = 0x06
 
+    # read a part of a container
+    SCAN = 0x07
+    SLICE = 0x08
+
+    # add to or subtract from an INT or FLOAT container,
+    # responds with the new value
+    INCR = 0x09
+    DECR = 0x0a
+
+    # add to a number in a dict container, responds with the new value
+    DICT_INCR = 0x0b
+
+    # compare-and-swap a single-value container or an entry of a dict
+    CAS = 0x0c
+
     # completely remove a key from stored resources
     CLEAN = 0x11
 
@@ -246,6 +565,19 @@ class Actions(metaclass=MetaEnum):
     # release a lock
     UNLOCK = 0x22
 
+    # read the lock waiting statistics
+    LOCK_STATS = 0x23
+
+    # read the memory statistics
+    STATS = 0x24
+
+    # receive notifications when a container is changed
+    SUBSCRIBE = 0x41
+    UNSUBSCRIBE = 0x42
+
+    # submit a group of requests in one datagram
+    BATCH = 0x31
+
     # create a new connection
     CONNECT = 0xf0
 
@@ -256,14 +588,54 @@ class Actions(metaclass=MetaEnum):
 ACTIONS_2_HANDLE_LOCK = [
     Actions.CREATE,
     Actions.READ,
+    Actions.SCAN,
+    Actions.SLICE,
     Actions.SET,
     Actions.ADD,
+    Actions.INCR,
+    Actions.DECR,
+    Actions.DICT_INCR,
+    Actions.CAS,
     Actions.CLEAN,
     Actions.REMOVE,
     Actions.LOCK,
     Actions.UNLOCK,
 ]
 
+# actions that change the container, subscribers will be notified
+ACTIONS_2_NOTIFY = [
+    Actions.CREATE,
+    Actions.SET,
+    Actions.ADD,
+    Actions.DICT_UPDATE,
+    Actions.INCR,
+    Actions.DECR,
+    Actions.DICT_INCR,
+    Actions.CAS,
+    Actions.CLEAN,
+    Actions.REMOVE,
+]
+
+# actions that accept the ttl field
+ACTIONS_WITH_TTL = [
+    Actions.CREATE,
+    Actions.SET,
+    Actions.ADD,
+    Actions.DICT_UPDATE,
+    Actions.DICT_INCR,
+]
+
+NOT_BATCHABLE_ACTIONS = [
+    Actions.LOCK_STATS,
+    Actions.STATS,
+    Actions.SUBSCRIBE,
+    Actions.UNSUBSCRIBE,
+    Actions.CONNECT,
+    Actions.DISCONNECT,
+    Actions.BATCH,
+]
+
+
 class ReturnCodes(metaclass=MetaEnum):
 
     # request completed successfully
@@ -285,6 +657,13 @@ class ReturnCodes(metaclass=MetaEnum):
     # The container which client side is trying to unlock is not locked
     NOT_LOCKED = 0x22
 
+    # The value is too large for the mmap slot or no slot is available
+    OUT_OF_SPACE = 0x31
+
+    # The request is not allowed in the current context,
+    # e.g. nested BATCH or CONNECT in a BATCH
+    NOT_ALLOWED = 0x41
+
     # something bad happend :(
     UNKNOWN_ERROR = 0xff
 
@@ -329,198 +708,837 @@ COMPATIBLE_TYPE_MAPPING = {
     SHMContainerTypes.BOOL: bool,
     SHMContainerTypes.SET: list,
     SHMContainerTypes.LIST: list,
-    SHMContainerTypes.DICT: ObjectifiedDict,
+    SHMContainerTypes.DICT: dict,
 }
 
 
-class Connection(ObjectifiedDict):
+def get_shard_idx(key, shard_amount):
+    ''' get index of the shard which owns the key
 
-    ''' The connections class for SharedMemoryManager
+    :param key: the container key
+    :param shard_amount: amount of shards
     '''
 
+    if shard_amount <= 1 or key is None:
+        return 0
 
-class SharedMemoryManager():
+    return zlib.crc32(key.encode()) % shard_amount
 
-    EV_MASK = select.EPOLLIN
 
-    def __init__(self, config, sensitive=True):
-        ''' Constructor
+def get_shard_socket_name(socket_name, shard_idx):
+    ''' name of the worker socket of a shard
 
-        :param config: the config
-        :param sensitive: The sensitive mode will make the client become
-                          sensitive, it will raise an SHMRequestFailed
-                          exception with a return code in exception.args[0]
-                          when the request is not successful.
-        '''
+    The first shard uses the manager_socket_name as it is, so the
+    SharedMemoryManager without sharding works as before.
+    '''
 
-        self.sensitive = sensitive
-        self.config = config
-        self.socket_dir = config.shm.socket_dir
+    if shard_idx == 0:
+        return socket_name
+    return f'{socket_name}-{shard_idx}'
 
-        ## the current connection between the SharedMemoryManager worker
-        self.current_connection = None
 
-        ## attributes below are for the SharedMemoryManager worker
-        self.worker_socket_path = os.path.join(
-                                      self.socket_dir,
-                                      self.config.shm.manager_socket_name,
-                                  )
+def dict_key_2_str(key):
+    ''' convert keys of dict containers into strings
 
-        self.__running = False
+    Keys of dict containers are always strings, because the JSON encoding
+    converts them. The binary encoding keeps keys as they are, so we convert
+    them here in the same way as json.dumps does to make both encodings
+    behave identically.
+    '''
 
-        # the resource container, all shared memories will be stored in it
-        self.resources = {}
+    if key.__class__ is str:
+        return key
+    if key is True:
+        return 'true'
+    if key is False:
+        return 'false'
+    if key is None:
+        return 'null'
+    return str(key)
 
-        # locks have been acquired by the client side
-        # structure: {resources.key: connection_id}
-        self.locks = {}
 
-        # connection container, all established connections will be stored in it
-        # structure: {connection_id: Connection}
-        self.connections = {}
+def add_values_2_container(container, values):
+    ''' add values into a multi-value container
 
-        # Because of the lock mechanism, some of requests can not be handled
-        # promptly, so they will be backlogged and will be handled later.
-        #
-        # structure: {serial_number, data}
-        self.backlogged_requests = {}
+    Shared by the SharedMemoryManager worker and the MMapBackend.
+    '''
 
-        # serial number counter for backlogged_requests
-        self.backlog_sn = 0
+    container_type = type(container)
 
-    def _create_socket(self, socket_path=None, blocking=False):
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-        sock.setblocking(blocking)
-        try:
-            if socket_path is not None:
-                logger.debug(
-                    f'created socket and tring to bind on {socket_path}'
-                )
-                sock.bind(socket_path)
-        except OSError as err:
-            if err.errno == 98:
-                raise AddressAlreadyInUse(
-                    f'{socket_path} is already in use, cannot bind on it'
-                )
-            else:
-                raise err
+    if container_type is set:
+        for value in values:
+            container.add(value)
 
-        return sock
+    if container_type is list:
+        for value in values:
+            container.append(value)
 
-    def gen_conn_id(self):
-        return gen_uuid()
+    if container_type is dict:
+        if isinstance(values, ObjectifiedDict):
+            values = values.__to_dict__()
+        elif not isinstance(values, dict):
+            raise TypeError
 
-    def gen_backlog_sn(self):
-        self.backlog_sn += 1
-        return self.backlog_sn
+        container.update(
+            {dict_key_2_str(k): v for k, v in values.items()}
+        )
 
-    def get_compatible_value(self, key):
-        ''' make the value type become compatible with json
 
-        currently, we just need to convert set type into lists
-        '''
+def remove_values_from_container(container, values):
+    ''' remove values from a multi-value container
 
-        value = self.resources.get(key)
+    :param values: when the type is dict, it will be keys of the dict,
+                   otherwise, it will be values of the set or list
+    '''
 
-        if isinstance(value, set):
-            return list(value)
-        else:
-            return value
+    type_ = type(container)
 
-    def _add_value_2_container(self, key, values):
-        container = self.resources[key]
-        container_type = type(container)
-
-        if container_type is set:
-            for value in values:
-                container.add(value)
-
-        if container_type is list:
-            for value in values:
-                container.append(value)
-
-        if container_type is dict:
-            if isinstance(values, dict):
-                container.update(values)
-            elif isinstance(values, ObjectifiedDict):
-                container.update(values.__to_dict__())
-            else:
-                raise TypeError
+    if type_ in (set, list):
+        for value in values:
+            try:
+                container.remove(value)
+            except (ValueError, KeyError):
+                pass
 
-    def _remove_value_from_container(self, key, *values):
-        ''' remove values from a container
+    if type_ is dict:
+        for value in values:
+            container.pop(dict_key_2_str(value), None)
 
-        :param values: multipurpose parameter, when the type is dict, it will
-                       be the key of dict, otherwise, it will be the value of
-                       set and list
-        '''
 
-        container = self.resources[key]
-        type_ = type(container)
+def scan_container(container, cursor=None, count=None):
+    ''' read a piece of a multi-value container from the cursor
 
-        if type_ in (set, list):
-            for value in values:
-                try:
-                    container.remove(value)
-                except (ValueError, KeyError):
-                    pass
+    Shared by the SharedMemoryManager worker and the MMapBackend.
 
-        if type_ is dict:
-            for value in values:
-                container.pop(value, None)
+    :return: {'cursor': cursor of the next piece, 0 if finished,
+              'items': elements in a dict or list}
+    '''
 
-    def _save_connection(self, conn_id, conn):
-        self.connections.update(
-            {conn_id: conn}
-        )
+    cursor = cursor or 0
+    count = count or DEFAULT_SCAN_COUNT
 
-    def _remove_connection(self, conn_id):
-        self.connections.pop(conn_id, None)
+    if (
+        type(container) not in (set, list, dict) or
+        type(cursor) is not int or
+        type(count) is not int or
+        cursor < 0 or
+        count <= 0
+    ):
+        raise TypeError
 
-    def _gen_response_json(self, conn_id, succeeded, value=None, rcode=None):
-        if rcode is None:
-            rcode = ReturnCodes.OK if succeeded else ReturnCodes.UNKNOWN_ERROR
+    stop = cursor + count
 
-        return {
-            'conn_id': conn_id,
-            'data': {
-                'succeeded': succeeded,
-                'value': value,
-                'rcode': rcode,
-            }
-        }
+    if type(container) is dict:
+        items = dict(islice(container.items(), cursor, stop))
+    else:
+        items = list(islice(container, cursor, stop))
 
-    def handle_connect(self, data):
-        resp_sock_path = os.path.join(self.socket_dir, data.socket)
-        conn_id = self.gen_conn_id()
-        sock = self._create_socket()
-        conn = Connection(
-                   conn_id=conn_id,
-                   socket=sock,
-                   resp_socket=resp_sock_path,
-               )
+    next_cursor = cursor + len(items)
+    if next_cursor >= len(container):
+        next_cursor = 0
 
-        self._save_connection(conn_id, conn)
+    return {
+        'cursor': next_cursor,
+        'items': items,
+    }
 
-        return {
-            'conn_id': conn_id,
-            'data': {
-                'succeeded': True,
-                'conn_id': conn_id,
-                'value': None,
-                'rcode': ReturnCodes.OK,
-            }
-        }
 
-    def handle_disconnect(self, data):
-        self._remove_connection(data.conn_id)
-        return None
+def slice_container(container, start=None, stop=None):
+    ''' read a slice of a LIST container
+    '''
 
-    def handle_lock(self, data):
-        key = data.key
-        conn_id = data.conn_id
+    if (
+        type(container) is not list or
+        (start is not None and type(start) is not int) or
+        (stop is not None and type(stop) is not int)
+    ):
+        raise TypeError
 
-        # Actually, we have done all necessary verifications before invoking
+    return container[start:stop]
+
+
+def incr_number(number, amount, negative=False):
+    ''' add the amount to a number
+
+    Shared by the SharedMemoryManager worker and the MMapBackend.
+    INT containers only accept integer amounts, so they will not be
+    turned into floats.
+
+    :param negative: subtract the amount instead
+    :return: the new number
+    '''
+
+    if (
+        type(number) not in (int, float) or
+        type(amount) not in (int, float) or
+        (type(number) is int and type(amount) is not int)
+    ):
+        raise TypeError
+
+    return number - amount if negative else number + amount
+
+
+def incr_dict_entry(container, value_key, amount):
+    ''' add the amount to a number in a dict container
+
+    Missing entries are treated as 0.
+
+    :return: the new number
+    '''
+
+    if type(container) is not dict:
+        raise TypeError
+
+    value_key = dict_key_2_str(value_key)
+    number = incr_number(container.get(value_key, 0), amount)
+    container[value_key] = number
+    return number
+
+
+def is_same_value(a, b):
+    ''' compare values in CAS, True and 1 are not the same
+    '''
+
+    if isinstance(b, ObjectifiedDict):
+        b = b.__to_dict__()
+    return type(a) is type(b) and a == b
+
+
+def cas_container(container, expected, value, value_key=None):
+    ''' compare-and-swap a single-value container or an entry of a dict
+
+    Shared by the SharedMemoryManager worker and the MMapBackend.
+
+    :param value_key: the key of the entry if the container is a dict,
+                      missing entries are compared as None
+    :return: (container, swapped), the container shall be stored back
+    '''
+
+    if isinstance(value, ObjectifiedDict):
+        value = value.__to_dict__()
+
+    if value_key is None:
+        if type(container) in (set, list, dict):
+            raise TypeError
+
+        if is_same_value(container, expected):
+            return value, True
+        return container, False
+
+    if type(container) is not dict:
+        raise TypeError
+
+    value_key = dict_key_2_str(value_key)
+    if is_same_value(container.get(value_key), expected):
+        container[value_key] = value
+        return container, True
+    return container, False
+
+
+def is_valid_ttl(ttl):
+    return type(ttl) in (int, float) and ttl > 0
+
+
+def get_compatible_value(value):
+    ''' make the value type become compatible with json
+
+    currently, we just need to convert set type into lists
+    '''
+
+    if isinstance(value, set):
+        return list(value)
+    else:
+        return value
+
+
+class Connection(ObjectifiedDict):
+
+    ''' The connections class for SharedMemoryManager
+    '''
+
+
+class SHMRequest(ObjectifiedDict):
+
+    ''' Requests received by the SharedMemoryManager worker
+
+    Values in requests will be stored into containers as they are, so we
+    shall not convert them into ObjectifiedDicts. And the binary encoding
+    allows dict keys that are not strings, they cannot be converted either.
+    '''
+
+    def __convert__(self, item):
+        return item
+
+
+class SHMBackends(metaclass=MetaEnum):
+
+    # all containers are kept in the SharedMemoryManager worker
+    WORKER = 'worker'
+
+    # hot containers are kept in the mmap region, see shmmmap
+    MMAP = 'mmap'
+
+
+class MMapBackend():
+
+    ''' The client side backend that accesses containers in the mmap region
+
+    It implements the same semantics as the SharedMemoryManager worker for
+    keys that belong to it, and it responds in the same format as the worker.
+
+    Differences with the worker:
+        Readings never block and are never blocked by a lock, they return the
+        last committed version of the container. Writings and LOCK requests
+        from other processes are still blocked by the lock.
+
+        A lock acquired on a key that doesn't exist yet will lock the whole
+        table of the region, so other processes cannot create keys until it's
+        released.
+
+        Locks are owned by the backend, so another connection in the same
+        process gets LOCKED instead of waiting for the lock.
+    '''
+
+    def __init__(self, region, key_prefixes=None):
+        self.region = region
+
+        if key_prefixes is None:
+            key_prefixes = DEFAULT_MMAP_KEY_PREFIXES
+        self.key_prefixes = tuple(key_prefixes)
+
+        # locks acquired by LOCK requests, {key: offset}
+        self.key_locks = {}
+
+    def owns(self, key):
+        return isinstance(key, str) and key.startswith(self.key_prefixes)
+
+    def _resp(self, succeeded, value=None, rcode=None):
+        if rcode is None:
+            rcode = ReturnCodes.OK if succeeded else ReturnCodes.UNKNOWN_ERROR
+
+        return {
+            'succeeded': succeeded,
+            'value': value,
+            'rcode': rcode,
+        }
+
+    def _acquire(self, offset, backlogging):
+        self.region.acquire(
+            offset,
+            blocking=backlogging,
+            timeout=SHM_MAX_BLOCKING_TIME,
+            owner=self,
+        )
+
+    def _release(self, offset):
+        self.region.release(offset, owner=self)
+
+    def handle(self, request):
+        ''' handle a request in the mmap region
+
+        :param request: the request arguments, same as the SHM protocol
+        :return: the response dict
+        '''
+
+        action = request.get('action')
+        key = request.get('key')
+        bkey = key.encode()
+
+        backlogging = request.get('backlogging')
+        backlogging = True if backlogging is None else backlogging
+
+        if request.get('ttl') is not None:
+            return self._resp(False, rcode=ReturnCodes.NOT_ALLOWED)
+
+        try:
+            if action == Actions.READ:
+                return self.handle_read(bkey)
+            if action == Actions.DICT_GET:
+                return self.handle_dict_get(bkey, request.get('value_key'))
+            if action == Actions.SCAN:
+                return self.handle_partial_read(
+                    bkey,
+                    scan_container,
+                    request.get('cursor'),
+                    request.get('count'),
+                )
+            if action == Actions.SLICE:
+                return self.handle_partial_read(
+                    bkey,
+                    slice_container,
+                    request.get('start'),
+                    request.get('stop'),
+                )
+            if action == Actions.LOCK:
+                return self.handle_lock(key, bkey, backlogging)
+            if action == Actions.UNLOCK:
+                return self.handle_unlock(key, bkey, backlogging)
+            if action == Actions.CREATE:
+                return self.handle_create(
+                    bkey, request.get('type'), request.get('value'), backlogging,
+                )
+            if action == Actions.CLEAN:
+                return self.handle_clean(bkey, backlogging)
+
+            return self.handle_modification(bkey, request, backlogging)
+        except LockBusy:
+            return self._resp(False, rcode=ReturnCodes.LOCKED)
+        except (SlotFull, TableFull, KeyTooLong):
+            return self._resp(False, rcode=ReturnCodes.OUT_OF_SPACE)
+        except TypeError:
+            return self._resp(False, rcode=ReturnCodes.TYPE_ERROR)
+
+    def handle_read(self, bkey):
+        offset = self.region.find(bkey)
+        type_, value = (None, None) if offset is None else \
+                       self.region.read(offset, bkey)
+
+        if type_ is None:
+            return self._resp(False, rcode=ReturnCodes.KEY_ERROR)
+
+        return self._resp(True, get_compatible_value(value))
+
+    def handle_dict_get(self, bkey, value_key):
+        resp = self.handle_read(bkey)
+        if not resp.get('succeeded'):
+            return resp
+
+        container = resp.get('value')
+        if not isinstance(container, dict):
+            return self._resp(False, rcode=ReturnCodes.TYPE_ERROR)
+
+        return self._resp(True, container.get(dict_key_2_str(value_key)))
+
+    def handle_partial_read(self, bkey, func, *args):
+        offset = self.region.find(bkey)
+        if offset is None:
+            return self._resp(False, rcode=ReturnCodes.KEY_ERROR)
+
+        type_, container = self.region.read(offset, bkey)
+        if type_ is None:
+            return self._resp(False, rcode=ReturnCodes.KEY_ERROR)
+
+        return self._resp(True, func(container, *args))
+
+    def handle_lock(self, key, bkey, backlogging):
+        offset = self.region.find(bkey)
+        offset = 0 if offset is None else offset
+
+        if self.key_locks.get(key) == offset:
+            return self._resp(True)
+
+        self._acquire(offset, backlogging)
+        self.key_locks[key] = offset
+        return self._resp(True)
+
+    def handle_unlock(self, key, bkey, backlogging):
+        offset = self.key_locks.pop(key, None)
+
+        if offset is not None:
+            self._release(offset)
+            return self._resp(True)
+
+        # We don't hold the lock. If another process holds it, then we shall
+        # wait for it as the worker does.
+        offset = self.region.find(bkey)
+        offset = 0 if offset is None else offset
+
+        self._acquire(offset, backlogging)
+        self._release(offset)
+        return self._resp(True, rcode=ReturnCodes.NOT_LOCKED)
+
+    def handle_create(self, bkey, type_, value, backlogging):
+        compatible_type = COMPATIBLE_TYPE_MAPPING.get(type_)
+
+        if type_ not in SHMContainerTypes or (
+            value is not None and not isinstance(value, compatible_type)
+        ):
+            return self._resp(False, rcode=ReturnCodes.TYPE_ERROR)
+
+        container = PY_TYPE_MAPPING.get(type_)()
+        if value is not None:
+            if type_ <= SHMContainerTypes.BOOL:
+                container = value
+            else:
+                add_values_2_container(container, value)
+
+        self._acquire(0, backlogging)
+        try:
+            if self.region.find(bkey) is not None:
+                return self._resp(False, rcode=ReturnCodes.KEY_CONFLICT)
+
+            self.region.insert(bkey, type_, pack_value(container))
+        finally:
+            self._release(0)
+
+        return self._resp(True)
+
+    def handle_clean(self, bkey, backlogging):
+        self._acquire(0, backlogging)
+        try:
+            offset = self.region.find(bkey)
+            if offset is None:
+                return self._resp(False, rcode=ReturnCodes.KEY_ERROR)
+
+            self._acquire(offset, backlogging)
+            try:
+                self.region.remove(offset)
+            finally:
+                self._release(offset)
+        finally:
+            self._release(0)
+
+        return self._resp(True)
+
+    def handle_modification(self, bkey, request, backlogging):
+        ''' handle SET, ADD, DICT_UPDATE, REMOVE, INCR, DECR, DICT_INCR and CAS
+
+        All of them are read-modify-write operations under the slot lock.
+        '''
+
+        action = request.get('action')
+        value = request.get('value')
+        result = None
+
+        offset = self.region.find(bkey)
+        if offset is None:
+            return self._resp(False, rcode=ReturnCodes.KEY_ERROR)
+
+        self._acquire(offset, backlogging)
+        try:
+            type_, container = self.region.read(offset, bkey)
+            if type_ is None:
+                return self._resp(False, rcode=ReturnCodes.KEY_ERROR)
+
+            if action == Actions.SET:
+                if type_ > SHMContainerTypes.BOOL:
+                    return self._resp(False, rcode=ReturnCodes.TYPE_ERROR)
+                container = value
+            elif action == Actions.ADD:
+                add_values_2_container(container, value)
+            elif action == Actions.REMOVE:
+                remove_values_from_container(container, value)
+            elif action == Actions.DICT_UPDATE:
+                if not isinstance(container, dict):
+                    return self._resp(False, rcode=ReturnCodes.TYPE_ERROR)
+
+                if isinstance(value, ObjectifiedDict):
+                    value = value.__to_dict__()
+
+                value_key = dict_key_2_str(request.get('value_key'))
+                container[value_key] = value
+            elif action in (Actions.INCR, Actions.DECR):
+                container = incr_number(
+                    container,
+                    1 if value is None else value,
+                    negative=action == Actions.DECR,
+                )
+                result = container
+            elif action == Actions.DICT_INCR:
+                result = incr_dict_entry(
+                    container,
+                    request.get('value_key'),
+                    1 if value is None else value,
+                )
+            elif action == Actions.CAS:
+                value_key = request.get('value_key')
+                container, swapped = cas_container(
+                    container, request.get('expected'), value, value_key,
+                )
+                result = {
+                    'swapped': swapped,
+                    'value': container if value_key is None else
+                             container.get(dict_key_2_str(value_key)),
+                }
+
+                if not swapped:
+                    return self._resp(True, result)
+            else:
+                return self._resp(False)
+
+            self.region.write(offset, type_, pack_value(container))
+        finally:
+            self._release(offset)
+
+        return self._resp(True, result)
+
+    def release_all(self):
+        ''' release all locks acquired by LOCK requests
+        '''
+
+        for offset in self.key_locks.values():
+            self._release(offset)
+        self.key_locks.clear()
+
+
+class SharedMemoryManager():
+
+    EV_MASK = select.EPOLLIN
+
+    def __init__(self, config, sensitive=True):
+        ''' Constructor
+
+        :param config: the config
+        :param sensitive: The sensitive mode will make the client become
+                          sensitive, it will raise an SHMRequestFailed
+                          exception with a return code in exception.args[0]
+                          when the request is not successful.
+        '''
+
+        self.sensitive = sensitive
+        self.config = config
+        self.socket_dir = config.shm.socket_dir
+
+        ## the current connection between the SharedMemoryManager worker
+        self.current_connection = None
+
+        # Connections to each shard, the current_connection is the
+        # connection to the first shard. They share the same socket.
+        self.shard_connections = []
+
+        # amount of worker processes which serve partitions of the key space
+        self.shard_amount = config.shm.shard_amount or 1
+        self.worker_socket_paths = [
+            os.path.join(
+                self.socket_dir,
+                get_shard_socket_name(self.config.shm.manager_socket_name, idx),
+            ) for idx in range(self.shard_amount)
+        ]
+
+        ## attributes below are for the SharedMemoryManager worker
+        self.shard_idx = 0
+        self.worker_socket_path = self.worker_socket_paths[0]
+
+        self.__running = False
+
+        # the resource container, all shared memories will be stored in it
+        self.resources = {}
+
+        # locks have been acquired by the client side
+        # structure: {resources.key: connection_id}
+        self.locks = {}
+
+        # connection container, all established connections will be stored in it
+        # structure: {connection_id: Connection}
+        self.connections = {}
+
+        # Because of the lock mechanism, some of requests can not be handled
+        # promptly, so they will be backlogged and will be handled later.
+        #
+        # structure: {serial_number, data}
+        self.backlogged_requests = {}
+
+        # serial number counter for backlogged_requests
+        self.backlog_sn = 0
+
+        # Backlogged requests waiting for locked keys, in FIFO order.
+        #
+        # structure: {key: deque([(serial_number, backlogged_time)])}
+        self.wait_queues = {}
+
+        # Backlogged requests that have been woken and will be handled right
+        # after the current request.
+        #
+        # structure: deque([(key, serial_number, backlogged_time)])
+        self.woken_requests = deque()
+
+        # lock waiting statistics
+        # structure: {key: {'waits': int, 'total_wait': float, 'max_wait': float}}
+        self.lock_wait_stats = {}
+
+        # Expiring time of containers and dict entries.
+        #
+        # structure: {key: timestamp}
+        self.key_expiry = {}
+        # structure: {key: {dict_key: timestamp}}
+        self.entry_expiry = {}
+
+        # Min-heap of expiring time, items are removed lazily, an item is
+        # valid only if it's same with the record in key_expiry or
+        # entry_expiry.
+        #
+        # structure: [(timestamp, seq, key, dict_key or None)]
+        self.expiry_heap = []
+        self.expiry_seq = 0
+
+        self.expired_keys_count = 0
+        self.expired_entries_count = 0
+
+        # Connections that subscribed keys. The flag tells if the
+        # subscriber shall be notified on the next change.
+        #
+        # structure: {key: {connection_id: bool}}
+        self.subscriptions = {}
+
+        # Keys changed by the atomic batch in progress, subscribers are
+        # notified only after the batch is committed, so they never see
+        # changes that are rolled back. None if no atomic batch is running.
+        self.deferred_notifications = None
+
+        ## attributes below are for the client side read cache
+        # keys subscribed by the current client
+        self.subscribed_keys = set()
+
+        # local copies of subscribed containers, {key: value}
+        self.read_cache = {}
+
+        # socket to receive notifications, created on the first subscribing
+        self.notify_socket = None
+        self.notify_socket_name = None
+
+        # The backend of containers, enumerated in SHMBackends.
+        #
+        # With the mmap backend, the worker creates the mmap region and
+        # clients access keys which belong to the region directly.
+        self.backend = config.shm.backend or SHMBackends.WORKER
+        self.mmap_path = config.shm.mmap_path or os.path.join(
+                             self.socket_dir, 'shm.mmap'
+                         )
+        self.mmap_backend = None
+
+        # The persistence of containers, it's only enabled in the worker
+        # if config.shm.snapshot_dir is given.
+        self.persister = None
+
+        # Hot keys would be lost silently on restarts, they are routed to
+        # the mmap region which is not persistent.
+        if (
+            self.backend == SHMBackends.MMAP and
+            config.shm.snapshot_dir is not None
+        ):
+            raise ConfigError(
+                'shm.snapshot_dir cannot be used with the mmap backend, '
+                'containers in the mmap region are not persistent'
+            )
+
+    def _create_socket(self, socket_path=None, blocking=False):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(blocking)
+        try:
+            if socket_path is not None:
+                logger.debug(
+                    f'created socket and tring to bind on {socket_path}'
+                )
+                sock.bind(socket_path)
+        except OSError as err:
+            if err.errno == 98:
+                raise AddressAlreadyInUse(
+                    f'{socket_path} is already in use, cannot bind on it'
+                )
+            else:
+                raise err
+
+        return sock
+
+    def gen_conn_id(self):
+        return gen_uuid()
+
+    def gen_backlog_sn(self):
+        self.backlog_sn += 1
+        return self.backlog_sn
+
+    def get_compatible_value(self, key):
+        ''' make the value type become compatible with json
+        '''
+
+        return get_compatible_value(self.resources.get(key))
+
+    def _add_value_2_container(self, key, values):
+        add_values_2_container(self.resources[key], values)
+
+    def _remove_value_from_container(self, key, *values):
+        ''' remove values from a container
+
+        :param values: multipurpose parameter, when the type is dict, it will
+                       be the key of dict, otherwise, it will be the value of
+                       set and list
+        '''
+
+        remove_values_from_container(self.resources[key], values)
+
+    def _save_connection(self, conn_id, conn):
+        self.connections.update(
+            {conn_id: conn}
+        )
+
+    def _remove_connection(self, conn_id):
+        self.connections.pop(conn_id, None)
+
+        # locks held by a closed connection will never be released,
+        # so we release them here and wake requests waiting for them
+        keys = [key for key, cid in self.locks.items() if cid == conn_id]
+        for key in keys:
+            self.locks.pop(key)
+            self.wake_waiter(key)
+
+            logger.debug(f'released lock <{key}> of closed connection')
+
+        for key in list(self.subscriptions):
+            self._remove_subscriber(key, conn_id)
+
+    def _gen_response_json(self, conn_id, succeeded, value=None, rcode=None):
+        if rcode is None:
+            rcode = ReturnCodes.OK if succeeded else ReturnCodes.UNKNOWN_ERROR
+
+        return {
+            'conn_id': conn_id,
+            'data': {
+                'succeeded': succeeded,
+                'value': value,
+                'rcode': rcode,
+            }
+        }
+
+    def handle_connect(self, data):
+        resp_sock_path = os.path.join(self.socket_dir, data.socket)
+        conn_id = self.gen_conn_id()
+        sock = self._create_socket()
+        encoding = self.negotiate_encoding(data.encodings)
+        conn = Connection(
+                   conn_id=conn_id,
+                   socket=sock,
+                   resp_socket=resp_sock_path,
+                   encoding=encoding,
+               )
+
+        self._save_connection(conn_id, conn)
+
+        # The response of CONNECT is always in JSON, the client
+        # doesn't know the encoding until it receives this response.
+        return {
+            'conn_id': conn_id,
+            'encoding': SHMEncodings.JSON,
+            'data': {
+                'succeeded': True,
+                'conn_id': conn_id,
+                'encoding': encoding,
+                'value': None,
+                'rcode': ReturnCodes.OK,
+            }
+        }
+
+    def negotiate_encoding(self, encodings):
+        ''' pick up the first supported encoding from the client's preference
+
+        :param encodings: encodings offered by the client, list or None
+        :return: the encoding, enumerated in SHMEncodings
+        '''
+
+        for encoding in encodings or []:
+            if encoding in CODECS:
+                return encoding
+
+        return SHMEncodings.JSON
+
+    def handle_disconnect(self, data):
+        self._remove_connection(data.conn_id)
+        return None
+
+    def handle_lock(self, data):
+        key = data.key
+        conn_id = data.conn_id
+
+        # Actually, we have done all necessary verifications before invoking
         # this method. And we don't need to verify if the key exists, because
         # pre-locking is allowed.
         self.locks.update(
@@ -540,8 +1558,111 @@ class SharedMemoryManager():
             )
 
         self.locks.pop(key)
+        self.wake_waiter(key)
         return self._gen_response_json(conn_id=conn_id, succeeded=True)
 
+    def handle_lock_stats(self, data):
+        if data.key is None:
+            keys = set(self.lock_wait_stats) | set(self.wait_queues)
+        else:
+            keys = [data.key]
+
+        stats = {}
+        for key in keys:
+            stat = dict(
+                self.lock_wait_stats.get(key) or
+                {'waits': 0, 'total_wait': 0.0, 'max_wait': 0.0}
+            )
+            stat.update(waiting=len(self.wait_queues.get(key) or []))
+            stats.update({key: stat})
+
+        return self._gen_response_json(
+            conn_id=data.conn_id,
+            succeeded=True,
+            value=stats,
+        )
+
+    def handle_subscribe(self, data):
+        key = data.key
+        conn_id = data.conn_id
+        conn = self.connections.get(conn_id)
+
+        if conn is None:
+            return None
+
+        if not isinstance(data.socket, str):
+            return self._gen_response_json(
+                conn_id=conn_id,
+                succeeded=False,
+                rcode=ReturnCodes.TYPE_ERROR,
+            )
+
+        conn.__update__(
+            notify_socket=os.path.join(self.socket_dir, data.socket)
+        )
+        self.subscriptions.setdefault(key, {}).update(
+            {conn_id: True}
+        )
+        return self._gen_response_json(conn_id=conn_id, succeeded=True)
+
+    def handle_unsubscribe(self, data):
+        self._remove_subscriber(data.key, data.conn_id)
+        return self._gen_response_json(conn_id=data.conn_id, succeeded=True)
+
+    def _remove_subscriber(self, key, conn_id):
+        subscribers = self.subscriptions.get(key)
+        if subscribers is None:
+            return
+
+        subscribers.pop(conn_id, None)
+        if len(subscribers) == 0:
+            self.subscriptions.pop(key)
+
+    def notify_subscribers(self, key):
+        ''' send notifications to subscribers of the key
+
+        The writer itself is also notified, so the read cache of the writer
+        is invalidated even if the change is made by a batch.
+        '''
+
+        subscribers = self.subscriptions.get(key)
+
+        for conn_id, armed in list(subscribers.items()):
+            if not armed:
+                continue
+
+            conn = self.connections.get(conn_id)
+            if conn is None:
+                self._remove_subscriber(key, conn_id)
+                continue
+
+            codec = CODECS.get(conn.encoding, JSONCodec)
+            data = codec.encode_response(
+                {
+                    'succeeded': True,
+                    'value': key,
+                    'rcode': ReturnCodes.OK,
+                }
+            )
+
+            try:
+                conn.socket.sendto(data, conn.notify_socket)
+                subscribers[conn_id] = False
+            except (ConnectionRefusedError, FileNotFoundError):
+                logger.warn(
+                    f'Socket <{conn.notify_socket}> closed when sending '
+                    f'notifications, subscription removed'
+                )
+                self._remove_subscriber(key, conn_id)
+            except BlockingIOError:
+                # Keep the flag, so we will try again on the next change.
+                # It should be rare, at most one notification of each key
+                # is pending on the socket.
+                logger.error(
+                    f'Socket <{conn.notify_socket}> is full, '
+                    f'failed to notify the change of {key}'
+                )
+
     def handle_create(self, data):
         key = data.key
         conn_id = data.conn_id
@@ -584,9 +1705,109 @@ class SharedMemoryManager():
 
         return self._gen_response_json(conn_id=conn_id, succeeded=True)
 
-    def handle_read(self, data):
-        conn_id = data.conn_id
+    def handle_read(self, data):
+        conn_id = data.conn_id
+        key = data.key
+
+        if key not in self.resources:
+            return self._gen_response_json(
+                conn_id=conn_id,
+                succeeded=False,
+                rcode=ReturnCodes.KEY_ERROR,
+            )
+
+        return self._gen_response_json(
+            conn_id=conn_id,
+            succeeded=True,
+            value=self.get_compatible_value(key),
+        )
+
+    def handle_scan(self, data):
+        return self._handle_partial_read(
+            data, scan_container, data.cursor, data.count,
+        )
+
+    def handle_slice(self, data):
+        return self._handle_partial_read(
+            data, slice_container, data.start, data.stop,
+        )
+
+    def _handle_partial_read(self, data, func, *args):
+        key = data.key
+        conn_id = data.conn_id
+
+        if key not in self.resources:
+            return self._gen_response_json(
+                conn_id=conn_id,
+                succeeded=False,
+                rcode=ReturnCodes.KEY_ERROR,
+            )
+
+        try:
+            value = func(self.resources[key], *args)
+        except TypeError:
+            return self._gen_response_json(
+                conn_id=conn_id,
+                succeeded=False,
+                rcode=ReturnCodes.TYPE_ERROR,
+            )
+
+        return self._gen_response_json(
+            conn_id=conn_id,
+            succeeded=True,
+            value=value,
+        )
+
+    def handle_set(self, data):
+        key = data.key
+        value = data.value
+        conn_id = data.conn_id
+
+        if key not in self.resources:
+            return self._gen_response_json(
+                conn_id=conn_id,
+                succeeded=False,
+                rcode=ReturnCodes.KEY_ERROR,
+            )
+
+        if type(self.resources.get(key)) not in (int, float, bool, str):
+            return self._gen_response_json(
+                conn_id=conn_id,
+                succeeded=False,
+                rcode=ReturnCodes.TYPE_ERROR,
+            )
+        else:
+            self.resources[key] = value
+            return self._gen_response_json(conn_id=conn_id, succeeded=True)
+
+    def handle_add(self, data):
+        key = data.key
+        value = data.value
+        conn_id = data.conn_id
+
+        if key not in self.resources:
+            return self._gen_response_json(
+                conn_id=conn_id,
+                succeeded=False,
+                rcode=ReturnCodes.KEY_ERROR,
+            )
+
+        try:
+            self._add_value_2_container(key, value)
+            return self._gen_response_json(conn_id=conn_id, succeeded=True)
+        except TypeError:
+            return self._gen_response_json(
+                conn_id=conn_id,
+                succeeded=False,
+                rcode=ReturnCodes.TYPE_ERROR,
+            )
+        except ValueError:
+            return self._gen_response_json(conn_id=conn_id, succeeded=False)
+
+    def handle_dict_get(self, data):
         key = data.key
+        value_key = data.value_key
+        conn_id = data.conn_id
 
         if key not in self.resources:
             return self._gen_response_json(
@@ -595,14 +1816,23 @@ class SharedMemoryManager():
                 rcode=ReturnCodes.KEY_ERROR,
             )
 
+        container = self.get_compatible_value(key)
+        if not isinstance(container, dict):
+            return self._gen_response_json(
+                conn_id=conn_id,
+                succeeded=False,
+                rcode=ReturnCodes.TYPE_ERROR,
+            )
+
         return self._gen_response_json(
             conn_id=conn_id,
             succeeded=True,
-            value=self.get_compatible_value(key),
+            value=container.get(value_key),
         )
 
-    def handle_set(self, data):
+    def handle_dict_update(self, data):
         key = data.key
+        value_key = data.value_key
         value = data.value
         conn_id = data.conn_id
 
@@ -613,20 +1843,29 @@ class SharedMemoryManager():
                 rcode=ReturnCodes.KEY_ERROR,
             )
 
-        if type(self.resources.get(key)) not in (int, float, bool, str):
+        container = self.resources.get(key)
+        if not isinstance(container, dict):
             return self._gen_response_json(
                 conn_id=conn_id,
                 succeeded=False,
                 rcode=ReturnCodes.TYPE_ERROR,
             )
-        else:
-            self.resources[key] = value
-            return self._gen_response_json(conn_id=conn_id, succeeded=True)
 
-    def handle_add(self, data):
+        if isinstance(value, ObjectifiedDict):
+            value = value.__to_dict__()
+
+        container.update(
+            {dict_key_2_str(value_key): value}
+        )
+        return self._gen_response_json(
+            conn_id=conn_id,
+            succeeded=True,
+        )
+
+    def handle_incr(self, data):
         key = data.key
-        value = data.value
         conn_id = data.conn_id
+        amount = 1 if data.value is None else data.value
 
         if key not in self.resources:
             return self._gen_response_json(
@@ -636,21 +1875,29 @@ class SharedMemoryManager():
             )
 
         try:
-            self._add_value_2_container(key, value)
-            return self._gen_response_json(conn_id=conn_id, succeeded=True)
+            number = incr_number(
+                self.resources.get(key),
+                amount,
+                negative=data.action == Actions.DECR,
+            )
         except TypeError:
             return self._gen_response_json(
                 conn_id=conn_id,
                 succeeded=False,
                 rcode=ReturnCodes.TYPE_ERROR,
             )
-        except ValueError:
-            return self._gen_response_json(conn_id=conn_id, succeeded=False)
 
-    def handle_dict_get(self, data):
+        self.resources[key] = number
+        return self._gen_response_json(
+            conn_id=conn_id,
+            succeeded=True,
+            value=number,
+        )
+
+    def handle_dict_incr(self, data):
         key = data.key
-        value_key = data.value_key
         conn_id = data.conn_id
+        amount = 1 if data.value is None else data.value
 
         if key not in self.resources:
             return self._gen_response_json(
@@ -659,8 +1906,11 @@ class SharedMemoryManager():
                 rcode=ReturnCodes.KEY_ERROR,
             )
 
-        container = self.get_compatible_value(key)
-        if not isinstance(container, dict):
+        try:
+            number = incr_dict_entry(
+                self.resources.get(key), data.value_key, amount,
+            )
+        except TypeError:
             return self._gen_response_json(
                 conn_id=conn_id,
                 succeeded=False,
@@ -670,13 +1920,12 @@ class SharedMemoryManager():
         return self._gen_response_json(
             conn_id=conn_id,
             succeeded=True,
-            value=container.get(value_key),
+            value=number,
         )
 
-    def handle_dict_update(self, data):
+    def handle_cas(self, data):
         key = data.key
         value_key = data.value_key
-        value = data.value
         conn_id = data.conn_id
 
         if key not in self.resources:
@@ -686,30 +1935,28 @@ class SharedMemoryManager():
                 rcode=ReturnCodes.KEY_ERROR,
             )
 
-        container = self.get_compatible_value(key)
-        if not isinstance(container, dict):
+        try:
+            container, swapped = cas_container(
+                self.resources.get(key), data.expected, data.value, value_key,
+            )
+        except TypeError:
             return self._gen_response_json(
                 conn_id=conn_id,
                 succeeded=False,
                 rcode=ReturnCodes.TYPE_ERROR,
             )
 
-        if value_key not in self.resources:
-            return self._gen_response_json(
-                conn_id=conn_id,
-                succeeded=False,
-                rcode=ReturnCodes.KEY_ERROR,
-            )
+        self.resources[key] = container
 
-        if isinstance(value, ObjectifiedDict):
-            value = value.__to_dict__()
+        if value_key is None:
+            current = container
+        else:
+            current = container.get(dict_key_2_str(value_key))
 
-        self.resources[value_key].update(
-            {value_key: value}
-        )
         return self._gen_response_json(
             conn_id=conn_id,
             succeeded=True,
+            value={'swapped': swapped, 'value': current},
         )
 
     def handle_clean(self, data):
@@ -749,6 +1996,11 @@ class SharedMemoryManager():
         then we raise a SHMContainerLocked error here
         '''
 
+        if data.action == Actions.BATCH:
+            for sub_request in self._get_sub_requests(data):
+                self.prehandle_lock(sub_request)
+            return
+
         if not data.action in ACTIONS_2_HANDLE_LOCK:
             return
 
@@ -757,7 +2009,8 @@ class SharedMemoryManager():
         if conn_id is None:
             return
         elif conn_id != data.conn_id:
-            raise SHMContainerLocked
+            # the locked key will be passed to the wait queue
+            raise SHMContainerLocked(data.key)
 
     def handle_request(self, data, data_parsed=False, backlogging=None):
         ''' handle the request
@@ -766,22 +2019,20 @@ class SharedMemoryManager():
         :param data_parsed: Tell the method if the data has been parsed.
                             If it has not been parsed then the data shall
                             be bytes. If it has been parsed, then the data
-                            shall be an ObjectifiedDict
+                            shall be an SHMRequest
 
         :param backlogging: To override the backlogging option in the data.
         '''
 
         if not data_parsed:
             try:
-                data = json.loads(data.decode('utf-8'))
-                if not isinstance(data, dict):
-                    raise ValueError
-            except (UnicodeDecodeError, ValueError):
+                data = detect_codec(data).decode_request(data)
+            except ValueError:
                 # If this was the packet which we sent, then it could not
                 # cause any of these errors, so we can simply ignore it.
                 raise DropPacket
 
-            data = ObjectifiedDict(**data)
+            data = SHMRequest(**data)
 
         if not data.action in Actions:
             # same as above
@@ -793,12 +2044,15 @@ class SharedMemoryManager():
 
         try:
             self.prehandle_lock(data)
-        except SHMContainerLocked:
+        except SHMContainerLocked as e:
             if backlogging:
                 sn = self.gen_backlog_sn()
                 self.backlogged_requests.update(
                     {sn: data}
                 )
+                self.wait_queues.setdefault(e.args[0], deque()).append(
+                    (sn, time.time())
+                )
                 backlog_count = len(self.backlogged_requests)
                 logger.debug(
                     f'request backlogged, current: {backlog_count}'
@@ -811,10 +2065,324 @@ class SharedMemoryManager():
                     rcode=ReturnCodes.LOCKED,
                 )
 
+        return self.dispatch(data)
+
+    def dispatch(self, data):
+        ''' invoke the handler of the action and notify subscribers
+
+        :param data: the parsed request, SHMRequest
+        :return: information of the response, see handle_responding
+        '''
+
+        if data.ttl is not None and not self._verify_ttl(data):
+            return self._gen_response_json(
+                conn_id=data.conn_id,
+                succeeded=False,
+                rcode=ReturnCodes.TYPE_ERROR,
+            )
+
+        resp = self.invoke_handler(data)
+
+        if (
+            data.action in ACTIONS_2_NOTIFY and
+            resp is not None and
+            resp['data'].get('succeeded')
+        ):
+            self.update_expiry(data)
+
+            if self.persister is not None:
+                self.persist(data)
+
+        subscribers = self.subscriptions.get(data.key)
+        if subscribers is not None:
+            if data.action == Actions.READ and data.conn_id in subscribers:
+                # the subscriber gets the latest value, notify it again
+                # when the container is changed next time
+                subscribers[data.conn_id] = True
+            elif (
+                data.action in ACTIONS_2_NOTIFY and
+                resp is not None and
+                resp['data'].get('succeeded')
+            ):
+                if self.deferred_notifications is None:
+                    self.notify_subscribers(data.key)
+                else:
+                    self.deferred_notifications.add(data.key)
+
+        return resp
+
+    def _verify_ttl(self, data):
+        if data.action not in ACTIONS_WITH_TTL or not is_valid_ttl(data.ttl):
+            return False
+
+        # TTLs in ADD requests are for dict entries
+        if data.action == Actions.ADD and (
+            type(self.resources.get(data.key)) is not dict
+        ):
+            return False
+
+        return True
+
+    def update_expiry(self, data):
+        ''' update expiry records after a container is changed
+        '''
+
+        key = data.key
+        action = data.action
+
+        if action == Actions.CLEAN:
+            self.key_expiry.pop(key, None)
+            self.entry_expiry.pop(key, None)
+            return
+
+        if action == Actions.REMOVE:
+            entries = self.entry_expiry.get(key)
+            if entries is not None:
+                for dict_key in data.value or []:
+                    entries.pop(dict_key_2_str(dict_key), None)
+            return
+
+        ttl = data.ttl
+        if ttl is None:
+            self._clear_overwritten_expiry(data)
+            return
+
+        expire_at = time.time() + ttl
+
+        if action in (Actions.CREATE, Actions.SET):
+            self.key_expiry.update({key: expire_at})
+            self._push_expiry(expire_at, key, None)
+        elif action == Actions.ADD:
+            for dict_key in data.value:
+                self._set_entry_expiry(
+                    key, dict_key_2_str(dict_key), expire_at
+                )
+        elif action in (Actions.DICT_UPDATE, Actions.DICT_INCR):
+            self._set_entry_expiry(
+                key, dict_key_2_str(data.value_key), expire_at
+            )
+
+    def _clear_overwritten_expiry(self, data):
+        ''' clear TTLs of values overwritten by a request without the ttl
+
+        Heap items of cleared records become invalid and will be skipped.
+        '''
+
+        key = data.key
+        action = data.action
+
+        if action == Actions.SET:
+            self.key_expiry.pop(key, None)
+            return
+
+        entries = self.entry_expiry.get(key)
+        if entries is None:
+            return
+
+        if action == Actions.ADD:
+            dict_keys = data.value
+        elif action == Actions.DICT_UPDATE:
+            dict_keys = [data.value_key]
+        else:
+            return
+
+        for dict_key in dict_keys:
+            entries.pop(dict_key_2_str(dict_key), None)
+
+        if len(entries) == 0:
+            self.entry_expiry.pop(key, None)
+
+    def persist(self, data):
+        ''' append a changing request into the persistent log
+        '''
+
+        record = {}
+        for field in PERSISTENT_FIELDS:
+            value = data.__get__(field)
+            if value is not None:
+                record[field] = value
+
+        if data.ttl is not None:
+            record['expire_at'] = time.time() + data.ttl
+
+        self.persister.append(record)
+
+    def load_persistent_state(self, persister):
+        ''' load the snapshot and replay the log
+
+        Replayed records will not be written into the log again, so the
+        persister is enabled after they are replayed.
+        '''
+
+        state, records = persister.load()
+
+        if state is not None:
+            self.resources = state.get('resources')
+            self.key_expiry = state.get('key_expiry')
+            self.entry_expiry = state.get('entry_expiry')
+
+            for key, expire_at in self.key_expiry.items():
+                self._push_expiry(expire_at, key, None)
+
+            for key, entries in self.entry_expiry.items():
+                for dict_key, expire_at in entries.items():
+                    self._push_expiry(expire_at, key, dict_key)
+
+        now = time.time()
+        for record in records:
+            expire_at = record.pop('expire_at', None)
+            if expire_at is not None:
+                record['ttl'] = max(expire_at - now, MIN_REPLAYED_TTL)
+
+            self.dispatch(SHMRequest(**record))
+
+        persister.open()
+        self.persister = persister
+
+        # containers expired during the downtime
+        self.expire()
+
+    def take_snapshot(self):
+        self.persister.snapshot(
+            {
+                'resources': self.resources,
+                'key_expiry': self.key_expiry,
+                'entry_expiry': self.entry_expiry,
+            }
+        )
+
+    def _set_entry_expiry(self, key, dict_key, expire_at):
+        self.entry_expiry.setdefault(key, {}).update({dict_key: expire_at})
+        self._push_expiry(expire_at, key, dict_key)
+
+    def _push_expiry(self, expire_at, key, dict_key):
+        self.expiry_seq += 1
+        heapq.heappush(
+            self.expiry_heap, (expire_at, self.expiry_seq, key, dict_key)
+        )
+
+    def get_poll_timeout(self):
+        ''' the poll timeout of the worker loop, until the next expiry
+        '''
+
+        if len(self.expiry_heap) == 0:
+            return POLL_TIMEOUT
+
+        timeout = self.expiry_heap[0][0] - time.time()
+        return min(max(timeout, 0), POLL_TIMEOUT)
+
+    def expire(self):
+        ''' remove expired containers and dict entries
+        '''
+
+        heap = self.expiry_heap
+        now = time.time()
+
+        while len(heap) > 0 and heap[0][0] <= now:
+            expire_at, _, key, dict_key = heapq.heappop(heap)
+
+            if dict_key is None:
+                if self.key_expiry.get(key) != expire_at:
+                    continue
+
+                self.key_expiry.pop(key)
+                self.entry_expiry.pop(key, None)
+                self.resources.pop(key, None)
+                self.expired_keys_count += 1
+                logger.debug(f'container <{key}> expired')
+
+                # Records are replayed at once, so expirations shall be
+                # recorded to keep the order with later changes.
+                if self.persister is not None:
+                    self.persister.append({'action': Actions.CLEAN, 'key': key})
+            else:
+                entries = self.entry_expiry.get(key)
+                if entries is None or entries.get(dict_key) != expire_at:
+                    continue
+
+                entries.pop(dict_key)
+                if len(entries) == 0:
+                    self.entry_expiry.pop(key)
+
+                container = self.resources.get(key)
+                if isinstance(container, dict):
+                    container.pop(dict_key, None)
+                self.expired_entries_count += 1
+
+                if self.persister is not None:
+                    self.persister.append(
+                        {
+                            'action': Actions.REMOVE,
+                            'key': key,
+                            'value': [dict_key],
+                        }
+                    )
+
+            if key in self.subscriptions:
+                self.notify_subscribers(key)
+
+    def handle_stats(self, data):
+        key = data.key
+        conn_id = data.conn_id
+
+        if key is not None:
+            if key not in self.resources:
+                return self._gen_response_json(
+                    conn_id=conn_id,
+                    succeeded=False,
+                    rcode=ReturnCodes.KEY_ERROR,
+                )
+
+            container = self.resources[key]
+            ttl = self.key_expiry.get(key)
+            if ttl is not None:
+                ttl = max(ttl - time.time(), 0)
+
+            stats = {
+                'entries': self._count_entries(container),
+                'bytes': len(pack_value(container)),
+                'expiring_entries': len(self.entry_expiry.get(key) or {}),
+                'ttl': ttl,
+            }
+        else:
+            stats = {
+                'keys': len(self.resources),
+                'entries': sum(
+                    self._count_entries(container)
+                    for container in self.resources.values()
+                ),
+                'bytes': sum(
+                    len(pack_value(container))
+                    for container in self.resources.values()
+                ),
+                'expiring_keys': len(self.key_expiry),
+                'expiring_entries': sum(
+                    len(entries) for entries in self.entry_expiry.values()
+                ),
+                'expired_keys': self.expired_keys_count,
+                'expired_entries': self.expired_entries_count,
+            }
+
+        return self._gen_response_json(
+            conn_id=conn_id,
+            succeeded=True,
+            value=stats,
+        )
+
+    def _count_entries(self, container):
+        if type(container) in (set, list, dict):
+            return len(container)
+        return 1
+
+    def invoke_handler(self, data):
         if data.action == Actions.CREATE:
             return self.handle_create(data)
         if data.action == Actions.READ:
             return self.handle_read(data)
+        if data.action == Actions.SCAN:
+            return self.handle_scan(data)
+        if data.action == Actions.SLICE:
+            return self.handle_slice(data)
         if data.action == Actions.SET:
             return self.handle_set(data)
         if data.action == Actions.ADD:
@@ -823,6 +2391,12 @@ class SharedMemoryManager():
             return self.handle_dict_get(data)
         if data.action == Actions.DICT_UPDATE:
             return self.handle_dict_update(data)
+        if data.action in (Actions.INCR, Actions.DECR):
+            return self.handle_incr(data)
+        if data.action == Actions.DICT_INCR:
+            return self.handle_dict_incr(data)
+        if data.action == Actions.CAS:
+            return self.handle_cas(data)
         if data.action == Actions.CLEAN:
             return self.handle_clean(data)
         if data.action == Actions.REMOVE:
@@ -835,30 +2409,226 @@ class SharedMemoryManager():
             return self.handle_connect(data)
         if data.action == Actions.DISCONNECT:
             return self.handle_disconnect(data)
+        if data.action == Actions.BATCH:
+            return self.handle_batch(data)
+        if data.action == Actions.LOCK_STATS:
+            return self.handle_lock_stats(data)
+        if data.action == Actions.STATS:
+            return self.handle_stats(data)
+        if data.action == Actions.SUBSCRIBE:
+            return self.handle_subscribe(data)
+        if data.action == Actions.UNSUBSCRIBE:
+            return self.handle_unsubscribe(data)
+
+    def _get_sub_requests(self, data):
+        ''' get parsed requests in a BATCH request
+        '''
 
-    def handle_backlogged_request(self, bl_sn, data):
-        ''' handle the backlogged request
+        if data.sub_requests is None:
+            sub_requests = []
 
-        :param bl_sn: serial number of backlogged request
-        :param data: data of the request
+            for request in data.requests or []:
+                if not isinstance(request, dict):
+                    raise DropPacket
+
+                sub_request = SHMRequest(**request)
+                sub_request.__update__(conn_id=data.conn_id)
+                sub_requests.append(sub_request)
+
+            data.__update__(sub_requests=sub_requests)
+
+        return data.sub_requests
+
+    def handle_batch(self, data):
+        conn_id = data.conn_id
+        atomic = bool(data.atomic)
+        sub_requests = self._get_sub_requests(data)
+
+        if atomic:
+            snapshot = self._snapshot(sub_requests)
+            self.deferred_notifications = set()
+
+            if self.persister is not None:
+                persistent_mark = self.persister.mark()
+
+        results = []
+        succeeded = True
+        rcode = ReturnCodes.OK
+
+        try:
+            for sub_request in sub_requests:
+                if sub_request.action in NOT_BATCHABLE_ACTIONS or (
+                    not sub_request.action in Actions
+                ):
+                    sub_resp = {
+                        'succeeded': False,
+                        'value': None,
+                        'rcode': ReturnCodes.NOT_ALLOWED,
+                    }
+                else:
+                    sub_resp = self.dispatch(sub_request).get('data')
+
+                results.append(sub_resp)
+
+                if succeeded and not sub_resp.get('succeeded'):
+                    succeeded = False
+                    rcode = sub_resp.get('rcode')
+
+                    if atomic:
+                        self._restore(snapshot)
+
+                        if self.persister is not None:
+                            self.persister.rollback(persistent_mark)
+                        break
+        finally:
+            if atomic:
+                changed_keys = self.deferred_notifications
+                self.deferred_notifications = None
+
+        # notifications of a rolled back batch are dropped
+        if atomic and succeeded:
+            for key in changed_keys:
+                if key in self.subscriptions:
+                    self.notify_subscribers(key)
+
+        return self._gen_response_json(
+            conn_id=conn_id,
+            succeeded=succeeded,
+            value=results,
+            rcode=rcode,
+        )
+
+    def _snapshot(self, requests):
+        ''' take a snapshot of containers that will be touched by requests
+
+        :return: (containers, locks), containers are recorded with their
+                 expiry records, containers not existing are recorded as
+                 None
         '''
 
-        resp = self.handle_request(data, data_parsed=True, backlogging=False)
+        containers = {}
+        for request in requests:
+            key = request.key
+            if key not in containers:
+                containers[key] = (
+                    copy.deepcopy(self.resources.get(key)),
+                    self.key_expiry.get(key),
+                    dict(self.entry_expiry.get(key) or {}),
+                )
+
+        return containers, dict(self.locks)
 
-        rdata = resp.get('data')
-        succeeded = rdata.get('succeeded')
-        rcode = rdata.get('rcode')
+    def _restore(self, snapshot):
+        containers, locks = snapshot
 
-        if not succeeded and rcode == ReturnCodes.LOCKED:
-            raise SHMContainerLocked('Container still locked')
-        else:
+        # Heap items of the restored expiry records are still there,
+        # and items pushed by the batch become invalid.
+        for key, (container, expire_at, entries) in containers.items():
+            if container is None:
+                self.resources.pop(key, None)
+            else:
+                self.resources[key] = container
+
+            if expire_at is None:
+                self.key_expiry.pop(key, None)
+            else:
+                self.key_expiry[key] = expire_at
+
+            if len(entries) == 0:
+                self.entry_expiry.pop(key, None)
+            else:
+                self.entry_expiry[key] = entries
+
+        self.locks = locks
+
+    def wake_waiter(self, key):
+        ''' wake the first backlogged request waiting for the key
+
+        The woken request will be handled by handle_woken_requests.
+        '''
+
+        queue = self.wait_queues.get(key)
+        if queue is None:
+            return
+
+        bl_sn, backlogged_time = queue.popleft()
+        if len(queue) == 0:
+            self.wait_queues.pop(key)
+
+        self.woken_requests.append((key, bl_sn, backlogged_time))
+
+    def _record_lock_wait(self, key, wait):
+        stat = self.lock_wait_stats.get(key)
+        if stat is None:
+            stat = {'waits': 0, 'total_wait': 0.0, 'max_wait': 0.0}
+            self.lock_wait_stats.update({key: stat})
+
+        stat['waits'] += 1
+        stat['total_wait'] += wait
+        if wait > stat['max_wait']:
+            stat['max_wait'] = wait
+
+    def handle_backlogged_request(self, key, bl_sn, backlogged_time):
+        ''' handle a woken backlogged request
+
+        :param key: the key which the request was waiting for
+        :param bl_sn: serial number of backlogged request
+        :param backlogged_time: when the request was backlogged
+        :return: information of the response
+        '''
+
+        data = self.backlogged_requests.get(bl_sn)
+
+        if data is None or data.conn_id not in self.connections:
+            # the client has gone, pass the turn to the next one
             self.backlogged_requests.pop(bl_sn, None)
-            remaining_bl = len(self.backlogged_requests)
-            logger.debug(
-                f'backlogged request <{bl_sn}> processed, '
-                f'remaining: {remaining_bl}'
-            )
-            return resp
+            self.wake_waiter(key)
+            return None
+
+        try:
+            self.prehandle_lock(data)
+        except SHMContainerLocked as e:
+            # Still locked. It can be locked again before the woken request
+            # is handled, or it's a batch that is waiting for another key.
+            locked_key = e.args[0]
+            queue = self.wait_queues.setdefault(locked_key, deque())
+
+            if locked_key == key:
+                queue.appendleft((bl_sn, backlogged_time))
+            else:
+                queue.append((bl_sn, backlogged_time))
+
+            logger.debug(f'backlogged request <{bl_sn}> still locked')
+            return None
+
+        self.backlogged_requests.pop(bl_sn)
+        self._record_lock_wait(key, time.time() - backlogged_time)
+
+        resp = self.dispatch(data)
+
+        # The woken request doesn't take the lock, so the next one
+        # can also be handled.
+        if key not in self.locks:
+            self.wake_waiter(key)
+
+        remaining_bl = len(self.backlogged_requests)
+        logger.debug(
+            f'backlogged request <{bl_sn}> processed, '
+            f'remaining: {remaining_bl}'
+        )
+        return resp
+
+    def handle_woken_requests(self):
+        while len(self.woken_requests) > 0:
+            key, bl_sn, backlogged_time = self.woken_requests.popleft()
+
+            try:
+                resp = self.handle_backlogged_request(
+                    key, bl_sn, backlogged_time
+                )
+                self.handle_responding(resp)
+            except DropPacket:
+                pass
 
     def handle_responding(self, resp):
         ''' handle responding
@@ -872,22 +2642,103 @@ class SharedMemoryManager():
                                      }
         '''
 
+        # changes shall be in the log before they are responded
+        if self.persister is not None:
+            self.persister.flush()
+
         if resp is None:
             return
 
         conn_id = resp['conn_id']
         conn = self.connections.get(conn_id)
-        data = json.dumps(resp['data']).encode()
+        if conn is None:
+            return
+
+        encoding = resp.get('encoding') or conn.encoding
+        codec = CODECS.get(encoding, JSONCodec)
+
+        try:
+            data = codec.encode_response(resp['data'])
+        except (TypeError, ValueError) as e:
+            logger.error(f'Failed to encode the response: {e}')
+            data = codec.encode_response(
+                {
+                    'succeeded': False,
+                    'value': None,
+                    'rcode': ReturnCodes.TYPE_ERROR,
+                }
+            )
 
         try:
-            conn.socket.sendto(data, conn.resp_socket)
-        except ConnectionRefusedError:
+            if len(data) <= UDP_BUFFER_SIZE:
+                conn.socket.sendto(data, conn.resp_socket)
+            else:
+                self._send_fragments(conn, data)
+        except (ConnectionRefusedError, FileNotFoundError):
             logger.warn(
                 f'Socket <{conn.resp_socket}> closed when sending back response'
             )
-            self._remove_connection(conn_id)
+            self._remove_connection(conn_id)
+        except (BlockingIOError, socket.timeout):
+            logger.error(
+                f'Socket <{conn.resp_socket}> is full, '
+                f'failed to send back response'
+            )
+
+    def _send_fragments(self, conn, data):
+        ''' send a large response in fragments
+
+        The client may not be able to hold all fragments in its socket
+        buffer, so the socket becomes blocking while sending them.
+        The client is waiting for the response, it won't take long.
+        '''
+
+        fragments = split_fragments(data, UDP_BUFFER_SIZE)
+        logger.debug(f'sending a response in {len(fragments)} fragments')
+
+        conn.socket.settimeout(SHM_MAX_BLOCKING_TIME)
+        try:
+            for fragment in fragments:
+                conn.socket.sendto(fragment, conn.resp_socket)
+        finally:
+            conn.socket.setblocking(False)
+
+    def _create_mmap_region(self):
+        if self.backend != SHMBackends.MMAP:
+            return None
+
+        return MMapRegion.create(
+            self.mmap_path,
+            slot_count=self.config.shm.mmap_slot_count,
+            slot_size=self.config.shm.mmap_slot_size,
+        )
+
+    def run_as_worker(self, shard_idx=0):
+        ''' run the worker
+
+        :param shard_idx: index of the shard that the worker serves,
+                          the mmap region is created by the first shard
+        '''
+
+        self.shard_idx = shard_idx
+        self.worker_socket_path = self.worker_socket_paths[shard_idx]
+
+        if shard_idx == 0:
+            mmap_region = self._create_mmap_region()
+        else:
+            mmap_region = None
+
+        snapshot_dir = self.config.shm.snapshot_dir
+        if snapshot_dir is not None:
+            self.load_persistent_state(
+                SHMPersister(
+                    snapshot_dir,
+                    f'shm-{shard_idx}',
+                    interval=self.config.shm.snapshot_interval,
+                    max_log_size=self.config.shm.snapshot_max_log_size,
+                )
+            )
 
-    def run_as_worker(self):
         self._epoll = select.epoll()
 
         self._worker_sock = self._create_socket(self.worker_socket_path)
@@ -895,8 +2746,7 @@ class SharedMemoryManager():
 
         self.__running = True
         while self.__running:
-            pt = POLL_TIMEOUT if len(self.backlogged_requests) == 0 else 0.001
-            events = self._epoll.poll(pt)
+            events = self._epoll.poll(self.get_poll_timeout())
 
             for fd, evt in events:
                 if evt & select.EPOLLERR:
@@ -912,22 +2762,29 @@ class SharedMemoryManager():
                     except (DropPacket, SHMRequestBacklogged):
                         pass
 
-            # we will change self.backlogged_requests during the iteration
-            dup = dict(self.backlogged_requests)
+                    # Requests woken by this one shall be handled before
+                    # any new requests, so the lock is handed over in order.
+                    self.handle_woken_requests()
 
-            for bl_sn, data in dup.items():
-                try:
-                    resp = self.handle_backlogged_request(bl_sn, data)
-                    self.handle_responding(resp)
-                except SHMContainerLocked:
-                    logger.debug(
-                        f'backlogged request <{bl_sn}> still locked'
-                    )
-                except (DropPacket, SHMRequestBacklogged):
-                    pass
+            self.expire()
+
+            if self.persister is not None:
+                self.persister.flush()
+                self.persister.poll_child()
+
+                if self.persister.need_snapshot():
+                    self.take_snapshot()
+
+        if self.persister is not None:
+            self.persister.close()
 
         self._worker_sock.close()
         os.remove(self.worker_socket_path)
+
+        if mmap_region is not None:
+            mmap_region.close()
+            os.remove(self.mmap_path)
+
         logger.info('SharedMemoryManager Worker exited successfully')
 
     def shutdown_worker(self):
@@ -939,22 +2796,149 @@ class SharedMemoryManager():
             raise RuntimeError(msg)
 
     ## Methods below will be used by the client side
-    def send_request(self, **request_args):
-        conn = self.current_connection
+    def get_connection(self, key=None):
+        ''' get the connection to the shard which owns the key
+
+        :param key: the container key, None for the first shard
+        '''
+
+        conns = self.shard_connections
+        if len(conns) == 0:
+            raise SHMWorkerNotConnected(MSG_NOT_CONNECTED)
+
+        return conns[get_shard_idx(key, len(conns))]
+
+    def send_request(self, conn=None, **request_args):
+        ''' send a request to the worker
+
+        :param conn: the connection to send through,
+                     the current_connection by default
+        '''
+
+        conn = conn or self.current_connection
         if conn is None:
             raise SHMWorkerNotConnected(MSG_NOT_CONNECTED)
 
-        data = json.dumps(request_args).encode('utf-8')
+        data = conn.codec.encode_request(request_args)
         try:
-            conn.socket.sendto(data, self.worker_socket_path)
+            conn.socket.sendto(data, conn.worker_socket_path)
         except (ConnectionRefusedError, FileNotFoundError):
             err_msg = (
-                f'Connection to {self.worker_socket_path} '
+                f'Connection to {conn.worker_socket_path} '
                 f'failed, seems SHM worker is not running.'
             )
             logger.error(err_msg)
             raise SharedMemoryError(err_msg)
 
+    def request(self, **request_args):
+        ''' send a request and read the response
+
+        Requests on keys which belong to the mmap region will be
+        handled in the current process directly. Others will be sent
+        to the shard which owns the key.
+        '''
+
+        key = request_args.get('key')
+        conn = self.get_connection(key)
+
+        if key in self.subscribed_keys:
+            data = self.handle_cached_request(conn, request_args)
+            if data is not None:
+                return data
+
+        mmap_backend = self.mmap_backend
+        if mmap_backend is not None and mmap_backend.owns(key):
+            data = mmap_backend.handle(request_args)
+
+            if not data.get('succeeded') and self.sensitive:
+                raise SHMRequestFailed(data.get('rcode'))
+
+            return data
+
+        self.send_request(conn, conn_id=conn.conn_id, **request_args)
+        return self.read_response(conn.conn_id)
+
+    def handle_cached_request(self, conn, request_args):
+        ''' handle a request on a subscribed key with the read cache
+
+        READ and DICT_GET requests will be served by the local copy,
+        changes invalidate the local copy.
+
+        :return: the response, or None if the request
+                 shall be sent to the worker
+        '''
+
+        self.drain_notifications()
+
+        key = request_args.get('key')
+        action = request_args.get('action')
+
+        if action in ACTIONS_2_NOTIFY:
+            self.read_cache.pop(key, None)
+            return None
+        elif action not in (Actions.READ, Actions.DICT_GET):
+            return None
+
+        if key not in self.read_cache:
+            self.send_request(
+                conn,
+                conn_id=conn.conn_id,
+                action=Actions.READ,
+                key=key,
+                backlogging=request_args.get('backlogging'),
+            )
+            data = self.read_response(conn.conn_id)
+
+            if not data.get('succeeded'):
+                return data
+
+            self.read_cache.update(
+                {key: data.get('value')}
+            )
+
+        value = self.read_cache[key]
+
+        if action == Actions.DICT_GET:
+            if not isinstance(value, dict):
+                if self.sensitive:
+                    raise SHMRequestFailed(ReturnCodes.TYPE_ERROR)
+
+                return {
+                    'succeeded': False,
+                    'value': None,
+                    'rcode': ReturnCodes.TYPE_ERROR,
+                }
+
+            value = value.get(request_args.get('value_key'))
+
+        return {
+            'succeeded': True,
+            'value': value,
+            'rcode': ReturnCodes.OK,
+        }
+
+    def drain_notifications(self):
+        ''' read all pending notifications and invalidate the read cache
+        '''
+
+        sock = self.notify_socket
+        if sock is None:
+            return
+
+        while True:
+            try:
+                data = sock.recv(UDP_BUFFER_SIZE)
+            except BlockingIOError:
+                return
+
+            try:
+                key = detect_codec(data).decode_response(data).get('value')
+            except (UnicodeDecodeError, ValueError):
+                logger.error(MSG_INVALID_DATA)
+                continue
+
+            self.read_cache.pop(key, None)
+
     def read_response(self, conn_id):
         ''' read responses from the worker
 
@@ -968,9 +2952,11 @@ class SharedMemoryManager():
 
         try:
             data, address = conn.socket.recvfrom(UDP_BUFFER_SIZE)
-            data = json.loads(data.decode('utf-8'))
-            if not isinstance(data, dict):
-                raise ValueError
+
+            if is_fragment(data):
+                data = self._read_fragments(conn.socket, data)
+
+            data = conn.codec.decode_response(data)
 
             if not data.get('succeeded') and self.sensitive:
                 rcode = data.get('rcode')
@@ -984,9 +2970,34 @@ class SharedMemoryManager():
             logger.error(MSG_INVALID_DATA)
             raise SharedMemoryError(MSG_INVALID_DATA)
 
+    def _read_fragments(self, sock, first_fragment):
+        ''' read all fragments of a response and join them
+
+        :param first_fragment: the fragment which has been received
+        :return: the joined data in bytes
+        '''
+
+        idx, total, payload = parse_fragment(first_fragment)
+        if idx != 0:
+            raise ValueError('unexpected fragment')
+
+        payloads = [payload]
+        for expected_idx in range(1, total):
+            data, address = sock.recvfrom(UDP_BUFFER_SIZE)
+            idx, _, payload = parse_fragment(data)
+
+            if idx != expected_idx:
+                raise ValueError('unexpected fragment')
+
+            payloads.append(payload)
+
+        return b''.join(payloads)
+
     def connect(self, socket_name):
         ''' Connect to the SharedMemoryManager worker
 
+        With sharding, it connects to all of the shards.
+
         :param socket_name: name of the socket to receive responses
         '''
 
@@ -994,18 +3005,27 @@ class SharedMemoryManager():
         sock = self._create_socket(socket_path, blocking=True)
         sock.settimeout(SHM_MAX_BLOCKING_TIME)
 
+        self.shard_connections = [
+            self._connect_shard(sock, socket_name, worker_socket_path)
+            for worker_socket_path in self.worker_socket_paths
+        ]
+        self.current_connection = self.shard_connections[0]
+
+        if self.backend == SHMBackends.MMAP:
+            self._open_mmap_region()
+
+    def _connect_shard(self, sock, socket_name, worker_socket_path):
         data = {
             'socket': socket_name,
             'action': Actions.CONNECT,
+            'encodings': self.get_preferred_encodings(),
         }
-        data = json.dumps(data).encode('utf-8')
-        sock.sendto(data, self.worker_socket_path)
+        data = JSONCodec.encode_request(data)
+        sock.sendto(data, worker_socket_path)
 
         try:
             data, address = sock.recvfrom(UDP_BUFFER_SIZE)
-            data = json.loads(data.decode('utf-8'))
-            if not isinstance(data, dict):
-                raise ValueError
+            data = JSONCodec.decode_response(data)
         except socket.timeout:
             logger.error(MSG_CONN_FAILED)
             raise SHMWorkerConnectFailed(MSG_CONN_FAILED)
@@ -1019,23 +3039,70 @@ class SharedMemoryManager():
                 f'Worker returns: {data}'
             )
             raise SHMWorkerConnectFailed(MSG_CONN_FAILED)
+
+        conn_id = data.get('conn_id')
+        encoding = data.get('encoding') or SHMEncodings.JSON
+        return Connection(
+                   socket=sock,
+                   socket_name=socket_name,
+                   conn_id=conn_id,
+                   encoding=encoding,
+                   codec=CODECS.get(encoding, JSONCodec),
+                   worker_socket_path=worker_socket_path,
+               )
+
+    def _open_mmap_region(self):
+        try:
+            region = MMapRegion.open(self.mmap_path)
+        except (OSError, ValueError) as e:
+            logger.error(f'Failed to open the mmap region: {e}')
+            raise SHMWorkerConnectFailed(MSG_CONN_FAILED)
+
+        self.mmap_backend = MMapBackend(
+                                region,
+                                self.config.shm.mmap_key_prefixes,
+                            )
+
+    def get_preferred_encodings(self):
+        ''' encodings that the client offers in the CONNECT request
+
+        The encoding can be specified by config.shm.encoding, "binary" or
+        "json". If it's not specified, then the binary encoding is preferred.
+        '''
+
+        specified = self.config.shm.encoding
+
+        if specified == 'binary':
+            return [SHMEncodings.BINARY]
+        elif specified == 'json':
+            return [SHMEncodings.JSON]
         else:
-            conn_id = data.get('conn_id')
-            self.current_connection = Connection(
-                                          socket=sock,
-                                          socket_name=socket_name,
-                                          conn_id=conn_id,
-                                      )
+            return list(DEFAULT_ENCODINGS)
 
     def disconnect(self):
         ''' disconnect from the SharedMemoryManager worker
         '''
 
         conn = self.current_connection
-        self.send_request(
-            conn_id=conn.conn_id,
-            action=Actions.DISCONNECT,
-        )
+        for shard_conn in self.shard_connections:
+            self.send_request(
+                shard_conn,
+                conn_id=shard_conn.conn_id,
+                action=Actions.DISCONNECT,
+            )
+
+        if self.mmap_backend is not None:
+            self.mmap_backend.release_all()
+            self.mmap_backend = None
+
+        if self.notify_socket is not None:
+            self.notify_socket.close()
+            os.remove(os.path.join(self.socket_dir, self.notify_socket_name))
+            self.notify_socket = None
+            self.notify_socket_name = None
+
+        self.subscribed_keys.clear()
+        self.read_cache.clear()
 
         conn.socket.close()
         socket_path = os.path.join(self.socket_dir, conn.socket_name)
@@ -1043,50 +3110,177 @@ class SharedMemoryManager():
 
         logger.debug(f'remove socket: {socket_path}')
         self.current_connection = None
+        self.shard_connections = []
+
+    def batch(self, atomic=False, backlogging=True):
+        ''' create a batch of requests, see SHMBatch
+        '''
+
+        return SHMBatch(self, atomic=atomic, backlogging=backlogging)
+
+    def get_lock_stats(self, key=None):
+        ''' get lock waiting statistics from the worker
+
+        Locks of keys in the mmap region are arbitrated by the kernel,
+        they are not counted.
+
+        :param key: the container key, None for all keys of all shards
+        '''
+
+        if key is not None:
+            conns = [self.get_connection(key)]
+        else:
+            conns = self.shard_connections
+
+        if len(conns) == 0:
+            raise SHMWorkerNotConnected(MSG_NOT_CONNECTED)
+
+        stats = {}
+        for conn in conns:
+            self.send_request(
+                conn,
+                conn_id=conn.conn_id,
+                action=Actions.LOCK_STATS,
+                key=key,
+            )
+            data = self.read_response(conn.conn_id)
+            stats.update(data.get('value'))
+
+        data.update(value=stats)
+        return data
+
+    def subscribe(self, key):
+        ''' keep a local copy of the container in the read cache
+
+        Then, read_key and get_dict_value on the key will be served by the
+        local copy. The worker notifies the client when the container is
+        changed and the local copy will be dropped, the next reading fetches
+        the container again.
+
+        It's designed for hot containers which are rarely changed. Note
+        that, readings from the local copy are not blocked by locks, and
+        the value in the local copy shall not be modified by the caller.
+
+        Keys in the mmap region are always read locally, so they will not
+        be subscribed.
+
+        :param key: the container key
+        '''
+
+        conn = self.get_connection(key)
+
+        if self.mmap_backend is not None and self.mmap_backend.owns(key):
+            return None
+
+        if self.notify_socket is None:
+            socket_name = f'{conn.socket_name}-notify'
+            self.notify_socket = self._create_socket(
+                                     os.path.join(self.socket_dir, socket_name)
+                                 )
+            self.notify_socket_name = socket_name
+
+        self.send_request(
+            conn,
+            conn_id=conn.conn_id,
+            action=Actions.SUBSCRIBE,
+            key=key,
+            socket=self.notify_socket_name,
+        )
+        data = self.read_response(conn.conn_id)
+
+        if data.get('succeeded'):
+            self.subscribed_keys.add(key)
+
+        return data
+
+    def unsubscribe(self, key):
+        ''' stop caching the container
+        '''
+
+        conn = self.get_connection(key)
+
+        if key not in self.subscribed_keys:
+            return None
+
+        self.subscribed_keys.discard(key)
+        self.read_cache.pop(key, None)
+
+        self.send_request(
+            conn,
+            conn_id=conn.conn_id,
+            action=Actions.UNSUBSCRIBE,
+            key=key,
+        )
+        return self.read_response(conn.conn_id)
+
+    def get_stats(self, key=None):
+        ''' get memory statistics from the worker
+
+        :param key: the container key, None for all keys of all shards
+        '''
+
+        if key is not None:
+            return self.request(action=Actions.STATS, key=key)
+
+        if len(self.shard_connections) == 0:
+            raise SHMWorkerNotConnected(MSG_NOT_CONNECTED)
+
+        stats = {}
+        for conn in self.shard_connections:
+            self.send_request(
+                conn,
+                conn_id=conn.conn_id,
+                action=Actions.STATS,
+            )
+            data = self.read_response(conn.conn_id)
+
+            for name, count in data.get('value').items():
+                stats.update({name: stats.get(name, 0) + count})
+
+        data.update(value=stats)
+        return data
 
     def lock_key(self, key, backlogging=True):
         ''' acquire the lock of a container
         '''
 
-        self.send_request(
-            conn_id=self.current_connection.conn_id,
+        return self.request(
             action=Actions.LOCK,
             key=key,
             backlogging=backlogging,
         )
-        return self.read_response(self.current_connection.conn_id)
 
     def unlock_key(self, key, backlogging=True):
         ''' release the lock of a container
         '''
 
-        self.send_request(
-            conn_id=self.current_connection.conn_id,
+        return self.request(
             action=Actions.UNLOCK,
             key=key,
             backlogging=backlogging,
         )
-        return self.read_response(self.current_connection.conn_id)
 
-    def create_key(self, key, type_, value=None, backlogging=True):
+    def create_key(self, key, type_, value=None, backlogging=True, ttl=None):
         ''' create a new container
 
         :param key: the container key
         :param type_: type of container, enumerated in SHMContainerTypes
         :param value: the initial value, type of the value should be same with
                       the container type
+        :param ttl: seconds, the container will be removed after it
         '''
 
-        value = list(value) if type_ == SHMContainerTypes.SET else value
-        self.send_request(
-            conn_id=self.current_connection.conn_id,
+        if type_ == SHMContainerTypes.SET and value is not None:
+            value = list(value)
+
+        return self.request(
             action=Actions.CREATE,
             key=key,
             type=type_,
             value=value,
+            ttl=ttl,
             backlogging=backlogging,
         )
-        return self.read_response(self.current_connection.conn_id)
 
     def create_key_and_ignore_conflict(self, *args, **kwargs):
         ''' invoke self.create_key and ignore the KEY_CONFLICT fault
@@ -1099,7 +3293,7 @@ class SharedMemoryManager():
             if rcode != ReturnCodes.KEY_CONFLICT:
                 raise e
 
-    def set_value(self, key, value, backlogging=True):
+    def set_value(self, key, value, backlogging=True, ttl=None):
         ''' change the value of a key
 
         allowed container types:
@@ -1107,18 +3301,18 @@ class SharedMemoryManager():
 
         :param key: the container key
         :param value: values to be set
+        :param ttl: seconds, the container will be removed after it
         '''
 
-        self.send_request(
-            conn_id=self.current_connection.conn_id,
+        return self.request(
             action=Actions.SET,
             key=key,
             value=value,
+            ttl=ttl,
             backlogging=backlogging,
         )
-        return self.read_response(self.current_connection.conn_id)
 
-    def add_value(self, key, value, backlogging=True):
+    def add_value(self, key, value, backlogging=True, ttl=None):
         ''' add values into the container
 
         allowed container types:
@@ -1127,17 +3321,74 @@ class SharedMemoryManager():
         :param key: the container key
         :param value: values to be added,
                       type of the value should be same with the container type
+        :param ttl: seconds, only for DICT containers, the added entries
+                    will be removed after it
         '''
 
         value = list(value) if isinstance(value, set) else value
-        self.send_request(
-            conn_id=self.current_connection.conn_id,
+        return self.request(
             action=Actions.ADD,
             key=key,
             value=value,
+            ttl=ttl,
+            backlogging=backlogging,
+        )
+
+    def incr_value(self, key, amount=1, backlogging=True):
+        ''' add the amount to the container in one atomic action
+
+        allowed container types:
+            INT, FLOAT
+
+        :param key: the container key
+        :param amount: int, or float for FLOAT containers
+        :return: the response, the value is the new number
+        '''
+
+        return self.request(
+            action=Actions.INCR,
+            key=key,
+            value=amount,
+            backlogging=backlogging,
+        )
+
+    def decr_value(self, key, amount=1, backlogging=True):
+        ''' subtract the amount from the container in one atomic action
+
+        allowed container types:
+            INT, FLOAT
+        '''
+
+        return self.request(
+            action=Actions.DECR,
+            key=key,
+            value=amount,
+            backlogging=backlogging,
+        )
+
+    def cas_value(self, key, expected, value, dict_key=None, backlogging=True):
+        ''' set the value only if the current value equals to the expected
+
+        allowed container types:
+            STR, INT, FLOAT, BOOL, or DICT with the dict_key
+
+        :param key: the container key
+        :param expected: the expected current value, None means the entry
+                         doesn't exist if the dict_key is given
+        :param value: the new value
+        :param dict_key: key in the dict container
+        :return: the response, the value is
+                 {'swapped': bool, 'value': the value after the action}
+        '''
+
+        return self.request(
+            action=Actions.CAS,
+            key=key,
+            value_key=None if dict_key is None else str(dict_key),
+            expected=expected,
+            value=value,
             backlogging=backlogging,
         )
-        return self.read_response(self.current_connection.conn_id)
 
     def remove_value(self, key, values, backlogging=True):
         ''' remove values from the container
@@ -1158,38 +3409,95 @@ class SharedMemoryManager():
             # TypeError means values is not iterable
             vl = [values]
 
-        self.send_request(
-            conn_id=self.current_connection.conn_id,
+        return self.request(
             action=Actions.REMOVE,
             key=key,
             value=vl,
             backlogging=backlogging,
         )
-        return self.read_response(self.current_connection.conn_id)
 
     def read_key(self, key, backlogging=True):
         ''' read the whole container
         '''
 
-        self.send_request(
-            conn_id=self.current_connection.conn_id,
+        return self.request(
             action=Actions.READ,
             key=key,
             backlogging=backlogging,
         )
-        return self.read_response(self.current_connection.conn_id)
+
+    def scan_key(self, key, cursor=0, count=DEFAULT_SCAN_COUNT,
+                 backlogging=True):
+        ''' read a piece of a multi-value container
+
+        allowed container types:
+            SET, LIST, DICT
+
+        :param key: the container key
+        :param cursor: the cursor returned by the last scanning,
+                       0 to start a new iteration
+        :param count: max amount of elements to read
+        :return: the response, the value is a dict that contains the
+                 next cursor and elements, see the protocol doc
+        '''
+
+        return self.request(
+            action=Actions.SCAN,
+            key=key,
+            cursor=cursor,
+            count=count,
+            backlogging=backlogging,
+        )
+
+    def iter_key(self, key, count=DEFAULT_SCAN_COUNT, backlogging=True):
+        ''' iterate a multi-value container by scan_key
+
+        Each SCAN request reads at most {count} elements, so the size of
+        responses doesn't grow with the container.
+
+        :return: a generator, it yields (key, value) pairs for DICT
+                 containers, and elements for SET and LIST containers.
+        '''
+
+        cursor = 0
+        while True:
+            resp = self.scan_key(key, cursor, count, backlogging)
+            if not resp.get('succeeded'):
+                return
+
+            value = resp.get('value')
+            items = value.get('items')
+
+            if isinstance(items, dict):
+                yield from items.items()
+            else:
+                yield from items
+
+            cursor = value.get('cursor')
+            if cursor == 0:
+                return
+
+    def slice_list(self, key, start=None, stop=None, backlogging=True):
+        ''' read a slice of a LIST container, same as list[start:stop]
+        '''
+
+        return self.request(
+            action=Actions.SLICE,
+            key=key,
+            start=start,
+            stop=stop,
+            backlogging=backlogging,
+        )
 
     def clean_key(self, key, backlogging=True):
         ''' completely remove a container
         '''
 
-        self.send_request(
-            conn_id=self.current_connection.conn_id,
+        return self.request(
             action=Actions.CLEAN,
             key=key,
             backlogging=backlogging,
         )
-        return self.read_response(self.current_connection.conn_id)
 
     def get_dict_value(self, key, value_key, backlogging=True):
         ''' get a value from a dict container
@@ -1205,16 +3513,14 @@ class SharedMemoryManager():
         # in Python dicts but it's invalid in JSON. The SHM client communicates
         # with the SHM worker by transporting JSONs, so we have to convert
         # value_key arguments in integer into strings here.
-        self.send_request(
-            conn_id=self.current_connection.conn_id,
+        return self.request(
             action=Actions.DICT_GET,
             key=key,
             value_key=str(value_key),
             backlogging=backlogging,
         )
-        return self.read_response(self.current_connection.conn_id)
 
-    def update_dict(self, key, dict_key, value, backlogging=True):
+    def update_dict(self, key, dict_key, value, backlogging=True, ttl=None):
         ''' change a value of a dict container
 
         allowed container type: DICT
@@ -1222,13 +3528,179 @@ class SharedMemoryManager():
         :param key: the container key
         :param dict_key: key in the dict container
         :param value: value for dict.update()
+        :param ttl: seconds, the entry will be removed after it
         '''
 
-        self.send_request(
-            conn_id=self.current_connection.conn_id,
+        return self.request(
             action=Actions.DICT_UPDATE,
             key=key,
+            value_key=str(dict_key),
             value=value,
+            ttl=ttl,
+            backlogging=backlogging,
+        )
+
+    def incr_dict_value(self, key, dict_key, amount=1, backlogging=True,
+                        ttl=None):
+        ''' add the amount to a number in a dict container atomically
+
+        allowed container type: DICT
+
+        :param key: the container key
+        :param dict_key: key in the dict container, a missing entry
+                         will be treated as 0
+        :param amount: int or float
+        :param ttl: seconds, the entry will be removed after it
+        :return: the response, the value is the new number
+        '''
+
+        return self.request(
+            action=Actions.DICT_INCR,
+            key=key,
+            value_key=str(dict_key),
+            value=amount,
+            ttl=ttl,
             backlogging=backlogging,
         )
-        return self.read_response(self.current_connection.conn_id)
+
+
+class SHMBatch():
+
+    ''' A group of requests that will be sent to the worker in one datagram
+
+    Usage:
+
+        batch = shm_mgr.batch()
+        batch.read_key('key_a')
+        batch.get_dict_value('key_b', 'x')
+        batch.add_value('key_c', [1, 2])
+        resp_a, resp_b, resp_c = batch.execute()
+
+    The batch provides the same request methods as the SharedMemoryManager,
+    but requests are only recorded until execute() is invoked. Then the
+    worker handles them in order without being interrupted by requests from
+    other connections, see the BATCH action in the protocol doc.
+
+    Requests on keys that belong to the mmap region will be handled in the
+    current process, they cannot be put into an atomic batch.
+
+    With sharding, the batch will be split into one datagram per shard,
+    and an atomic batch can only contain keys of the same shard.
+    '''
+
+    def __init__(self, shm_mgr, atomic=False, backlogging=True):
+        self.shm_mgr = shm_mgr
+        self.atomic = atomic
+        self.backlogging = backlogging
+        self.requests = []
+
+    def __len__(self):
+        return len(self.requests)
+
+    def request(self, **request_args):
+        if self.atomic:
+            self._check_atomic(request_args.get('key'))
+
+        self.requests.append(request_args)
+
+    def _check_atomic(self, key):
+        shm_mgr = self.shm_mgr
+        mmap_backend = shm_mgr.mmap_backend
+
+        if mmap_backend is not None and mmap_backend.owns(key):
+            raise ArgumentError(
+                'keys in the mmap region cannot be put into an atomic batch'
+            )
+
+        if len(self.requests) > 0:
+            shard_amount = len(shm_mgr.shard_connections)
+            first_key = self.requests[0].get('key')
+
+            if get_shard_idx(key, shard_amount) != get_shard_idx(
+                first_key, shard_amount
+            ):
+                raise ArgumentError(
+                    'keys in an atomic batch must belong to the same shard'
+                )
+
+    lock_key = SharedMemoryManager.lock_key
+    unlock_key = SharedMemoryManager.unlock_key
+    create_key = SharedMemoryManager.create_key
+    set_value = SharedMemoryManager.set_value
+    add_value = SharedMemoryManager.add_value
+    remove_value = SharedMemoryManager.remove_value
+    read_key = SharedMemoryManager.read_key
+    scan_key = SharedMemoryManager.scan_key
+    slice_list = SharedMemoryManager.slice_list
+    clean_key = SharedMemoryManager.clean_key
+    get_dict_value = SharedMemoryManager.get_dict_value
+    update_dict = SharedMemoryManager.update_dict
+    incr_value = SharedMemoryManager.incr_value
+    decr_value = SharedMemoryManager.decr_value
+    cas_value = SharedMemoryManager.cas_value
+    incr_dict_value = SharedMemoryManager.incr_dict_value
+
+    def execute(self):
+        ''' send all recorded requests and clear the batch
+
+        If the SharedMemoryManager is sensitive, then SHMRequestFailed will
+        be raised once any of the requests failed.
+
+        :return: a list of responses, in the order of requests. Requests
+                 which have not been handled in a failed atomic batch
+                 will get None, and changes made by the handled ones
+                 have been rolled back.
+        '''
+
+        shm_mgr = self.shm_mgr
+        if shm_mgr.current_connection is None:
+            raise SHMWorkerNotConnected(MSG_NOT_CONNECTED)
+
+        requests, self.requests = self.requests, []
+        results = [None] * len(requests)
+
+        mmap_backend = shm_mgr.mmap_backend
+        shard_amount = len(shm_mgr.shard_connections)
+        local_idxes = []
+
+        # indexes of requests to send, {shard_idx: [idx]}
+        remote_idxes = {}
+
+        for idx, request in enumerate(requests):
+            key = request.get('key')
+
+            if mmap_backend is not None and mmap_backend.owns(key):
+                local_idxes.append(idx)
+            else:
+                shard_idx = get_shard_idx(key, shard_amount)
+                remote_idxes.setdefault(shard_idx, []).append(idx)
+
+        for shard_idx, idxes in remote_idxes.items():
+            conn = shm_mgr.shard_connections[shard_idx]
+            shm_mgr.send_request(
+                conn,
+                conn_id=conn.conn_id,
+                action=Actions.BATCH,
+                requests=[requests[idx] for idx in idxes],
+                atomic=self.atomic,
+                backlogging=self.backlogging,
+            )
+            data = shm_mgr.read_response(conn.conn_id)
+
+            # The whole batch fails with a bare response if it's locked
+            sub_responses = data.get('value')
+            if not isinstance(sub_responses, list):
+                sub_responses = [data] * len(idxes)
+
+            for idx, sub_resp in zip(idxes, sub_responses):
+                results[idx] = sub_resp
+
+        for idx in local_idxes:
+            data = mmap_backend.handle(requests[idx])
+
+            if not data.get('succeeded') and shm_mgr.sensitive:
+                raise SHMRequestFailed(data.get('rcode'))
+
+            results[idx] = data
+
+        return results
@@ -0,0 +1,364 @@
+#!/usr/bin/python3.6
+#coding: utf-8
+
+import json
+import struct
+import marshal
+
+from neverland.utils import MetaEnum, ObjectifiedDict
+
+
+__all__ = [
+    'SHMEncodings',
+    'JSONCodec',
+    'BinaryCodec',
+    'CODECS',
+    'detect_codec',
+    'split_fragments',
+    'is_fragment',
+    'parse_fragment',
+]
+
+
+''' The codecs of the SharedMemoryManager IPC protocol
+
+Originally, the SharedMemoryManager transfers stringified JSON through the
+socket. It's simple, but the JSON serialization takes most of the cost of a
+single SHM request, and it can't handle bytes, so modules like the
+ConnectionManager have to encode IVs in base64 before they store them.
+
+So here is the binary encoding, a datagram in the binary encoding looks like:
+
+    |  magic  | action |  type  |  rcode  |  flags  |      conn_id       |
+    +---------+--------+--------+---------+---------+--------------------+
+    |    1    |   1    |   1    |    1    |    1    |         16         |
+
+    followed by the typed payload.
+
+    magic:
+        Always be 0xfb. JSON datagrams are always started with "{",
+        so the worker can distinguish encodings by the first byte.
+
+    action, type:
+        Same with the "action" and "type" fields in the JSON format.
+        0 means the field is not given.
+
+    rcode:
+        The return code, only used in responses.
+
+    flags:
+        Bit flags, see FLAG_* constants below.
+
+    conn_id:
+        The connection ID in 16 bytes UUID format, all zero if not given.
+
+    payload:
+        A typed value in the format of the marshal std-lib. In requests,
+        it's a dict that contains all remaining fields (key, value,
+        value_key, etc.). In responses, it's a dict that contains all fields
+        except "succeeded" and "rcode", or the bare value if the
+        FLAG_BARE_VALUE is set.
+
+        The marshal format is implemented in C and handles bytes, sets and
+        integers of any size natively, that's why we choose it. It's not
+        safe against malicious data, but the same as the JSON encoding, we
+        rely on the permission mechanism of the Unix domain socket.
+
+        Unlike JSON, the marshal format keeps Python types as they are,
+        so dict keys in integer will not be converted into strings and
+        bytes can be stored without base64. ObjectifiedDicts will be
+        converted into dicts before marshalling.
+
+
+Responses which are larger than a datagram will be split into fragments in
+both encodings, each fragment looks like:
+
+    |  magic  |  index  |  total  |        payload        |
+    +---------+---------+---------+-----------------------+
+    |    1    |    4    |    4    |          ...          |
+
+    magic:
+        Always be 0xfc.
+
+    index, total:
+        Index of the fragment and amount of fragments. Fragments are sent
+        in order, and the Unix domain socket keeps them in order.
+
+    payload:
+        A part of the encoded response. The receiver joins payloads of all
+        fragments and decodes the result with the negotiated codec.
+'''
+
+
+class SHMEncodings(metaclass=MetaEnum):
+
+    JSON = 0x01
+    BINARY = 0x02
+
+
+BINARY_MAGIC = 0xfb
+
+# in requests, the backlogging option is given
+FLAG_BACKLOGGING_SET = 0x01
+# in requests, the value of the backlogging option
+FLAG_BACKLOGGING = 0x02
+# in responses, the request succeeded
+FLAG_SUCCEEDED = 0x04
+# in responses, the payload is the bare value but not a dict
+FLAG_BARE_VALUE = 0x08
+
+HEADER = struct.Struct('!BBBBB16s')
+HEADER_LEN = HEADER.size
+
+FRAGMENT_MAGIC = 0xfc
+FRAGMENT_HEADER = struct.Struct('!BII')
+FRAGMENT_HEADER_LEN = FRAGMENT_HEADER.size
+
+_NULL_CONN_ID = bytes(16)
+
+# fields carried by the fixed header
+_HEADER_FIELDS = ('action', 'type', 'conn_id', 'backlogging')
+_RESP_HEADER_FIELDS = ('succeeded', 'rcode')
+
+
+def _to_marshallable(item):
+    ''' convert values that marshal doesn't support
+    '''
+
+    if isinstance(item, ObjectifiedDict):
+        return item.__to_dict__()
+    if isinstance(item, dict):
+        return {k: _to_marshallable(v) for k, v in item.items()}
+    if isinstance(item, (list, tuple)):
+        return [_to_marshallable(unit) for unit in item]
+    if isinstance(item, (bytearray, memoryview)):
+        return bytes(item)
+    return item
+
+
+def pack_value(value):
+    ''' pack a value into the typed format
+
+    :return: bytes
+    '''
+
+    try:
+        return marshal.dumps(value)
+    except ValueError:
+        pass
+
+    try:
+        return marshal.dumps(_to_marshallable(value))
+    except ValueError:
+        raise TypeError(f'{type(value)} is not supported in SHM')
+
+
+def unpack_value(data, offset=0):
+    ''' unpack a value in the typed format
+
+    :param data: bytes
+    :param offset: where the typed value starts
+    :return: the value
+    '''
+
+    try:
+        return marshal.loads(data[offset:])
+    except (EOFError, TypeError) as e:
+        raise ValueError(f'failed to unpack: {e}')
+
+
+def _conn_id_2_bytes(conn_id):
+    if conn_id is None:
+        return _NULL_CONN_ID
+    return bytes.fromhex(conn_id.replace('-', ''))
+
+
+def _bytes_2_conn_id(raw):
+    if raw == _NULL_CONN_ID:
+        return None
+
+    h = raw.hex()
+    return f'{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}'
+
+
+class JSONCodec():
+
+    ''' The original stringified JSON encoding
+    '''
+
+    encoding = SHMEncodings.JSON
+
+    @classmethod
+    def encode_request(cls, request):
+        return json.dumps(request).encode('utf-8')
+
+    @classmethod
+    def decode_request(cls, data):
+        try:
+            request = json.loads(data.decode('utf-8'))
+        except UnicodeDecodeError:
+            raise ValueError('invalid JSON request')
+
+        if not isinstance(request, dict):
+            raise ValueError('invalid JSON request')
+        return request
+
+    @classmethod
+    def encode_response(cls, response):
+        return json.dumps(response).encode('utf-8')
+
+    @classmethod
+    def decode_response(cls, data):
+        return cls.decode_request(data)
+
+
+class BinaryCodec():
+
+    ''' The binary encoding, see the module doc for the format
+    '''
+
+    encoding = SHMEncodings.BINARY
+
+    @classmethod
+    def encode_request(cls, request):
+        flags = 0
+        backlogging = request.get('backlogging')
+        if backlogging is not None:
+            flags |= FLAG_BACKLOGGING_SET
+            if backlogging:
+                flags |= FLAG_BACKLOGGING
+
+        payload = {
+            k: v for k, v in request.items() if k not in _HEADER_FIELDS
+        }
+        header = HEADER.pack(
+                     BINARY_MAGIC,
+                     request.get('action') or 0,
+                     request.get('type') or 0,
+                     0,
+                     flags,
+                     _conn_id_2_bytes(request.get('conn_id')),
+                 )
+        return header + pack_value(payload)
+
+    @classmethod
+    def decode_request(cls, data):
+        try:
+            magic, action, type_, _, flags, raw_conn_id = \
+                HEADER.unpack_from(data)
+        except struct.error:
+            raise ValueError('binary request too short')
+
+        if magic != BINARY_MAGIC:
+            raise ValueError('invalid magic number')
+
+        request = unpack_value(data, HEADER_LEN)
+        if not isinstance(request, dict):
+            raise ValueError('invalid binary request')
+
+        request['action'] = action
+        request['conn_id'] = _bytes_2_conn_id(raw_conn_id)
+
+        if type_:
+            request['type'] = type_
+        if flags & FLAG_BACKLOGGING_SET:
+            request['backlogging'] = bool(flags & FLAG_BACKLOGGING)
+
+        return request
+
+    @classmethod
+    def encode_response(cls, response):
+        flags = FLAG_SUCCEEDED if response.get('succeeded') else 0
+
+        if len(response) <= 3 and 'value' in response:
+            flags |= FLAG_BARE_VALUE
+            payload = response.get('value')
+        else:
+            payload = {
+                k: v for k, v in response.items()
+                if k not in _RESP_HEADER_FIELDS
+            }
+
+        header = HEADER.pack(
+                     BINARY_MAGIC,
+                     0,
+                     0,
+                     response.get('rcode') or 0,
+                     flags,
+                     _NULL_CONN_ID,
+                 )
+        return header + pack_value(payload)
+
+    @classmethod
+    def decode_response(cls, data):
+        try:
+            magic, _, _, rcode, flags, _ = HEADER.unpack_from(data)
+        except struct.error:
+            raise ValueError('binary response too short')
+
+        if magic != BINARY_MAGIC:
+            raise ValueError('invalid magic number')
+
+        payload = unpack_value(data, HEADER_LEN)
+
+        if flags & FLAG_BARE_VALUE:
+            response = {'value': payload}
+        elif isinstance(payload, dict):
+            response = payload
+        else:
+            raise ValueError('invalid binary response')
+
+        response['succeeded'] = bool(flags & FLAG_SUCCEEDED)
+        response['rcode'] = rcode
+        return response
+
+
+CODECS = {
+    SHMEncodings.JSON: JSONCodec,
+    SHMEncodings.BINARY: BinaryCodec,
+}
+
+
+def split_fragments(data, max_size):
+    ''' split encoded data into fragments
+
+    :param data: the encoded response in bytes
+    :param max_size: max size of a datagram
+    :return: a list of fragments in bytes
+    '''
+
+    payload_size = max_size - FRAGMENT_HEADER_LEN
+    total = (len(data) + payload_size - 1) // payload_size
+
+    return [
+        FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, idx, total) +
+        data[idx * payload_size: (idx + 1) * payload_size]
+        for idx in range(total)
+    ]
+
+
+def is_fragment(data):
+    return len(data) > 0 and data[0] == FRAGMENT_MAGIC
+
+
+def parse_fragment(data):
+    ''' parse a fragment
+
+    :return: (index, total, payload)
+    '''
+
+    try:
+        _, idx, total = FRAGMENT_HEADER.unpack_from(data)
+    except struct.error:
+        raise ValueError('fragment too short')
+
+    return idx, total, data[FRAGMENT_HEADER_LEN:]
+
+
+def detect_codec(data):
+    ''' pick up a codec by the first byte of the datagram
+    '''
+
+    if len(data) > 0 and data[0] == BINARY_MAGIC:
+        return BinaryCodec
+    return JSONCodec
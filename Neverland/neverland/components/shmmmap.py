@@ -0,0 +1,444 @@
+#!/usr/bin/python3.6
+#coding: utf-8
+
+import os
+import mmap
+import time
+import zlib
+import fcntl
+import struct
+import marshal
+import logging
+
+from neverland.exceptions import SharedMemoryError, SHMResponseTimeout
+
+
+__all__ = [
+    'MMapRegion',
+    'SlotFull',
+    'TableFull',
+    'KeyTooLong',
+    'LockBusy',
+    'DEFAULT_MMAP_KEY_PREFIXES',
+]
+
+
+''' The mmap backend of the SharedMemoryManager
+
+The SharedMemoryManager worker keeps all containers in a dict inside its own
+process, so every reading from a forked worker costs a round trip through the
+Unix domain socket. For those hot containers that will be read on almost
+every packet, we can put them in a real shared memory region instead.
+
+The region is a file mapped by mmap, it can be placed in /dev/shm or any
+other file system. It's created by the SharedMemoryManager worker, and each
+process opens it once.
+
+Layout of the region:
+
+    | header | slot 0 | slot 1 | ... | slot n-1 |
+
+    header:
+        |  magic  | slot_count | slot_size |
+        +---------+------------+-----------+
+        |    4    |     4      |     4     |   padded to 64 bytes
+
+    slot:
+        |  seq  | state | type | key_len | value_len |   key   |   value   |
+        +-------+-------+------+---------+-----------+---------+-----------+
+        |   8   |   1   |  1   |    2    |     4     |   48    |    ...    |
+
+        seq:
+            The sequence number of the seqlock. It's odd while the slot is
+            being written and even while the slot is stable.
+
+        state:
+            0 for empty, 1 for used and 2 for removed. Removed slots are
+            skipped but not treated as the end of probing.
+
+        type:
+            The container type, enumerated in shm.SHMContainerTypes
+
+        value:
+            The container in marshal format, see shmcodec.pack_value
+
+Keys are placed by open addressing with linear probing on crc32(key).
+
+
+Synchronization:
+
+    Readers never lock. They read the seq, copy the value out of a memoryview
+    of the slot, and read the seq again. The reading will be retried if the
+    seq is odd or changed.
+
+    Writers lock the first byte of the slot with fcntl.lockf, so the kernel
+    arbitrates writers from different processes and sleeping writers don't
+    spin. The first byte of the header is used as the lock of the whole table
+    when a key is being inserted.
+
+    POSIX record locks belong to the process, so one process opens the region
+    only once, and we count the locks held in the current process ourselves,
+    otherwise the inner unlocking of a nested lock will release the outer one.
+
+    For the same reason, the kernel never arbitrates between two owners
+    (e.g. two SharedMemoryManager connections) in one process, so we also
+    record the owner of each lock. A lock held by another owner in the
+    current process is always treated as busy, waiting for it would never
+    end since the process itself is waiting.
+'''
+
+
+logger = logging.getLogger('SHM')
+
+
+REGION_MAGIC = 0x4e4c4d4d   # NLMM
+
+HEADER = struct.Struct('!III')
+HEADER_SIZE = 64
+
+SLOT_HEADER = struct.Struct('=QBBHI')
+SEQ = struct.Struct('=Q')
+SLOT_HEADER_SIZE = SLOT_HEADER.size
+
+KEY_MAX_LEN = 48
+VALUE_OFFSET = SLOT_HEADER_SIZE + KEY_MAX_LEN
+
+SLOT_EMPTY = 0
+SLOT_USED = 1
+SLOT_REMOVED = 2
+
+DEFAULT_SLOT_COUNT = 256
+DEFAULT_SLOT_SIZE = 8192
+
+# seconds to sleep between retries of a busy lock
+LOCK_RETRY_INTERVAL = 0.0005
+
+# max retries of a seqlock reading, a writer must have died if it's exceeded
+MAX_READ_RETRIES = 100000
+
+# keys of hot containers, matched by prefix
+#
+# Each container must fit in one slot, so containers that grow without a
+# limit are not here, e.g. connections of the ConnectionManager, which
+# grow with remotes. Repeating states of the SpecialPacketRepeater are not
+# here either, they are stored with TTLs, which are not supported in the
+# mmap region.
+DEFAULT_MMAP_KEY_PREFIXES = [
+    'Core_',
+]
+
+
+class SlotFull(Exception):
+
+    ''' The encoded value is larger than the slot
+    '''
+
+
+class TableFull(Exception):
+
+    ''' No free slot for a new key
+    '''
+
+
+class KeyTooLong(Exception):
+
+    ''' The key is longer than KEY_MAX_LEN
+    '''
+
+
+class LockBusy(Exception):
+
+    ''' The lock is held by another process or another owner
+    '''
+
+
+# open regions in the current process, {path: MMapRegion}
+_regions = {}
+
+# locks held by the current process, {(path, offset): [owner, count]}
+_held_locks = {}
+_held_locks_pid = None
+
+
+def _get_held_locks():
+    global _held_locks, _held_locks_pid
+
+    # record locks are not inherited by forked children
+    pid = os.getpid()
+    if _held_locks_pid != pid:
+        _held_locks = {}
+        _held_locks_pid = pid
+
+    return _held_locks
+
+
+class MMapRegion():
+
+    ''' The mmap'd region with seqlock protected slots
+    '''
+
+    def __init__(self, path, fd, mm, slot_count, slot_size):
+        self.path = path
+        self.fd = fd
+        self.mm = mm
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.value_capacity = slot_size - VALUE_OFFSET
+
+    @classmethod
+    def create(cls, path, slot_count=None, slot_size=None):
+        ''' create or truncate the region file and initialize it
+
+        It should only be invoked by the SharedMemoryManager worker.
+        '''
+
+        slot_count = slot_count or DEFAULT_SLOT_COUNT
+        slot_size = slot_size or DEFAULT_SLOT_SIZE
+
+        if slot_size <= VALUE_OFFSET:
+            raise ValueError(f'slot_size must be greater than {VALUE_OFFSET}')
+
+        size = HEADER_SIZE + slot_count * slot_size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.ftruncate(fd, size)
+        mm = mmap.mmap(fd, size, mmap.MAP_SHARED)
+        HEADER.pack_into(mm, 0, REGION_MAGIC, slot_count, slot_size)
+
+        region = cls(path, fd, mm, slot_count, slot_size)
+        _regions[path] = region
+
+        logger.info(
+            f'Created mmap region {path}, '
+            f'{slot_count} slots * {slot_size} bytes'
+        )
+        return region
+
+    @classmethod
+    def open(cls, path):
+        ''' open an existing region, once per process
+        '''
+
+        region = _regions.get(path)
+        if region is not None:
+            return region
+
+        fd = os.open(path, os.O_RDWR)
+        mm = mmap.mmap(fd, 0, mmap.MAP_SHARED)
+        magic, slot_count, slot_size = HEADER.unpack_from(mm, 0)
+
+        if magic != REGION_MAGIC:
+            mm.close()
+            os.close(fd)
+            raise ValueError(f'{path} is not a Neverland mmap region')
+
+        region = cls(path, fd, mm, slot_count, slot_size)
+        _regions[path] = region
+        return region
+
+    def close(self):
+        _regions.pop(self.path, None)
+        self.mm.close()
+        os.close(self.fd)
+
+    def _slot_offset(self, idx):
+        return HEADER_SIZE + idx * self.slot_size
+
+    ## locks
+    def acquire(self, offset, blocking=True, timeout=None, owner=None):
+        ''' acquire the lock of a slot or the table
+
+        :param offset: offset of the slot, or 0 for the table
+        :param blocking: wait until the lock is acquired
+        :param timeout: max waiting seconds, it only works in blocking mode
+        :param owner: the owner of the lock in the current process,
+                      the lock is reentrant for the same owner only
+        '''
+
+        held = _get_held_locks()
+        lock_id = (self.path, offset)
+
+        record = held.get(lock_id)
+        if record is not None:
+            if record[0] is not owner:
+                raise LockBusy
+
+            record[1] += 1
+            return
+
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            try:
+                fcntl.lockf(
+                    self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset
+                )
+                break
+            except (BlockingIOError, PermissionError):
+                if not blocking:
+                    raise LockBusy
+
+            if deadline is None:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, offset)
+                break
+            elif time.time() >= deadline:
+                raise SHMResponseTimeout(f'lock timeout: {offset}')
+
+            time.sleep(LOCK_RETRY_INTERVAL)
+
+        held[lock_id] = [owner, 1]
+
+    def release(self, offset, owner=None):
+        ''' release the lock of a slot or the table
+
+        :param owner: the owner of the lock in the current process
+        :return: False if the lock is not held by the owner
+        '''
+
+        held = _get_held_locks()
+        lock_id = (self.path, offset)
+
+        record = held.get(lock_id)
+        if record is None or record[0] is not owner:
+            return False
+        elif record[1] > 1:
+            record[1] -= 1
+            return True
+
+        held.pop(lock_id)
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, offset)
+        return True
+
+    def is_locked_by_me(self, offset, owner=None):
+        record = _get_held_locks().get((self.path, offset))
+        return record is not None and record[0] is owner
+
+    ## slots
+    def find(self, key):
+        ''' find the slot of a key
+
+        :param key: the key in bytes
+        :return: offset of the slot, or None if not found
+        '''
+
+        mm = self.mm
+        start = zlib.crc32(key) % self.slot_count
+        key_len = len(key)
+
+        for i in range(self.slot_count):
+            offset = self._slot_offset((start + i) % self.slot_count)
+            _, state, _, kl, _ = SLOT_HEADER.unpack_from(mm, offset)
+
+            if state == SLOT_EMPTY:
+                return None
+
+            key_offset = offset + SLOT_HEADER_SIZE
+            if (
+                state == SLOT_USED and
+                kl == key_len and
+                mm[key_offset: key_offset + kl] == key
+            ):
+                return offset
+
+        return None
+
+    def insert(self, key, type_, value):
+        ''' insert a new key, the caller shall hold the table lock
+
+        :return: offset of the slot
+        '''
+
+        if len(key) > KEY_MAX_LEN:
+            raise KeyTooLong
+
+        mm = self.mm
+        start = zlib.crc32(key) % self.slot_count
+
+        for i in range(self.slot_count):
+            offset = self._slot_offset((start + i) % self.slot_count)
+            _, state, _, _, _ = SLOT_HEADER.unpack_from(mm, offset)
+
+            if state != SLOT_USED:
+                key_offset = offset + SLOT_HEADER_SIZE
+                mm[key_offset: key_offset + len(key)] = key
+                self.write(offset, type_, value, key_len=len(key))
+                return offset
+
+        raise TableFull
+
+    def write(self, offset, type_, value, key_len=None, state=SLOT_USED):
+        ''' write the slot in the seqlock protocol
+
+        The caller shall hold the lock of the slot (or the table).
+
+        :param value: the encoded value in bytes
+        '''
+
+        value_len = len(value)
+        if value_len > self.value_capacity:
+            raise SlotFull
+
+        mm = self.mm
+        seq, _, _, kl, _ = SLOT_HEADER.unpack_from(mm, offset)
+        if key_len is None:
+            key_len = kl
+
+        # odd seq, readers will retry
+        SEQ.pack_into(mm, offset, seq + 1)
+
+        value_offset = offset + VALUE_OFFSET
+        mm[value_offset: value_offset + value_len] = value
+        SLOT_HEADER.pack_into(
+            mm, offset, seq + 1, state, type_, key_len, value_len
+        )
+
+        # even seq, the slot is stable again
+        SEQ.pack_into(mm, offset, seq + 2)
+
+    def remove(self, offset):
+        ''' mark the slot as removed, the caller shall hold the lock
+        '''
+
+        self.write(offset, 0, b'', state=SLOT_REMOVED)
+
+    def read(self, offset, key):
+        ''' read the slot without locking
+
+        The value is decoded from a memoryview of the slot directly.
+
+        :param key: the key in bytes, to make sure the slot hasn't been
+                    reused by another key after we found it
+        :return: (type, value), or (None, None) if the key is not there
+        '''
+
+        mm = self.mm
+        key_offset = offset + SLOT_HEADER_SIZE
+        value_offset = offset + VALUE_OFFSET
+
+        with memoryview(mm) as buf:
+            for _ in range(MAX_READ_RETRIES):
+                seq0, state, type_, key_len, value_len = \
+                    SLOT_HEADER.unpack_from(mm, offset)
+
+                if seq0 & 1:
+                    continue
+
+                if (
+                    state != SLOT_USED or
+                    buf[key_offset: key_offset + key_len] != key
+                ):
+                    type_ = value = None
+                else:
+                    try:
+                        value = marshal.loads(
+                            buf[value_offset: value_offset + value_len]
+                        )
+                    except (EOFError, ValueError, TypeError):
+                        # torn reading, check the seq and retry
+                        value = None
+
+                seq1 = SEQ.unpack_from(mm, offset)[0]
+                if seq0 == seq1:
+                    return type_, value
+
+        raise SharedMemoryError(f'seqlock of slot {offset} is stuck')
+
@@ -0,0 +1,389 @@
+#!/usr/bin/python3.6
+#coding: utf-8
+
+import os
+import re
+import time
+import zlib
+import struct
+import marshal
+import logging
+
+from neverland.components.shmcodec import pack_value
+
+
+__all__ = [
+    'SHMPersister',
+    'DEFAULT_SNAPSHOT_INTERVAL',
+    'DEFAULT_MAX_LOG_SIZE',
+]
+
+
+''' The persistence of the SharedMemoryManager worker
+
+Containers of the SharedMemoryManager worker only live in the memory of the
+worker process. When the node restarts, everything is gone, and the node has
+to rebuild all of its states, like slots in the ConnectionManager and nodes
+of the cluster.
+
+So the worker can keep its containers on disk by enabling the persistence
+(config.shm.snapshot_dir). It's made of two kinds of files:
+
+    shm-<shard>.snapshot:
+        The full copy of containers and their expiry records.
+
+        |  magic  | generation |  crc32  |        payload        |
+        +---------+------------+---------+-----------------------+
+        |    4    |     8      |    4    |          ...          |
+
+        payload:
+            {
+                'resources': {key: container},
+                'key_expiry': {key: timestamp},
+                'entry_expiry': {key: {dict_key: timestamp}},
+            }
+            in the marshal format
+
+        generation:
+            The snapshot contains all changes in logs before the generation.
+
+    shm-<shard>.log.<generation>:
+        The append-only log of changing requests, each record looks like:
+
+        |  length  |        payload        |
+        +----------+-----------------------+
+        |    4     |          ...          |
+
+        payload:
+            The request in the marshal format, without the conn_id and
+            the backlogging option. The ttl field is converted into the
+            absolute expiring time "expire_at".
+
+Records are buffered in the memory, and written before the worker sends
+the response, so a BATCH request is written in one go. They are written
+into the page cache without fsync, so they survive crashes of the worker
+process, but not crashes of the system. Snapshots are fsync'd.
+
+Compaction:
+    When the snapshot interval is exceeded, or the current log is larger
+    than the max log size, the worker switches to a new log generation and
+    forks a child. The child writes the snapshot from its copy-on-write
+    memory, so the worker loop isn't blocked. Once the child exited
+    successfully, logs of older generations are removed.
+
+    If the child fails, the old snapshot and logs are kept as they are,
+    so we can still rebuild the state from them.
+
+Loading:
+    When the worker starts, it loads the snapshot and replays logs of the
+    snapshot's generation and later generations in order.
+'''
+
+
+logger = logging.getLogger('SHM')
+
+
+SNAPSHOT_MAGIC = 0x4e4c5353   # NLSS
+
+SNAPSHOT_HEADER = struct.Struct('!IQI')
+RECORD_HEADER = struct.Struct('!I')
+
+# seconds between two snapshots
+DEFAULT_SNAPSHOT_INTERVAL = 60
+
+# bytes, a snapshot will be taken once the current log is larger than it
+DEFAULT_MAX_LOG_SIZE = 64 * 1024 * 1024
+
+
+class SHMPersister():
+
+    ''' Snapshots and append-only logs of a SharedMemoryManager worker
+    '''
+
+    def __init__(
+        self, directory, name,
+        interval=None, max_log_size=None,
+    ):
+        ''' Constructor
+
+        :param directory: the directory to store files
+        :param name: prefix of file names, different in each shard
+        :param interval: seconds between two snapshots
+        :param max_log_size: bytes, max size of a log before compaction
+        '''
+
+        self.directory = directory
+        self.name = name
+        self.interval = interval or DEFAULT_SNAPSHOT_INTERVAL
+        self.max_log_size = max_log_size or DEFAULT_MAX_LOG_SIZE
+
+        self.snapshot_path = os.path.join(directory, f'{name}.snapshot')
+        self._log_pattern = re.compile(
+            re.escape(f'{name}.log.') + r'(\d+)$'
+        )
+
+        # generation of the current log
+        self.generation = 0
+        self.log_file = None
+        self.log_size = 0
+
+        # encoded records that have not been written
+        self.buffer = []
+
+        # if there are changes since the last snapshot
+        self.dirty = False
+        self.last_snapshot_time = time.time()
+
+        # the child that is writing the snapshot
+        self.child_pid = None
+        self.child_generation = None
+
+    def _log_path(self, generation):
+        return os.path.join(self.directory, f'{self.name}.log.{generation}')
+
+    def _list_logs(self):
+        ''' list generations of existing logs in order
+        '''
+
+        generations = []
+        for filename in os.listdir(self.directory):
+            matched = self._log_pattern.match(filename)
+            if matched is not None:
+                generations.append(int(matched.group(1)))
+
+        generations.sort()
+        return generations
+
+    def load(self):
+        ''' load the snapshot and records of logs
+
+        :return: (state, records), state is the payload of the snapshot or
+                 None if there is no valid snapshot, records is a list of
+                 requests to be replayed in order
+        '''
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        state = None
+        generation = 0
+
+        if os.path.exists(self.snapshot_path):
+            try:
+                generation, state = self._read_snapshot()
+            except ValueError as e:
+                # Logs before the generation are gone, replaying the rest
+                # of them would give us a broken state.
+                logger.error(
+                    f'Failed to load the snapshot {self.snapshot_path}: {e}, '
+                    f'starting with an empty state'
+                )
+                self._remove_logs(before=None)
+                self.generation = 0
+                return None, []
+
+        records = []
+        last_generation = generation
+
+        for log_generation in self._list_logs():
+            if log_generation < generation:
+                os.remove(self._log_path(log_generation))
+                continue
+
+            records.extend(self._read_log(log_generation))
+            last_generation = log_generation
+
+        # new records will be written into a new log
+        self.generation = last_generation + 1
+        self.dirty = len(records) > 0
+
+        logger.info(
+            f'Loaded SHM snapshot of generation {generation} '
+            f'with {len(records)} log records'
+        )
+        return state, records
+
+    def _read_snapshot(self):
+        with open(self.snapshot_path, 'rb') as f:
+            data = f.read()
+
+        try:
+            magic, generation, crc = SNAPSHOT_HEADER.unpack_from(data)
+        except struct.error:
+            raise ValueError('snapshot too short')
+
+        payload = memoryview(data)[SNAPSHOT_HEADER.size:]
+        if magic != SNAPSHOT_MAGIC or zlib.crc32(payload) != crc:
+            raise ValueError('invalid snapshot')
+
+        try:
+            state = marshal.loads(payload)
+        except (EOFError, ValueError, TypeError):
+            raise ValueError('invalid snapshot payload')
+
+        return generation, state
+
+    def _read_log(self, generation):
+        path = self._log_path(generation)
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        records = []
+        offset = 0
+        total = len(data)
+
+        while offset < total:
+            try:
+                length = RECORD_HEADER.unpack_from(data, offset)[0]
+                start = offset + RECORD_HEADER.size
+                if start + length > total:
+                    raise ValueError
+
+                records.append(marshal.loads(data[start: start + length]))
+            except (struct.error, EOFError, ValueError, TypeError):
+                # the tail record was being written when the worker died
+                logger.warning(f'Truncated SHM log record in {path}')
+                break
+
+            offset = start + length
+
+        return records
+
+    def open(self):
+        ''' open the log of the current generation for appending
+        '''
+
+        path = self._log_path(self.generation)
+        self.log_file = open(path, 'ab')
+        self.log_size = self.log_file.tell()
+
+    def append(self, record):
+        ''' append a record into the buffer
+
+        :param record: the request in dict
+        '''
+
+        payload = pack_value(record)
+        self.buffer.append(RECORD_HEADER.pack(len(payload)))
+        self.buffer.append(payload)
+
+    def mark(self):
+        ''' get the current position of the buffer for rollback
+        '''
+
+        return len(self.buffer)
+
+    def rollback(self, mark):
+        ''' drop records appended after the mark
+        '''
+
+        del self.buffer[mark:]
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+
+        data = b''.join(self.buffer)
+        self.buffer.clear()
+
+        self.log_file.write(data)
+        self.log_file.flush()
+        self.log_size += len(data)
+        self.dirty = True
+
+    def need_snapshot(self):
+        if self.child_pid is not None or not self.dirty:
+            return False
+
+        return (
+            self.log_size >= self.max_log_size or
+            time.time() - self.last_snapshot_time >= self.interval
+        )
+
+    def snapshot(self, state):
+        ''' switch to a new log and write the snapshot in a forked child
+
+        :param state: the payload of the snapshot
+        '''
+
+        self.flush()
+        self.log_file.close()
+
+        self.generation += 1
+        self.open()
+
+        self.dirty = False
+        self.last_snapshot_time = time.time()
+
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self._write_snapshot(self.generation, state)
+                code = 0
+            except Exception as e:
+                logger.error(f'Failed to write the SHM snapshot: {e}')
+            finally:
+                os._exit(code)
+
+        self.child_pid = pid
+        self.child_generation = self.generation
+
+    def _write_snapshot(self, generation, state):
+        payload = pack_value(state)
+        header = SNAPSHOT_HEADER.pack(
+                     SNAPSHOT_MAGIC, generation, zlib.crc32(payload)
+                 )
+
+        tmp_path = f'{self.snapshot_path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(tmp_path, self.snapshot_path)
+
+    def poll_child(self, blocking=False):
+        ''' check if the child has finished the snapshot
+        '''
+
+        if self.child_pid is None:
+            return
+
+        flags = 0 if blocking else os.WNOHANG
+        pid, status = os.waitpid(self.child_pid, flags)
+        if pid == 0:
+            return
+
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            self._remove_logs(before=self.child_generation)
+            logger.debug(
+                f'SHM snapshot of generation {self.child_generation} '
+                f'has been written'
+            )
+        else:
+            # Logs are kept, the next snapshot will cover them
+            self.dirty = True
+            logger.error('Failed to write the SHM snapshot')
+
+        self.child_pid = None
+        self.child_generation = None
+
+    def _remove_logs(self, before):
+        ''' remove logs older than the generation, or all logs if it's None
+        '''
+
+        for generation in self._list_logs():
+            if before is None or generation < before:
+                os.remove(self._log_path(generation))
+
+    def close(self):
+        ''' flush records and wait for the child
+        '''
+
+        self.poll_child(blocking=True)
+
+        if self.log_file is not None:
+            self.flush()
+            self.log_file.close()
+            self.log_file = None
@@ -6,12 +6,12 @@ import json
 import time
 import select
 import logging
+import traceback
 
-from neverland.pkt import UDPPacket, PktTypes
+from neverland.pkt import UDPPacket, PktTypes, PktFields
 from neverland.node.context import NodeContext
 from neverland.utils import (
     Converter,
-    ObjectifiedDict,
     get_localhost_ip,
 )
 from neverland.exceptions import (
@@ -19,11 +19,11 @@ from neverland.exceptions import (
     ConfigError,
     ArgumentError,
     SharedMemoryError,
-    SHMResponseTimeout,
 )
 from neverland.protocol.v0.subjects import\
         ClusterControllingSubjects as CCSubjects
 from neverland.core.state import ClusterControllingStates as CCStates
+from neverland.afferents.udp import DEFAULT_BATCH_SIZE
 from neverland.components.idgeneration import IDGenerator
 from neverland.components.shm import (
     ReturnCodes,
@@ -59,9 +59,10 @@ class BaseCore():
 
     SHM_SOCKET_NAME_TEMPLATE = 'SHM-Core-%d.socket'
 
-    # SHM container for containing allocated core id
+    # SHM container for containing the last allocated core id,
+    # -1 if no id has been allocated
     # data structure:
-    #     [1, 2, 3, 4]
+    #     4
     SHM_KEY_CORE_ID = 'Core_id'
 
     # The shared status of cluster controlling,
@@ -95,6 +96,9 @@ class BaseCore():
         self.logic_handler = logic_handler
         self.protocol_wrapper = protocol_wrapper
 
+        # max amount of packets to be received and handled in one batch
+        self.batch_size = config.net.recv_batch_size or DEFAULT_BATCH_SIZE
+
         self.shm_mgr = SharedMemoryManager(self.config)
 
         self.plug_afferent(self.main_afferent)
@@ -120,7 +124,8 @@ class BaseCore():
 
         self.shm_mgr.create_key_and_ignore_conflict(
             self.SHM_KEY_CORE_ID,
-            SHMContainerTypes.LIST,
+            SHMContainerTypes.INT,
+            -1,
         )
         self.shm_mgr.create_key_and_ignore_conflict(
             self.SHM_KEY_CC_STATE,
@@ -128,6 +133,10 @@ class BaseCore():
             CCStates.INIT,
         )
 
+        # The cc_state will be read on every packet but it's rarely changed,
+        # so we keep a local copy of it
+        self.shm_mgr.subscribe(self.SHM_KEY_CC_STATE)
+
         logger.debug(f'init_shm for core of worker {NodeContext.pid} has done')
 
     def close_shm(self):
@@ -137,33 +146,11 @@ class BaseCore():
         ''' Let the core pick up an id for itself
         '''
 
-        try:
-            resp = self.shm_mgr.lock_key(self.SHM_KEY_CORE_ID)
-        except SHMResponseTimeout:
-            # Currently, SHM_MAX_BLOCKING_TIME is 4 seconds and
-            # these works can be definitely done in 4 seconds.
-            # If a SHMResponseTimeout occurred, then there must
-            # be a deadlock
-            raise SHMResponseTimeout(
-                f'deadlock of key: {self.SHM_KEY_CORE_ID}'
-            )
-
-        resp = self.shm_mgr.read_key(self.SHM_KEY_CORE_ID)
-        allocated_id = resp.get('value')
-
-        if len(allocated_id) == 0:
-            id_ = 0
-        else:
-            last_id = allocated_id[-1]
-            id_ = last_id + 1
-
-        self.shm_mgr.add_value(
-            self.SHM_KEY_CORE_ID,
-            [id_],
-        )
+        # INCR is handled atomically, so we don't need to lock the key
+        resp = self.shm_mgr.incr_value(self.SHM_KEY_CORE_ID)
+        id_ = resp.get('value')
         self.core_id = id_
 
-        self.shm_mgr.unlock_key(self.SHM_KEY_CORE_ID)
         logger.debug(
             f'core of worker {NodeContext.pid} has self-allocated id: {id_}'
         )
@@ -209,7 +196,7 @@ class BaseCore():
         dest = (entrance.ip, entrance.port)
 
         pkt = UDPPacket()
-        pkt.fields = ObjectifiedDict(
+        pkt.fields = PktFields(
                          type=PktTypes.CTRL,
                          dest=dest,
                          subject=subject,
@@ -245,7 +232,7 @@ class BaseCore():
         dest = (entrance.ip, entrance.port)
 
         pkt = UDPPacket()
-        pkt.fields = ObjectifiedDict(
+        pkt.fields = PktFields(
                          type=PktTypes.CTRL,
                          dest=dest,
                          subject=subject,
@@ -273,7 +260,31 @@ class BaseCore():
             return
 
         pkt = self.protocol_wrapper.wrap(pkt)
-        self.efferent.transmit(pkt)
+        self.efferent.enqueue(pkt)
+
+    def handle_pkts(self, pkts):
+        ''' handle a batch of received packets
+
+        Packets to be sent are queued in the efferent during the handling,
+        and they are transmitted together after the whole batch is handled.
+        A packet that fails to be handled is dropped alone, the rest of the
+        batch is still handled.
+
+        :param pkts: a list of UDPPacket objects
+        '''
+
+        try:
+            for pkt in pkts:
+                try:
+                    self.handle_pkt(pkt)
+                except Exception:
+                    err_msg = traceback.format_exc()
+                    logger.error(
+                        f'Failed to handle packet from {pkt.previous_hop}, '
+                        f'packet dropped. Traceback:\n{err_msg}'
+                    )
+        finally:
+            self.efferent.flush()
 
     def _poll(self):
         events = self._epoll.poll(POLL_TIMEOUT)
@@ -285,8 +296,12 @@ class BaseCore():
                 self.unplug_afferent(fd)
                 afferent.destroy()
             elif evt & select.EPOLLIN:
-                pkt = afferent.recv()
-                self.handle_pkt(pkt)
+                pkts = afferent.recv_batch(self.batch_size)
+                self.handle_pkts(pkts)
+
+        # packets left in the queue because of the full sending buffer
+        if self.efferent.queued_amount > 0:
+            self.efferent.flush()
 
     def run(self):
         self.set_cc_state(CCStates.WORKING)
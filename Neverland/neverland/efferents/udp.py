@@ -2,10 +2,26 @@
 #coding: utf-8
 
 import socket
+import logging
+
+
+logger = logging.getLogger('Main')
+
+
+# max amount of packets waiting in the queue, packets beyond it are dropped,
+# so a persistently full sending buffer doesn't exhaust the memory
+MAX_QUEUED_PKTS = 4096
 
 
 class UDPTransmitter():
 
+    ''' A normal implementation of the efferents
+
+    Packets can be transmitted immediately with the transmit method, or
+    queued with the enqueue method and transmitted together by the flush
+    method, so the core can handle received packets as a batch.
+    '''
+
     def __init__(self, config, shared_socket=None):
         ''' Constructor
 
@@ -21,6 +37,11 @@ class UDPTransmitter():
         else:
             self._sock = self.create_socket()
 
+        # packets waiting for the flushing, structure: [(data, target)]
+        self._queue = []
+        self.max_queued_pkts = MAX_QUEUED_PKTS
+        self.dropped_amount = 0
+
     def create_socket(self, bind_port=None):
         # TODO ipv6 support
         af, type_, proto, canon, sa = socket.getaddrinfo(
@@ -39,6 +60,10 @@ class UDPTransmitter():
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         return sock
 
+    def destroy(self):
+        self._sock.close()
+        self._sock = None
+
     def transmit(self, pkt):
         ''' transmit a packet
 
@@ -52,3 +77,55 @@ class UDPTransmitter():
             target = tuple(target)
 
         self._sock.sendto(data, target)
+
+    def enqueue(self, pkt):
+        ''' queue a packet, it will be transmitted in the next flushing
+
+        :param pkt: neverland.pkt.UDPPacket object
+        :return: False if the queue is full and the packet is dropped
+        '''
+
+        if len(self._queue) >= self.max_queued_pkts:
+            self.dropped_amount += 1
+            logger.warning(
+                f'Efferent queue is full, packet to {pkt.next_hop} dropped'
+            )
+            return False
+
+        target = pkt.next_hop
+        if isinstance(target, list):
+            target = tuple(target)
+
+        self._queue.append((pkt.data, target))
+        return True
+
+    def flush(self):
+        ''' transmit all queued packets
+
+        If the sending buffer of the socket is full, the rest of packets
+        are kept in the queue for the next flushing.
+
+        :return: amount of transmitted packets
+        '''
+
+        queue = self._queue
+        if len(queue) == 0:
+            return 0
+
+        sendto = self._sock.sendto
+        sent = 0
+
+        try:
+            for data, target in queue:
+                sendto(data, target)
+                sent += 1
+        except BlockingIOError:
+            pass
+        finally:
+            del queue[:sent]
+
+        return sent
+
+    @property
+    def queued_amount(self):
+        return len(self._queue)
@@ -26,6 +26,10 @@ class InvalidPkt(Exception):
     pass
 
 
+class DecryptionFailed(Exception):
+    pass
+
+
 class AddressAlreadyInUse(Exception):
     pass
 
@@ -66,15 +66,18 @@ class BaseLogicHandler(_BaseLogicHandler):
             raise DropPacket
 
         pkt_mgr = NodeContext.pkt_mgr
-        pkt = pkt_mgr.get_pkt(responding_sn)
+        pkt, rpt_state = pkt_mgr.get_pkt_and_repeat_state(responding_sn)
 
         if pkt is None:
             logger.debug(
-                f'Packet manager can\'t find the original pkt, sn: {sn}. '
-                f'Drop the response packet.'
+                f'Packet manager can\'t find the original pkt, '
+                f'sn: {responding_sn}. Drop the response packet.'
             )
             raise DropPacket
 
+        # the round trip is measured before the repeat is cancelled
+        pkt_mgr.sample_rtt(pkt, rpt_state)
+
         if pkt.fields.type == PktTypes.CTRL:
             if pkt.fields.subject == CCSubjects.JOIN_CLUSTER:
                 self.handle_resp_0x01_join_cluster(pkt, resp_pkt)
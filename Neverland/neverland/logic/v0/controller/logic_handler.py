@@ -3,8 +3,7 @@
 
 import logging
 
-from neverland.pkt import PktTypes, UDPPacket
-from neverland.utils import ObjectifiedDict
+from neverland.pkt import PktTypes, UDPPacket, PktFields
 from neverland.node import Roles
 from neverland.node.context import NodeContext
 from neverland.logic.v0.base import BaseLogicHandler
@@ -79,7 +78,7 @@ class ControllerLogicHandler(BaseLogicHandler):
         src = (NodeContext.local_ip, NodeContext.core.main_afferent.listen_port)
 
         resp_pkt = UDPPacket()
-        resp_pkt.fields = ObjectifiedDict(
+        resp_pkt.fields = PktFields(
                               type=PktTypes.CTRL,
                               src=src,
                               dest=dest,
@@ -127,8 +126,10 @@ class ControllerLogicHandler(BaseLogicHandler):
         )
 
     def get_cluster_nodes(self):
-        resp = self.shm_mgr.read_key(self.SHM_KEY_CLUSTER_NODES)
-        return resp.get('value')
+        # The container grows with the cluster, so we read it in pieces
+        return dict(
+            self.shm_mgr.iter_key(self.SHM_KEY_CLUSTER_NODES)
+        )
 
     def get_relay_nodes(self):
         all_nodes = self.get_cluster_nodes()
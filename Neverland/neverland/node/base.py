@@ -37,9 +37,12 @@ from neverland.protocol.v0.fmt import (
 )
 from neverland.components.idgeneration import IDGenerator
 from neverland.components.shm import SharedMemoryManager
+from neverland.components.connmgmt import ConnectionManager
 from neverland.components.pktmgmt import (
+    PktRpterModes,
     SpecialPacketManager,
     SpecialPacketRepeater,
+    NodePacketRepeater,
 )
 
 
@@ -71,6 +74,9 @@ CORE_MAPPING = {
 
 TERM_SIGNALS = [sig.SIGINT, sig.SIGQUIT, sig.SIGTERM]
 
+# the name of the socket that the master process receives SHM responses
+MASTER_SHM_SOCKET_NAME_TEMPLATE = 'SHM-Master-%d.socket'
+
 
 class BaseNode():
 
@@ -84,8 +90,17 @@ class BaseNode():
         self.role = role or self.role
 
         self.worker_pids = []
-        self.shm_worker_pid = None
+        self.shm_worker_pids = []
         self.pkt_rpter_worker_pid = None
+        self.node_pkt_rpter_pid = None
+
+        # the SHM connection of the master process, connected lazily
+        self.master_shm_mgr = None
+        self.shutting_down = False
+
+        self.pkt_rpter_mode = (
+            self.config.net.special_pkt_rpter or PktRpterModes.WORKER
+        )
 
         self.node_id = self.config.basic.node_id
 
@@ -117,6 +132,7 @@ class BaseNode():
     def _handle_term_master(self, signal, sf):
         logger.debug(f'Master process received signal: {signal}')
         logger.debug(f'The master process starts to shut down workers')
+        self.shutting_down = True
         self.shutdown_workers()
 
         pid_path = self.config.basic.pid_file
@@ -181,14 +197,35 @@ class BaseNode():
 
             time.sleep(0.5)
 
-        # shutdown SharedMemoryManager worker at last
-        shm_pid = self.shm_worker_pid
-        self._kill(shm_pid)
-        os.waitpid(shm_pid, 0)
-        logger.debug(f'SharedMemoryManager worker {shm_pid} terminated')
+        if self.master_shm_mgr is not None:
+            self.master_shm_mgr.disconnect()
+            self.master_shm_mgr = None
+
+        # the node-level repeater and SharedMemoryManager workers at last
+        self._shutdown_node_pkt_rpter()
+        self._shutdown_shm_workers()
 
         logger.debug('All workers terminated')
 
+    def _shutdown_shm_workers(self):
+        for shm_pid in self.shm_worker_pids:
+            self._kill(shm_pid)
+
+        for shm_pid in self.shm_worker_pids:
+            os.waitpid(shm_pid, 0)
+            logger.debug(f'SharedMemoryManager worker {shm_pid} terminated')
+
+    def _shutdown_node_pkt_rpter(self):
+        if self.node_pkt_rpter_pid is None:
+            return
+
+        self._kill(self.node_pkt_rpter_pid)
+        os.waitpid(self.node_pkt_rpter_pid, 0)
+        logger.debug(
+            f'NodePacketRepeater worker {self.node_pkt_rpter_pid} terminated'
+        )
+        self.node_pkt_rpter_pid = None
+
     def _kill(self, pid):
         try:
             logger.debug(f'Sending SIGTERM to {pid}')
@@ -236,14 +273,18 @@ class BaseNode():
     def _start_shm_mgr(self):
         self.shm_mgr = SharedMemoryManager(self.config)
 
-        # start SharedMemoryManager worker
+        # start a SharedMemoryManager worker for each shard
+        for shard_idx in range(self.shm_mgr.shard_amount):
+            self._start_shm_worker(shard_idx)
+
+    def _start_shm_worker(self, shard_idx):
         pid = os.fork()
         if pid == -1:
             raise OSError('fork failed')
         elif pid == 0:
             self._sig_shm_worker()
             try:
-                self.shm_mgr.run_as_worker()
+                self.shm_mgr.run_as_worker(shard_idx)
             except Exception:
                 err_msg = traceback.format_exc()
                 shm_logger.error(
@@ -254,8 +295,10 @@ class BaseNode():
 
             sys.exit(0)  # the sub-process ends here
         else:
-            self.shm_worker_pid = pid
-            logger.info(f'Started SharedMemoryManager: {pid}')
+            self.shm_worker_pids.append(pid)
+            logger.info(
+                f'Started SharedMemoryManager: {pid}, shard: {shard_idx}'
+            )
 
     def _start_pkt_rpter(self):
         '''
@@ -263,19 +306,25 @@ class BaseNode():
         so we shouldn't use this method before components are initialized
         '''
 
+        self.pkt_rpter = SpecialPacketRepeater(
+                             self.config,
+                             self.efferent,
+                             self.protocol_wrapper,
+                         )
+
+        # The notification socket is bound before the fork, so the packet
+        # manager can notify the repeater as soon as the worker starts.
+        self.pkt_rpter.listen()
+
         pid = os.fork()
         if pid == -1:
             raise OSError('fork failed')
         elif pid == 0:
             self._sig_pkt_rpter_worker()
-            self.pkt_rpter = SpecialPacketRepeater(
-                                 self.config,
-                                 self.efferent,
-                                 self.protocol_wrapper,
-                             )
 
             try:
                 self.pkt_rpter.init_shm()
+                self._create_pkt_rpter_context()
                 self.pkt_rpter.run()
             except Exception:
                 err_msg = traceback.format_exc()
@@ -285,29 +334,74 @@ class BaseNode():
                 )
                 sys.exit(1)
 
+            self._clean_pkt_rpter_context()
             sys.exit(0)  # the sub-process ends here
         else:
-            self.pkt_rpter = SpecialPacketRepeater(
-                                 self.config,
-                                 self.efferent,
-                                 self.protocol_wrapper,
-                             )
+            # the socket file belongs to the repeater worker
+            self.pkt_rpter.close_sock(unlink=False)
             self.pkt_rpter_worker_pid = pid
             logger.info(f'Started SpecialPacketRepeater: {pid}')
 
+    def _start_node_pkt_rpter(self):
+        ''' start the node-level repeater for all workers
+
+        It's forked by the master process before anything else is loaded,
+        and it works during the cluster joining as well. So the repeater
+        creates the NodeContext it needs by itself.
+        '''
+
+        # all partitions of the repeater send packets in one efferent
+        self.pkt_rpter = NodePacketRepeater(
+                             self.config,
+                             UDPTransmitter(self.config),
+                             self._create_protocol_wrapper(),
+                         )
+        self.pkt_rpter.listen()
+
+        pid = os.fork()
+        if pid == -1:
+            raise OSError('fork failed')
+        elif pid == 0:
+            self._sig_pkt_rpter_worker()
+
+            try:
+                self.pkt_rpter.init_shm()
+                self._create_pkt_rpter_context()
+                self.pkt_rpter.run()
+            except Exception:
+                err_msg = traceback.format_exc()
+                logger.error(
+                    f'Unexpected error occurred, NodePacketRepeater worker '
+                    f'crashed. Traceback:\n{err_msg}'
+                )
+                sys.exit(1)
+
+            self._clean_pkt_rpter_context()
+            sys.exit(0)  # the sub-process ends here
+        else:
+            # the socket file and the efferent belong to the repeater worker
+            self.pkt_rpter.close_sock(unlink=False)
+            self.pkt_rpter.efferent.destroy()
+            self.pkt_rpter = None
+            self.node_pkt_rpter_pid = pid
+            logger.info(f'Started NodePacketRepeater: {pid}')
+
+    def _create_protocol_wrapper(self):
+        return ProtocolWrapper(
+                   self.config,
+                   HeaderFormat,
+                   DataPktFormat,
+                   CtrlPktFormat,
+                   ConnCtrlPktFormat,
+               )
+
     def _load_modules(self):
         self.afferent_cls = AFFERENT_MAPPING[self.role]
         self.main_afferent = self.afferent_cls(self.config)
 
         self.efferent = UDPTransmitter(self.config)
 
-        self.protocol_wrapper = ProtocolWrapper(
-                                    self.config,
-                                    HeaderFormat,
-                                    DataPktFormat,
-                                    CtrlPktFormat,
-                                    ConnCtrlPktFormat,
-                                )
+        self.protocol_wrapper = self._create_protocol_wrapper()
 
         self.logic_handler_cls = LOGIC_HANDLER_MAPPING[self.role]
         self.logic_handler = self.logic_handler_cls(self.config)
@@ -324,10 +418,18 @@ class BaseNode():
 
         self.pkt_mgr = SpecialPacketManager(self.config)
 
+        # connections only carry IVs, they are not needed without crypto
+        if self.config.net.crypto.cipher is None:
+            self.conn_mgr = None
+        else:
+            self.conn_mgr = ConnectionManager(self.config)
+
         # The packet repeater is a part of the packet manager, so we will
         # use it as a normal module. Each worker shall have it's own packet
-        # repeater but not share it like the shared memory manager worker
-        self._start_pkt_rpter()
+        # repeater but not share it like the shared memory manager worker,
+        # unless the node-level repeater is used.
+        if self.pkt_rpter_mode == PktRpterModes.WORKER:
+            self._start_pkt_rpter()
 
         self.logic_handler.init_shm()
 
@@ -336,16 +438,21 @@ class BaseNode():
 
         self.pkt_mgr.init_shm()
 
+        if self.conn_mgr is not None:
+            self.conn_mgr.init_shm()
+
         pid = os.getpid()
         logger.debug(f'Worker {pid} loaded modules')
 
     def _clean_modules(self):
-        self._kill(self.pkt_rpter_worker_pid)
-        os.waitpid(self.pkt_rpter_worker_pid, 0)
-        logger.debug(
-            f'SpecialPacketRepeater worker '
-            f'{self.pkt_rpter_worker_pid} terminated'
-        )
+        if self.pkt_rpter_worker_pid is not None:
+            self._kill(self.pkt_rpter_worker_pid)
+            os.waitpid(self.pkt_rpter_worker_pid, 0)
+            logger.debug(
+                f'SpecialPacketRepeater worker '
+                f'{self.pkt_rpter_worker_pid} terminated'
+            )
+            self.pkt_rpter_worker_pid = None
 
         self.core.shutdown()
         self.main_afferent.destroy()
@@ -354,12 +461,16 @@ class BaseNode():
         self.core.close_shm()
         self.pkt_mgr.close_shm()
 
+        if self.conn_mgr is not None:
+            self.conn_mgr.close_shm()
+
         self.main_afferent = None
         self.efferent = None
         self.protocol_wrapper = None
         self.logic_handler = None
         self.core = None
         self.pkt_mgr = None
+        self.conn_mgr = None
 
         pid = os.getpid()
         logger.debug(f'Worker {pid} cleaned modules')
@@ -368,19 +479,52 @@ class BaseNode():
         return NodeContext
 
     def _create_context(self):
-        NodeContext.pkt_rpter_pid = self.pkt_rpter_worker_pid
+        NodeContext.pkt_rpter_pid = (
+            self.pkt_rpter_worker_pid or self.node_pkt_rpter_pid
+        )
         NodeContext.local_ip = get_localhost_ip()
         NodeContext.listen_port = self.config.net.aff_listen_port
         NodeContext.core = self.core
         NodeContext.main_efferent = self.efferent
         NodeContext.protocol_wrapper = self.protocol_wrapper
         NodeContext.pkt_mgr = self.pkt_mgr
+        NodeContext.conn_mgr = self.conn_mgr
 
         NodeContext.id_generator = IDGenerator(self.node_id, self.core.core_id)
 
         pid = os.getpid()
         logger.debug(f'Worker {pid} created NodeContext')
 
+    def _create_pkt_rpter_context(self):
+        ''' create the NodeContext in the repeater worker
+
+        Packets are wrapped again in the repeater, so the protocol wrapper
+        needs the address and connections of the node like in workers.
+        '''
+
+        NodeContext.pid = os.getpid()
+
+        # connections only carry IVs, they are not needed without crypto
+        if self.config.net.crypto.cipher is None:
+            conn_mgr = None
+        else:
+            conn_mgr = ConnectionManager(self.config)
+            conn_mgr.init_shm()
+
+        NodeContext.local_ip = get_localhost_ip()
+        NodeContext.listen_port = self.config.net.aff_listen_port
+        NodeContext.main_efferent = self.pkt_rpter.efferent
+        NodeContext.protocol_wrapper = self.pkt_rpter.protocol_wrapper
+        NodeContext.conn_mgr = conn_mgr
+
+        logger.debug(f'Repeater worker {NodeContext.pid} created NodeContext')
+
+    def _clean_pkt_rpter_context(self):
+        if NodeContext.conn_mgr is not None:
+            NodeContext.conn_mgr.close_shm()
+
+        self._clean_context()
+
     def _clean_context(self):
         NodeContext.pkt_rpter_pid = None
         NodeContext.id_generator = None
@@ -389,6 +533,8 @@ class BaseNode():
         NodeContext.core = None
         NodeContext.main_efferent = None
         NodeContext.protocol_wrapper = None
+        NodeContext.pkt_mgr = None
+        NodeContext.conn_mgr = None
 
         pid = os.getpid()
         logger.debug(f'Worker {pid} cleaned NodeContext')
@@ -431,6 +577,9 @@ class BaseNode():
         self._write_master_pid()
         self._start_shm_mgr()
 
+        if self.pkt_rpter_mode == PktRpterModes.NODE:
+            self._start_node_pkt_rpter()
+
         # Before we start workers, we need to join the cluster first.
         if self.role != Roles.CONTROLLER:
             # Before we join the cluster, we need to load modules at first,
@@ -496,10 +645,39 @@ class BaseNode():
 
         while True:
             try:
-                os.waitpid(-1, 0)
+                pid, _ = os.waitpid(-1, 0)
             except ChildProcessError:
                 break
 
+            self._on_worker_exit(pid)
+
+    def _on_worker_exit(self, pid):
+        ''' a hook that is invoked when a worker exits
+
+        Normal workers deregister themselves from the node-level repeater
+        when they exit, but a killed or crashed one may not. Its packets
+        would never be finished if it's left in the registry, so the
+        master process deregisters it again.
+        '''
+
+        if self.shutting_down or pid not in self.worker_pids:
+            return
+
+        self.worker_pids.remove(pid)
+        logger.warning(f'Worker {pid} exited unexpectedly')
+
+        if self.pkt_rpter_mode != PktRpterModes.NODE:
+            return
+
+        if self.master_shm_mgr is None:
+            self.master_shm_mgr = SharedMemoryManager(self.config)
+            self.master_shm_mgr.connect(
+                MASTER_SHM_SOCKET_NAME_TEMPLATE % NodeContext.pid
+            )
+
+        NodePacketRepeater.deregister_worker(self.master_shm_mgr, pid)
+        logger.debug(f'Deregistered worker {pid} from NodePacketRepeater')
+
     def shutdown(self):
         pid = self._read_master_pid()
         self._kill(pid)
@@ -511,10 +689,8 @@ class BaseNode():
         by some exception
         '''
 
-        shm_pid = self.shm_worker_pid
-        self._kill(shm_pid)
-        os.waitpid(shm_pid, 0)
-        logger.debug(f'SharedMemoryManager worker {shm_pid} terminated')
+        self._shutdown_node_pkt_rpter()
+        self._shutdown_shm_workers()
 
         pid_fl = self.config.basic.pid_file
         os.remove(pid_fl)
@@ -36,3 +36,6 @@ class NodeContext():
 
     # The packet manager instance
     pkt_mgr = None
+
+    # The connection manager instance
+    conn_mgr = None
@@ -1,6 +1,8 @@
 #!/usr/bin/python3.6
 #coding: utf-8
 
+import json
+
 from neverland.utils import ObjectifiedDict, MetaEnum
 
 
@@ -30,45 +32,150 @@ class FieldTypes(metaclass=MetaEnum):
     PY_DICT = 0x42
 
 
-class UDPPacket(ObjectifiedDict):
+def _to_dumpable(value, keep_bytes=True):
+    if value.__class__ is memoryview:
+        value = bytes(value)
+    elif value.__class__ is dict:
+        # PY_DICT fields are kept as dicts in slotted fields
+        return {
+            key: _to_dumpable(unit, keep_bytes) for key, unit in value.items()
+        }
+    return ObjectifiedDict.__to_dumpable__(value, keep_bytes)
+
 
-    ''' The UDP Packet
+class PktFields():
+
+    ''' Values of packet fields
+
+    Fields of packets built by hand are PktFields instances, they take any
+    field names as keyword arguments. Packets wrapped or unwrapped by the
+    ProtocolWrapper carry instances of slotted subclasses generated from
+    packet formats, see make_fields_cls.
+
+    Fields that are not given are read as None.
+    '''
+
+    # names of slots in generated subclasses, in the order of the format
+    __fields__ = ()
+
+    def __init__(self, *values, **kwargs):
+        ''' Constructor
+
+        :param values: values of __fields__ in order
+        :param kwargs: values of fields by name
+        '''
+
+        for name, value in zip(self.__fields__, values):
+            setattr(self, name, value)
+
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    def __getattr__(self, name):
+        # only invoked when the field has not been set
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return None
+
+    def __update__(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    def __iter__(self):
+        for name in self.__fields__:
+            try:
+                yield name, object.__getattribute__(self, name)
+            except AttributeError:
+                pass
 
-    Inner Data Structure:
-        {
-            valid: bool or None,
-            type: int,
-            data: bytes,
-            fields: ObjectifiedDict,
-            byte_fields: ObjectifiedDict,
-            previous_hop: (ip, port)
-            next_hop: (ip, port),
+        yield from self.__dict__.items()
+
+    def __to_dict__(self, keep_bytes=True):
+        return {
+            name: _to_dumpable(value, keep_bytes) for name, value in self
         }
 
+    def __str__(self):
+        return json.dumps(
+            self.__to_dict__(keep_bytes=False), indent=4
+        )
+
+
+def make_fields_cls(name, field_names):
+    ''' generate a slotted PktFields class
+
+    :param name: name of the class
+    :param field_names: names of fields in order
+    :return: a subclass of PktFields
+    '''
+
+    field_names = tuple(field_names)
+    return type(
+               name,
+               (PktFields,),
+               {'__slots__': field_names, '__fields__': field_names},
+           )
+
+
+class UDPPacket():
+
+    ''' The UDP Packet
+
+    Attributes:
+        valid: bool or None,
+        type: int,
+        data: bytes or memoryview,
+        fields: PktFields,
+        byte_fields: PktByteFields,
+        previous_hop: (ip, port)
+        next_hop: (ip, port),
+        src, dest: addresses of packets from the tproxy, client only
+
     By default, the "valid" field is None. It should be set
     during the unpacking if the packet is from other node.
 
     The "data" field is bytes which is going to transmit or just received.
+    Received packets carry a memoryview of the receiving buffer instead of
+    bytes, and the payload of DATA packets is parsed as a memoryview slice
+    of it. Modules that keep the payload for a long time should copy it
+    with bytes() so the buffer can be reused.
 
     The "fields" field is the data that hasn't been wrapped or has been parsed.
     The "byte_fields" fields is a duplicate of the "fields" field,
     the difference is data in this field is bytes.
-    '''
-
-    def __init__(self, **kwargs):
-        for kw in ['previous_hop', 'next_hop']:
-            if kw not in kwargs:
-                kwargs.update(
-                    {kw: (None, None)}
-                )
 
-        for kw in ['fields', 'byte_fields']:
-            if kw not in kwargs:
-                kwargs.update(
-                    {kw: ObjectifiedDict()}
-                )
-
-        if 'valid' not in kwargs:
-            kwargs.update(valid=None)
+    Packets are created for every datagram, so this class and classes of
+    fields are slotted, they cost much less than ObjectifiedDicts.
+    '''
 
-        ObjectifiedDict.__init__(self, **kwargs)
+    __slots__ = (
+        'valid',
+        'type',
+        'data',
+        'fields',
+        'byte_fields',
+        'previous_hop',
+        'next_hop',
+        'src',
+        'dest',
+    )
+
+    def __init__(
+        self, data=None, fields=None, byte_fields=None, type=None,
+        valid=None, previous_hop=(None, None), next_hop=(None, None),
+        src=None, dest=None,
+    ):
+        if fields is None:
+            fields = PktFields()
+        elif isinstance(fields, dict):
+            fields = PktFields(**fields)
+
+        self.valid = valid
+        self.type = type
+        self.data = data
+        self.fields = fields
+        self.byte_fields = byte_fields or PktFields()
+        self.previous_hop = previous_hop
+        self.next_hop = next_hop
+        self.src = src
+        self.dest = dest
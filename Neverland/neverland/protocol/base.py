@@ -2,21 +2,30 @@
 #coding: utf-8
 
 import os
+import hmac
 import json
 import time
+import socket
 import struct
 
-from neverland.pkt import UDPPacket, PktTypes, FieldTypes
+from neverland.pkt import UDPPacket, PktTypes, FieldTypes, make_fields_cls
 from neverland.utils import (
+    MetaEnum,
     HashTools,
     ObjectifiedDict,
     get_localhost_ip,
 )
 from neverland.node.context import NodeContext
+from neverland.protocol.crypto import (
+    CryptorCache,
+    DEFAULT_IV_SLOT_ID,
+    is_aead_cipher,
+)
 from neverland.exceptions import (
     PktWrappingError,
     PktUnwrappingError,
     InvalidPkt,
+    DecryptionFailed,
 )
 
 
@@ -40,6 +49,7 @@ class BasePktFormat():
              default       = <default value of the field>,
              calculator    = <specify a function to calculate the field>,
              calc_priority = <an integer, smaller number means higher priority>,
+             verifier      = <specify a function to verify received packets>,
          )
 
     }
@@ -57,6 +67,10 @@ class BasePktFormat():
 
             return value
 
+    The "verifier" has the same arguments with the "calculator", it will be
+    invoked after received packets are parsed and shall raise InvalidPkt if
+    the packet is not acceptable.
+
     -------------------------------------------
 
     This kind of classes depends on the ordered dict feature which implemented
@@ -156,18 +170,71 @@ def mac_calculator(pkt, header_fmt, body_fmt):
         Here I define the default rule of mac calculating as this:
 
             SHA256( <salt> + <other_fields> )
+
+    This is the "sha256" mac method, see MACMethods.
     '''
 
-    data_2_hash = pkt.byte_fields.salt
+    byte_fields = pkt.byte_fields
+    data_2_hash = b''.join(
+        [byte_fields.salt] + [
+            getattr(byte_fields, field_name)
+            for field_name in header_fmt.__fmt__
+            if field_name not in ('salt', 'mac')
+        ]
+    )
+
+    return HashTools.sha256(data_2_hash)
+
 
-    for field_name, definition in header_fmt.__fmt__.items():
-        if field_name in ('salt', 'mac'):
-            continue
+class MACMethods(metaclass=MetaEnum):
 
-        byte_value = getattr(pkt.byte_fields, field_name)
-        data_2_hash += byte_value
+    # SHA256 of the header in 64 bytes hex string, see mac_calculator
+    SHA256 = 'sha256'
 
-    return HashTools.sha256(data_2_hash)
+    # Keyed HMAC-SHA256 of the whole packet in 32 bytes, see HMACCalculator
+    HMAC_SHA256 = 'hmac-sha256'
+
+
+class HMACCalculator():
+
+    ''' Calculator and verifier of the mac field in the hmac-sha256 method
+
+    Unlike the sha256 method, the digest covers the whole packet except the
+    mac field itself, body included, and it's keyed, so nodes without the
+    key cannot forge packets. The digest is 32 bytes raw binary.
+
+    Received packets are verified in constant time.
+    '''
+
+    DIGEST_SIZE = 32
+
+    def __init__(self, key, field_name='mac'):
+        ''' Constructor
+
+        :param key: the HMAC key in bytes
+        :param field_name: name of the mac field
+        '''
+
+        self.field_name = field_name
+
+        # the keyed state is computed once and copied for each packet
+        self._hmac = hmac.new(key, digestmod='sha256')
+
+    def digest(self, byte_fields):
+        head, tail = byte_fields.split(self.field_name)
+
+        h = self._hmac.copy()
+        h.update(head)
+        h.update(tail)
+        return h.digest()
+
+    def calculate(self, pkt, header_fmt, body_fmt):
+        return self.digest(pkt.byte_fields)
+
+    def verify(self, pkt, header_fmt, body_fmt):
+        mac = getattr(pkt.fields, self.field_name)
+        if not hmac.compare_digest(self.digest(pkt.byte_fields), mac):
+            raise InvalidPkt('invalid mac')
 
 
 def time_calculator(*_):
@@ -179,6 +246,333 @@ def time_calculator(*_):
     )
 
 
+# struct formats of fields, all fields are packed in the native byte order
+# without alignment, so "L" shall be replaced with the native size of it
+_NATIVE_U_LONG = 'Q' if struct.calcsize('L') == 8 else 'I'
+
+STRUCT_FORMATS = {
+    FieldTypes.STRUCT_U_CHAR: 'B',
+    FieldTypes.STRUCT_U_INT: 'I',
+    FieldTypes.STRUCT_U_LONG: _NATIVE_U_LONG,
+    FieldTypes.STRUCT_U_LONG_LONG: 'Q',
+    FieldTypes.STRUCT_IPV4_SA: '4sH',
+}
+
+# field types that can be the variable-length tail of packets
+TAIL_FIELD_TYPES = (FieldTypes.PY_BYTES, FieldTypes.PY_DICT)
+
+
+def _pack_bytes(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return value
+    elif isinstance(value, str):
+        return value.encode()
+    else:
+        raise PktWrappingError(f'{type(value)} cannot be packed as PY_BYTES')
+
+
+def _slice_tail(data):
+    return data
+
+
+def _pack_fixed_bytes(value):
+    return (_pack_bytes(value),)
+
+
+def _pack_dict(value):
+    if isinstance(value, dict):
+        return json.dumps(value).encode()
+    elif isinstance(value, ObjectifiedDict):
+        return json.dumps(value.__to_dict__()).encode()
+    else:
+        raise PktWrappingError(f'{type(value)} cannot be packed as PY_DICT')
+
+
+def _unpack_dict(data):
+    try:
+        value = json.loads(str(data, 'utf-8'))
+    except json.decoder.JSONDecodeError:
+        raise InvalidPkt('failed to parse a PY_DICT field')
+    except UnicodeDecodeError:
+        raise InvalidPkt('failed to decode a PY_DICT field')
+
+    # logic handlers read the content as an ObjectifiedDict
+    if isinstance(value, dict):
+        return ObjectifiedDict(**value)
+    return value
+
+
+def _pack_ipv4_sa(value):
+    # ipv4 socket address should in the following format: (ip, port)
+    return socket.inet_aton(value[0]), socket.htons(value[1])
+
+
+def _unpack_ipv4_sa(ip, port):
+    return socket.inet_ntoa(ip), socket.ntohs(port)
+
+
+class PktCodec():
+
+    ''' The compiled codec of a packet type
+
+    The header format and the body format are combined and compiled into
+    one struct.Struct, so wrapping or unwrapping a packet costs only one
+    pack or unpack call.
+
+    All fields are fixed-size, except the last one. If the last field is a
+    PY_BYTES or PY_DICT field, then it's the tail of the packet, it takes
+    all of the rest bytes.
+
+    Packets can be unpacked from memoryviews without copying. In this case,
+    the PY_BYTES tail is a memoryview of the original data, and fixed-size
+    PY_BYTES fields are copied into small bytes objects by struct.
+    '''
+
+    def __init__(self, fields, allow_tail=True, name='PktFields'):
+        ''' Constructor
+
+        :param fields: a list of (field_name, definition) in order
+        :param allow_tail: allow the last field to be the variable-length tail
+        :param name: name of the generated fields class
+        '''
+
+        self.fields = fields
+        self.names = [field_name for field_name, _ in fields]
+
+        # the slotted class of fields of this packet type
+        self.fields_cls = make_fields_cls(name, self.names)
+
+        fixed_fields = fields
+        self.tail_packer = None
+        self.tail_unpacker = None
+
+        last_type = fields[-1][1].type if len(fields) > 0 else None
+        if allow_tail and last_type in TAIL_FIELD_TYPES:
+            fixed_fields = fields[:-1]
+
+            if last_type == FieldTypes.PY_BYTES:
+                # the tail is sliced as it is, no copy for memoryviews
+                self.tail_packer = _pack_bytes
+                self.tail_unpacker = _slice_tail
+            else:
+                self.tail_packer = _pack_dict
+                self.tail_unpacker = _unpack_dict
+
+        fmt = '='
+
+        # converters of fixed fields, None means the value is packed as it is
+        self.packers = []
+        # (converter, amount of struct items) of fixed fields
+        self.unpackers = []
+        # values for packing fields that haven't been calculated
+        self.placeholders = []
+        # struct formats of fields, {field_name: format}
+        self.formats = {}
+        # positions of fields, {field_name: (start, stop)}
+        self.offsets = {}
+
+        for field_name, definition in fixed_fields:
+            field_type = definition.type
+
+            if field_type == FieldTypes.PY_BYTES:
+                field_fmt = f'{definition.length}s'
+                self.packers.append(_pack_fixed_bytes)
+                self.unpackers.append((None, 1))
+                self.placeholders.append(b'')
+            elif field_type == FieldTypes.STRUCT_IPV4_SA:
+                field_fmt = STRUCT_FORMATS[field_type]
+                self.packers.append(_pack_ipv4_sa)
+                self.unpackers.append((_unpack_ipv4_sa, 2))
+                self.placeholders.append(('0.0.0.0', 0))
+            elif field_type in STRUCT_FORMATS:
+                field_fmt = STRUCT_FORMATS[field_type]
+                self.packers.append(None)
+                self.unpackers.append((None, 1))
+                self.placeholders.append(0)
+            else:
+                # TODO ipv6 support
+                raise PktWrappingError(
+                    f'Field {field_name} cannot be packed in a fixed size'
+                )
+
+            start = struct.calcsize(fmt)
+            fmt += field_fmt
+            self.formats.update({field_name: field_fmt})
+            self.offsets.update({field_name: (start, struct.calcsize(fmt))})
+
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+
+        if self.tail_packer is not None:
+            self.placeholders.append(b'')
+            self.offsets.update({fields[-1][0]: (self.size, None)})
+
+        # field definitions that contains a calculator,
+        # sorted by the calculator priority
+        #
+        # structure: [(index, field_name, calculator)]
+        self.calculators = [
+            (idx, field_name, definition.calculator)
+            for idx, field_name, definition in sorted(
+                [
+                    (idx, field_name, definition)
+                    for idx, (field_name, definition) in enumerate(fields)
+                    if definition.calculator is not None
+                ],
+                key=lambda item: item[2].calc_priority or 0,
+            )
+        ]
+
+        # verifiers of received packets
+        self.verifiers = [
+            definition.verifier
+            for _, definition in fields
+            if definition.verifier is not None
+        ]
+
+        # definitions are read on every packet, so we keep what we need in
+        # plain tuples, structure: [(field_name, has_calculator, default)]
+        self.specs = [
+            (field_name, definition.calculator is not None, definition.default)
+            for field_name, definition in fields
+        ]
+
+    def pack(self, values, partial=False):
+        ''' pack values of fields
+
+        :param values: a list of values in the order of fields
+        :param partial: pack None values as placeholders
+        :return: bytes
+        '''
+
+        if partial:
+            values = [
+                ph if value is None else value
+                for value, ph in zip(values, self.placeholders)
+            ]
+
+        args = []
+        try:
+            for value, packer in zip(values, self.packers):
+                if packer is None:
+                    args.append(value)
+                else:
+                    args.extend(packer(value))
+
+            data = self.struct.pack(*args)
+        except (struct.error, TypeError, ValueError, OSError) as e:
+            raise PktWrappingError(f'failed to pack fields: {e}')
+
+        if self.tail_packer is not None:
+            data += self.tail_packer(values[-1])
+
+        return data
+
+    def unpack(self, data):
+        ''' unpack raw packet data
+
+        :param data: bytes
+        :return: a list of values in the order of fields
+        '''
+
+        try:
+            items = self.struct.unpack_from(data)
+        except struct.error:
+            raise InvalidPkt('packet too short')
+
+        values = []
+        cur = 0
+        for unpacker, amount in self.unpackers:
+            if unpacker is None:
+                values.append(items[cur])
+            else:
+                values.append(unpacker(*items[cur: cur + amount]))
+            cur += amount
+
+        if self.tail_unpacker is not None:
+            # Packet too short, it must be invalid
+            if len(data) <= self.size:
+                raise InvalidPkt('packet too short')
+
+            values.append(self.tail_unpacker(data[self.size:]))
+
+        return values
+
+
+class PktByteFields():
+
+    ''' Bytes of fields, sliced from the packed data on demand
+
+    This is the "byte_fields" of packets, we don't slice all fields
+    of every packet but only the ones that are used.
+
+    If the packed data is a memoryview, slices are memoryviews too.
+    '''
+
+    __slots__ = ('_codec', '_values', '_data')
+
+    def __init__(self, codec, values=None, data=None):
+        ''' Constructor
+
+        :param codec: the PktCodec instance
+        :param values: values of fields, they will be packed on demand if
+                       the data is not given
+        :param data: the packed data
+        '''
+
+        self._codec = codec
+        self._values = values
+        self._data = data
+
+    def split(self, name):
+        ''' get bytes before the field and bytes after the field
+
+        :return: (head, tail) in memoryviews
+        '''
+
+        start, stop = self._codec.offsets[name]
+
+        if self._data is None:
+            self._data = self._codec.pack(self._values, partial=True)
+
+        data = memoryview(self._data)
+        return data[:start], data[len(data) if stop is None else stop:]
+
+    def reset(self, data=None):
+        ''' drop the packed data after values are changed,
+        or replace it with the given data
+        '''
+
+        self._data = data
+
+    def packed(self):
+        ''' get the packed data of all fields
+        '''
+
+        if self._data is None:
+            self._data = self._codec.pack(self._values, partial=True)
+
+        return self._data
+
+    def __getattr__(self, name):
+        span = self._codec.offsets.get(name)
+        if span is None:
+            return None
+
+        if self._data is None:
+            self._data = self._codec.pack(self._values, partial=True)
+
+        start, stop = span
+        return self._data[start: stop]
+
+
+# slot ID and the sender in front of encrypted packets
+CRYPTO_PREFIX_STRUCT = struct.Struct('=B4sH')
+
+# slot ID, the sender and sn in front of packets encrypted by AEAD ciphers
+AEAD_PREFIX_STRUCT = struct.Struct('=B4sHQ')
+
+
 class BaseProtocolWrapper():
 
     ''' The ProtocolWrapper class
@@ -187,6 +581,9 @@ class BaseProtocolWrapper():
     They pack the field values into bytes that can be transmitted or
     parse the received bytes into defined fields.
 
+    The header format and body formats are compiled into a PktCodec for
+    each packet type on the first use, see PktCodec.
+
     Notice about the struct std-lib:
         As the Python doc says:
             Native byte order is big-endian or little-endian,
@@ -194,12 +591,51 @@ class BaseProtocolWrapper():
             For example, Intel x86 and AMD64 (x86-64) are little-endian;
 
         Neverland is supposed to run only in x86 or x86_64 environments.
-        In current implementation, we used the native packing options in
-        most of invoking of strcut.pack, and it will help us to ensure
-        the length of the packed bytes.
+        In current implementation, we pack fields in the native byte order
+        without alignment (the "=" option of struct), and sizes of fields
+        are the same as the native sizes.
 
         So, in this case, current implementation of ProtocolWrappers are
         totally dependent on the hardware architecture.
+
+    Encryption:
+        If net.crypto.cipher is configured, packed packets will be
+        encrypted with the IV of the connection with the next hop, and
+        the IV slot ID and the sender will be put in front of the
+        encrypted data in cleartext:
+
+            +---------+--------+----------------------------+
+            | slot ID | sender | encrypted packet           |
+            +---------+--------+----------------------------+
+
+        The sender is the socket address that the sending node listens
+        on, in the same format as the src field. The recipient finds the
+        IV by the slot ID and the sender. The source address of the UDP
+        packet is not used, nodes send packets from sockets other than the
+        one they listen on, e.g. the efferent and the packet repeater.
+
+        Conn-ctrl packets and packets to remotes without an established
+        connection are encrypted with the default IV (slot ID 0x00).
+        Cryptor objects are cached in a CryptorCache, see CryptorCache.
+
+        AEAD ciphers need a unique nonce for each packet, which is made
+        from the IV and the sn of the packet, so the sn is put in front
+        of the encrypted data in cleartext too. The whole cleartext
+        prefix is authenticated as the AAD, and the tag is appended:
+
+            +---------+--------+----+------------------------+-----+
+            | slot ID | sender | sn | encrypted packet       | tag |
+            +---------+--------+----+------------------------+-----+
+
+        The tag authenticates the packet, so there is no mac field in
+        headers, see neverland.protocol.v0.fmt.gen_mac_definition.
+
+    Rewrapping:
+        Packets that have been wrapped can be kept in the packed format,
+        which is the data before the encryption, see PktByteFields.packed.
+        The rewrap method wraps them again by encrypting the packed data
+        only, fields are not packed or calculated again, except the time
+        field and the mac field if the packet is restamped.
     '''
 
     def __init__(
@@ -228,8 +664,61 @@ class BaseProtocolWrapper():
             PktTypes.CONN_CTRL: self.conn_ctrl_pkt_fmt,
         }
 
-        # used by self.make_udp_pkt
-        self.complexed_fmt_cache = dict()
+        # compiled codecs of each packet type, {packet type: PktCodec}
+        self._codecs = dict()
+
+        # the struct and offset to read the type field before
+        # we know which codec should be used
+        self._type_struct = None
+        self._type_offset = None
+
+        if self.config.net.crypto.cipher is None:
+            self.cryptor_cache = None
+        else:
+            self.cryptor_cache = CryptorCache(config)
+
+        self.aead = is_aead_cipher(self.config.net.crypto.cipher)
+
+    def get_codec(self, pkt_type):
+        ''' get the compiled codec of a packet type
+
+        :return: PktCodec instance, or None if the type is unknown
+        '''
+
+        codec = self._codecs.get(pkt_type)
+        if codec is not None:
+            return codec
+
+        body_fmt = self._body_fmt_mapping.get(pkt_type)
+        if body_fmt is None or pkt_type == 'header':
+            return None
+
+        codec = PktCodec(
+                    list(self.header_fmt.__fmt__.items()) +
+                    list(body_fmt.__fmt__.items()),
+                    name=body_fmt.__name__.replace('Format', 'Fields'),
+                )
+        self._codecs.update({pkt_type: codec})
+        return codec
+
+    def _read_type(self, data):
+        ''' read the type field in the header
+        '''
+
+        if self._type_struct is None:
+            header_codec = PktCodec(
+                list(self.header_fmt.__fmt__.items()),
+                allow_tail=False,
+            )
+            self._type_struct = struct.Struct(
+                                    '=' + header_codec.formats['type']
+                                )
+            self._type_offset = header_codec.offsets['type'][0]
+
+        try:
+            return self._type_struct.unpack_from(data, self._type_offset)[0]
+        except struct.error:
+            raise InvalidPkt('packet too short')
 
     def wrap(self, pkt):
         ''' make a valid Neverland UDP packet
@@ -249,122 +738,246 @@ class BaseProtocolWrapper():
         pkt.type = _type
 
         udp_data = self.make_udp_pkt(pkt, pkt_fmt)
+
+        if self.cryptor_cache is not None:
+            udp_data = self.encrypt(pkt, udp_data)
+
         pkt.data = udp_data
         return pkt
 
-    def make_udp_pkt(self, pkt, body_fmt):
-        ''' make a valid Neverland UDP packet
+    def rewrap(self, pkt, restamp=False):
+        ''' wrap a packet again from its packed data
+
+        :param pkt: neverland.pkt.UDPPacket object, pkt.data shall be the
+                    packed data, pkt.type, pkt.next_hop and pkt.fields.sn
+                    are required as well
+        :param restamp: update the time field and the mac field
+        :return: neverland.pkt.UDPPacket object
+        '''
+
+        udp_data = pkt.data
+
+        if restamp:
+            udp_data = self.restamp(pkt)
+
+        if self.cryptor_cache is not None:
+            udp_data = self.encrypt(pkt, udp_data)
+
+        pkt.data = udp_data
+        return pkt
+
+    def restamp(self, pkt):
+        ''' recalculate the time field and the mac field of packed data
 
-        During the packing, this method will put each fields into pkt.byte_fields
+        Packets encrypted by AEAD ciphers cannot be restamped, the nonce
+        is made from the sn, so it would be reused with a different
+        plaintext.
+
+        :param pkt: neverland.pkt.UDPPacket object, pkt.data shall be the
+                    packed data
+        :return: the restamped packed data
+        '''
+
+        if self.aead:
+            raise PktWrappingError(
+                'Packets encrypted by AEAD ciphers cannot be restamped'
+            )
+
+        codec = self.get_codec(pkt.type)
+        if codec is None:
+            raise PktWrappingError(f'Unknown packet type: {pkt.type}')
+
+        body_fmt = self._body_fmt_mapping.get(pkt.type)
+        data = bytearray(pkt.data)
+
+        # the mac is always calculated at last
+        for field_name in ('time', 'mac'):
+            definition = self.header_fmt.__fmt__.get(field_name)
+            if definition is None:
+                continue
+
+            # calculators read bytes of other fields from the byte_fields
+            pkt.byte_fields = PktByteFields(codec, data=bytes(data))
+            value = definition.calculator(pkt, self.header_fmt, body_fmt)
+
+            if definition.type == FieldTypes.PY_BYTES:
+                value = _pack_bytes(value)
+
+            struct.pack_into(
+                '=' + codec.formats[field_name],
+                data,
+                codec.offsets[field_name][0],
+                value,
+            )
+
+        udp_data = bytes(data)
+        pkt.byte_fields = PktByteFields(codec, data=udp_data)
+        return udp_data
+
+    def get_conn_iv(self, pkt):
+        ''' get the IV of the connection with the next hop
+
+        :return: (slot_id, iv), iv is None for the default IV
+        '''
+
+        conn_mgr = NodeContext.conn_mgr
+        remote = pkt.next_hop
+
+        if (
+            conn_mgr is None or
+            remote is None or
+            pkt.type == PktTypes.CONN_CTRL
+        ):
+            return DEFAULT_IV_SLOT_ID, None
+
+        slot_id, iv = conn_mgr.get_current_iv(remote)
+        if slot_id is None:
+            return DEFAULT_IV_SLOT_ID, None
+
+        return slot_id, iv
+
+    def encrypt(self, pkt, udp_data):
+        ''' encrypt the packed packet and put the cleartext prefix in front
 
         :param pkt: neverland.pkt.UDPPacket object
-        :param body_fmt: the format definition class of the packet body
+        :param udp_data: the packed packet
         :return: udp_data
         '''
 
-        udp_data = b''
-        fmt_name = body_fmt.__class__.__name__
+        slot_id, iv = self.get_conn_iv(pkt)
+        remote = pkt.next_hop
+        if iv is not None:
+            remote = (remote[0], remote[1])
 
-        # Here, we need combine the header format and the body format,
-        # so that the calculator priority can work in both 2 format classes
-        if fmt_name in self.complexed_fmt_cache:
-            fmt = self.complexed_fmt_cache.get(fmt_name)
-        else:
-            fmt = ComplexedFormat()
-            fmt.combine_fmt(self.header_fmt)
-            fmt.combine_fmt(body_fmt)
-            fmt.sort_calculators()
+        cryptor = self.cryptor_cache.get(remote, slot_id, iv)
+        sender_ip, sender_port = _pack_ipv4_sa(
+            (NodeContext.local_ip or '0.0.0.0', NodeContext.listen_port or 0)
+        )
 
-            self.complexed_fmt_cache.update({fmt_name: fmt})
+        if not self.aead:
+            prefix = CRYPTO_PREFIX_STRUCT.pack(slot_id, sender_ip, sender_port)
+            return prefix + cryptor.encrypt(udp_data)
 
-        for field_name, definition in fmt.__fmt__.items():
-            value = getattr(pkt.fields, field_name)
+        sn = pkt.fields.sn
+        prefix = AEAD_PREFIX_STRUCT.pack(slot_id, sender_ip, sender_port, sn)
+        return prefix + cryptor.encrypt(udp_data, sn=sn, aad=prefix)
 
-            if value is None:
-                if definition.calculator is None:
-                    if definition.default is not None:
-                        value = definition.default
-                    else:
-                        raise PktWrappingError(
-                            f'Field {field_name} has no value '
-                            f'nor calculator or a default value'
-                        )
-                else:
-                    # we will calculate it later by the specified calculator
-                    continue
+    def decrypt(self, pkt):
+        ''' decrypt a received packet
 
-            fragment = self._pack_field(value, definition.type)
-            pkt.byte_fields.__update__(**{field_name: fragment})
+        :param pkt: neverland.pkt.UDPPacket object
+        :return: the decrypted udp_data
+        :raises InvalidPkt: if we cannot find the IV of the sender
+        '''
 
-        for field_name, definition in fmt.__calc_definition__.items():
-            value = getattr(pkt.fields, field_name)
+        data = pkt.data
 
-            if value is None:
-                value = definition.calculator(pkt, self.header_fmt, body_fmt)
+        if self.aead:
+            prefix_len = AEAD_PREFIX_STRUCT.size
+            if len(data) <= prefix_len:
+                raise InvalidPkt('packet too short')
 
-                if value is None:
-                    raise PktWrappingError(
-                        f'Field {field_name}: calculator {calculator} doesn\'t '
-                        f'return a valid value'
-                    )
+            slot_id, sender_ip, sender_port, sn = \
+                AEAD_PREFIX_STRUCT.unpack_from(data)
+        else:
+            prefix_len = CRYPTO_PREFIX_STRUCT.size
+            if len(data) <= prefix_len:
+                raise InvalidPkt('packet too short')
+
+            slot_id, sender_ip, sender_port = \
+                CRYPTO_PREFIX_STRUCT.unpack_from(data)
 
-                pkt.fields.__update__(**{field_name: value})
+        if slot_id == DEFAULT_IV_SLOT_ID:
+            sender = None
+            iv = None
+        else:
+            conn_mgr = NodeContext.conn_mgr
+            if conn_mgr is None:
+                raise InvalidPkt('no connection')
 
-                fragment = self._pack_field(value, definition.type)
-                pkt.byte_fields.__update__(**{field_name: fragment})
+            sender = _unpack_ipv4_sa(sender_ip, sender_port)
+            iv = conn_mgr.get_iv(sender, slot_id)
+            if iv is None:
+                raise InvalidPkt('no connection')
 
-        # Finally, all fields are ready. Now we can combine them into udp_data
-        for field_name, definition in fmt.__fmt__.items():
-            bytes_ = getattr(pkt.byte_fields, field_name)
-            udp_data += bytes_
+        cryptor = self.cryptor_cache.get(sender, slot_id, iv)
 
-        return udp_data
+        if not self.aead:
+            return cryptor.decrypt(memoryview(data)[prefix_len:])
 
-    def _pack_field(self, value, field_type):
-        ''' pack a single field
+        data = memoryview(data)
+        try:
+            return cryptor.decrypt(
+                       data[prefix_len:],
+                       sn=sn,
+                       aad=bytes(data[:prefix_len]),
+                   )
+        except DecryptionFailed:
+            raise InvalidPkt('authentication failed')
 
-        :param value: value of the field
-        :param field_type: type of the field, select from neverland.pkt.FieldTypes
-        :return: bytes
+    def make_udp_pkt(self, pkt, body_fmt):
+        ''' make a valid Neverland UDP packet
+
+        During the packing, this method will set pkt.byte_fields
+
+        :param pkt: neverland.pkt.UDPPacket object
+        :param body_fmt: the format definition class of the packet body
+        :return: udp_data
         '''
 
-        if field_type == FieldTypes.STRUCT_U_CHAR:
-            return struct.pack('B', value)
-        if field_type == FieldTypes.STRUCT_U_INT:
-            return struct.pack('I', value)
-        if field_type == FieldTypes.STRUCT_U_LONG:
-            return struct.pack('L', value)
-        if field_type == FieldTypes.STRUCT_U_LONG_LONG:
-            return struct.pack('Q', value)
-        if field_type == FieldTypes.STRUCT_IPV4_SA:
-            # ipv4 socket address should in the following format: (ip, port)
-            ip, port = value[0], value[1]
-            ip = [int(u) for u in ip.split('.')]
-            return struct.pack('!BBBBH', *ip, port)
-        if field_type == FieldTypes.STRUCT_IPV6_SA:
-            # TODO ipv6 support
-            return None
-        if field_type == FieldTypes.PY_BYTES:
-            if isinstance(value, bytes):
-                return value
-            elif isinstance(value, str):
-                return value.encode()
-            else:
-                raise PktWrappingError(
-                    f'{type(value)} cannot be packed as PY_BYTES'
-                )
-        if field_type == FieldTypes.PY_DICT:
-            if isinstance(value, dict):
-                data = json.dumps(value)
-                return data.encode()
-            elif isinstance(value, ObjectifiedDict):
-                data = json.dumps(value.__to_dict__())
-                return data.encode()
-            else:
+        codec = self.get_codec(pkt.type)
+        fields = pkt.fields
+
+        # fields built by hand are converted into the slotted class
+        if fields.__class__ is not codec.fields_cls:
+            if not isinstance(fields, dict):
+                fields = dict(iter(fields))
+
+            fields = codec.fields_cls(**fields)
+            pkt.fields = fields
+
+        values = []
+        for field_name, has_calculator, default in codec.specs:
+            value = getattr(fields, field_name)
+
+            # If the field has a calculator,
+            # we will calculate it later by the specified calculator
+            if value is None and not has_calculator:
+                if default is not None:
+                    value = default
+                else:
+                    raise PktWrappingError(
+                        f'Field {field_name} has no value '
+                        f'nor calculator or a default value'
+                    )
+
+            values.append(value)
+
+        # calculators may read bytes of fields calculated before them
+        byte_fields = PktByteFields(codec, values=values)
+        pkt.byte_fields = byte_fields
+
+        for idx, field_name, calculator in codec.calculators:
+            if values[idx] is not None:
+                continue
+
+            value = calculator(pkt, self.header_fmt, body_fmt)
+
+            if value is None:
                 raise PktWrappingError(
-                    f'{type(value)} cannot be packed as PY_DICT'
+                    f'Field {field_name}: calculator '
+                    f'{calculator} doesn\'t return a valid value'
                 )
 
+            values[idx] = value
+            setattr(fields, field_name, value)
+            byte_fields.reset()
+
+        # Finally, all fields are ready. Now we can pack them into udp_data
+        udp_data = codec.pack(values)
+        byte_fields.reset(udp_data)
+        return udp_data
+
     def unwrap(self, pkt):
         ''' unpack a raw UDP packet
 
@@ -377,6 +990,7 @@ class BaseProtocolWrapper():
             pkt.fields = fields
             pkt.byte_fields = byte_fields
             pkt.type = fields.type
+            self.verify_pkt(pkt)
             pkt.valid = True
         except InvalidPkt as e:
             pkt.fields = None
@@ -385,90 +999,45 @@ class BaseProtocolWrapper():
 
         return pkt
 
-    def parse_udp_pkt(self, pkt):
-        ''' parse a raw UDP packet
+    def verify_pkt(self, pkt):
+        ''' run verifiers of fields on a parsed packet
 
-        :param value: value of the field
-        :return: (fields, byte_fields)
+        :raises InvalidPkt: if the packet fails in verifying
         '''
 
-        cur = 0   # cursor
-        fields = ObjectifiedDict()
-        byte_fields = ObjectifiedDict()
-
-        # parse the header first
-        for field_name, definition in self.header_fmt.__fmt__.items():
-            field_data = pkt.data[cur: cur + definition.length]
-
-            # Packet too short, it must be invalid
-            if len(field_data) == 0:
-                raise InvalidPkt('packet too short')
-
-            try:
-                value = self._unpack_field(field_data, definition.type)
-            except struct.error:
-                raise InvalidPkt('unpack failed')
+        codec = self.get_codec(pkt.type)
+        if len(codec.verifiers) == 0:
+            return
 
-            fields.__update__(**{field_name: value})
-            byte_fields.__update__(**{field_name: field_data})
-            cur += definition.length
+        body_fmt = self._body_fmt_mapping.get(pkt.type)
+        for verifier in codec.verifiers:
+            verifier(pkt, self.header_fmt, body_fmt)
 
-        body_type = fields.type
-        body_fmt = self._body_fmt_mapping.get(body_type)
-        if body_fmt is None:
-            raise InvalidPkt('invalid type')
-
-        # parse the body
-        for field_name, definition in body_fmt.__fmt__.items():
-            field_data = pkt.data[cur: cur + definition.length]
-            # Packet too short, it must be invalid
+    def parse_udp_pkt(self, pkt):
+        ''' parse a raw UDP packet
 
-            if len(field_data) == 0:
-                raise InvalidPkt('packet too short')
+        :param pkt: neverland.pkt.UDPPacket object
+        :return: (fields, byte_fields)
+        '''
 
-            try:
-                value = self._unpack_field(field_data, definition.type)
-            except struct.error:
-                raise InvalidPkt('unpack failed')
+        # bytes or a memoryview of the receiving buffer
+        data = pkt.data
 
-            fields.__update__(**{field_name: value})
-            byte_fields.__update__(**{field_name: field_data})
-            cur += definition.length
+        if self.cryptor_cache is not None:
+            data = self.decrypt(pkt)
 
-        return fields, byte_fields
+        return self.parse_packed(data)
 
-    def _unpack_field(self, data, field_type):
-        ''' unpack a single field
+    def parse_packed(self, data):
+        ''' parse packed data, which has been decrypted or not encrypted
 
-        :param data: bytes
-        :param field_type: type of the field, choosed from neverland.pkt.FieldTypes
-        :return: the unpacked value
+        :param data: bytes or memoryview
+        :return: (fields, byte_fields)
         '''
 
-        if field_type == FieldTypes.STRUCT_U_CHAR:
-            return struct.unpack('B', data)[0]
-        if field_type == FieldTypes.STRUCT_U_INT:
-            return struct.unpack('I', data)[0]
-        if field_type == FieldTypes.STRUCT_U_LONG:
-            return struct.unpack('L', data)[0]
-        if field_type == FieldTypes.STRUCT_U_LONG_LONG:
-            return struct.unpack('Q', data)[0]
-        if field_type == FieldTypes.STRUCT_IPV4_SA:
-            info = struct.unpack('!BBBBH', data)
-            ip = '.'.join(
-                    [str(unit) for unit in info[0:4]]
-                 )
-            port = info[-1]
-            return (ip, port)
-        if field_type == FieldTypes.STRUCT_IPV6_SA:
-            # TODO ipv6 support
-            return None
-        if field_type == FieldTypes.PY_BYTES:
-            return data
-        if field_type == FieldTypes.PY_DICT:
-            try:
-                return json.loads(data.decode())
-            except json.decoder.JSONDecodeError:
-                raise InvalidPkt('failed to parse a PY_DICT field')
-            except UnicodeDecodeError:
-                raise InvalidPkt('failed to decode a PY_DICT field')
+        codec = self.get_codec(self._read_type(data))
+        if codec is None:
+            raise InvalidPkt('invalid type')
+
+        fields = codec.fields_cls(*codec.unpack(data))
+        return fields, PktByteFields(codec, data=data)
@@ -1,18 +1,37 @@
 #!/usr/bin/python3.6
 # coding: utf-8
 
+from collections import OrderedDict
+
 from neverland.utils import HashTools
 from neverland.exceptions import ArgumentError
 from neverland.protocol.crypto.mode import Modes
 from neverland.protocol.crypto.openssl import OpenSSLCryptor, load_libcrypto
+from neverland.protocol.crypto.kc.aead.gcm import GCMKernelCryptor
 
 
 openssl_ciphers = {
     cipher: OpenSSLCryptor for cipher in OpenSSLCryptor.supported_ciphers
 }
 
+kc_ciphers = {
+    cipher: GCMKernelCryptor for cipher in GCMKernelCryptor.supported_ciphers
+}
+
 supported_ciphers = {}
 supported_ciphers.update(openssl_ciphers)
+supported_ciphers.update(kc_ciphers)
+
+# ciphers that authenticate the data by themselves
+aead_ciphers = set(OpenSSLCryptor.aead_ciphers)
+aead_ciphers.update(GCMKernelCryptor.aead_ciphers)
+
+
+# The IV slot ID of the default IV, see CryptorCache
+DEFAULT_IV_SLOT_ID = 0x00
+
+# default capacity of the CryptorCache
+DEFAULT_CRYPTOR_CACHE_SIZE = 128
 
 
 openssl_preload_func_map = {
@@ -24,6 +43,10 @@ preload_funcs = {}
 preload_funcs.update(openssl_preload_func_map)
 
 
+def is_aead_cipher(cipher_name):
+    return cipher_name in aead_ciphers
+
+
 def preload_crypto_lib(cipher_name=None, libpath='libcrypto.so.1.1'):
     preload_func = preload_funcs.get(cipher_name)
     if preload_func is not None:
@@ -33,10 +56,20 @@ def preload_crypto_lib(cipher_name=None, libpath='libcrypto.so.1.1'):
 class Cryptor(object):
 
     def __init__(self, config, key=None, iv=None):
+        ''' Constructor
+
+        :param config: the config
+        :param key: reserved, the key is always derived from the password
+        :param iv: the IV of the connection, the default IV derived from
+                   the config will be used if it's None
+        '''
+
         self.config = config
+        self._iv = iv
 
         self._cipher_name = self.config.net.crypto.cipher
         self._cipher_cls = supported_ciphers.get(self._cipher_name)
+        self.aead = is_aead_cipher(self._cipher_name)
 
         if self._cipher_cls is None:
             raise Exception('unsupported cipher')
@@ -47,15 +80,109 @@ class Cryptor(object):
         self._init_ciphers()
 
     def _init_ciphers(self):
-        self._cipher = self._cipher_cls(self.config, Modes.ENCRYPTING)
-        self._decipher = self._cipher_cls(self.config, Modes.DECRYPTING)
+        self._cipher = self._cipher_cls(
+                           self.config, Modes.ENCRYPTING, iv=self._iv
+                       )
+        self._decipher = self._cipher_cls(
+                             self.config, Modes.DECRYPTING, iv=self._iv
+                         )
 
     def reset(self):
         self._cipher.reset()
         self._decipher.reset()
 
-    def encrypt(self, data):
-        return self._cipher.update(data)
+    def encrypt(self, data, sn=None, aad=None):
+        ''' encrypt data
+
+        :param data: bytes or bytes-like object
+        :param sn: AEAD ciphers only, the packet sn to make the nonce
+        :param aad: AEAD ciphers only, additional authenticated data
+        '''
+
+        if sn is None:
+            return self._cipher.update(data)
+
+        nonce = self._cipher.make_nonce(sn)
+        return self._cipher.update(data, nonce, aad)
+
+    def decrypt(self, data, sn=None, aad=None):
+        ''' decrypt data
+
+        :param data: bytes or bytes-like object
+        :param sn: AEAD ciphers only, the packet sn to make the nonce
+        :param aad: AEAD ciphers only, additional authenticated data
+        :raises DecryptionFailed: if the data fails in authenticating
+        '''
+
+        if sn is None:
+            return self._decipher.update(data)
+
+        nonce = self._decipher.make_nonce(sn)
+        return self._decipher.update(data, nonce, aad)
+
+
+class CryptorCache():
+
+    ''' The LRU cache of Cryptor objects
+
+    Initializing a Cryptor costs a lot (OpenSSL contexts or AF_ALG sockets),
+    so we don't create them for each packet. Cryptors are cached by the
+    remote node, the IV slot and the IV, once the connection in a slot is
+    replaced, the IV changes and the old Cryptor will be evicted finally.
+
+    IV slots are identified by one byte IDs in packets, see the
+    ConnectionManager. The default IV has the slot ID DEFAULT_IV_SLOT_ID,
+    it's shared by all remotes.
+    '''
+
+    def __init__(self, config, capacity=None):
+        ''' Constructor
+
+        :param config: the config
+        :param capacity: max amount of cached Cryptor objects
+        '''
+
+        self.config = config
+        self.capacity = (
+            capacity or
+            config.net.crypto.cache_size or
+            DEFAULT_CRYPTOR_CACHE_SIZE
+        )
+
+        # structure: {(remote, slot_id, iv): Cryptor}
+        self._cryptors = OrderedDict()
+
+    def get(self, remote, slot_id, iv):
+        ''' get a cryptor, create it if it's not cached
+
+        :param remote: remote socket address, (ip, port)
+        :param slot_id: ID of the IV slot
+        :param iv: the IV of the connection, None for the default IV
+        :return: Cryptor object
+        '''
+
+        if slot_id == DEFAULT_IV_SLOT_ID:
+            remote = None
+            iv = None
+
+        key = (remote, slot_id, iv)
+        cryptors = self._cryptors
+
+        cryptor = cryptors.get(key)
+        if cryptor is not None:
+            cryptors.move_to_end(key)
+            return cryptor
+
+        cryptor = Cryptor(self.config, iv=iv)
+        cryptors[key] = cryptor
+
+        if len(cryptors) > self.capacity:
+            cryptors.popitem(last=False)
+
+        return cryptor
+
+    def clear(self):
+        self._cryptors.clear()
 
-    def decrypt(self, data):
-        return self._decipher.update(data)
+    def __len__(self):
+        return len(self._cryptors)
@@ -2,10 +2,11 @@
 #coding: utf-8
 
 import os
+import errno
 import socket
 import platform
 
-from neverland.exceptions import ArgumentError
+from neverland.exceptions import ArgumentError, DecryptionFailed
 from neverland.utils import HashTools
 from neverland.protocol.crypto.mode import Modes
 from neverland.protocol.crypto.kc.base import BaseKernelCryptor
@@ -19,6 +20,12 @@ Supported algorithms:
     aes-256-gcm
 
 Linux kernel >= 4.9 is required
+
+If a nonce or an AAD is passed to update, the data is processed in the
+same format as the OpenSSLCryptor: the AAD is not a part of the input or
+the output, and the tag is appended to the cipher text. Otherwise, a
+random AAD is put in front of the cipher text and the IV of the cryptor
+is used as the nonce.
 '''
 
 
@@ -41,6 +48,8 @@ class GCMKernelCryptor(BaseKernelCryptor):
         'kc-aes-256-gcm',
     ]
 
+    aead_ciphers = supported_ciphers
+
     key_length_mapping = {
         'kc-aes-128-gcm': 16,
         'kc-aes-192-gcm': 24,
@@ -57,38 +66,65 @@ class GCMKernelCryptor(BaseKernelCryptor):
         self._aad_len = AAD_LENGTH
         self._icv_len = ICV_LENGTH
 
-    def update(self, data):
-        ''' do encryption or decryption
+    def submit(self, op_sock, data, iv=None, aad=None):
+        ''' send a request of encryption or decryption
+
+        :return: (recv_buffer_len, start, stop), the result is
+                 res[start: stop] of the received data
         '''
 
-        if self._mode == Modes.ENCRYPTING:
-            aad = os.urandom(self._aad_len)
-            msg = aad + data
+        # the AAD is carried by the data itself
+        aad_in_data = iv is None and aad is None
 
-            recv_buffer_len = self._aad_len + len(data) + self._icv_len
+        if aad_in_data:
+            aad = os.urandom(self._aad_len) if \
+                  self._mode == Modes.ENCRYPTING else b''
+            assoclen = self._aad_len
         else:
-            msg = data
-            recv_buffer_len = len(data)
+            aad = aad or b''
+            assoclen = len(aad)
+
+        msg = aad + data
+
+        # In encrypting mode of GCM ciphers,
+        # the kernel crypto api returns cipher text in following format:
+        #
+        #     |     AAD       |        cipher text       |      ICV      |
+        #     +---------------+--------------------------+---------------|
+        #
+        # and the AAD and the plain text in decrypting mode.
+        if self._mode == Modes.ENCRYPTING:
+            recv_buffer_len = len(msg) + self._icv_len
+            start = 0 if aad_in_data else assoclen
+            stop = recv_buffer_len
+        else:
+            if len(msg) < assoclen + self._icv_len:
+                raise DecryptionFailed('data is shorter than the tag')
+
+            recv_buffer_len = len(msg)
+            start = assoclen
+            stop = recv_buffer_len - self._icv_len
 
-        self.alg_conn.sendmsg_afalg(
+        op_sock.sendmsg_afalg(
             [msg],
             op=self._op,
-            iv=self._iv,
-            assoclen=self._aad_len,
+            iv=iv or self._iv,
+            assoclen=assoclen,
         )
 
-        res = self.alg_conn.recv(recv_buffer_len)
+        return recv_buffer_len, start, stop
 
-        if self._mode == Modes.ENCRYPTING:
-            # In encrypting mode of GCM ciphers,
-            # the kernel crypto api returns cipher text in following format:
-            #
-            #     |     AAD       |        cipher text       |      ICV      |
-            #     +---------------+--------------------------+---------------|
-            #
-            # We don't need to transform it into another format.
-            # It can be sent to the remote directly.
-            return res
-        else:
-            # Here we extract the plain text and return the plain text only
-            return res[self._aad_len: recv_buffer_len - self._icv_len]
+    def collect(self, op_sock, ticket):
+        ''' receive the result of a request
+        '''
+
+        recv_buffer_len, start, stop = ticket
+
+        try:
+            res = op_sock.recv(recv_buffer_len)
+        except OSError as e:
+            if e.errno == errno.EBADMSG:
+                raise DecryptionFailed('tag mismatches')
+            raise
+
+        return res[start: stop]
@@ -8,14 +8,27 @@ import platform
 from neverland.exceptions import ArgumentError
 from neverland.utils import HashTools
 from neverland.protocol.crypto.mode import Modes
+from neverland.protocol.crypto.kc.pool import alg_sock_pool
+from neverland.protocol.crypto.openssl import AEAD_MIN_IV_LENGTH
 
 
 ''' The kernel crypto module
 
 Linux kernel >= 4.9 is required
+
+AF_ALG sockets are shared between cryptors with the same key,
+see neverland.protocol.crypto.kc.pool
+
+AEAD ciphers make nonces from the IV and the packet sn in the same way
+as the OpenSSLCryptor, so packets have the same format in both backends,
+see OpenSSLCryptor.make_nonce.
 '''
 
 
+# default max amount of operation sockets used in update_many
+DEFAULT_KC_BATCH_SIZE = 16
+
+
 _kernel_version_checked = False
 
 
@@ -30,6 +43,9 @@ class BaseKernelCryptor():
 
     supported_ciphers = []
 
+    # ciphers that authenticate the data by themselves
+    aead_ciphers = []
+
     _iv_len = None
     _key_len = None
 
@@ -37,6 +53,7 @@ class BaseKernelCryptor():
     _kc_cipher_name = None
 
     _aad_len = None
+    _icv_len = None
 
     _aead = False
 
@@ -62,12 +79,13 @@ class BaseKernelCryptor():
             f'{KERNEL_MOJOR_VERSION}.{KERNEL_MINOR_VERSION} is required.'
         )
 
-    def __init__(self, config, mode):
+    def __init__(self, config, mode, iv=None):
         ''' Constructor
 
         :param config: the config
         :param mode: the working mod of the cryptor,
                     0 to decrypting and 1 to encrypting
+        :param iv: the IV, the default IV will be used if it's None
         '''
 
         self.config = config
@@ -76,6 +94,7 @@ class BaseKernelCryptor():
         self.__identification = self.config.net.identification
         self.__passwd = self.config.net.crypto.password
         self._mode = mode
+        self._given_iv = iv
 
         self.prepare()
         self.checkup()
@@ -93,6 +112,7 @@ class BaseKernelCryptor():
 
             attributes for aead:
                 self._aad_len
+                self._icv_len
         '''
 
     def checkup(self):
@@ -119,6 +139,11 @@ class BaseKernelCryptor():
         if self._iv_len is None:
             raise RuntimeError(f'{cls_name}._iv_len is None')
 
+        if self._given_iv is not None and len(self._given_iv) != self._iv_len:
+            raise ArgumentError(
+                f'IV length of {self.cipher_name} shall be {self._iv_len}'
+            )
+
         if self._kc_cipher_type is None:
             raise RuntimeError(f'{cls_name}._kc_cipher_type is None')
 
@@ -137,45 +162,130 @@ class BaseKernelCryptor():
             raise ArgumentError(f'Invalid mod: {self._mode}')
 
         self._key = HashTools.hkdf(self.__passwd, self._key_len)
-        self._iv = HashTools.hdivdf(self.__identification, self._iv_len)
-
-        self.alg_sock = self.create_alg_sock()
-        self.alg_conn, _ = self.alg_sock.accept()
+        self._iv = (
+            self._given_iv or
+            HashTools.hdivdf(self.__identification, self._iv_len)
+        )
 
-    def create_alg_sock(self):
-        alg_sock = socket.socket(socket.AF_ALG, socket.SOCK_SEQPACKET)
-        alg_sock.bind(
-            (self._kc_cipher_type, self._kc_cipher_name)
+        self.batch_size = (
+            self.config.net.crypto.kc_batch_size or DEFAULT_KC_BATCH_SIZE
         )
 
-        alg_sock.setsockopt(socket.SOL_ALG, socket.ALG_SET_KEY, self._key)
+        self.alg_context = alg_sock_pool.get_context(
+                               self._kc_cipher_type,
+                               self._kc_cipher_name,
+                               self._key,
+                               self._icv_len if self._aead else None,
+                           )
+        self.alg_conn = self.alg_context.get_op_socks(1)[0]
 
         if self._aead:
-            alg_sock.setsockopt(
-                socket.SOL_ALG,
-                socket.ALG_SET_AEAD_AUTHSIZE,
-                None,
-                self._aad_len,
-            )
+            if len(self._iv) < AEAD_MIN_IV_LENGTH:
+                raise ArgumentError(
+                    f'IV of AEAD ciphers shall be at least '
+                    f'{AEAD_MIN_IV_LENGTH} bytes'
+                )
+
+            # the tail of the IV which the sn will be mixed into
+            self._iv_head = self._iv[:-AEAD_MIN_IV_LENGTH]
+            self._iv_tail = int.from_bytes(
+                                self._iv[-AEAD_MIN_IV_LENGTH:], 'big'
+                            )
+
+    def make_nonce(self, sn):
+        ''' make a nonce for AEAD ciphers from the IV and the packet sn
+
+        :param sn: an unsigned 64 bits integer
+        :return: bytes
+        '''
+
+        tail = (self._iv_tail ^ sn).to_bytes(AEAD_MIN_IV_LENGTH, 'big')
+        return self._iv_head + tail
+
+    def submit(self, op_sock, data, iv=None, aad=None):
+        ''' send a request of encryption or decryption
+
+        :param op_sock: the operation socket
+        :param data: bytes
+        :param iv: the IV used for this data only
+        :param aad: additional authenticated data, AEAD ciphers only
+        :return: anything that collect needs to receive the result
+        '''
+
+    def collect(self, op_sock, ticket):
+        ''' receive the result of a request sent by submit
 
-        return alg_sock
+        :param op_sock: the operation socket
+        :param ticket: the return value of submit
+        :return: bytes
+        '''
 
-    def update(self, data):
+    def update(self, data, iv=None, aad=None):
         ''' do encryption or decryption
+
+        :param data: bytes or bytes-like object
+        :param iv: the IV used for this data only, the IV of the cryptor
+                   will be used if it's None
+        :param aad: additional authenticated data, AEAD ciphers only
+        :return: bytes
+        :raises DecryptionFailed: if the tag of AEAD ciphers mismatches
+        '''
+
+        ticket = self.submit(self.alg_conn, data, iv, aad)
+        return self.collect(self.alg_conn, ticket)
+
+    def update_many(self, data_list, ivs=None):
+        ''' do encryption or decryption for a list of data
+
+        Data are sent to multiple operation sockets before we receive
+        any result, at most batch_size requests are in flight at once.
+
+        :param data_list: list of bytes
+        :param ivs: a list of IVs for each data, or None to use the IV
+                    of the cryptor for all of them
+        :return: list of bytes
         '''
 
+        amount = min(len(data_list), self.batch_size)
+        if amount == 0:
+            return []
+
+        if ivs is None:
+            ivs = [None] * len(data_list)
+        elif len(ivs) != len(data_list):
+            raise ArgumentError('amount of IVs mismatches the data')
+
+        op_socks = self.alg_context.get_op_socks(amount)
+
+        results = []
+        for start in range(0, len(data_list), amount):
+            batch = zip(
+                        data_list[start: start + amount],
+                        ivs[start: start + amount],
+                    )
+            tickets = [
+                self.submit(op_sock, data, iv)
+                for op_sock, (data, iv) in zip(op_socks, batch)
+            ]
+            results.extend(
+                self.collect(op_sock, ticket)
+                for op_sock, ticket in zip(op_socks, tickets)
+            )
+
+        return results
+
     def change_iv(self, iv):
         self._iv = iv
 
     def clean(self):
         ''' clean/close the cryptor and release resources
-        '''
 
-        if hasattr(self, 'alg_conn'):
-            self.alg_conn.close()
+        Sockets are owned by the alg_sock_pool, so they are not closed
+        here, see AlgSocketPool.close.
+        '''
 
-        if hasattr(self, 'alg_sock'):
-            self.alg_sock.close()
+        self.alg_conn = None
+        self.alg_context = None
 
     def reset(self):
         ''' reset the cryptor
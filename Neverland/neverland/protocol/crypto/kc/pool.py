@@ -0,0 +1,112 @@
+#!/usr/bin/python3.6
+#coding: utf-8
+
+import socket
+
+
+''' The pool of AF_ALG sockets
+
+An AF_ALG socket that bound to an algorithm and keyed by setsockopt is
+a template of transformations, sockets accepted from it are operation
+sockets. Each request sent to an operation socket carries the operation
+and the IV by itself, so operation sockets don't belong to any specific
+cryptor either.
+
+In Neverland, all cryptors of a node derive the key from the same
+password, only the IV differs between connections. So we bind and key
+the template socket only once for each (cipher type, cipher name, key,
+authsize), and all cryptors with the same key share the template socket
+and the operation sockets accepted from it.
+
+A cryptor may borrow multiple operation sockets to process a batch of
+data. Requests are sent to all of them first and results are received
+afterwards, the kernel processes each request in recv, so there is no
+need to poll them.
+'''
+
+
+class AlgContext():
+
+    ''' The template socket and the operation sockets of a key
+    '''
+
+    def __init__(self, cipher_type, cipher_name, key, authsize=None):
+        ''' Constructor
+
+        :param cipher_type: type of the algorithm, e.g. "aead"
+        :param cipher_name: name of the algorithm, e.g. "gcm(aes)"
+        :param key: the key
+        :param authsize: the size of the ICV, AEAD ciphers only
+        '''
+
+        self.alg_sock = socket.socket(socket.AF_ALG, socket.SOCK_SEQPACKET)
+        self.alg_sock.bind((cipher_type, cipher_name))
+        self.alg_sock.setsockopt(socket.SOL_ALG, socket.ALG_SET_KEY, key)
+
+        if authsize is not None:
+            self.alg_sock.setsockopt(
+                socket.SOL_ALG,
+                socket.ALG_SET_AEAD_AUTHSIZE,
+                None,
+                authsize,
+            )
+
+        self._op_socks = []
+
+    def get_op_socks(self, amount=1):
+        ''' get operation sockets, accept new ones if necessary
+
+        :param amount: amount of operation sockets
+        :return: list of sockets
+        '''
+
+        op_socks = self._op_socks
+        while len(op_socks) < amount:
+            op_sock, _ = self.alg_sock.accept()
+            op_socks.append(op_sock)
+
+        return op_socks[:amount]
+
+    def close(self):
+        for op_sock in self._op_socks:
+            op_sock.close()
+        self._op_socks = []
+
+        self.alg_sock.close()
+
+
+class AlgSocketPool():
+
+    ''' The pool of AlgContext objects
+    '''
+
+    def __init__(self):
+        # structure: {(cipher_type, cipher_name, key, authsize): AlgContext}
+        self._contexts = dict()
+
+    def get_context(self, cipher_type, cipher_name, key, authsize=None):
+        ''' get the shared AlgContext, create it if it doesn't exist
+
+        :return: AlgContext object
+        '''
+
+        context_key = (cipher_type, cipher_name, key, authsize)
+
+        context = self._contexts.get(context_key)
+        if context is None:
+            context = AlgContext(cipher_type, cipher_name, key, authsize)
+            self._contexts.update({context_key: context})
+
+        return context
+
+    def close(self):
+        for context in self._contexts.values():
+            context.close()
+        self._contexts.clear()
+
+    def __len__(self):
+        return len(self._contexts)
+
+
+# the pool shared by all kernel cryptors in the process
+alg_sock_pool = AlgSocketPool()
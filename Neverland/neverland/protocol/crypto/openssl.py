@@ -7,12 +7,12 @@ from ctypes import (
     CDLL,
     c_void_p,
     c_int,
-    c_long,
     c_char_p,
+    string_at,
     create_string_buffer,
 )
 
-from neverland.exceptions import ArgumentError
+from neverland.exceptions import ArgumentError, DecryptionFailed
 from neverland.utils import HashTools
 from neverland.protocol.crypto.mode import Modes
 
@@ -21,12 +21,34 @@ from neverland.protocol.crypto.mode import Modes
 
 libcrypto.so.1.1 is required
 
-Currently, it's not used.
+Each packet is encrypted from the beginning of the IV, so the cipher
+context shall be rewound after each update. Rewinding is done by calling
+EVP_CipherInit_ex with only the IV, the cipher and the key schedule are
+kept in the context. Ciphers without IV (rc4) are rewound by the key.
+
+Cryptors write into a reusable output buffer instead of allocating one
+for each update, the result is copied out of it.
+
+AEAD ciphers (GCM and ChaCha20-Poly1305) are finalized after each update,
+the tag is appended to the cipher text in encrypting and verified in
+decrypting. Reusing a nonce with the same key breaks them, so the IV of
+the cryptor shall not be used directly, a nonce shall be passed with
+each data instead, see OpenSSLCryptor.make_nonce.
 '''
 
 
 EVP_MAX_KEY_LENGTH = 64
 EVP_MAX_IV_LENGTH = 16
+EVP_MAX_BLOCK_LENGTH = 32
+
+EVP_CTRL_AEAD_SET_IVLEN = 0x09
+EVP_CTRL_AEAD_GET_TAG = 0x10
+EVP_CTRL_AEAD_SET_TAG = 0x11
+
+AEAD_TAG_LENGTH = 16
+
+# the sn is mixed into the tail of the IV to make nonces
+AEAD_MIN_IV_LENGTH = 8
 
 
 libcrypto = None
@@ -48,6 +70,17 @@ def load_libcrypto(libpath='libcrypto.so.1.1'):
         libcrypto.EVP_CipherUpdate.argtypes = [
             c_void_p, c_void_p, c_void_p, c_char_p, c_int
         ]
+        libcrypto.EVP_CipherFinal_ex.argtypes = [c_void_p, c_void_p, c_void_p]
+        libcrypto.EVP_CIPHER_CTX_ctrl.argtypes = [
+            c_void_p, c_int, c_int, c_void_p
+        ]
+
+        # renamed in OpenSSL 3.0, the old name is a macro now
+        get_iv_length = getattr(libcrypto, 'EVP_CIPHER_get_iv_length', None)
+        if get_iv_length is None:
+            get_iv_length = libcrypto.EVP_CIPHER_iv_length
+        get_iv_length.argtypes = [c_void_p]
+        libcrypto.get_iv_length = get_iv_length
 
         lib_loaded = True
         logging.info('Successfully loaded crypto library from {libpath}')
@@ -90,12 +123,20 @@ class OpenSSLCryptor(object):
         'rc4-hmac-md5',
     ]
 
-    def __init__(self, config, mode):
+    aead_ciphers = [
+        'aes-128-gcm',
+        'aes-192-gcm',
+        'aes-256-gcm',
+        'chacha20-poly1305',
+    ]
+
+    def __init__(self, config, mode, iv=None):
         ''' Constructor
 
         :param config: the config
         :param mode: mod argument for EVP_CipherInit_ex. 0 or 1,
                      0 means decrypting and 1 means encrypting,
+        :param iv: the IV, the default IV will be used if it's None
         '''
 
         self.config = config
@@ -113,7 +154,7 @@ class OpenSSLCryptor(object):
             raise ArgumentError('IV length overflows')
 
         self._key = HashTools.hkdf(self.__passwd, EVP_MAX_KEY_LENGTH)
-        self._iv = HashTools.hdivdf(self.__passwd, self._iv_len)
+        self._iv = iv or HashTools.hdivdf(self.__passwd, self._iv_len)
 
         if self.cipher_name not in self.supported_ciphers:
             raise ArgumentError(f'Unsupported cipher name: {self.cipher_name}')
@@ -121,26 +162,219 @@ class OpenSSLCryptor(object):
         if not lib_loaded:
             load_libcrypto(self.libpath)
 
-        self._cph_ctx, self._cph = new_cipher_ctx(
-            self.cipher_name.encode(), self._key, self._iv, self._mod
+        self.aead = self.cipher_name in self.aead_ciphers
+
+        if self.aead:
+            self._cph_ctx, self._cph = new_cipher_ctx(
+                self.cipher_name.encode(), None, None, self._mod
+            )
+            self._init_aead_ctx()
+        else:
+            self._cph_ctx, self._cph = new_cipher_ctx(
+                self.cipher_name.encode(), self._key, self._iv, self._mod
+            )
+
+            if len(self._iv) < libcrypto.get_iv_length(self._cph):
+                raise ArgumentError('IV is shorter than the cipher requires')
+
+        # ciphers without IV cannot be rewound by the IV
+        self._rekey_iv_only = libcrypto.get_iv_length(self._cph) > 0
+
+        self._out = create_string_buffer(self.buf_size)
+        self._outl = c_int(0)
+
+    def _init_aead_ctx(self):
+        ''' set the IV length and the key of an AEAD cipher context
+        '''
+
+        if len(self._iv) < AEAD_MIN_IV_LENGTH:
+            raise ArgumentError(
+                f'IV of AEAD ciphers shall be at least '
+                f'{AEAD_MIN_IV_LENGTH} bytes'
+            )
+
+        iv_len = len(self._iv)
+        if iv_len != libcrypto.get_iv_length(self._cph):
+            res = libcrypto.EVP_CIPHER_CTX_ctrl(
+                      self._cph_ctx, EVP_CTRL_AEAD_SET_IVLEN, iv_len, None
+                  )
+            if res != 1:
+                raise ArgumentError(
+                    f'IV length {iv_len} is not supported by '
+                    f'{self.cipher_name}'
+                )
+
+        libcrypto.EVP_CipherInit_ex(
+            self._cph_ctx, None, None, self._key, self._iv, self._mod
         )
 
-    def update(self, data):
-        in_ = c_char_p(data)
+        # the tail of the IV which the sn will be mixed into
+        self._iv_head = self._iv[:-AEAD_MIN_IV_LENGTH]
+        self._iv_tail = int.from_bytes(self._iv[-AEAD_MIN_IV_LENGTH:], 'big')
+
+    def make_nonce(self, sn):
+        ''' make a nonce for AEAD ciphers from the IV and the packet sn
+
+        The sn is XORed into the tail of the IV, so the nonce is unique
+        as long as the sn is unique under the same IV.
+
+        :param sn: an unsigned 64 bits integer
+        :return: bytes
+        '''
+
+        tail = (self._iv_tail ^ sn).to_bytes(AEAD_MIN_IV_LENGTH, 'big')
+        return self._iv_head + tail
+
+    def _get_out_buffer(self, size):
+        ''' get the reusable output buffer, enlarge it if necessary
+        '''
+
+        if len(self._out) < size:
+            self._out = create_string_buffer(size * 2)
+        return self._out
+
+    def _rewind(self, iv):
+        ''' rewind the context to the beginning of the IV
+        '''
+
+        if self._rekey_iv_only:
+            key = None
+        else:
+            key = self._key
+
+        libcrypto.EVP_CipherInit_ex(
+            self._cph_ctx, None, None, key, iv, self._mod
+        )
+
+    def update(self, data, iv=None, aad=None):
+        ''' encrypt or decrypt data
+
+        :param data: bytes or bytes-like object
+        :param iv: the IV used for this data only, the IV of the cryptor
+                   will be used if it's None
+        :param aad: additional authenticated data, AEAD ciphers only
+        :return: bytes
+        :raises DecryptionFailed: if the tag of AEAD ciphers mismatches
+        '''
+
+        if data.__class__ is not bytes:
+            data = bytes(data)
+
+        if self.aead:
+            return self._update_aead(data, iv or self._iv, aad)
+
+        if iv is not None:
+            self._rewind(iv)
+
         inl = len(data)
-        buf_size = self.buf_size if self.buf_size >= inl else inl * 2
-        out = create_string_buffer(buf_size)
-        outl = c_long(0)
+        out = self._get_out_buffer(inl + EVP_MAX_BLOCK_LENGTH)
+        outl = self._outl
 
         libcrypto.EVP_CipherUpdate(
             self._cph_ctx,
-            byref(out),
+            out,
             byref(outl),
-            in_,
+            data,
             inl,
         )
-        self.reset()
-        return out.raw[:outl.value]
+        self._rewind(self._iv)
+        return string_at(out, outl.value)
+
+    def update_many(self, data_list, ivs=None):
+        ''' encrypt or decrypt a list of data
+
+        This works like calling update for each data, but the lookups
+        are done only once for the whole list.
+
+        :param data_list: a list of bytes or bytes-like objects
+        :param ivs: a list of IVs for each data, or None to use the IV
+                    of the cryptor for all of them
+        :return: a list of bytes
+        '''
+
+        if len(data_list) == 0:
+            return []
+
+        if self.aead:
+            if ivs is None:
+                ivs = [None] * len(data_list)
+            return [self.update(data, iv) for data, iv in zip(data_list, ivs)]
+
+        cipher_update = libcrypto.EVP_CipherUpdate
+        cipher_init = libcrypto.EVP_CipherInit_ex
+
+        ctx = self._cph_ctx
+        mod = self._mod
+        key = None if self._rekey_iv_only else self._key
+        out = self._get_out_buffer(
+                  max(len(data) for data in data_list) + EVP_MAX_BLOCK_LENGTH
+              )
+        outl = self._outl
+        p_outl = byref(outl)
+
+        if ivs is None:
+            ivs = [self._iv] * len(data_list)
+        elif len(ivs) != len(data_list):
+            raise ArgumentError('amount of IVs mismatches the data')
+
+        results = []
+        for data, iv in zip(data_list, ivs):
+            if data.__class__ is not bytes:
+                data = bytes(data)
+
+            cipher_init(ctx, None, None, key, iv, mod)
+            cipher_update(ctx, out, p_outl, data, len(data))
+            results.append(string_at(out, outl.value))
+
+        self._rewind(self._iv)
+        return results
+
+    def _update_aead(self, data, nonce, aad):
+        cipher_update = libcrypto.EVP_CipherUpdate
+        cipher_ctrl = libcrypto.EVP_CIPHER_CTX_ctrl
+
+        ctx = self._cph_ctx
+        outl = self._outl
+        p_outl = byref(outl)
+
+        inl = len(data)
+        if self._mod == Modes.DECRYPTING:
+            inl -= AEAD_TAG_LENGTH
+            if inl < 0:
+                raise DecryptionFailed('data is shorter than the tag')
+
+        out = self._get_out_buffer(inl + AEAD_TAG_LENGTH)
+
+        libcrypto.EVP_CipherInit_ex(ctx, None, None, None, nonce, self._mod)
+
+        if aad:
+            cipher_update(ctx, None, p_outl, aad, len(aad))
+
+        cipher_update(ctx, out, p_outl, data, inl)
+        length = outl.value
+
+        if self._mod == Modes.DECRYPTING:
+            tag = data[inl:]
+            cipher_ctrl(ctx, EVP_CTRL_AEAD_SET_TAG, AEAD_TAG_LENGTH, tag)
+
+            res = libcrypto.EVP_CipherFinal_ex(
+                      ctx, byref(out, length), p_outl
+                  )
+            if res != 1:
+                raise DecryptionFailed('tag mismatches')
+
+            return string_at(out, length + outl.value)
+        else:
+            libcrypto.EVP_CipherFinal_ex(ctx, byref(out, length), p_outl)
+            length += outl.value
+
+            cipher_ctrl(
+                ctx,
+                EVP_CTRL_AEAD_GET_TAG,
+                AEAD_TAG_LENGTH,
+                byref(out, length),
+            )
+            return string_at(out, length + AEAD_TAG_LENGTH)
 
     def clean(self):
         if hasattr(self, '_cph_ctx'):
@@ -152,6 +386,14 @@ class OpenSSLCryptor(object):
 
     def reset(self):
         libcrypto.EVP_CIPHER_CTX_reset(self._cph_ctx)
+
+        if self.aead:
+            libcrypto.EVP_CipherInit_ex(
+                self._cph_ctx, self._cph, None, None, None, self._mod
+            )
+            self._init_aead_ctx()
+            return
+
         libcrypto.EVP_CipherInit_ex(
             self._cph_ctx,
             self._cph,
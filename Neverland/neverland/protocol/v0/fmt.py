@@ -2,7 +2,12 @@
 #coding: utf-8
 
 from neverland.pkt import FieldTypes, PktTypes
+from neverland.utils import HashTools
+from neverland.exceptions import ConfigError
+from neverland.protocol.crypto import is_aead_cipher
 from neverland.protocol.base import (
+    MACMethods,
+    HMACCalculator,
     FieldDefinition,
     BasePktFormat,
     src_calculator,
@@ -27,6 +32,50 @@ it shall contain the data we need to transfer.
 '''
 
 
+def gen_mac_definition(config):
+    ''' generate the definition of the mac field by config.net.mac_method
+
+    The key of the hmac-sha256 method is derived from config.net.mac_key,
+    or the password of the cipher if the mac_key is not given.
+
+    Packets encrypted by AEAD ciphers are authenticated by the tag,
+    so there is no mac field at all, and None will be returned.
+    '''
+
+    if is_aead_cipher(config.net.crypto.cipher):
+        return None
+
+    method = config.net.mac_method or MACMethods.SHA256
+
+    if method == MACMethods.SHA256:
+        # In the sha256 method, the mac is the hex digest,
+        # so the length is fixed to 64
+        return FieldDefinition(
+                   length        = 64,
+                   type          = FieldTypes.PY_BYTES,
+                   calculator    = mac_calculator,
+                   calc_priority = 0xff,
+               )
+    elif method == MACMethods.HMAC_SHA256:
+        password = config.net.mac_key or config.net.crypto.password
+        if password is None:
+            raise ConfigError(
+                'net.mac_key or net.crypto.password is required '
+                'by the hmac-sha256 mac method'
+            )
+
+        calculator = HMACCalculator(HashTools.mac_key(password))
+        return FieldDefinition(
+                   length        = HMACCalculator.DIGEST_SIZE,
+                   type          = FieldTypes.PY_BYTES,
+                   calculator    = calculator.calculate,
+                   calc_priority = 0xff,
+                   verifier      = calculator.verify,
+               )
+    else:
+        raise ConfigError(f'Unsupported mac method: {method}')
+
+
 class HeaderFormat(BasePktFormat):
 
     ''' The format of packet headers
@@ -47,14 +96,8 @@ class HeaderFormat(BasePktFormat):
                     ),
 
             # The Message Authentication Code.
-            # In protocol v0, we use sha256 as the digest method,
-            # so the length is fixed to 64
-            'mac': FieldDefinition(
-                       length        = 64,
-                       type          = FieldTypes.PY_BYTES,
-                       calculator    = mac_calculator,
-                       calc_priority = 0xff,
-                   ),
+            # Calculated in the method selected by config.net.mac_method
+            'mac': gen_mac_definition(config),
 
             # Each UDP packet shall have a serial number as its identifier.
             'sn': FieldDefinition(
@@ -103,6 +146,9 @@ class HeaderFormat(BasePktFormat):
                     ),
         }
 
+        if cls.__fmt__['mac'] is None:
+            cls.__fmt__.pop('mac')
+
 
 class DataPktFormat(BasePktFormat):
 
@@ -143,6 +143,21 @@ class HashTools():
             digest.encode()
         )[x:].encode()
 
+    @classmethod
+    def mac_key(cls, password):
+        ''' derive the key of the keyed mac from the password
+
+        The password is also used in deriving the cipher key, so we add a
+        prefix here to make sure these 2 keys are different.
+
+        :param password: the password in str
+        :return: 32 bytes key
+        '''
+
+        return hashlib.sha256(
+            b'neverland-mac:' + password.encode()
+        ).digest()
+
 
 class Converter():
 
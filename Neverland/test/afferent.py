@@ -0,0 +1,190 @@
+#!/usr/bin/python3.6
+#coding: utf-8
+
+import socket
+import unittest
+
+import __code_path__
+from neverland.pkt import UDPPacket, PktTypes
+from neverland.utils import ObjectifiedDict
+from neverland.afferents.udp import UDPReceiver
+from neverland.efferents.udp import UDPTransmitter
+from neverland.protocol.v0 import ProtocolWrapper
+from neverland.protocol.v0.fmt import (
+    HeaderFormat,
+    DataPktFormat,
+    CtrlPktFormat,
+    ConnCtrlPktFormat,
+)
+from neverland.node.context import NodeContext
+from neverland.components.bufpool import BufferPool
+from neverland.components.idgeneration import IDGenerator
+
+
+NodeContext.id_generator = IDGenerator(1, 1)
+NodeContext.local_ip = '127.0.0.1'
+NodeContext.listen_port = 40000
+
+
+json_config = {
+    'net': {
+        'ipv6': False,
+        'aff_listen_addr': '127.0.0.1',
+        'aff_listen_port': 40010,
+        'crypto': {
+            'salt_len': 8
+        }
+    }
+}
+config = ObjectifiedDict(**json_config)
+
+wrapper = ProtocolWrapper(
+              config,
+              HeaderFormat,
+              DataPktFormat,
+              CtrlPktFormat,
+              ConnCtrlPktFormat,
+          )
+
+
+class AfferentTest(unittest.TestCase):
+
+    def test_0_buffer_pool(self):
+        pool = BufferPool(16, 2, 3)
+        self.assertEqual(len(pool), 2)
+
+        buf0 = pool.acquire()
+        self.assertEqual(len(buf0), 16)
+
+        # free buffers are used in turn
+        buf1 = pool.acquire()
+        self.assertIsNot(buf0, buf1)
+        self.assertIs(pool.acquire(), buf0)
+
+        # exported buffers shall not be reused
+        view0 = memoryview(buf0)[2:4]
+        view1 = memoryview(buf1)
+        self.assertTrue(BufferPool.is_exported(buf0))
+
+        buf2 = pool.acquire()
+        self.assertIsNot(buf2, buf0)
+        self.assertIsNot(buf2, buf1)
+        self.assertEqual(len(pool), 3)
+
+        # the pool is full, buffers are allocated temporarily
+        view2 = memoryview(buf2)
+        buf3 = pool.acquire()
+        self.assertEqual(len(buf3), 16)
+        self.assertEqual(len(pool), 3)
+
+        # buffers can be reused after views are released
+        del view0
+        self.assertFalse(BufferPool.is_exported(buf0))
+        self.assertIs(pool.acquire(), buf0)
+        self.assertEqual(len(buf0), 16)
+
+    def test_1_recv_into(self):
+        receiver = UDPReceiver(config, buffer_amount=2)
+        receiver.listen()
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        try:
+            payloads = [b'a' * 100, b'b' * 1000]
+            for payload in payloads:
+                pkt = UDPPacket()
+                pkt.fields = ObjectifiedDict(
+                                 type=PktTypes.DATA,
+                                 dest=('127.0.0.1', 40011),
+                                 data=payload,
+                             )
+                pkt = wrapper.wrap(pkt)
+                sock.sendto(pkt.data, ('127.0.0.1', 40010))
+
+            received = []
+            for payload in payloads:
+                receiver._sock.setblocking(True)
+                pkt = receiver.recv()
+                self.assertIsInstance(pkt.data, memoryview)
+
+                pkt = wrapper.unwrap(pkt)
+                self.assertTrue(pkt.valid)
+                self.assertEqual(pkt.previous_hop[0], '127.0.0.1')
+
+                # the payload is a slice of the receiving buffer
+                self.assertIsInstance(pkt.fields.data, memoryview)
+                self.assertEqual(pkt.fields.data, payload)
+                self.assertEqual(pkt.fields.dest, ('127.0.0.1', 40011))
+
+                received.append(pkt)
+
+            # packets still alive hold their buffers
+            self.assertEqual(received[0].fields.data, payloads[0])
+            self.assertEqual(received[1].fields.data, payloads[1])
+
+            # the payload can be wrapped again without copying it first
+            pkt = received[1]
+            pkt.fields = ObjectifiedDict(
+                             type=PktTypes.DATA,
+                             dest=pkt.fields.dest,
+                             data=pkt.fields.data,
+                         )
+            pkt = wrapper.wrap(pkt)
+            self.assertEqual(
+                wrapper.unwrap(UDPPacket(data=pkt.data)).fields.data,
+                payloads[1],
+            )
+        finally:
+            sock.close()
+            receiver.destroy()
+
+    def test_2_batch(self):
+        receiver = UDPReceiver(config, buffer_amount=4)
+        receiver.listen()
+
+        efferent = UDPTransmitter(config)
+
+        try:
+            self.assertEqual(receiver.recv_batch(), [])
+
+            for idx in range(10):
+                pkt = UDPPacket(
+                          data=bytes([idx]) * 10,
+                          next_hop=['127.0.0.1', 40010],
+                      )
+                efferent.enqueue(pkt)
+
+            self.assertEqual(efferent.queued_amount, 10)
+            self.assertEqual(efferent.flush(), 10)
+            self.assertEqual(efferent.queued_amount, 0)
+            self.assertEqual(efferent.flush(), 0)
+
+            pkts = receiver.recv_batch(8)
+            self.assertEqual(len(pkts), 8)
+            pkts += receiver.recv_batch(8)
+            self.assertEqual(len(pkts), 10)
+
+            # packets are received in order and their buffers are not
+            # overwritten though there are only 4 buffers in the pool
+            for idx, pkt in enumerate(pkts):
+                self.assertEqual(pkt.data, bytes([idx]) * 10)
+
+            # packets beyond the max amount of the queue are dropped
+            efferent.max_queued_pkts = 2
+            for idx in range(3):
+                pkt = UDPPacket(
+                          data=bytes([idx]) * 10,
+                          next_hop=['127.0.0.1', 40010],
+                      )
+                queued = efferent.enqueue(pkt)
+                self.assertEqual(queued, idx < 2)
+
+            self.assertEqual(efferent.queued_amount, 2)
+            self.assertEqual(efferent.dropped_amount, 1)
+            self.assertEqual(efferent.flush(), 2)
+        finally:
+            receiver.destroy()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,250 @@
+#!/usr/bin/python3.6
+#coding: utf-8
+
+''' Benchmark of the cryptors
+
+Measures encryption and decryption of every cipher in supported_ciphers,
+both OpenSSL and kernel (kc-*) backends, over a sweep of payload sizes.
+Ciphers that cannot be initialized in the current environment (e.g. the
+kernel has no AF_ALG, or libcrypto lacks legacy ciphers) are reported as
+skipped.
+
+Each case is warmed up first, then every operation is timed on its own
+until the duration of the case is exceeded. Results are ops/s, MB/s and
+percentiles of the latency.
+
+AEAD ciphers are benchmarked the way the ProtocolWrapper uses them, with
+a nonce made from the sn for each packet.
+
+Usage:
+    python3 bench_crypto.py [-c CIPHER ...] [-s SIZE ...] [-d SECONDS]
+                            [--json PATH]
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import ctypes.util
+
+import __code_path__
+from neverland.utils import ObjectifiedDict
+from neverland.protocol.crypto import (
+    Cryptor,
+    supported_ciphers,
+    is_aead_cipher,
+)
+
+
+SIZES = [64, 256, 1024, 4096, 16384, 65536]
+WARMUP = 50
+
+# the sn of the first packet, sns are increased for each packet
+FIRST_SN = 1 << 40
+
+PERCENTILES = [50, 90, 99]
+
+
+def make_config(cipher):
+    return ObjectifiedDict(
+        net={
+            'identification': 'bench identification',
+            'crypto': {
+                'cipher': cipher,
+                'password': 'password',
+                'iv_len': 12 if is_aead_cipher(cipher) else 16,
+                'lib_path': ctypes.util.find_library('crypto'),
+            },
+        }
+    )
+
+
+def get_backend(cipher):
+    return 'kc' if cipher.startswith('kc-') else 'openssl'
+
+
+def percentile(sorted_values, pct):
+    ''' the nearest-rank percentile
+    '''
+
+    idx = max(0, -(-len(sorted_values) * pct // 100) - 1)
+    return sorted_values[idx]
+
+
+def run_case(func, args_list, duration):
+    ''' time func(*args) one by one, args are used in turn
+
+    :return: list of elapsed seconds of each operation
+    '''
+
+    perf_counter = time.perf_counter
+    amount = len(args_list)
+
+    for idx in range(WARMUP):
+        func(*args_list[idx % amount])
+
+    elapsed_list = []
+    deadline = perf_counter() + duration
+    idx = 0
+    while True:
+        args = args_list[idx % amount]
+        t0 = perf_counter()
+        func(*args)
+        t1 = perf_counter()
+
+        elapsed_list.append(t1 - t0)
+        idx += 1
+
+        if t1 > deadline:
+            break
+
+    return elapsed_list
+
+
+def make_result(cipher, op, size, elapsed_list):
+    elapsed_list.sort()
+    total = sum(elapsed_list)
+    ops = len(elapsed_list)
+
+    result = {
+        'cipher': cipher,
+        'backend': get_backend(cipher),
+        'op': op,
+        'size': size,
+        'ops': ops,
+        'ops_per_sec': ops / total,
+        'mb_per_sec': ops * size / total / 1024 / 1024,
+    }
+
+    for pct in PERCENTILES:
+        result[f'p{pct}_us'] = percentile(elapsed_list, pct) * 1000000
+
+    return result
+
+
+def bench_cipher(cipher, sizes, duration, report_file):
+    cryptor = Cryptor(make_config(cipher))
+    aead = cryptor.aead
+
+    results = []
+    for size in sizes:
+        # a few packets in turn, so we don't encrypt the same data only
+        payloads = [os.urandom(size) for _ in range(8)]
+
+        if aead:
+            plain_args = [
+                (payload, FIRST_SN + idx)
+                for idx, payload in enumerate(payloads)
+            ]
+            cipher_args = [
+                (cryptor.encrypt(payload, sn), sn)
+                for payload, sn in plain_args
+            ]
+
+            def encrypt(data, sn):
+                return cryptor.encrypt(data, sn=sn)
+
+            def decrypt(data, sn):
+                return cryptor.decrypt(data, sn=sn)
+        else:
+            plain_args = [(payload,) for payload in payloads]
+            cipher_args = [(cryptor.encrypt(payload),) for payload in payloads]
+            encrypt = cryptor.encrypt
+            decrypt = cryptor.decrypt
+
+        assert decrypt(*cipher_args[0]) == payloads[0]
+
+        for op, func, args_list in [
+            ('encrypt', encrypt, plain_args),
+            ('decrypt', decrypt, cipher_args),
+        ]:
+            elapsed_list = run_case(func, args_list, duration)
+            result = make_result(cipher, op, size, elapsed_list)
+            results.append(result)
+            report(result, report_file)
+
+    return results
+
+
+def report(result, report_file):
+    pcts = '  '.join(
+        f'p{pct} {result[f"p{pct}_us"]:9.2f}us' for pct in PERCENTILES
+    )
+    print(
+        f'{result["cipher"]:<20} {result["op"]:<8} {result["size"]:>6}B  '
+        f'{result["ops_per_sec"]:10.0f} ops/s  '
+        f'{result["mb_per_sec"]:9.2f} MB/s  {pcts}',
+        file=report_file,
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark of the cryptors')
+    parser.add_argument(
+        '-c', '--cipher',
+        dest='ciphers',
+        action='append',
+        help='cipher to benchmark, all supported ciphers by default',
+    )
+    parser.add_argument(
+        '-s', '--size',
+        dest='sizes',
+        type=int,
+        action='append',
+        help=f'payload size in bytes, default: {SIZES}',
+    )
+    parser.add_argument(
+        '-d', '--duration',
+        type=float,
+        default=0.2,
+        help='seconds to run each case, default: 0.2',
+    )
+    parser.add_argument(
+        '--json',
+        dest='json_path',
+        help='write results into this file in JSON, "-" for stdout',
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    ciphers = args.ciphers or sorted(supported_ciphers)
+    sizes = args.sizes or SIZES
+
+    # keep the stdout clean for the JSON
+    report_file = sys.stderr if args.json_path == '-' else sys.stdout
+
+    results = []
+    skipped = {}
+    for cipher in ciphers:
+        try:
+            results.extend(
+                bench_cipher(cipher, sizes, args.duration, report_file)
+            )
+        except Exception as e:
+            skipped[cipher] = f'{type(e).__name__}: {e}'
+            print(f'{cipher:<20} skipped, {skipped[cipher]}', file=report_file)
+
+    if args.json_path is None:
+        return
+
+    output = {
+        'platform': sys.platform,
+        'python': sys.version.split()[0],
+        'duration': args.duration,
+        'results': results,
+        'skipped': skipped,
+    }
+
+    if args.json_path == '-':
+        json.dump(output, sys.stdout, indent=4)
+        print()
+    else:
+        with open(args.json_path, 'w') as f:
+            json.dump(output, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/python3.6
+#coding: utf-8
+
+''' Benchmark of the ProtocolWrapper
+
+Measures packets per second of wrapping and unwrapping data packets,
+with all calculators (salt, sn, time, src and mac) enabled, in each of
+the mac methods, and then with encryption enabled in each of CIPHERS.
+The mac field is dropped with AEAD ciphers.
+
+Usage:
+    python3 bench_protocol.py [times] [payload_size]
+'''
+
+import sys
+import time
+import tracemalloc
+import ctypes.util
+
+import __code_path__
+from neverland.pkt import UDPPacket, PktTypes, PktFields
+from neverland.utils import ObjectifiedDict
+from neverland.node.context import NodeContext
+from neverland.afferents.udp import UDP_BUFFER_SIZE
+from neverland.protocol.v0 import ProtocolWrapper
+from neverland.protocol.base import MACMethods
+from neverland.protocol.crypto import is_aead_cipher
+from neverland.protocol.v0.fmt import (
+    HeaderFormat,
+    DataPktFormat,
+    CtrlPktFormat,
+    ConnCtrlPktFormat,
+)
+from neverland.components.bufpool import BufferPool
+from neverland.components.idgeneration import IDGenerator
+
+
+TIMES = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+PAYLOAD_SIZE = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+
+
+CIPHERS = ['aes-256-cfb', 'chacha20', 'aes-256-gcm', 'chacha20-poly1305']
+
+
+config = ObjectifiedDict(
+             net={
+                 'ipv6': False,
+                 'crypto': {
+                     'password': 'password',
+                     'lib_path': ctypes.util.find_library('crypto'),
+                 },
+             }
+         )
+
+NodeContext.id_generator = IDGenerator(1, 1)
+NodeContext.local_ip = '127.0.0.1'
+NodeContext.listen_port = 40000
+
+
+def report(name, elapsed):
+    pps = TIMES / elapsed
+    per_pkt = elapsed / TIMES * 1000000
+    print(f'{name:<12} {pps:10.0f} pkt/s  {per_pkt:8.2f}us/pkt')
+
+
+def main():
+    for _, mac_method in MACMethods:
+        bench(mac_method)
+
+    if config.net.crypto.lib_path is None:
+        print('libcrypto is not available, skip the encryption')
+        return
+
+    for cipher in CIPHERS:
+        bench(MACMethods.SHA256, cipher)
+
+
+def bench(mac_method, cipher=None):
+    config.net.mac_method = mac_method
+    config.net.crypto.cipher = cipher
+
+    # AEAD ciphers authenticate packets by the tag instead of the mac
+    if is_aead_cipher(cipher):
+        config.net.crypto.iv_len = 12
+        mac_method = 'none (aead tag)'
+    else:
+        config.net.crypto.iv_len = 16
+    wrapper = ProtocolWrapper(
+                  config,
+                  HeaderFormat,
+                  DataPktFormat,
+                  CtrlPktFormat,
+                  ConnCtrlPktFormat,
+              )
+    payload = b'x' * PAYLOAD_SIZE
+
+    print(
+        f'---------- {TIMES} data packets, {PAYLOAD_SIZE} bytes, '
+        f'mac {mac_method}, cipher {cipher} ----------'
+    )
+
+    data_list = []
+    t0 = time.perf_counter()
+    for _ in range(TIMES):
+        pkt = UDPPacket()
+        pkt.fields = PktFields(
+                         type=PktTypes.DATA,
+                         dest=('127.0.0.1', 40001),
+                         data=payload,
+                     )
+        data_list.append(wrapper.wrap(pkt).data)
+    report('wrap', time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    for data in data_list:
+        pkt = UDPPacket(data=data)
+        pkt = wrapper.unwrap(pkt)
+    report('unwrap', time.perf_counter() - t0)
+
+    assert pkt.valid and pkt.fields.data == payload
+
+    # packets received by afferents are memoryviews of pooled buffers
+    pool = BufferPool(UDP_BUFFER_SIZE)
+    t0 = time.perf_counter()
+    for data in data_list:
+        buf = pool.acquire()
+        nbytes = len(data)
+        buf[:nbytes] = data
+        pkt = UDPPacket(data=memoryview(buf)[:nbytes])
+        pkt = wrapper.unwrap(pkt)
+    report('unwrap(mv)', time.perf_counter() - t0)
+
+    assert pkt.valid and pkt.fields.data == payload
+
+    report_memory(wrapper, data_list)
+
+
+def report_memory(wrapper, data_list, amount=1000):
+    ''' memory allocated for keeping unwrapped packets, excluding the data
+    '''
+
+    data_list = data_list[:amount]
+    amount = len(data_list)
+
+    tracemalloc.start()
+    pkts = [wrapper.unwrap(UDPPacket(data=data)) for data in data_list]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert all(pkt.valid for pkt in pkts)
+
+    # payloads are sliced from the data
+    payload_size = sum(len(pkt.fields.data) for pkt in pkts)
+    per_pkt = (size - payload_size) / amount
+    print(f'{"memory":<12} {per_pkt:10.0f} bytes/pkt  (unwrapped, no payload)')
+
+
+if __name__ == '__main__':
+    main()
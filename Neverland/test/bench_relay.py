@@ -0,0 +1,216 @@
+#!/usr/bin/python3.6
+#coding: utf-8
+
+''' Benchmark of the relay forwarding path over the loopback
+
+A relay core receives data packets from the loopback, unwraps them,
+wraps them again and forwards them to a sink socket. Packets are sent
+in bursts which fit in the receiving buffer, only the time spent by the
+core is measured.
+
+The core is benchmarked with different batch sizes, batch size 1 works
+like the previous one-packet-per-event core.
+
+Usage:
+    python3 bench_relay.py [times] [payload_size] [burst]
+'''
+
+import sys
+import time
+import socket
+import select
+
+import __code_path__
+from neverland.pkt import UDPPacket, PktTypes, PktFields
+from neverland.utils import ObjectifiedDict
+from neverland.exceptions import DropPacket
+from neverland.node.context import NodeContext
+from neverland.afferents.udp import UDPReceiver
+from neverland.efferents.udp import UDPTransmitter
+from neverland.logic.base import BaseLogicHandler
+from neverland.core.relay import RelayCore
+from neverland.protocol.v0 import ProtocolWrapper
+from neverland.protocol.v0.fmt import (
+    HeaderFormat,
+    DataPktFormat,
+    CtrlPktFormat,
+    ConnCtrlPktFormat,
+)
+from neverland.components.idgeneration import IDGenerator
+
+
+TIMES = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+PAYLOAD_SIZE = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+BURST = int(sys.argv[3]) if len(sys.argv) > 3 else 256
+
+RELAY_ADDR = ('127.0.0.1', 40020)
+SOCK_BUFFER_SIZE = 32 * 1024 * 1024
+
+
+json_config = {
+    'net': {
+        'ipv6': False,
+        'aff_listen_addr': RELAY_ADDR[0],
+        'aff_listen_port': RELAY_ADDR[1],
+        'crypto': {},
+    },
+    'shm': {
+        'socket_dir': '/tmp/nl-bench-relay',
+        'manager_socket_name': 'manager',
+    },
+}
+
+NodeContext.id_generator = IDGenerator(1, 1)
+NodeContext.local_ip = RELAY_ADDR[0]
+NodeContext.listen_port = RELAY_ADDR[1]
+
+
+class ForwardingLogicHandler(BaseLogicHandler):
+
+    ''' forward data packets to the sink without checking anything
+    '''
+
+    def __init__(self, config, sink_addr):
+        BaseLogicHandler.__init__(self, config)
+        self.sink_addr = sink_addr
+
+    def handle_data(self, pkt):
+        pkt.fields = PktFields(
+                         type=PktTypes.DATA,
+                         dest=pkt.fields.dest,
+                         data=pkt.fields.data,
+                     )
+        pkt.next_hop = self.sink_addr
+        return pkt
+
+    def handle_ctrl(self, pkt):
+        raise DropPacket
+
+
+def enlarge_buffers(sock):
+    for opt, force_opt in [
+        (socket.SO_RCVBUF, 33),   # SO_RCVBUFFORCE
+        (socket.SO_SNDBUF, 32),   # SO_SNDBUFFORCE
+    ]:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, force_opt, SOCK_BUFFER_SIZE)
+        except PermissionError:
+            sock.setsockopt(socket.SOL_SOCKET, opt, SOCK_BUFFER_SIZE)
+
+
+def make_data_list(wrapper, sink_addr):
+    payload = b'x' * PAYLOAD_SIZE
+    data_list = []
+
+    for _ in range(BURST):
+        pkt = UDPPacket()
+        pkt.fields = PktFields(
+                         type=PktTypes.DATA,
+                         dest=sink_addr,
+                         data=payload,
+                     )
+        data_list.append(wrapper.wrap(pkt).data)
+
+    return data_list
+
+
+def drain(sock):
+    amount = 0
+    try:
+        while True:
+            sock.recv(65535)
+            amount += 1
+    except BlockingIOError:
+        pass
+
+    return amount
+
+
+def bench(batch_size):
+    config = ObjectifiedDict(**json_config)
+    config.net.recv_batch_size = batch_size
+
+    wrapper = ProtocolWrapper(
+                  config,
+                  HeaderFormat,
+                  DataPktFormat,
+                  CtrlPktFormat,
+                  ConnCtrlPktFormat,
+              )
+
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    sink.setblocking(False)
+    enlarge_buffers(sink)
+    sink_addr = sink.getsockname()
+
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    enlarge_buffers(sender)
+
+    afferent = UDPReceiver(config)
+    enlarge_buffers(afferent._sock)
+    efferent = UDPTransmitter(config)
+    enlarge_buffers(efferent._sock)
+
+    core = RelayCore(
+               config,
+               efferent=efferent,
+               logic_handler=ForwardingLogicHandler(config, sink_addr),
+               protocol_wrapper=wrapper,
+               main_afferent=afferent,
+           )
+    afferent.listen()
+
+    data_list = make_data_list(wrapper, sink_addr)
+
+    forwarded = 0
+    polls = 0
+    elapsed = 0
+
+    try:
+        while forwarded < TIMES:
+            for data in data_list:
+                sender.sendto(data, RELAY_ADDR)
+
+            received = 0
+            t0 = time.perf_counter()
+            while received < BURST:
+                # packets dropped by the kernel will never arrive
+                if not select.select([afferent.fd], [], [], 0)[0]:
+                    break
+
+                core._poll()
+                polls += 1
+                received += drain(sink)
+            elapsed += time.perf_counter() - t0
+
+            received += drain(sink)
+            if received < BURST:
+                print(f'{BURST - received} packets lost')
+
+            forwarded += received
+    finally:
+        sender.close()
+        sink.close()
+        afferent.destroy()
+
+    pps = forwarded / elapsed
+    per_pkt = elapsed / forwarded * 1000000
+    print(
+        f'batch {batch_size:<4} {pps:10.0f} pkt/s  {per_pkt:8.2f}us/pkt  '
+        f'{forwarded / polls:6.1f} pkt/poll'
+    )
+
+
+def main():
+    print(
+        f'---------- relay {TIMES} data packets, {PAYLOAD_SIZE} bytes, '
+        f'burst {BURST} ----------'
+    )
+
+    for batch_size in [1, 8, 64]:
+        bench(batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+#!/usr/bin/python3.6
+#coding: utf-8
+
+''' Benchmark of the SpecialPacketRepeater with outstanding control packets
+
+Control packets are stored to be repeated in the SpecialPacketManager,
+and then the cost of a single wakeup of the repeater is measured:
+
+    legacy tick:  what the repeater did in each tick before, reading all
+                  repeating states and all packets from the shared memory
+                  and checking their repeat time one by one
+    wakeup:       the repeater handles notifications and repeats packets
+                  that are due in its RepeatSchedule, with different
+                  amounts of due packets
+    resync:       reloading all repeating states from the shared memory,
+                  which the repeater does every RESYNC_INTERVAL seconds
+
+And then the cost of repeating a packet in each storage mode of special
+packets, see PktStorageModes.
+
+Usage:
+    python3 bench_repeater.py [outstanding] [rounds]
+'''
+
+import os
+import sys
+import time
+import shutil
+import socket
+import signal as sig
+
+import __code_path__
+from neverland.pkt import UDPPacket, PktTypes, PktFields
+from neverland.utils import ObjectifiedDict
+from neverland.node.context import NodeContext
+from neverland.efferents.udp import UDPTransmitter
+from neverland.protocol.v0 import ProtocolWrapper
+from neverland.protocol.v0.fmt import (
+    HeaderFormat,
+    DataPktFormat,
+    CtrlPktFormat,
+    ConnCtrlPktFormat,
+)
+from neverland.protocol.v0.subjects import ClusterControllingSubjects
+from neverland.components.shm import SharedMemoryManager
+from neverland.components.pktmgmt import (
+    MAX_RPT_PER_WAKEUP,
+    PktStorageModes,
+    SpecialPacketManager,
+    SpecialPacketRepeater,
+)
+from neverland.components.idgeneration import IDGenerator
+
+
+OUTSTANDING = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+ROUNDS = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+# at most MAX_RPT_PER_WAKEUP packets are repeated in a wakeup
+DUE_AMOUNTS = [0, 1, 10, MAX_RPT_PER_WAKEUP]
+
+# SHM requests must fit in a datagram
+CHUNK_SIZE = 500
+
+# packets that are not due will not be repeated in an hour
+FAR_FUTURE = 3600
+
+
+json_config = {
+    'net': {
+        'ipv6': False,
+        'crypto': {},
+    },
+    'shm': {
+        'socket_dir': '/tmp/nl_rpter_bench_sock/',
+        'manager_socket_name': 'manager',
+    },
+}
+config = ObjectifiedDict(**json_config)
+
+NodeContext.pid = os.getpid()
+NodeContext.id_generator = IDGenerator(1, 1)
+NodeContext.local_ip = '127.0.0.1'
+NodeContext.listen_port = 40030
+
+
+def report(name, samples):
+    samples.sort()
+    avg = sum(samples) / len(samples) * 1000
+    p50 = samples[len(samples) // 2] * 1000
+    print(f'{name:<32} avg: {avg:10.3f}ms  p50: {p50:10.3f}ms')
+
+
+def drain(sock):
+    amount = 0
+    try:
+        while True:
+            sock.recv(65535)
+            amount += 1
+    except BlockingIOError:
+        pass
+
+    return amount
+
+
+def store_pkts(wrapper, pkt_mgr, rpter, dest):
+    sn_list = []
+    for idx in range(OUTSTANDING):
+        pkt = UDPPacket()
+        pkt.fields = PktFields(
+                         type=PktTypes.CTRL,
+                         dest=dest,
+                         subject=ClusterControllingSubjects.JOIN_CLUSTER,
+                         content={'identification': 'bench', 'idx': idx},
+                     )
+        pkt.next_hop = dest
+        pkt = wrapper.wrap(pkt)
+
+        pkt_mgr.repeat_pkt(pkt, max_rpt_times=1000000)
+        sn_list.append(pkt.fields.sn)
+
+        # don't let notifications overflow the socket
+        if idx % 8 == 0:
+            rpter.handle_notifications()
+
+    rpter.handle_notifications()
+    return sn_list
+
+
+def legacy_tick(pkt_mgr):
+    ''' a tick of the polling repeater, when nothing is due
+
+    The polling repeater read all packets in one SHM batch, which doesn't
+    fit in a datagram with so many packets, so they are read in chunks.
+    '''
+
+    states = pkt_mgr.get_repeating_states()
+    sn_list = [int(key) for key in states]
+
+    pkts = []
+    for idx in range(0, len(sn_list), CHUNK_SIZE):
+        pkts += pkt_mgr.get_pkts(sn_list[idx:idx + CHUNK_SIZE])
+
+    current_ts = time.time()
+    due = 0
+
+    for sn, pkt in zip(sn_list, pkts):
+        key = str(sn)
+        next_rpt_ts = states[key].get('next_rpt_time')
+        if next_rpt_ts is None or current_ts >= next_rpt_ts:
+            due += 1
+
+    return due
+
+
+def bench(wrapper, pkt_mgr, rpter, sink):
+    dest = sink.getsockname()
+
+    t0 = time.perf_counter()
+    sn_list = store_pkts(wrapper, pkt_mgr, rpter, dest)
+    elapsed = time.perf_counter() - t0
+    print(f'{"store":<32} {OUTSTANDING / elapsed:10.0f} pkt/s')
+
+    # all packets are due now, schedule them in the future, so we can
+    # control how many of them are due in each wakeup
+    far_ts = time.time() + FAR_FUTURE
+    for sn in sn_list:
+        rpter.schedule.reschedule(sn, far_ts, 1)
+
+    state = pkt_mgr.new_repeat_state(1000000)
+    state.update(rpted_times=1, next_rpt_time=far_ts)
+
+    for idx in range(0, OUTSTANDING, CHUNK_SIZE):
+        chunk = sn_list[idx:idx + CHUNK_SIZE]
+        pkt_mgr.shm_mgr.add_value(
+            pkt_mgr.shm_key_repeat_states,
+            {sn: state for sn in chunk},
+        )
+
+    samples = []
+    for _ in range(ROUNDS):
+        t0 = time.perf_counter()
+        due = legacy_tick(pkt_mgr)
+        samples.append(time.perf_counter() - t0)
+    assert due == 0
+    report('legacy tick, 0 due', samples)
+
+    for due_amount in DUE_AMOUNTS:
+        samples = []
+        for round_ in range(ROUNDS):
+            start = round_ * due_amount % (OUTSTANDING - due_amount + 1)
+            for sn in sn_list[start:start + due_amount]:
+                rpter.schedule.reschedule(sn, 0, 1)
+
+            t0 = time.perf_counter()
+            rpter.run_once(0)
+            samples.append(time.perf_counter() - t0)
+
+            assert drain(sink) == due_amount
+
+        report(f'wakeup, {due_amount} due', samples)
+
+    samples = []
+    for _ in range(max(1, ROUNDS // 4)):
+        t0 = time.perf_counter()
+        rpter.resync()
+        samples.append(time.perf_counter() - t0)
+    report('resync', samples)
+
+    for idx in range(0, OUTSTANDING, CHUNK_SIZE):
+        pkt_mgr.remove_repeat_states(sn_list[idx:idx + CHUNK_SIZE])
+
+
+def bench_storage(wrapper, pkt_mgr, rpter, sink):
+    dest = sink.getsockname()
+
+    for storage, restamp in [
+        (PktStorageModes.FIELDS, False),
+        (PktStorageModes.PACKED, False),
+        (PktStorageModes.PACKED, True),
+    ]:
+        pkt_mgr.storage = storage
+        rpter.restamp = restamp
+
+        sn_list = []
+        for idx in range(MAX_RPT_PER_WAKEUP):
+            pkt = UDPPacket()
+            pkt.fields = PktFields(
+                             type=PktTypes.CTRL,
+                             dest=dest,
+                             subject=ClusterControllingSubjects.JOIN_CLUSTER,
+                             content={'identification': 'bench', 'idx': idx},
+                         )
+            pkt.next_hop = dest
+            pkt = wrapper.wrap(pkt)
+            pkt_mgr.store_pkt(pkt)
+            sn_list.append(pkt.fields.sn)
+
+        samples = []
+        for _ in range(ROUNDS):
+            t0 = time.perf_counter()
+            pkts = pkt_mgr.get_pkts(sn_list)
+            for sn, pkt in zip(sn_list, pkts):
+                rpter.repeat(sn, pkt, 0)
+            samples.append(
+                (time.perf_counter() - t0) / MAX_RPT_PER_WAKEUP
+            )
+
+            assert drain(sink) == MAX_RPT_PER_WAKEUP
+
+        name = f'repeat, {storage}' + (' (restamp)' if restamp else '')
+        report(name, samples)
+
+        for sn in sn_list:
+            pkt_mgr.remove_pkt(sn)
+            rpter.handle_notifications()
+
+
+def main():
+    if os.path.isdir(config.shm.socket_dir):
+        shutil.rmtree(config.shm.socket_dir)
+    os.mkdir(config.shm.socket_dir)
+
+    pid = os.fork()
+    if pid == 0:
+        SharedMemoryManager(config).run_as_worker()
+        sys.exit(0)
+
+    time.sleep(0.5)
+
+    wrapper = ProtocolWrapper(
+                  config,
+                  HeaderFormat,
+                  DataPktFormat,
+                  CtrlPktFormat,
+                  ConnCtrlPktFormat,
+              )
+
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    sink.setblocking(False)
+
+    pkt_mgr = SpecialPacketManager(config)
+    rpter = SpecialPacketRepeater(config, UDPTransmitter(config), wrapper)
+
+    # the repeater and the packet manager share the SHM connection
+    # in the same process
+    rpter.pkt_mgr = pkt_mgr
+
+    print(
+        f'---------- {OUTSTANDING} outstanding control packets, '
+        f'{ROUNDS} rounds ----------'
+    )
+
+    try:
+        pkt_mgr.init_shm()
+        rpter.listen()
+        bench(wrapper, pkt_mgr, rpter, sink)
+
+        print('\n---------- repeat a packet in storage modes ----------')
+        bench_storage(wrapper, pkt_mgr, rpter, sink)
+    finally:
+        rpter.close_sock()
+        sink.close()
+        os.kill(pid, sig.SIGTERM)
+        os.waitpid(pid, 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/python3.6
+#coding: utf-8
+
+''' Benchmark of the SHM IPC encodings
+
+Compares the JSON encoding and the binary encoding of the
+SharedMemoryManager, both the pure codec cost and the round trip latency.
+
+Usage:
+    python3 bench_shm_codec.py [times]
+'''
+
+import os
+import sys
+import time
+import shutil
+import signal as sig
+
+import __code_path__
+from neverland.utils import ObjectifiedDict
+from neverland.components.shm import (
+    Actions,
+    SharedMemoryManager,
+    SHMContainerTypes,
+)
+from neverland.components.shmcodec import JSONCodec, BinaryCodec
+
+
+SOCKET_DIR = '/tmp/nl_shm_bench_sock/'
+TIMES = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+
+def make_config(encoding):
+    return ObjectifiedDict(
+        shm={
+            'socket_dir': SOCKET_DIR,
+            'manager_socket_name': 'manager',
+            'encoding': encoding,
+        }
+    )
+
+
+def percentile(sorted_samples, p):
+    idx = int(len(sorted_samples) * p / 100)
+    idx = min(idx, len(sorted_samples) - 1)
+    return sorted_samples[idx]
+
+
+def report(name, samples, elapsed):
+    samples.sort()
+    avg = sum(samples) / len(samples) * 1000000
+    p50 = percentile(samples, 50) * 1000000
+    p99 = percentile(samples, 99) * 1000000
+    rps = len(samples) / elapsed
+
+    print(
+        f'{name:<28} avg: {avg:8.2f}us  p50: {p50:8.2f}us  '
+        f'p99: {p99:8.2f}us  {rps:10.0f} req/s'
+    )
+
+
+def bench_codec(codec):
+    request = {
+        'conn_id': '7d8c3c0e-6b5b-4e0f-9a55-5d7e5d0b3a11',
+        'action': Actions.DICT_GET,
+        'key': 'SpecPktMgr_Packets',
+        'value_key': '6502355943728545793',
+        'backlogging': True,
+    }
+    response = {
+        'succeeded': True,
+        'value': {
+            'type': 2,
+            'fields': {'sn': 6502355943728545793, 'subject': 1},
+            'previous_hop': ['127.0.0.1', 17152],
+            'next_hop': ['127.0.0.1', 17153],
+        },
+        'rcode': 0,
+    }
+
+    t0 = time.perf_counter()
+    for _ in range(TIMES):
+        codec.decode_request(codec.encode_request(request))
+        codec.decode_response(codec.encode_response(response))
+    elapsed = time.perf_counter() - t0
+
+    per_op = elapsed / TIMES * 1000000
+    print(f'{codec.__name__:<28} encode + decode: {per_op:8.2f}us')
+
+
+def bench_round_trip(encoding):
+    shm_mgr = SharedMemoryManager(make_config(encoding))
+    shm_mgr.connect(f'bench_{encoding}')
+
+    key = f'bench_{encoding}'
+    shm_mgr.create_key_and_ignore_conflict(key, SHMContainerTypes.DICT)
+    shm_mgr.add_value(key, {'k': {'a': 1, 'b': [1, 2, 3], 'c': 'x' * 32}})
+
+    for name, func in (
+        ('add_value', lambda: shm_mgr.add_value(key, {'n': 1})),
+        ('get_dict_value', lambda: shm_mgr.get_dict_value(key, 'k')),
+    ):
+        # warm up
+        for _ in range(1000):
+            func()
+
+        samples = []
+        t_start = time.perf_counter()
+        for _ in range(TIMES):
+            t0 = time.perf_counter()
+            func()
+            samples.append(time.perf_counter() - t0)
+        elapsed = time.perf_counter() - t_start
+
+        report(f'{encoding} {name}', samples, elapsed)
+
+    shm_mgr.clean_key(key)
+    shm_mgr.disconnect()
+
+
+def main():
+    if os.path.isdir(SOCKET_DIR):
+        shutil.rmtree(SOCKET_DIR)
+    os.mkdir(SOCKET_DIR)
+
+    print(f'---------- codec only, {TIMES} times ----------')
+    bench_codec(JSONCodec)
+    bench_codec(BinaryCodec)
+
+    pid = os.fork()
+    if pid == 0:
+        SharedMemoryManager(make_config(None)).run_as_worker()
+        sys.exit(0)
+
+    time.sleep(0.5)
+
+    try:
+        print(f'\n---------- round trip, {TIMES} times ----------')
+        bench_round_trip('json')
+        bench_round_trip('binary')
+    finally:
+        os.kill(pid, sig.SIGTERM)
+        os.waitpid(pid, 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/python3.6
+#coding: utf-8
+
+''' Benchmark of the sharded SharedMemoryManager
+
+Measures the aggregate throughput of concurrent clients with different
+amounts of shards. Each client process works on its own keys, as node
+workers do with their per-pid containers.
+
+Usage:
+    python3 bench_shm_shards.py [times] [max_clients] [max_shards]
+'''
+
+import os
+import sys
+import time
+import shutil
+import signal as sig
+
+import __code_path__
+from neverland.utils import ObjectifiedDict
+from neverland.components.shm import SharedMemoryManager, SHMContainerTypes
+
+
+SOCKET_DIR = '/tmp/nl_shm_bench_shards_sock/'
+TIMES = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+MAX_CLIENTS = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+MAX_SHARDS = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+
+def make_config(shard_amount):
+    return ObjectifiedDict(
+        shm={
+            'socket_dir': SOCKET_DIR,
+            'manager_socket_name': 'manager',
+            'shard_amount': shard_amount,
+        }
+    )
+
+
+def powers_of_2(limit):
+    n = 1
+    while n <= limit:
+        yield n
+        n *= 2
+
+
+def launch_workers(config):
+    pids = []
+    for shard_idx in range(config.shm.shard_amount):
+        pid = os.fork()
+        if pid == 0:
+            SharedMemoryManager(config).run_as_worker(shard_idx)
+            os._exit(0)
+        pids.append(pid)
+
+    time.sleep(0.3)
+    return pids
+
+
+def run_client(config, client_idx, start_at):
+    shm_mgr = SharedMemoryManager(config)
+    shm_mgr.connect(f'bench_client_{client_idx}')
+
+    keys = [f'bench_{client_idx}_{i}' for i in range(16)]
+    for key in keys:
+        shm_mgr.create_key_and_ignore_conflict(key, SHMContainerTypes.DICT)
+
+    # start all clients at the same time
+    time.sleep(max(start_at - time.time(), 0))
+
+    for i in range(TIMES):
+        key = keys[i % 16]
+        shm_mgr.add_value(key, {'n': i})
+        shm_mgr.get_dict_value(key, 'n')
+
+    shm_mgr.disconnect()
+
+
+def bench(shard_amount, client_amount):
+    config = make_config(shard_amount)
+    worker_pids = launch_workers(config)
+
+    start_at = time.time() + 0.5
+    client_pids = []
+    for client_idx in range(client_amount):
+        pid = os.fork()
+        if pid == 0:
+            run_client(config, client_idx, start_at)
+            os._exit(0)
+        client_pids.append(pid)
+
+    for pid in client_pids:
+        os.waitpid(pid, 0)
+    elapsed = time.time() - start_at
+
+    for pid in worker_pids:
+        os.kill(pid, sig.SIGTERM)
+        os.waitpid(pid, 0)
+
+    requests = TIMES * 2 * client_amount
+    print(
+        f'shards: {shard_amount:<3} clients: {client_amount:<3} '
+        f'{requests / elapsed:10.0f} req/s'
+    )
+
+
+def main():
+    print(f'---------- {TIMES} * 2 requests per client ----------')
+
+    for shard_amount in powers_of_2(MAX_SHARDS):
+        for client_amount in powers_of_2(MAX_CLIENTS):
+            # workers are killed by SIGTERM, so the sockets are left
+            if os.path.isdir(SOCKET_DIR):
+                shutil.rmtree(SOCKET_DIR)
+            os.mkdir(SOCKET_DIR)
+
+            bench(shard_amount, client_amount)
+
+    shutil.rmtree(SOCKET_DIR)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/python3.6
+#coding: utf-8
+
+import os
+import sys
+import copy
+import time
+import shutil
+import signal as sig
+import unittest
+import ctypes.util
+
+import __code_path__
+from neverland.pkt import UDPPacket, PktTypes, PktFields
+from neverland.utils import ObjectifiedDict
+from neverland.node.context import NodeContext
+from neverland.components.shm import SharedMemoryManager
+from neverland.components.idgeneration import IDGenerator
+from neverland.components.connmgmt import (
+    Connection,
+    ConnStates,
+    ConnectionManager,
+    SLOT_0,
+    SLOT_IDS,
+)
+from neverland.protocol.v0 import ProtocolWrapper
+from neverland.protocol.v0.fmt import (
+    HeaderFormat,
+    DataPktFormat,
+    CtrlPktFormat,
+    ConnCtrlPktFormat,
+)
+
+
+json_config = {
+    'basic': {
+        'node_id': 1,
+    },
+    'net': {
+        'ipv6': False,
+        # the verifier of the mac tells packets decrypted with wrong IVs
+        'mac_method': 'hmac-sha256',
+        'crypto': {
+            'cipher': 'aes-256-cfb',
+            'password': 'password',
+            'lib_path': ctypes.util.find_library('crypto'),
+            'iv_len': 16,
+            'iv_duration_range': [1000, 2000],
+        },
+    },
+    'shm': {
+        'socket_dir': '/tmp/nl_connmgmt_sock/',
+        'manager_socket_name': 'manager',
+    }
+}
+config = ObjectifiedDict(**json_config)
+
+NodeContext.pid = os.getpid()
+NodeContext.id_generator = IDGenerator(1, 1)
+
+
+# socket addresses of nodes
+NODE_A = ('127.0.0.1', 40000)
+NODE_B = ('127.0.0.1', 40001)
+NODE_C = ('127.0.0.1', 40002)
+
+
+def make_node_config(node_id):
+    node_json_config = copy.deepcopy(json_config)
+    node_json_config['basic']['node_id'] = node_id
+    return ObjectifiedDict(**node_json_config)
+
+
+def make_conn(remote, iv):
+    return Connection(
+               remote={'ip': remote[0], 'port': remote[1]},
+               sn=NodeContext.id_generator.gen(),
+               state=ConnStates.ESTABLISHED,
+               slot=SLOT_0,
+               iv=iv,
+               iv_duration=1000,
+           )
+
+
+@unittest.skipIf(
+    ctypes.util.find_library('crypto') is None,
+    'libcrypto is not available',
+)
+class ConnMgmtTest(unittest.TestCase):
+
+    def setUp(self):
+        # 3 nodes share the SharedMemoryManager worker here,
+        # their connections are stored in different containers
+        self.conn_mgrs = {}
+        for node_id, node in enumerate([NODE_A, NODE_B, NODE_C], 1):
+            # the pid names the SHM socket of the ConnectionManager
+            NodeContext.pid = node_id
+            conn_mgr = ConnectionManager(make_node_config(node_id))
+            conn_mgr.init_shm()
+            self.conn_mgrs[node] = conn_mgr
+
+        NodeContext.pid = os.getpid()
+
+        self.wrapper = ProtocolWrapper(
+                           config,
+                           HeaderFormat,
+                           DataPktFormat,
+                           CtrlPktFormat,
+                           ConnCtrlPktFormat,
+                       )
+
+    def tearDown(self):
+        for conn_mgr in self.conn_mgrs.values():
+            conn_mgr.shm_mgr.clean_key(conn_mgr.shm_key_conns)
+            conn_mgr.close_shm()
+
+        NodeContext.conn_mgr = None
+        NodeContext.local_ip = None
+        NodeContext.listen_port = None
+
+    def use_node(self, node):
+        NodeContext.conn_mgr = self.conn_mgrs[node]
+        NodeContext.local_ip, NodeContext.listen_port = node
+
+    def send(self, src, dest, payload):
+        self.use_node(src)
+
+        pkt = UDPPacket(next_hop=dest)
+        pkt.fields = PktFields(type=PktTypes.DATA, dest=dest, data=payload)
+        return self.wrapper.wrap(pkt).data
+
+    def recv(self, dest, data):
+        self.use_node(dest)
+
+        # packets are sent from an ephemeral port of the sender
+        return self.wrapper.unwrap(
+                   UDPPacket(data=data, previous_hop=('127.0.0.1', 50000))
+               )
+
+    def test_0_store_conn(self):
+        conn_mgr = self.conn_mgrs[NODE_A]
+        iv = os.urandom(16)
+        conn_mgr.store_conn(make_conn(NODE_B, iv), SLOT_0)
+
+        conns = conn_mgr.get_conns(NODE_B)
+        self.assertEqual(conns[SLOT_0].iv, iv)
+        self.assertEqual(conn_mgr.get_conn(NODE_B).iv, iv)
+        self.assertEqual(
+            conn_mgr.get_current_iv(NODE_B), (SLOT_IDS[SLOT_0], iv)
+        )
+        self.assertEqual(conn_mgr.get_iv(NODE_B, SLOT_IDS[SLOT_0]), iv)
+
+        conn_mgr.remove_conn(NODE_B, SLOT_0)
+        self.assertEqual(conn_mgr.get_current_iv(NODE_B), (None, None))
+
+    def test_1_wrap_unwrap(self):
+        iv_ab = os.urandom(16)
+        iv_ac = os.urandom(16)
+
+        # both ends of each connection have the same IV
+        self.conn_mgrs[NODE_A].store_conn(make_conn(NODE_B, iv_ab), SLOT_0)
+        self.conn_mgrs[NODE_B].store_conn(make_conn(NODE_A, iv_ab), SLOT_0)
+        self.conn_mgrs[NODE_A].store_conn(make_conn(NODE_C, iv_ac), SLOT_0)
+        self.conn_mgrs[NODE_C].store_conn(make_conn(NODE_A, iv_ac), SLOT_0)
+
+        payload = b'data' * 100
+        data_b = self.send(NODE_A, NODE_B, payload)
+        data_c = self.send(NODE_A, NODE_C, payload)
+
+        # remotes get their own IVs
+        self.assertEqual(data_b[0], SLOT_IDS[SLOT_0])
+        self.assertEqual(data_c[0], SLOT_IDS[SLOT_0])
+        self.assertEqual(
+            {key[2] for key in self.wrapper.cryptor_cache._cryptors},
+            {iv_ab, iv_ac},
+        )
+
+        pkt = self.recv(NODE_B, data_b)
+        self.assertTrue(pkt.valid)
+        self.assertEqual(pkt.fields.data, payload)
+
+        pkt = self.recv(NODE_C, data_c)
+        self.assertTrue(pkt.valid)
+        self.assertEqual(pkt.fields.data, payload)
+
+        # the packet cannot be read with the IV of another connection
+        self.assertFalse(self.recv(NODE_C, data_b).valid)
+
+        # and the reply goes back through the same connection
+        data_a = self.send(NODE_B, NODE_A, payload)
+        pkt = self.recv(NODE_A, data_a)
+        self.assertTrue(pkt.valid)
+        self.assertEqual(pkt.fields.src, NODE_B)
+
+
+def launch_shm_worker():
+    if os.path.isdir(config.shm.socket_dir):
+        shutil.rmtree(config.shm.socket_dir)
+    os.mkdir(config.shm.socket_dir)
+
+    pid = os.fork()
+    if pid == 0:
+        SharedMemoryManager(config).run_as_worker()
+        sys.exit(0)
+
+    # wait for shm worker
+    time.sleep(0.5)
+    return pid
+
+
+if __name__ == '__main__':
+    pid = launch_shm_worker()
+
+    try:
+        unittest.main()
+    finally:
+        os.kill(pid, sig.SIGTERM)
+        os.waitpid(pid, 0)
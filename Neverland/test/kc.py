@@ -5,10 +5,13 @@ import os
 import time
 import struct
 import unittest
+import ctypes.util
 
 import __code_path__
 from neverland.utils import ObjectifiedDict as OD
 from neverland.protocol.crypto import Modes
+from neverland.protocol.crypto.openssl import OpenSSLCryptor
+from neverland.protocol.crypto.kc.pool import alg_sock_pool
 from neverland.protocol.crypto.kc.aead.gcm import GCMKernelCryptor
 
 
@@ -67,6 +70,55 @@ class IDGTest(unittest.TestCase):
         print(f'Seconds spent on generating random data: {tsum_urandom}')
         print(f'Seconds spent on encrypting & decrypting: {tsum_crypto}')
 
+    def test_1_pooled_sockets(self):
+        # cryptors with the same key share sockets
+        amount = len(alg_sock_pool)
+        cipher = GCMKernelCryptor(config, Modes.ENCRYPTING, iv=os.urandom(12))
+        self.assertEqual(len(alg_sock_pool), amount)
+        self.assertIs(cipher.alg_context, gcm_cipher.alg_context)
+
+        data_list = [os.urandom(1500) for _ in range(100)]
+        cipher_texts = gcm_cipher.update_many(data_list)
+        self.assertEqual(gcm_decipher.update_many(cipher_texts), data_list)
+        self.assertEqual(
+            [gcm_decipher.update(cipher_text) for cipher_text in cipher_texts],
+            data_list,
+        )
+
+    def test_2_kc_vs_openssl(self):
+        times = 20000
+        bs = 1500
+        data_list = [os.urandom(bs) for _ in range(64)]
+
+        opsl_config = OD(**config_json)
+        opsl_config.net.crypto.cipher = 'aes-256-gcm'
+        opsl_config.net.crypto.iv_len = 12
+        opsl_config.net.crypto.lib_path = ctypes.util.find_library('crypto')
+        opsl_cipher = OpenSSLCryptor(opsl_config, Modes.ENCRYPTING)
+
+        print(
+            f'Running {times} times of encryption with data block size '
+            f'{bs}, in batches of {len(data_list)}\n'
+        )
+
+        for name, cryptor, batched in [
+            ('kc update', gcm_cipher, False),
+            ('kc update_many', gcm_cipher, True),
+            ('openssl update', opsl_cipher, False),
+            ('openssl update_many', opsl_cipher, True),
+        ]:
+            t0 = time.time()
+            for _ in range(times // len(data_list)):
+                if batched:
+                    cryptor.update_many(data_list)
+                else:
+                    for data in data_list:
+                        cryptor.update(data)
+            t1 = time.time()
+
+            us_per_op = (t1 - t0) / times * 1000000
+            print(f'{name:<20} {us_per_op:8.2f}us/op')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -5,18 +5,23 @@ import os
 import time
 import struct
 import unittest
+import ctypes.util
 
 import __code_path__
 from neverland.utils import ObjectifiedDict as OD
 from neverland.protocol.crypto import Modes
-from neverland.protocol.crypto.openssl import OpenSSLCryptor
+from neverland.exceptions import DecryptionFailed
+from neverland.protocol.crypto.openssl import OpenSSLCryptor, AEAD_TAG_LENGTH
 
 
 config_json = {
     'net': {
         'identification': 'a l00o00oOOoOOoo00oOOo00ong identification string',
         'crypto': {
-            'libpath': '/usr/lib/libcrypto.so.1.1',
+            'lib_path': (
+                ctypes.util.find_library('crypto') or
+                '/usr/lib/libcrypto.so.1.1'
+            ),
             'password': 'a SUPER SUPER LONG AND VERY INDESCRIBABLE pASSw0rD',
             'cipher': 'aes-256-gcm',
             'iv_len': 12,
@@ -69,6 +74,65 @@ class IDGTest(unittest.TestCase):
         print(f'Seconds spent on generating random data: {tsum_urandom}')
         print(f'Seconds spent on encrypting & decrypting: {tsum_crypto}')
 
+    def test_1_rewind(self):
+        data_list = [os.urandom(bs) for bs in (1, 100, 1500, 5000)]
+
+        # each update starts from the beginning of the IV
+        cipher_texts = [
+            OpenSSLCryptor(config, Modes.ENCRYPTING).update(data)
+            for data in data_list
+        ]
+        self.assertEqual(
+            [opsl_cipher.update(data) for data in data_list],
+            cipher_texts,
+        )
+        self.assertEqual(opsl_cipher.update_many(data_list), cipher_texts)
+        self.assertEqual(opsl_decipher.update_many(cipher_texts), data_list)
+
+        # IVs passed per data
+        ivs = [os.urandom(config.net.crypto.iv_len) for _ in data_list]
+        cipher_texts_1 = opsl_cipher.update_many(data_list, ivs)
+        self.assertNotEqual(cipher_texts_1[-1], cipher_texts[-1])
+        self.assertEqual(
+            [
+                opsl_decipher.update(cipher_text, iv)
+                for cipher_text, iv in zip(cipher_texts_1, ivs)
+            ],
+            data_list,
+        )
+
+        # the IV of the cryptor is restored
+        self.assertEqual(opsl_cipher.update(data_list[-1]), cipher_texts[-1])
+
+    def test_2_aead(self):
+        self.assertTrue(opsl_cipher.aead)
+
+        data = os.urandom(1500)
+        aad = b'aad'
+        nonce_0 = opsl_cipher.make_nonce(0)
+        nonce_1 = opsl_cipher.make_nonce(1)
+        self.assertEqual(len(nonce_1), config.net.crypto.iv_len)
+        self.assertNotEqual(nonce_0, nonce_1)
+
+        cipher_text = opsl_cipher.update(data, nonce_1, aad)
+        self.assertEqual(len(cipher_text), len(data) + AEAD_TAG_LENGTH)
+        self.assertNotEqual(opsl_cipher.update(data, nonce_0, aad), cipher_text)
+        self.assertEqual(opsl_decipher.update(cipher_text, nonce_1, aad), data)
+
+        tampered = bytearray(cipher_text)
+        tampered[-1] ^= 0x01
+        for args in [
+            (bytes(tampered), nonce_1, aad),
+            (cipher_text, nonce_0, aad),
+            (cipher_text, nonce_1, b'another'),
+            (cipher_text[:AEAD_TAG_LENGTH - 1], nonce_1, aad),
+        ]:
+            with self.assertRaises(DecryptionFailed):
+                opsl_decipher.update(*args)
+
+        # the context works after failures
+        self.assertEqual(opsl_decipher.update(cipher_text, nonce_1, aad), data)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,529 @@
+#!/usr/bin/python3.6
+#coding: utf-8
+
+import os
+import sys
+import copy
+import time
+import shutil
+import signal as sig
+import unittest
+
+import __code_path__
+from neverland.pkt import UDPPacket, PktTypes, PktFields
+from neverland.utils import ObjectifiedDict
+from neverland.node.context import NodeContext
+from neverland.components.shm import SharedMemoryManager
+from neverland.components.idgeneration import IDGenerator
+from neverland.components.rtt import (
+    RTTEstimator,
+    INITIAL_RTO,
+    MIN_RTO,
+    RTO_JITTER,
+)
+from neverland.protocol.v0 import ProtocolWrapper
+from neverland.protocol.v0.fmt import (
+    HeaderFormat,
+    DataPktFormat,
+    CtrlPktFormat,
+    ConnCtrlPktFormat,
+)
+from neverland.components.pktmgmt import (
+    PktStorageModes,
+    PktRpterModes,
+    RepeatSchedule,
+    SpecialPacketManager,
+    SpecialPacketRepeater,
+    NodePacketRepeater,
+)
+
+
+json_config = {
+    'net': {
+        'ipv6': False,
+        'crypto': {},
+
+        # repeat packets in a fixed interval, except in test_3_rtt
+        'special_pkt_rto': {
+            'initial': 0.2,
+            'min': 0.2,
+            'max': 0.2,
+        },
+    },
+    'shm': {
+        'socket_dir': '/tmp/nl_pktmgmt_sock/',
+        'manager_socket_name': 'manager',
+    }
+}
+config = ObjectifiedDict(**json_config)
+
+node_rpter_json_config = copy.deepcopy(json_config)
+node_rpter_json_config['net']['special_pkt_rpter'] = PktRpterModes.NODE
+node_rpter_config = ObjectifiedDict(**node_rpter_json_config)
+
+NodeContext.pid = os.getpid()
+NodeContext.id_generator = IDGenerator(1, 1)
+NodeContext.local_ip = '127.0.0.1'
+NodeContext.listen_port = 40000
+
+
+class DummyProtocolWrapper():
+
+    ''' returns packets as they are, the repeater only needs wrap
+    '''
+
+    def wrap(self, pkt):
+        return pkt
+
+
+class Efferent():
+
+    ''' records transmitted packets
+    '''
+
+    def __init__(self):
+        self.pkts = []
+
+    def transmit(self, pkt):
+        self.pkts.append(pkt)
+
+
+def make_pkt(sn):
+    pkt = UDPPacket()
+    pkt.fields = PktFields(
+                     sn=sn,
+                     salt=b'salt',
+                     type=PktTypes.CTRL,
+                     dest=['127.0.0.1', 40000],
+                 )
+    pkt.type = PktTypes.CTRL
+    pkt.previous_hop = ['127.0.0.1', 40000]
+    pkt.next_hop = ['127.0.0.1', 40001]
+    return pkt
+
+
+class RepeatScheduleTest(unittest.TestCase):
+
+    def test_0_pop_due(self):
+        schedule = RepeatSchedule()
+        for sn, due_ts in [(1, 3), (2, 1), (3, 2)]:
+            schedule.add(sn, due_ts)
+
+        # adding an existing packet changes nothing
+        schedule.add(2, 10, 3)
+        self.assertEqual(schedule.get(2), [1, 0])
+
+        self.assertEqual(len(schedule), 3)
+        self.assertEqual(schedule.next_due_ts(), 1)
+        self.assertEqual(schedule.pop_due(0), [])
+        self.assertEqual(schedule.pop_due(2), [2, 3])
+
+        # popped packets are still in the schedule until they are
+        # rescheduled or cancelled
+        self.assertIn(2, schedule)
+        schedule.reschedule(2, 4, 1)
+        schedule.cancel(3)
+        self.assertNotIn(3, schedule)
+        self.assertEqual(schedule.get(2), [4, 1])
+
+        self.assertEqual(schedule.next_due_ts(), 3)
+        self.assertEqual(schedule.pop_due(10), [1, 2])
+
+    def test_1_stale_entries(self):
+        schedule = RepeatSchedule()
+        schedule.add(1, 1)
+        schedule.add(2, 2)
+
+        # the stale entry of the rescheduled packet is skipped
+        schedule.reschedule(1, 5, 1)
+        self.assertEqual(schedule.next_due_ts(), 2)
+
+        schedule.cancel(2)
+        self.assertEqual(schedule.next_due_ts(), 5)
+        self.assertEqual(schedule.pop_due(4), [])
+
+        schedule.cancel(1)
+        self.assertEqual(schedule.next_due_ts(), None)
+        self.assertEqual(schedule.pop_due(10), [])
+
+        # the heap is compacted if stale entries are piled up
+        schedule.add(3, 0)
+        for idx in range(1000):
+            schedule.reschedule(3, idx, idx)
+        self.assertLess(len(schedule._heap), 100)
+        self.assertEqual(schedule.pop_due(1000), [3])
+
+
+class RepeaterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pkt_mgr = SpecialPacketManager(config)
+        self.pkt_mgr.init_shm()
+
+        self.efferent = Efferent()
+        self.rpter = SpecialPacketRepeater(
+                         config,
+                         self.efferent,
+                         DummyProtocolWrapper(),
+                     )
+
+        # the repeater and the packet manager are in the same process here,
+        # so they share the SHM connection
+        self.rpter.pkt_mgr = self.pkt_mgr
+        self.rpter.listen()
+
+    def tearDown(self):
+        self.rpter.close_sock()
+        self.pkt_mgr.close_shm()
+
+    def test_0_notifications(self):
+        for sn in range(1, 7):
+            self.pkt_mgr.repeat_pkt(make_pkt(sn), max_rpt_times=2)
+        self.pkt_mgr.cancel_repeat(6)
+
+        self.rpter.run_once(0)
+        self.assertEqual(len(self.rpter.schedule), 5)
+        self.assertEqual(
+            sorted(pkt.fields.sn for pkt in self.efferent.pkts),
+            list(range(1, 6)),
+        )
+
+        # nothing is due before the interval
+        self.rpter.run_once(0)
+        self.assertEqual(len(self.efferent.pkts), 5)
+
+        self.pkt_mgr.cancel_repeats([1, 2])
+
+        # the notification is lost, but the cancelled repeat is found
+        # when the packet is due
+        self.pkt_mgr.remove_repeat_states([3])
+
+        time.sleep(0.25)
+        self.rpter.run_once(0)
+        self.assertEqual(len(self.efferent.pkts), 7)
+        self.assertEqual(len(self.rpter.schedule), 2)
+
+        # the max repeat times is reached
+        time.sleep(0.25)
+        self.rpter.run_once(0)
+        self.assertEqual(len(self.efferent.pkts), 7)
+        self.assertEqual(len(self.rpter.schedule), 0)
+        self.assertEqual(self.pkt_mgr.get_repeating_sn_list(), [])
+
+        for sn in range(1, 7):
+            self.pkt_mgr.remove_pkt(sn)
+
+    def test_1_resync(self):
+        # the repeater is not notified, the packet will be found in resync
+        self.pkt_mgr.store_pkt(make_pkt(11))
+        self.pkt_mgr.shm_mgr.add_value(
+            self.pkt_mgr.shm_key_repeat_states,
+            {11: self.pkt_mgr.new_repeat_state(1)},
+        )
+
+        self.rpter.run_once(0)
+        self.assertEqual(len(self.efferent.pkts), 0)
+
+        self.rpter.resync()
+        self.rpter.run_once(0)
+        self.assertEqual(len(self.efferent.pkts), 1)
+
+        state = self.pkt_mgr.get_repeating_state(11)
+        self.assertEqual(state.get('rpted_times'), 1)
+        self.assertEqual(
+            state.get('next_rpt_time'),
+            self.rpter.schedule.get(11)[0],
+        )
+
+        # the packet is removed without notification
+        self.pkt_mgr.remove_repeat_states([11])
+        self.rpter.resync()
+        self.assertEqual(len(self.rpter.schedule), 0)
+
+        self.pkt_mgr.remove_pkt(11)
+
+    def test_2_cancel_during_repeat(self):
+        self.pkt_mgr.repeat_pkt(make_pkt(21), max_rpt_times=2)
+        self.rpter.handle_notifications()
+
+        # the repeat is cancelled after the repeater read the state,
+        # the state shall not be brought back by the repeater
+        get_repeating_pkts = self.pkt_mgr.get_repeating_pkts
+
+        def get_and_cancel(sn_list):
+            pkts = get_repeating_pkts(sn_list)
+            self.pkt_mgr.remove_repeat_states(sn_list)
+            return pkts
+
+        self.pkt_mgr.get_repeating_pkts = get_and_cancel
+        try:
+            self.rpter.run_once(0)
+        finally:
+            del self.pkt_mgr.get_repeating_pkts
+
+        self.assertEqual(len(self.efferent.pkts), 1)
+        self.assertIsNone(self.pkt_mgr.get_repeating_state(21))
+        self.assertNotIn(21, self.rpter.schedule)
+
+        self.pkt_mgr.remove_pkt(21)
+
+    def test_3_rtt(self):
+        self.pkt_mgr.repeat_pkt(make_pkt(31), max_rpt_times=3)
+        self.rpter.run_once(0)
+
+        pkt, state = self.pkt_mgr.get_pkt_and_repeat_state(31)
+        self.assertEqual(pkt.fields.sn, 31)
+
+        sent_ts = state.get('last_rpt_time')
+        sample = self.pkt_mgr.sample_rtt(pkt, state, sent_ts + 0.05)
+        self.assertAlmostEqual(sample, 0.05)
+
+        estimates = self.pkt_mgr.get_rtt_estimates()
+        self.assertAlmostEqual(estimates['127.0.0.1:40001']['srtt'], 0.05)
+
+        # the packet has been sent twice, the response is ambiguous
+        state.update(rpted_times=2)
+        self.assertIsNone(self.pkt_mgr.sample_rtt(pkt, state))
+
+        # the repeater uses the estimate after resync
+        self.rpter.rtt_estimator = RTTEstimator(ObjectifiedDict(net={}))
+        self.rpter.resync()
+        timeout = self.rpter.gen_interval(pkt.next_hop, 1)
+        self.assertLessEqual(timeout, MIN_RTO)
+        self.assertGreaterEqual(timeout, MIN_RTO * (1 - RTO_JITTER))
+        self.assertLessEqual(
+            self.rpter.gen_interval(['127.0.0.1', 40002], 1),
+            INITIAL_RTO,
+        )
+
+        self.pkt_mgr.remove_pkt(31)
+        self.pkt_mgr.shm_mgr.remove_value(
+            self.pkt_mgr.shm_key_rtt,
+            ['127.0.0.1:40001'],
+        )
+
+    def test_4_packed_storage(self):
+        wrapper = ProtocolWrapper(
+                      config,
+                      HeaderFormat,
+                      DataPktFormat,
+                      CtrlPktFormat,
+                      ConnCtrlPktFormat,
+                  )
+        NodeContext.protocol_wrapper = wrapper
+
+        pkt_mgr = self.pkt_mgr
+        pkt_mgr.storage = PktStorageModes.PACKED
+
+        rpter = self.rpter
+        rpter.protocol_wrapper = wrapper
+        rpter.restamp = True
+
+        try:
+            pkt = UDPPacket()
+            pkt.fields = PktFields(
+                             type=PktTypes.CTRL,
+                             dest=('127.0.0.1', 40001),
+                             subject=0x01,
+                             content={'identification': 'test'},
+                         )
+            pkt.next_hop = ('127.0.0.1', 40001)
+            pkt = wrapper.wrap(pkt)
+            sn = pkt.fields.sn
+
+            pkt_mgr.store_pkt(pkt, need_repeat=True, max_rpt_times=1)
+
+            # the logic handler gets the original packet with all fields
+            stored = pkt_mgr.get_pkt(sn)
+            self.assertEqual(stored.fields.sn, sn)
+            self.assertEqual(stored.fields.content.identification, 'test')
+            self.assertEqual(stored.next_hop, ('127.0.0.1', 40001))
+
+            # the packed data is sent with a new time and a new mac
+            rpter.run_once(0)
+            self.assertEqual(len(self.efferent.pkts), 1)
+
+            received = wrapper.unwrap(
+                           UDPPacket(data=self.efferent.pkts[0].data)
+                       )
+            self.assertTrue(received.valid)
+            self.assertEqual(received.fields.sn, sn)
+            self.assertGreater(received.fields.time, pkt.fields.time)
+            self.assertEqual(received.fields.content.identification, 'test')
+
+            pkt_mgr.remove_pkt(sn)
+            self.assertIsNone(pkt_mgr.get_pkt(sn))
+        finally:
+            NodeContext.protocol_wrapper = None
+
+    def test_5_repeat_failure(self):
+        for sn in [61, 62]:
+            self.pkt_mgr.repeat_pkt(make_pkt(sn), max_rpt_times=3)
+
+        def failing_repeat_pkt(pkt):
+            raise OSError('network is unreachable')
+
+        self.rpter.repeat_pkt = failing_repeat_pkt
+        try:
+            with self.assertRaises(OSError):
+                self.rpter.run_once(0)
+        finally:
+            del self.rpter.repeat_pkt
+
+        # packets are retried later rather than being lost in the schedule
+        current_ts = time.time()
+        for sn in [61, 62]:
+            due_ts, rpted_times = self.rpter.schedule.get(sn)
+            self.assertGreater(due_ts, current_ts)
+            self.assertEqual(rpted_times, 0)
+        self.assertEqual(self.rpter.schedule.pop_due(current_ts), [])
+
+        time.sleep(0.25)
+        self.rpter.run_once(0)
+        self.assertEqual(
+            sorted(pkt.fields.sn for pkt in self.efferent.pkts),
+            [61, 62],
+        )
+        for sn in [61, 62]:
+            state = self.pkt_mgr.get_repeating_state(sn)
+            self.assertEqual(state.get('rpted_times'), 1)
+            self.pkt_mgr.remove_pkt(sn)
+
+
+class NodeRepeaterTest(unittest.TestCase):
+
+    WORKER_PIDS = [1001, 1002]
+
+    def setUp(self):
+        self.efferent = Efferent()
+        self.rpter = NodePacketRepeater(
+                         node_rpter_config,
+                         self.efferent,
+                         DummyProtocolWrapper(),
+                     )
+        self.rpter.listen()
+        self.rpter.init_shm()
+
+        # packet managers of workers, they register themselves to the
+        # repeater in init_shm
+        self.pkt_mgrs = {}
+        for pid in self.WORKER_PIDS:
+            pkt_mgr = SpecialPacketManager(node_rpter_config, pid=pid)
+            pkt_mgr.init_shm()
+            self.pkt_mgrs[pid] = pkt_mgr
+
+    def tearDown(self):
+        for pkt_mgr in self.pkt_mgrs.values():
+            pkt_mgr.close_shm()
+
+        self.rpter.close_sock()
+        self.rpter.close_shm()
+
+    def test_0_partitions(self):
+        self.assertEqual(
+            sorted(self.rpter.get_worker_pids()),
+            self.WORKER_PIDS,
+        )
+
+        # workers store packets with the same sn in their own containers
+        for pid, pkt_mgr in self.pkt_mgrs.items():
+            pkt_mgr.store_pkt(
+                make_pkt(pid),
+                need_repeat=True,
+                max_rpt_times=1,
+            )
+            pkt_mgr.repeat_pkt(make_pkt(41), max_rpt_times=1)
+
+        self.rpter.run_once(0)
+        self.assertEqual(sorted(self.rpter.partitions), self.WORKER_PIDS)
+
+        # all partitions send packets in the efferent of the repeater
+        for partition in self.rpter.partitions.values():
+            self.assertIs(partition.efferent, self.efferent)
+
+        self.assertEqual(
+            sorted(pkt.fields.sn for pkt in self.efferent.pkts),
+            sorted([41, 41] + self.WORKER_PIDS),
+        )
+
+        # the max repeat times is reached
+        time.sleep(0.25)
+        self.rpter.run_once(0)
+        for pid, pkt_mgr in self.pkt_mgrs.items():
+            self.assertEqual(pkt_mgr.get_repeating_sn_list(), [])
+            pkt_mgr.remove_pkt(pid)
+
+        # the partition is removed after the worker exits
+        pid = self.WORKER_PIDS[0]
+        self.pkt_mgrs.pop(pid).close_shm()
+        self.rpter.handle_notifications()
+        self.rpter.resync()
+        self.assertEqual(sorted(self.rpter.partitions), self.WORKER_PIDS[1:])
+
+        self.pkt_mgrs[self.WORKER_PIDS[1]].remove_pkt(41)
+
+    def test_1_resync(self):
+        # the worker is registered but the notification is lost
+        pid = self.WORKER_PIDS[1]
+        pkt_mgr = self.pkt_mgrs[pid]
+        pkt_mgr.store_pkt(make_pkt(51))
+        pkt_mgr.shm_mgr.add_value(
+            pkt_mgr.shm_key_repeat_states,
+            {51: pkt_mgr.new_repeat_state(1)},
+        )
+
+        self.rpter.resync()
+        self.rpter.run_once(0)
+
+        self.assertEqual([pkt.fields.sn for pkt in self.efferent.pkts], [51])
+
+        pkt_mgr.remove_pkt(51)
+
+    def test_2_deregister(self):
+        # the worker crashed and left a packet that is being repeated
+        pid = self.WORKER_PIDS[0]
+        pkt_mgr = self.pkt_mgrs[pid]
+        pkt_mgr.store_pkt(make_pkt(61), need_repeat=True, max_rpt_times=1)
+
+        self.rpter.run_once(0)
+        NodePacketRepeater.deregister_worker(self.rpter.shm_mgr, pid)
+        self.assertEqual(self.rpter.get_worker_pids(), self.WORKER_PIDS[1:])
+
+        # the partition is kept until the packet is finished
+        self.rpter.resync()
+        self.assertIn(pid, self.rpter.partitions)
+
+        time.sleep(0.25)
+        self.rpter.run_once(0)
+        self.assertEqual(pkt_mgr.get_repeating_sn_list(), [])
+        self.assertEqual([pkt.fields.sn for pkt in self.efferent.pkts], [61])
+
+        self.rpter.resync()
+        self.assertNotIn(pid, self.rpter.partitions)
+
+        pkt_mgr.remove_pkt(61)
+
+
+def launch_shm_worker():
+    if os.path.isdir(config.shm.socket_dir):
+        shutil.rmtree(config.shm.socket_dir)
+    os.mkdir(config.shm.socket_dir)
+
+    pid = os.fork()
+    if pid == 0:
+        SharedMemoryManager(config).run_as_worker()
+        sys.exit(0)
+
+    # wait for shm worker
+    time.sleep(0.5)
+    return pid
+
+
+if __name__ == '__main__':
+    pid = launch_shm_worker()
+
+    try:
+        unittest.main()
+    finally:
+        os.kill(pid, sig.SIGTERM)
+        os.waitpid(pid, 0)
@@ -1,12 +1,18 @@
 #!/usr/bin/python3.6
 #coding: utf-8
 
+import os
+import time
+import socket
 import unittest
+import ctypes.util
 
 import __code_path__
-from neverland.pkt import UDPPacket, PktTypes
+from neverland.pkt import UDPPacket, PktTypes, PktFields
 from neverland.utils import ObjectifiedDict
+from neverland.exceptions import PktWrappingError
 from neverland.protocol.v0 import ProtocolWrapper
+from neverland.protocol.crypto import is_aead_cipher
 from neverland.protocol.v0.fmt import (
     HeaderFormat,
     DataPktFormat,
@@ -14,6 +20,7 @@ from neverland.protocol.v0.fmt import (
     ConnCtrlPktFormat,
 )
 from neverland.node.context import NodeContext
+from neverland.components.connmgmt import SLOT_IDS, SLOT_0, SLOT_1
 from neverland.components.idgeneration import IDGenerator
 
 
@@ -21,6 +28,34 @@ id_generator = IDGenerator(1, 1)
 NodeContext.id_generator = id_generator
 
 
+def is_af_alg_available():
+    try:
+        socket.socket(socket.AF_ALG, socket.SOCK_SEQPACKET, 0).close()
+    except (AttributeError, OSError):
+        return False
+    return True
+
+
+# AEAD ciphers of each backend, with the reason to skip them
+AEAD_CIPHER_CASES = [
+    (
+        'aes-256-gcm',
+        ctypes.util.find_library('crypto') is None,
+        'libcrypto is not available',
+    ),
+    (
+        'chacha20-poly1305',
+        ctypes.util.find_library('crypto') is None,
+        'libcrypto is not available',
+    ),
+    (
+        'kc-aes-256-gcm',
+        not is_af_alg_available(),
+        'AF_ALG is not available',
+    ),
+]
+
+
 json_config = {
     'net': {
         'ipv6': False,
@@ -63,6 +98,7 @@ class PWTest(unittest.TestCase):
                          diverged=0x01,
                          src=('127.0.0.1', 65535),
                          dest=('127.0.0.1', 65535),
+                         communicating=0x01,
                          iv_changed=0x01,
                          iv_duration=10000,
                          iv=b'iviviviviv'
@@ -87,6 +123,411 @@ class PWTest(unittest.TestCase):
             str(pkt1.fields)
         )
 
+    def test_2_all_types(self):
+        NodeContext.local_ip = '127.0.0.1'
+        NodeContext.listen_port = 40000
+
+        fields_list = [
+            ObjectifiedDict(
+                type=PktTypes.DATA,
+                dest=('10.0.0.1', 80),
+                data=b'data',
+            ),
+            ObjectifiedDict(
+                type=PktTypes.CTRL,
+                dest=('10.0.0.1', 80),
+                subject=0x01,
+                content={'a': [1, 2]},
+            ),
+            ObjectifiedDict(
+                type=PktTypes.CONN_CTRL,
+                dest=('10.0.0.1', 80),
+                communicating=0x01,
+                iv_changed=0x00,
+                iv_duration=100,
+                iv=b'iviviviv',
+            ),
+        ]
+
+        # codecs of different types shall not affect each other
+        for _ in range(2):
+            for fields in fields_list:
+                pkt = UDPPacket()
+                pkt.fields = fields
+                pkt = base_wrapper.wrap(pkt)
+
+                pkt1 = UDPPacket(data=pkt.data)
+                pkt1 = base_wrapper.unwrap(pkt1)
+
+                self.assertEqual(pkt1.valid, True)
+                self.assertEqual(pkt1.fields.sn, pkt.fields.sn)
+                self.assertEqual(pkt1.fields.src, ('127.0.0.1', 40000))
+                self.assertEqual(pkt1.fields.mac, pkt.fields.mac.encode())
+                self.assertEqual(pkt1.byte_fields.salt, pkt.fields.salt)
+
+        self.assertEqual(pkt1.fields.iv, b'iviviviv')
+
+        # packets too short or with unknown types
+        pkt1 = base_wrapper.unwrap(UDPPacket(data=pkt.data[:20]))
+        self.assertEqual(pkt1.valid, False)
+
+        codec = base_wrapper.get_codec(PktTypes.DATA)
+        data = bytearray(pkt.data)
+        data[codec.offsets['type'][0]] = 0xff
+        pkt1 = base_wrapper.unwrap(UDPPacket(data=bytes(data)))
+        self.assertEqual(pkt1.valid, False)
+
+    def test_3_slotted_fields(self):
+        pkt = UDPPacket()
+        pkt.fields = PktFields(
+                         type=PktTypes.DATA,
+                         dest=('10.0.0.1', 80),
+                         data=b'data',
+                     )
+        self.assertEqual(pkt.fields.sn, None)
+
+        pkt = base_wrapper.wrap(pkt)
+        codec = base_wrapper.get_codec(PktTypes.DATA)
+
+        # hand-built fields are converted into the generated class
+        self.assertIs(pkt.fields.__class__, codec.fields_cls)
+        self.assertIsNotNone(pkt.fields.sn)
+
+        pkt1 = base_wrapper.unwrap(UDPPacket(data=pkt.data))
+        fields = pkt1.fields
+        self.assertIs(fields.__class__, codec.fields_cls)
+        self.assertEqual(fields.__fields__, tuple(codec.names))
+        self.assertEqual(fields.data, b'data')
+        self.assertEqual(fields.subject, None)
+
+        d = fields.__to_dict__()
+        self.assertEqual(list(d.keys()), codec.names)
+        self.assertEqual(d['sn'], pkt.fields.sn)
+
+        # packets restored from dicts
+        pkt2 = UDPPacket(fields=d, type=PktTypes.DATA)
+        self.assertEqual(pkt2.fields.sn, pkt.fields.sn)
+        self.assertEqual(base_wrapper.wrap(pkt2).fields.data, b'data')
+
+        with self.assertRaises(AttributeError):
+            pkt2.unknown = 1
+
+    def test_4_hmac(self):
+        def make_wrapper(password):
+            hmac_config = ObjectifiedDict(**json_config)
+            hmac_config.net.mac_method = 'hmac-sha256'
+            hmac_config.net.crypto.password = password
+
+            return ProtocolWrapper(
+                       hmac_config,
+                       HeaderFormat,
+                       DataPktFormat,
+                       CtrlPktFormat,
+                       ConnCtrlPktFormat,
+                   )
+
+        try:
+            wrapper = make_wrapper('password')
+
+            pkt = UDPPacket()
+            pkt.fields = PktFields(
+                             type=PktTypes.DATA,
+                             dest=('10.0.0.1', 80),
+                             data=b'data' * 100,
+                         )
+            pkt = wrapper.wrap(pkt)
+            data = pkt.data
+
+            # 32 bytes binary digest instead of 64 bytes hex digest
+            self.assertEqual(len(pkt.fields.mac), 32)
+            self.assertEqual(
+                len(data),
+                len(base_wrapper.wrap(UDPPacket(fields=pkt.fields)).data) - 32,
+            )
+
+            pkt1 = wrapper.unwrap(UDPPacket(data=data))
+            self.assertTrue(pkt1.valid)
+            self.assertEqual(pkt1.fields.mac, pkt.fields.mac)
+
+            # the body is covered by the mac too
+            tampered = bytearray(data)
+            tampered[-1] ^= 0x01
+            pkt1 = wrapper.unwrap(UDPPacket(data=bytes(tampered)))
+            self.assertFalse(pkt1.valid)
+
+            codec = wrapper.get_codec(PktTypes.DATA)
+            tampered = bytearray(data)
+            tampered[codec.offsets['mac'][0]] ^= 0x01
+            pkt1 = wrapper.unwrap(UDPPacket(data=bytes(tampered)))
+            self.assertFalse(pkt1.valid)
+
+            # nodes with another key
+            pkt1 = make_wrapper('another').unwrap(UDPPacket(data=data))
+            self.assertFalse(pkt1.valid)
+        finally:
+            HeaderFormat.gen_fmt(config)
+
+    @unittest.skipIf(
+        ctypes.util.find_library('crypto') is None,
+        'libcrypto is not available',
+    )
+    def test_5_crypto(self):
+        class ConnMgr():
+
+            ''' works like the ConnectionManager with in-memory slots
+            '''
+
+            def __init__(self):
+                self.ivs = dict()
+
+            def get_iv(self, remote, slot_id):
+                return self.ivs.get((remote, slot_id))
+
+            def get_current_iv(self, remote):
+                for slot in (SLOT_1, SLOT_0):
+                    iv = self.ivs.get((remote, SLOT_IDS[slot]))
+                    if iv is not None:
+                        return SLOT_IDS[slot], iv
+                return None, None
+
+        crypto_config = ObjectifiedDict(**json_config)
+        crypto_config.net.crypto.cipher = 'aes-256-cfb'
+        crypto_config.net.crypto.password = 'password'
+        crypto_config.net.crypto.lib_path = ctypes.util.find_library('crypto')
+        crypto_config.net.crypto.iv_len = 16
+        crypto_config.net.crypto.cache_size = 2
+        wrapper = ProtocolWrapper(
+                      crypto_config,
+                      HeaderFormat,
+                      DataPktFormat,
+                      CtrlPktFormat,
+                      ConnCtrlPktFormat,
+                  )
+
+        local = ('127.0.0.1', 40000)
+        remote = ('127.0.0.1', 40001)
+        payload = b'data' * 100
+        NodeContext.local_ip, NodeContext.listen_port = local
+
+        def send(pkt_type=PktTypes.DATA, **kwargs):
+            pkt = UDPPacket(next_hop=remote)
+            pkt.fields = PktFields(type=pkt_type, dest=remote, **kwargs)
+            return wrapper.wrap(pkt).data
+
+        def recv(data):
+            # the IV is found by the sender in the prefix,
+            # but not the source address of the UDP packet
+            return wrapper.unwrap(
+                       UDPPacket(data=data, previous_hop=('127.0.0.1', 50000))
+                   )
+
+        conn_mgr = ConnMgr()
+        NodeContext.conn_mgr = conn_mgr
+        try:
+            # the default IV is used before the connection is established
+            data = send(data=payload)
+            self.assertEqual(data[0], 0x00)
+            self.assertNotIn(payload, data)
+
+            pkt = recv(data)
+            self.assertTrue(pkt.valid)
+            self.assertEqual(pkt.fields.data, payload)
+
+            # nodes without crypto cannot read it
+            self.assertFalse(base_wrapper.unwrap(UDPPacket(data=data)).valid)
+
+            # connections in slots
+            iv0 = os.urandom(16)
+            conn_mgr.ivs[(remote, SLOT_IDS[SLOT_0])] = iv0
+            conn_mgr.ivs[(local, SLOT_IDS[SLOT_0])] = iv0
+            data0 = send(data=payload)
+            self.assertEqual(data0[0], SLOT_IDS[SLOT_0])
+            self.assertNotEqual(data0[7:], data[7:])
+            self.assertEqual(recv(data0).fields.data, payload)
+
+            iv1 = os.urandom(16)
+            conn_mgr.ivs[(remote, SLOT_IDS[SLOT_1])] = iv1
+            conn_mgr.ivs[(local, SLOT_IDS[SLOT_1])] = iv1
+            data1 = send(data=payload)
+            self.assertEqual(data1[0], SLOT_IDS[SLOT_1])
+            self.assertEqual(recv(data1).fields.data, payload)
+
+            # the previous connection is still available
+            self.assertEqual(recv(data0).fields.data, payload)
+
+            # conn_ctrl packets always use the default IV
+            data = send(
+                       pkt_type=PktTypes.CONN_CTRL,
+                       communicating=1,
+                       iv_changed=1,
+                       iv_duration=1000,
+                       iv=iv1,
+                   )
+            self.assertEqual(data[0], 0x00)
+            self.assertEqual(recv(data).fields.iv, iv1)
+
+            # cryptors are reused and the cache is limited
+            self.assertEqual(len(wrapper.cryptor_cache), 2)
+            cryptor = wrapper.cryptor_cache.get(None, 0x00, None)
+            self.assertIs(wrapper.cryptor_cache.get(None, 0x00, None), cryptor)
+
+            # removed connection
+            del conn_mgr.ivs[(local, SLOT_IDS[SLOT_0])]
+            self.assertFalse(recv(data0).valid)
+        finally:
+            NodeContext.conn_mgr = None
+
+    def test_6_aead(self):
+        for cipher, skip, reason in AEAD_CIPHER_CASES:
+            # packets have the same format in all backends
+            self.assertTrue(is_aead_cipher(cipher))
+
+            with self.subTest(cipher=cipher):
+                if skip:
+                    self.skipTest(reason)
+
+                self._test_aead(cipher)
+
+    def _test_aead(self, cipher):
+        aead_config = ObjectifiedDict(**json_config)
+        aead_config.net.identification = 'identification'
+        aead_config.net.mac_method = 'hmac-sha256'
+        aead_config.net.crypto.cipher = cipher
+        aead_config.net.crypto.password = 'password'
+        aead_config.net.crypto.lib_path = ctypes.util.find_library('crypto')
+        aead_config.net.crypto.iv_len = 12
+
+        try:
+            wrapper = ProtocolWrapper(
+                          aead_config,
+                          HeaderFormat,
+                          DataPktFormat,
+                          CtrlPktFormat,
+                          ConnCtrlPktFormat,
+                      )
+
+            # the tag takes the place of the mac field
+            codec = wrapper.get_codec(PktTypes.DATA)
+            self.assertNotIn('mac', codec.offsets)
+
+            data_list = []
+            for _ in range(2):
+                pkt = UDPPacket()
+                pkt.fields = PktFields(
+                                 type=PktTypes.DATA,
+                                 dest=('10.0.0.1', 80),
+                                 data=b'data' * 100,
+                             )
+                pkt = wrapper.wrap(pkt)
+                data_list.append(pkt.data)
+
+                # slot ID + sender + sn + encrypted packet + tag
+                plain = wrapper.decrypt(UDPPacket(data=pkt.data))
+                self.assertEqual(
+                    len(pkt.data), 1 + 6 + 8 + len(plain) + 16
+                )
+
+            data0, data1 = data_list
+            self.assertNotEqual(data0[:15], data1[:15])
+
+            for data in data_list:
+                pkt = wrapper.unwrap(UDPPacket(data=data))
+                self.assertTrue(pkt.valid)
+                self.assertEqual(pkt.fields.data, b'data' * 100)
+                self.assertIsNone(pkt.fields.mac)
+
+            # any modification breaks the tag,
+            # including the slot ID, the sender and the sn in cleartext
+            for idx in [0, 1, 7, 20, len(data0) - 1]:
+                tampered = bytearray(data0)
+                tampered[idx] ^= 0x01
+                pkt = wrapper.unwrap(UDPPacket(data=bytes(tampered)))
+                self.assertFalse(pkt.valid)
+
+            self.assertFalse(
+                wrapper.unwrap(UDPPacket(data=data0[:20])).valid
+            )
+        finally:
+            HeaderFormat.gen_fmt(config)
+
+    def test_7_rewrap(self):
+        cases = [('sha256', None), ('hmac-sha256', None)]
+        if ctypes.util.find_library('crypto') is not None:
+            cases += [('sha256', 'aes-256-cfb'), (None, 'aes-256-gcm')]
+
+        for mac_method, cipher in cases:
+            rewrap_config = ObjectifiedDict(**json_config)
+            rewrap_config.net.mac_method = mac_method
+            rewrap_config.net.crypto.cipher = cipher
+            rewrap_config.net.crypto.password = 'password'
+            rewrap_config.net.crypto.lib_path = ctypes.util.find_library(
+                                                    'crypto'
+                                                )
+            rewrap_config.net.crypto.iv_len = (
+                12 if is_aead_cipher(cipher) else 16
+            )
+
+            try:
+                wrapper = ProtocolWrapper(
+                              rewrap_config,
+                              HeaderFormat,
+                              DataPktFormat,
+                              CtrlPktFormat,
+                              ConnCtrlPktFormat,
+                          )
+
+                pkt = UDPPacket()
+                pkt.fields = PktFields(
+                                 type=PktTypes.CTRL,
+                                 dest=('10.0.0.1', 80),
+                                 subject=0x01,
+                                 content={'identification': 'test'},
+                             )
+                pkt.next_hop = ('10.0.0.1', 80)
+                pkt = wrapper.wrap(pkt)
+                fields = pkt.fields
+
+                def make_stored_pkt():
+                    return UDPPacket(
+                               data=pkt.byte_fields.packed(),
+                               fields=PktFields(
+                                          type=fields.type,
+                                          sn=fields.sn,
+                                      ),
+                               type=PktTypes.CTRL,
+                               next_hop=pkt.next_hop,
+                           )
+
+                # the same packet is sent again
+                rewrapped = wrapper.rewrap(make_stored_pkt())
+                if cipher is None or is_aead_cipher(cipher):
+                    self.assertEqual(rewrapped.data, pkt.data)
+
+                received = wrapper.unwrap(UDPPacket(data=rewrapped.data))
+                self.assertTrue(received.valid)
+                self.assertEqual(received.fields.time, fields.time)
+
+                if is_aead_cipher(cipher):
+                    with self.assertRaises(PktWrappingError):
+                        wrapper.rewrap(make_stored_pkt(), restamp=True)
+                    continue
+
+                # the time field and the mac field are updated
+                time.sleep(0.001)
+                restamped = wrapper.rewrap(make_stored_pkt(), restamp=True)
+                received = wrapper.unwrap(UDPPacket(data=restamped.data))
+                self.assertTrue(received.valid)
+                self.assertGreater(received.fields.time, fields.time)
+                self.assertNotEqual(received.fields.mac, fields.mac)
+                self.assertEqual(received.fields.sn, fields.sn)
+                self.assertEqual(received.fields.salt, fields.salt)
+                self.assertEqual(
+                    received.fields.content.identification,
+                    'test',
+                )
+            finally:
+                HeaderFormat.gen_fmt(config)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/python3.6
+#coding: utf-8
+
+import unittest
+
+import __code_path__
+from neverland.utils import ObjectifiedDict
+from neverland.exceptions import ConfigError
+from neverland.components.rtt import (
+    RTTEstimator,
+    INITIAL_RTO,
+    MIN_RTO,
+    MAX_RTO,
+    RTO_JITTER,
+)
+
+
+class RTTEstimatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.estimator = RTTEstimator(ObjectifiedDict(net={}))
+
+    def test_0_update(self):
+        estimate = self.estimator.update(None, 0.4)
+        self.assertEqual(estimate, {'srtt': 0.4, 'rttvar': 0.2})
+
+        estimate = self.estimator.update(estimate, 0.4)
+        self.assertAlmostEqual(estimate['srtt'], 0.4)
+        self.assertAlmostEqual(estimate['rttvar'], 0.15)
+
+        # the estimate converges to stable samples
+        for _ in range(100):
+            estimate = self.estimator.update(estimate, 0.1)
+        self.assertAlmostEqual(estimate['srtt'], 0.1, places=3)
+        self.assertAlmostEqual(estimate['rttvar'], 0, places=3)
+
+    def test_1_rto(self):
+        self.assertEqual(self.estimator.rto(None), INITIAL_RTO)
+
+        estimate = {'srtt': 0.5, 'rttvar': 0.1}
+        self.assertAlmostEqual(self.estimator.rto(estimate), 0.9)
+
+        # the RTO is limited in the range
+        self.assertEqual(
+            self.estimator.rto({'srtt': 0.001, 'rttvar': 0}),
+            MIN_RTO,
+        )
+        self.assertEqual(
+            self.estimator.rto({'srtt': 100, 'rttvar': 10}),
+            MAX_RTO,
+        )
+
+    def test_2_backoff(self):
+        estimate = {'srtt': 0.5, 'rttvar': 0.1}
+
+        for rpted_times, expected in [
+            (1, 0.9),
+            (2, 1.8),
+            (3, 3.6),
+            (10, MAX_RTO),
+            (1000, MAX_RTO),
+        ]:
+            timeout = self.estimator.gen_timeout(estimate, rpted_times)
+            self.assertLessEqual(timeout, expected + 1e-9)
+            self.assertGreaterEqual(timeout, expected * (1 - RTO_JITTER))
+
+    def test_3_config(self):
+        estimator = RTTEstimator(
+            ObjectifiedDict(net={'special_pkt_rto': {'min': 1, 'max': 2}})
+        )
+        self.assertEqual(estimator.rto({'srtt': 0.1, 'rttvar': 0}), 1)
+        self.assertEqual(estimator.rto({'srtt': 5, 'rttvar': 0}), 2)
+
+        with self.assertRaises(ConfigError):
+            RTTEstimator(
+                ObjectifiedDict(net={'special_pkt_rto': {'min': 3, 'max': 2}})
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,27 +9,55 @@ import unittest
 
 import __code_path__
 from neverland.utils import ObjectifiedDict
+from neverland.exceptions import ArgumentError, ConfigError
 from neverland.components.shm import (
     SharedMemoryManager,
     SHMContainerTypes,
     ReturnCodes,
+    get_shard_idx,
 )
+from neverland.components.shmcodec import SHMEncodings
 
 
 json_config = {
     'shm': {
         'socket_dir': '/tmp/nl_shm_sock/',
         'manager_socket_name': 'manager',
+        'backend': 'mmap',
+        'mmap_key_prefixes': ['mmap_'],
     }
 }
 config = ObjectifiedDict(**json_config)
 
+json_config['shm']['encoding'] = 'json'
+config_json_encoding = ObjectifiedDict(**json_config)
+
+config_sharded = ObjectifiedDict(
+    shm={
+        'socket_dir': json_config['shm']['socket_dir'],
+        'manager_socket_name': 'sharded_manager',
+        'shard_amount': 3,
+    }
+)
+
+config_persistent = ObjectifiedDict(
+    shm={
+        'socket_dir': json_config['shm']['socket_dir'],
+        'manager_socket_name': 'persistent_manager',
+        'snapshot_dir': '/tmp/nl_shm_snapshot/',
+        'snapshot_interval': 0.5,
+    }
+)
+
 
 # clean the socket directory
 if os.path.isdir(config.shm.socket_dir):
     shutil.rmtree(config.shm.socket_dir)
 os.mkdir(config.shm.socket_dir)
 
+if os.path.isdir(config_persistent.shm.snapshot_dir):
+    shutil.rmtree(config_persistent.shm.snapshot_dir)
+
 
 KEY = 'k0'
 DATA = [
@@ -248,6 +276,740 @@ class SHMTest(unittest.TestCase):
         shm_mgr.disconnect()
         shm_mgr1.disconnect()
 
+    def test_3_encodings(self):
+        print('\n\n=====================encodings====================')
+        shm_mgr = SharedMemoryManager(config, sensitive=False)
+        shm_mgr.connect('test_enc_bin')
+        self.assertEqual(
+            shm_mgr.current_connection.encoding,
+            SHMEncodings.BINARY,
+        )
+
+        shm_mgr1 = SharedMemoryManager(config_json_encoding, sensitive=False)
+        shm_mgr1.connect('test_enc_json')
+        self.assertEqual(
+            shm_mgr1.current_connection.encoding,
+            SHMEncodings.JSON,
+        )
+
+        # bytes can be stored with the binary encoding directly
+        resp = shm_mgr.create_key('enc_dict', SHMContainerTypes.DICT)
+        self.assertTrue(resp.get('succeeded'))
+        resp = shm_mgr.add_value('enc_dict', {1: b'\x00\xff', 'f': 1.5})
+        self.assertTrue(resp.get('succeeded'))
+
+        resp = shm_mgr.get_dict_value('enc_dict', 1)
+        self.assertEqual(resp.get('value'), b'\x00\xff')
+
+        # and the JSON client reads the same container
+        resp = shm_mgr1.get_dict_value('enc_dict', 'f')
+        self.assertEqual(resp.get('value'), 1.5)
+
+        # but bytes cannot be sent back in JSON
+        resp = shm_mgr1.get_dict_value('enc_dict', 1)
+        self.assertEqual(resp.get('succeeded'), False)
+        self.assertEqual(resp.get('rcode'), ReturnCodes.TYPE_ERROR)
+
+        shm_mgr.clean_key('enc_dict')
+        shm_mgr.disconnect()
+        shm_mgr1.disconnect()
+
+    def test_4_mmap(self):
+        print('\n\n=====================mmap-backend====================')
+        shm_mgr = SharedMemoryManager(config, sensitive=False)
+        shm_mgr.connect('test_mmap')
+        self.assertIsNotNone(shm_mgr.mmap_backend)
+
+        key = 'mmap_dict'
+        resp = shm_mgr.create_key(key, SHMContainerTypes.DICT, {'a': 1})
+        self.assertTrue(resp.get('succeeded'))
+
+        resp = shm_mgr.create_key(key, SHMContainerTypes.DICT)
+        self.assertEqual(resp.get('rcode'), ReturnCodes.KEY_CONFLICT)
+
+        resp = shm_mgr.add_value(key, {2: b'iv'})
+        self.assertTrue(resp.get('succeeded'))
+        resp = shm_mgr.update_dict(key, 'a', {'x': 1})
+        self.assertTrue(resp.get('succeeded'))
+
+        resp = shm_mgr.get_dict_value(key, 2)
+        self.assertEqual(resp.get('value'), b'iv')
+        resp = shm_mgr.read_key(key)
+        self.assertEqual(resp.get('value'), {'a': {'x': 1}, '2': b'iv'})
+
+        resp = shm_mgr.remove_value(key, 2)
+        self.assertTrue(resp.get('succeeded'))
+        resp = shm_mgr.read_key(key)
+        self.assertEqual(resp.get('value'), {'a': {'x': 1}})
+
+        resp = shm_mgr.create_key('mmap_int', SHMContainerTypes.INT, 1)
+        self.assertTrue(resp.get('succeeded'))
+        resp = shm_mgr.set_value('mmap_int', 2)
+        self.assertTrue(resp.get('succeeded'))
+        resp = shm_mgr.read_key('mmap_int')
+        self.assertEqual(resp.get('value'), 2)
+
+        # the lock held by another process
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            shm_mgr.current_connection.socket.close()
+            os.close(r)
+
+            shm_mgr1 = SharedMemoryManager(config, sensitive=False)
+            shm_mgr1.connect('test_mmap_1')
+            shm_mgr1.lock_key(key)
+            os.write(w, b'1')
+            time.sleep(0.5)
+            shm_mgr1.unlock_key(key)
+            shm_mgr1.disconnect()
+            os._exit(0)
+
+        os.close(w)
+        os.read(r, 1)
+        os.close(r)
+
+        resp = shm_mgr.add_value(key, {'b': 2}, backlogging=False)
+        self.assertEqual(resp.get('rcode'), ReturnCodes.LOCKED)
+
+        # readings are not blocked
+        resp = shm_mgr.read_key(key)
+        self.assertTrue(resp.get('succeeded'))
+
+        t0 = time.time()
+        resp = shm_mgr.add_value(key, {'b': 2})
+        self.assertTrue(resp.get('succeeded'))
+        self.assertTrue(time.time() - t0 > 0.2)
+        os.waitpid(pid, 0)
+
+        # the lock held by another connection in the same process
+        shm_mgr1 = SharedMemoryManager(config, sensitive=False)
+        shm_mgr1.connect('test_mmap_2')
+
+        resp = shm_mgr.lock_key(key)
+        self.assertTrue(resp.get('succeeded'))
+        resp = shm_mgr1.lock_key(key)
+        self.assertEqual(resp.get('rcode'), ReturnCodes.LOCKED)
+        resp = shm_mgr1.add_value(key, {'c': 3})
+        self.assertEqual(resp.get('rcode'), ReturnCodes.LOCKED)
+
+        # the owner can still modify it
+        resp = shm_mgr.add_value(key, {'c': 3})
+        self.assertTrue(resp.get('succeeded'))
+
+        resp = shm_mgr.unlock_key(key)
+        self.assertTrue(resp.get('succeeded'))
+        resp = shm_mgr1.lock_key(key)
+        self.assertTrue(resp.get('succeeded'))
+        resp = shm_mgr1.unlock_key(key)
+        self.assertTrue(resp.get('succeeded'))
+        shm_mgr1.disconnect()
+
+        resp = shm_mgr.clean_key(key)
+        self.assertTrue(resp.get('succeeded'))
+        resp = shm_mgr.read_key(key)
+        self.assertEqual(resp.get('rcode'), ReturnCodes.KEY_ERROR)
+
+        # keys longer than the slot allows
+        resp = shm_mgr.create_key('mmap_' + 'k' * 64, SHMContainerTypes.INT)
+        self.assertEqual(resp.get('rcode'), ReturnCodes.OUT_OF_SPACE)
+
+        shm_mgr.clean_key('mmap_int')
+        shm_mgr.disconnect()
+
+    def test_5_batch(self):
+        print('\n\n=====================batch====================')
+        shm_mgr = SharedMemoryManager(config, sensitive=False)
+        shm_mgr.connect('test_batch')
+        shm_mgr1 = SharedMemoryManager(config, sensitive=False)
+        shm_mgr1.connect('test_batch1')
+
+        batch = shm_mgr.batch()
+        batch.create_key('batch_list', SHMContainerTypes.LIST, [1])
+        batch.create_key('mmap_batch_dict', SHMContainerTypes.DICT)
+        batch.add_value('batch_list', [2, 3])
+        batch.update_dict('mmap_batch_dict', 1, 'a')
+        batch.read_key('batch_list')
+        batch.get_dict_value('mmap_batch_dict', 1)
+        batch.read_key('batch_not_exists')
+        self.assertEqual(len(batch), 7)
+
+        results = batch.execute()
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(len(results), 7)
+        self.assertTrue(all(r.get('succeeded') for r in results[:6]))
+        self.assertEqual(results[4].get('value'), [1, 2, 3])
+        self.assertEqual(results[5].get('value'), 'a')
+        self.assertEqual(results[6].get('rcode'), ReturnCodes.KEY_ERROR)
+
+        # an atomic batch will be rolled back once a request fails
+        batch = shm_mgr.batch(atomic=True)
+        batch.add_value('batch_list', [4])
+        batch.lock_key('batch_list')
+        batch.set_value('batch_list', 1)
+        batch.read_key('batch_list')
+        results = batch.execute()
+        self.assertEqual(results[2].get('rcode'), ReturnCodes.TYPE_ERROR)
+        self.assertIsNone(results[3])
+
+        resp = shm_mgr.read_key('batch_list')
+        self.assertEqual(resp.get('value'), [1, 2, 3])
+        resp = shm_mgr1.lock_key('batch_list', backlogging=False)
+        self.assertTrue(resp.get('succeeded'))
+
+        # the whole batch is rejected if any of the keys is locked
+        batch = shm_mgr.batch(backlogging=False)
+        batch.read_key('batch_list')
+        results = batch.execute()
+        self.assertEqual(results[0].get('rcode'), ReturnCodes.LOCKED)
+        shm_mgr1.unlock_key('batch_list')
+
+        # keys in the mmap region cannot be put into an atomic batch
+        batch = shm_mgr.batch(atomic=True)
+        with self.assertRaises(ArgumentError):
+            batch.read_key('mmap_batch_dict')
+
+        shm_mgr.clean_key('batch_list')
+        shm_mgr.clean_key('mmap_batch_dict')
+        shm_mgr.disconnect()
+        shm_mgr1.disconnect()
+
+    def test_6_wait_queue(self):
+        print('\n\n=====================wait-queue====================')
+        key = 'wq_key'
+        log_key = 'wq_log'
+
+        shm_mgr = SharedMemoryManager(config, sensitive=False)
+        shm_mgr.connect('test_wq')
+        shm_mgr.create_key(key, SHMContainerTypes.LIST)
+        shm_mgr.create_key(log_key, SHMContainerTypes.LIST)
+        shm_mgr.lock_key(key)
+
+        def waiter(name):
+            pid = os.fork()
+            if pid == 0:
+                shm_mgr.current_connection.socket.close()
+                shm_mgr1 = SharedMemoryManager(config, sensitive=False)
+                shm_mgr1.connect(f'test_wq_{name}')
+                resp = shm_mgr1.lock_key(key)
+                shm_mgr1.add_value(log_key, [name])
+                shm_mgr1.unlock_key(key)
+                shm_mgr1.disconnect()
+                os._exit(0 if resp.get('succeeded') else 1)
+            return pid
+
+        # waiters acquire the lock in FIFO order
+        pids = []
+        for name in ('w0', 'w1', 'w2'):
+            pids.append(waiter(name))
+            time.sleep(0.1)
+
+        time.sleep(0.2)
+        shm_mgr.unlock_key(key)
+        for pid in pids:
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(status, 0)
+
+        resp = shm_mgr.read_key(log_key)
+        self.assertEqual(resp.get('value'), ['w0', 'w1', 'w2'])
+
+        resp = shm_mgr.get_lock_stats(key)
+        stat = resp.get('value').get(key)
+        self.assertEqual(stat.get('waits'), 3)
+        self.assertEqual(stat.get('waiting'), 0)
+        self.assertTrue(stat.get('max_wait') >= 0.4)
+
+        # the lock of a closed connection will be released
+        shm_mgr2 = SharedMemoryManager(config, sensitive=False)
+        shm_mgr2.connect('test_wq_holder')
+        shm_mgr2.lock_key(key)
+
+        pid = waiter('w3')
+        time.sleep(0.2)
+        shm_mgr2.disconnect()
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
+        shm_mgr.clean_key(key)
+        shm_mgr.clean_key(log_key)
+        shm_mgr.disconnect()
+
+    def test_7_shards(self):
+        print('\n\n=====================shards====================')
+        pids = []
+        for shard_idx in range(config_sharded.shm.shard_amount):
+            pid = os.fork()
+            if pid == 0:
+                SharedMemoryManager(config_sharded).run_as_worker(shard_idx)
+                os._exit(0)
+            pids.append(pid)
+
+        time.sleep(0.5)
+
+        try:
+            shm_mgr = SharedMemoryManager(config_sharded, sensitive=False)
+            shm_mgr.connect('test_shards')
+            shm_mgr1 = SharedMemoryManager(config_sharded, sensitive=False)
+            shm_mgr1.connect('test_shards1')
+            self.assertEqual(len(shm_mgr.shard_connections), 3)
+
+            keys = [f'shard_key_{i}' for i in range(12)]
+            self.assertEqual(
+                {get_shard_idx(key, 3) for key in keys}, {0, 1, 2}
+            )
+
+            for key in keys:
+                resp = shm_mgr.create_key(key, SHMContainerTypes.INT, 1)
+                self.assertTrue(resp.get('succeeded'))
+
+                # the second client sees the same key
+                resp = shm_mgr1.create_key(key, SHMContainerTypes.INT, 2)
+                self.assertEqual(resp.get('rcode'), ReturnCodes.KEY_CONFLICT)
+
+                resp = shm_mgr1.lock_key(key)
+                self.assertTrue(resp.get('succeeded'))
+                resp = shm_mgr.set_value(key, 3, backlogging=False)
+                self.assertEqual(resp.get('rcode'), ReturnCodes.LOCKED)
+                shm_mgr1.unlock_key(key)
+
+            # a batch across shards
+            batch = shm_mgr.batch()
+            for key in keys:
+                batch.read_key(key)
+            results = batch.execute()
+            self.assertEqual([r.get('value') for r in results], [1] * 12)
+
+            # but an atomic batch cannot
+            key0 = [k for k in keys if get_shard_idx(k, 3) == 0][0]
+            key1 = [k for k in keys if get_shard_idx(k, 3) == 1][0]
+            batch = shm_mgr.batch(atomic=True)
+            batch.read_key(key0)
+            with self.assertRaises(ArgumentError):
+                batch.read_key(key1)
+
+            resp = shm_mgr.get_lock_stats()
+            self.assertEqual(len(resp.get('value')), 0)
+
+            for key in keys:
+                shm_mgr.clean_key(key)
+
+            shm_mgr.disconnect()
+            shm_mgr1.disconnect()
+        finally:
+            for pid in pids:
+                os.kill(pid, sig.SIGTERM)
+                os.waitpid(pid, 0)
+
+    def test_8_read_cache(self):
+        print('\n\n=====================read-cache====================')
+        key = 'cache_dict'
+
+        shm_mgr = SharedMemoryManager(config, sensitive=False)
+        shm_mgr.connect('test_cache')
+        shm_mgr1 = SharedMemoryManager(config, sensitive=False)
+        shm_mgr1.connect('test_cache1')
+
+        shm_mgr.create_key(key, SHMContainerTypes.DICT, {'a': 1})
+        resp = shm_mgr.subscribe(key)
+        self.assertTrue(resp.get('succeeded'))
+
+        resp = shm_mgr.read_key(key)
+        self.assertEqual(resp.get('value'), {'a': 1})
+        self.assertIn(key, shm_mgr.read_cache)
+
+        # served by the local copy, even if the key is locked
+        shm_mgr1.lock_key(key)
+        resp = shm_mgr.get_dict_value(key, 'a')
+        self.assertEqual(resp.get('value'), 1)
+        shm_mgr1.unlock_key(key)
+
+        # changes made by other clients invalidate the local copy
+        shm_mgr1.add_value(key, {'b': 2})
+        resp = shm_mgr.get_dict_value(key, 'b')
+        self.assertEqual(resp.get('value'), 2)
+
+        # changes made by itself, including batches
+        shm_mgr.update_dict(key, 'a', 3)
+        resp = shm_mgr.get_dict_value(key, 'a')
+        self.assertEqual(resp.get('value'), 3)
+
+        batch = shm_mgr.batch()
+        batch.remove_value(key, ['a'])
+        batch.execute()
+        resp = shm_mgr.read_key(key)
+        self.assertEqual(resp.get('value'), {'b': 2})
+
+        # changes rolled back by an atomic batch are not notified
+        batch = shm_mgr1.batch(atomic=True)
+        batch.add_value(key, {'x': 1})
+        batch.set_value('cache_not_existing', 1)
+        batch.execute()
+        shm_mgr.drain_notifications()
+        self.assertEqual(shm_mgr.read_cache.get(key), {'b': 2})
+
+        # and committed ones are notified after the batch
+        batch = shm_mgr1.batch(atomic=True)
+        batch.add_value(key, {'x': 1})
+        batch.add_value(key, {'y': 2})
+        batch.execute()
+        shm_mgr.drain_notifications()
+        self.assertNotIn(key, shm_mgr.read_cache)
+        resp = shm_mgr.read_key(key)
+        self.assertEqual(resp.get('value'), {'b': 2, 'x': 1, 'y': 2})
+        shm_mgr1.remove_value(key, ['x', 'y'])
+
+        # only one notification is pending before the next reading
+        for i in range(5):
+            shm_mgr1.add_value(key, {'c': i})
+        resp = shm_mgr.get_dict_value(key, 'c')
+        self.assertEqual(resp.get('value'), 4)
+
+        shm_mgr.unsubscribe(key)
+        self.assertNotIn(key, shm_mgr.read_cache)
+        shm_mgr1.clean_key(key)
+        resp = shm_mgr.read_key(key)
+        self.assertEqual(resp.get('rcode'), ReturnCodes.KEY_ERROR)
+
+        shm_mgr.disconnect()
+        shm_mgr1.disconnect()
+
+    def test_9_partial_read(self):
+        print('\n\n=====================partial-read====================')
+        shm_mgr = SharedMemoryManager(config, sensitive=False)
+        shm_mgr.connect('test_partial')
+        shm_mgr1 = SharedMemoryManager(config_json_encoding, sensitive=False)
+        shm_mgr1.connect('test_partial1')
+
+        # larger than a datagram
+        big = {str(i): 'x' * 64 for i in range(5000)}
+        shm_mgr.create_key('partial_dict', SHMContainerTypes.DICT, big)
+
+        resp = shm_mgr.read_key('partial_dict')
+        self.assertEqual(resp.get('value'), big)
+        resp = shm_mgr1.read_key('partial_dict')
+        self.assertEqual(resp.get('value'), big)
+
+        resp = shm_mgr.scan_key('partial_dict', count=10)
+        value = resp.get('value')
+        self.assertEqual(value.get('cursor'), 10)
+        self.assertEqual(len(value.get('items')), 10)
+
+        self.assertEqual(
+            dict(shm_mgr.iter_key('partial_dict', count=300)), big
+        )
+        self.assertEqual(
+            dict(shm_mgr1.iter_key('partial_dict', count=300)), big
+        )
+
+        lst = [0, 1, 2, 3]
+        shm_mgr.create_key('partial_list', SHMContainerTypes.LIST, lst)
+        resp = shm_mgr.slice_list('partial_list', 1, 3)
+        self.assertEqual(resp.get('value'), [1, 2])
+        resp = shm_mgr.slice_list('partial_list', start=-1)
+        self.assertEqual(resp.get('value'), [3])
+        self.assertEqual(list(shm_mgr.iter_key('partial_list', 3)), lst)
+
+        resp = shm_mgr.slice_list('partial_dict', 1, 3)
+        self.assertEqual(resp.get('rcode'), ReturnCodes.TYPE_ERROR)
+        resp = shm_mgr.scan_key('partial_list', cursor=-1)
+        self.assertEqual(resp.get('rcode'), ReturnCodes.TYPE_ERROR)
+
+        # containers in the mmap region
+        shm_mgr.create_key('mmap_partial', SHMContainerTypes.SET, [1, 2, 3])
+        self.assertEqual(set(shm_mgr.iter_key('mmap_partial', 2)), {1, 2, 3})
+        shm_mgr.clean_key('mmap_partial')
+
+        shm_mgr.clean_key('partial_dict')
+        shm_mgr.clean_key('partial_list')
+        shm_mgr.disconnect()
+        shm_mgr1.disconnect()
+
+    def test_10_ttl(self):
+        print('\n\n=====================ttl====================')
+        shm_mgr = SharedMemoryManager(config, sensitive=False)
+        shm_mgr.connect('test_ttl')
+
+        resp = shm_mgr.create_key('ttl_int', SHMContainerTypes.INT, 1, ttl=0.2)
+        self.assertTrue(resp.get('succeeded'))
+        shm_mgr.create_key('ttl_dict', SHMContainerTypes.DICT)
+        shm_mgr.add_value('ttl_dict', {'a': 1, 'b': 2}, ttl=0.2)
+        shm_mgr.update_dict('ttl_dict', 'c', 3, ttl=0.6)
+        shm_mgr.update_dict('ttl_dict', 'd', 4)
+
+        # removed entries will not be removed again after re-added
+        shm_mgr.remove_value('ttl_dict', ['b'])
+        shm_mgr.add_value('ttl_dict', {'b': 5})
+
+        resp = shm_mgr.get_stats('ttl_dict')
+        stats = resp.get('value')
+        self.assertEqual(stats.get('entries'), 4)
+        self.assertEqual(stats.get('expiring_entries'), 2)
+        self.assertIsNone(stats.get('ttl'))
+
+        resp = shm_mgr.get_stats()
+        stats = resp.get('value')
+        self.assertEqual(stats.get('expiring_keys'), 1)
+        self.assertTrue(stats.get('bytes') > 0)
+
+        # overwriting without the ttl clears the TTL, like SET in Redis,
+        # but increasing doesn't touch it
+        shm_mgr.create_key('ttl_str', SHMContainerTypes.STR, 'x', ttl=0.2)
+        shm_mgr.set_value('ttl_str', 'y')
+        shm_mgr.update_dict('ttl_dict', 'a', 10)
+        shm_mgr.incr_dict_value('ttl_dict', 'c')
+
+        resp = shm_mgr.get_stats('ttl_dict')
+        self.assertEqual(resp.get('value').get('expiring_entries'), 1)
+        resp = shm_mgr.get_stats('ttl_str')
+        self.assertIsNone(resp.get('value').get('ttl'))
+
+        # invalid TTLs
+        resp = shm_mgr.add_value('ttl_dict', {'e': 1}, ttl=-1)
+        self.assertEqual(resp.get('rcode'), ReturnCodes.TYPE_ERROR)
+        shm_mgr.create_key('ttl_list', SHMContainerTypes.LIST)
+        resp = shm_mgr.add_value('ttl_list', [1], ttl=1)
+        self.assertEqual(resp.get('rcode'), ReturnCodes.TYPE_ERROR)
+        resp = shm_mgr.create_key('mmap_ttl', SHMContainerTypes.INT, ttl=1)
+        self.assertEqual(resp.get('rcode'), ReturnCodes.NOT_ALLOWED)
+
+        time.sleep(0.3)
+        resp = shm_mgr.read_key('ttl_int')
+        self.assertEqual(resp.get('rcode'), ReturnCodes.KEY_ERROR)
+        resp = shm_mgr.read_key('ttl_dict')
+        self.assertEqual(
+            resp.get('value'), {'a': 10, 'b': 5, 'c': 4, 'd': 4}
+        )
+        resp = shm_mgr.read_key('ttl_str')
+        self.assertEqual(resp.get('value'), 'y')
+
+        time.sleep(0.4)
+        resp = shm_mgr.read_key('ttl_dict')
+        self.assertEqual(resp.get('value'), {'a': 10, 'b': 5, 'd': 4})
+
+        resp = shm_mgr.get_stats()
+        stats = resp.get('value')
+        self.assertEqual(stats.get('expired_keys'), 1)
+        self.assertEqual(stats.get('expired_entries'), 1)
+        self.assertEqual(stats.get('expiring_entries'), 0)
+
+        shm_mgr.clean_key('ttl_dict')
+        shm_mgr.clean_key('ttl_str')
+        shm_mgr.clean_key('ttl_list')
+        shm_mgr.disconnect()
+
+    def test_11_atomic_actions(self):
+        print('\n\n=================atomic-actions=================')
+        shm_mgr = SharedMemoryManager(config, sensitive=False)
+        shm_mgr.connect('test_atomic')
+
+        # the same semantics in the worker and in the mmap region
+        for prefix in ('atomic_', 'mmap_atomic_'):
+            counter = f'{prefix}counter'
+            d = f'{prefix}dict'
+            s = f'{prefix}str'
+
+            shm_mgr.create_key(counter, SHMContainerTypes.INT, 0)
+            shm_mgr.create_key(d, SHMContainerTypes.DICT)
+            shm_mgr.create_key(s, SHMContainerTypes.STR, 'a')
+
+            resp = shm_mgr.incr_value(counter)
+            self.assertEqual(resp.get('value'), 1)
+            resp = shm_mgr.incr_value(counter, 5)
+            self.assertEqual(resp.get('value'), 6)
+            resp = shm_mgr.decr_value(counter, 2)
+            self.assertEqual(resp.get('value'), 4)
+
+            # INT containers don't accept floats
+            resp = shm_mgr.incr_value(counter, 0.5)
+            self.assertEqual(resp.get('rcode'), ReturnCodes.TYPE_ERROR)
+            resp = shm_mgr.incr_value(s)
+            self.assertEqual(resp.get('rcode'), ReturnCodes.TYPE_ERROR)
+
+            resp = shm_mgr.incr_dict_value(d, 1)
+            self.assertEqual(resp.get('value'), 1)
+            resp = shm_mgr.incr_dict_value(d, 1, 2)
+            self.assertEqual(resp.get('value'), 3)
+            resp = shm_mgr.get_dict_value(d, 1)
+            self.assertEqual(resp.get('value'), 3)
+
+            resp = shm_mgr.cas_value(s, 'b', 'c')
+            self.assertEqual(
+                resp.get('value'), {'swapped': False, 'value': 'a'}
+            )
+            resp = shm_mgr.cas_value(s, 'a', 'c')
+            self.assertEqual(resp.get('value'), {'swapped': True, 'value': 'c'})
+
+            # True is not the same with 1
+            resp = shm_mgr.cas_value(counter, True, 0)
+            self.assertFalse(resp.get('value').get('swapped'))
+
+            resp = shm_mgr.cas_value(d, None, 'x', dict_key='new')
+            self.assertTrue(resp.get('value').get('swapped'))
+            resp = shm_mgr.cas_value(d, None, 'y', dict_key='new')
+            self.assertEqual(
+                resp.get('value'), {'swapped': False, 'value': 'x'}
+            )
+
+            resp = shm_mgr.cas_value(d, None, 'x')
+            self.assertEqual(resp.get('rcode'), ReturnCodes.TYPE_ERROR)
+
+        # no lost updates with concurrent clients
+        times = 200
+        pids = []
+        for i in range(2):
+            pid = os.fork()
+            if pid == 0:
+                shm_mgr.current_connection.socket.close()
+
+                shm_mgr1 = SharedMemoryManager(config, sensitive=False)
+                shm_mgr1.connect(f'test_atomic_{i}')
+                for _ in range(times):
+                    shm_mgr1.incr_value('atomic_counter')
+                    shm_mgr1.incr_dict_value('mmap_atomic_dict', 'n')
+                shm_mgr1.disconnect()
+                os._exit(0)
+            pids.append(pid)
+
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+        resp = shm_mgr.read_key('atomic_counter')
+        self.assertEqual(resp.get('value'), 4 + times * 2)
+        resp = shm_mgr.get_dict_value('mmap_atomic_dict', 'n')
+        self.assertEqual(resp.get('value'), times * 2)
+
+        for prefix in ('atomic_', 'mmap_atomic_'):
+            for name in ('counter', 'dict', 'str'):
+                shm_mgr.clean_key(f'{prefix}{name}')
+        shm_mgr.disconnect()
+
+    def test_12_persistence(self):
+        print('\n\n=====================persistence====================')
+        snapshot_dir = config_persistent.shm.snapshot_dir
+        socket_path = os.path.join(
+            config_persistent.shm.socket_dir,
+            config_persistent.shm.manager_socket_name,
+        )
+
+        def start_worker():
+            pid = os.fork()
+            if pid == 0:
+                SharedMemoryManager(config_persistent).run_as_worker()
+                os._exit(0)
+
+            time.sleep(0.3)
+            return pid
+
+        def kill_worker(pid):
+            os.kill(pid, sig.SIGTERM)
+            os.waitpid(pid, 0)
+
+            # the socket is left by SIGTERM
+            os.remove(socket_path)
+
+        pid = start_worker()
+        try:
+            shm_mgr = SharedMemoryManager(config_persistent, sensitive=False)
+            shm_mgr.connect('test_persistence')
+
+            shm_mgr.create_key('p_counter', SHMContainerTypes.INT, 0)
+            for _ in range(3):
+                shm_mgr.incr_value('p_counter')
+
+            shm_mgr.create_key('p_dict', SHMContainerTypes.DICT)
+            shm_mgr.add_value('p_dict', {'a': 1}, ttl=0.2)
+            shm_mgr.update_dict('p_dict', 'b', [1, 2])
+            shm_mgr.create_key('p_set', SHMContainerTypes.SET, {1, 2})
+            shm_mgr.create_key('p_tmp', SHMContainerTypes.STR, 'x', ttl=60)
+
+            # changes rolled back by an atomic batch are not persistent
+            batch = shm_mgr.batch(atomic=True)
+            batch.add_value('p_set', {3})
+            batch.set_value('p_not_existing', 1)
+            batch.execute()
+
+            # let the entry expire before the worker is killed
+            time.sleep(0.3)
+            shm_mgr.disconnect()
+            kill_worker(pid)
+
+            # restart from the log
+            pid = start_worker()
+            shm_mgr.connect('test_persistence')
+
+            resp = shm_mgr.read_key('p_counter')
+            self.assertEqual(resp.get('value'), 3)
+            resp = shm_mgr.read_key('p_dict')
+            self.assertEqual(resp.get('value'), {'b': [1, 2]})
+            resp = shm_mgr.read_key('p_set')
+            self.assertEqual(set(resp.get('value')), {1, 2})
+            resp = shm_mgr.get_stats('p_tmp')
+            self.assertTrue(0 < resp.get('value').get('ttl') <= 60)
+
+            shm_mgr.incr_value('p_counter', 10)
+
+            # wait for the compaction, the worker checks the snapshot
+            # interval and the child every POLL_TIMEOUT seconds
+            time.sleep(2.5)
+            files = os.listdir(snapshot_dir)
+            self.assertIn('shm-0.snapshot', files)
+            self.assertEqual(
+                len([f for f in files if f.startswith('shm-0.log.')]), 1
+            )
+
+            shm_mgr.clean_key('p_tmp')
+            shm_mgr.disconnect()
+            kill_worker(pid)
+
+            # restart from the snapshot and the log
+            pid = start_worker()
+            shm_mgr.connect('test_persistence')
+
+            resp = shm_mgr.read_key('p_counter')
+            self.assertEqual(resp.get('value'), 13)
+            resp = shm_mgr.read_key('p_dict')
+            self.assertEqual(resp.get('value'), {'b': [1, 2]})
+            resp = shm_mgr.read_key('p_tmp')
+            self.assertEqual(resp.get('rcode'), ReturnCodes.KEY_ERROR)
+
+            shm_mgr.disconnect()
+        finally:
+            kill_worker(pid)
+            shutil.rmtree(snapshot_dir)
+
+    def test_13_persistence_with_mmap(self):
+        print('\n\n================persistence-with-mmap===============')
+        config_mmap_persistent = ObjectifiedDict(
+            shm={
+                'socket_dir': json_config['shm']['socket_dir'],
+                'manager_socket_name': 'mmap_persistent_manager',
+                'backend': 'mmap',
+                'mmap_path': '/tmp/nl_shm_persistent.mmap',
+                'snapshot_dir': config_persistent.shm.snapshot_dir,
+            }
+        )
+
+        # the worker refuses to start, in the first run and in restarts,
+        # rather than losing containers in the mmap region
+        for _ in range(2):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    SharedMemoryManager(
+                        config_mmap_persistent
+                    ).run_as_worker()
+                except ConfigError:
+                    os._exit(3)
+                os._exit(0)
+
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(os.WEXITSTATUS(status), 3)
+
+        with self.assertRaises(ConfigError):
+            SharedMemoryManager(config_mmap_persistent)
+
+        self.assertFalse(os.path.exists('/tmp/nl_shm_persistent.mmap'))
+
     def test_999_backlog(self):
         global do_not_kill_shm_worker
 